@@ -0,0 +1,224 @@
+"""
+Resultados de auditoría en disco, para leerlos por partes.
+
+Cada auditoría escribe sus cambios como NDJSON (un objeto JSON por línea,
+en el orden en que se detectan) y, al terminar, un resumen con la cantidad
+de cambios por hoja y el rango de bytes que ocupa cada hoja en el NDJSON.
+Mientras el resumen no existe la auditoría sigue en curso y el NDJSON puede
+leerse a medida que crece.
+
+Las páginas usan como cursor la posición en bytes de la siguiente línea, de
+modo que cada página se lee con un `seek` y la memoria no depende del tamaño
+de la auditoría. Las auditorías se borran al superar `ttl_seconds`.
+"""
+import json
+import os
+import re
+import time
+import uuid
+from datetime import date, datetime, time as dt_time, timedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from xlsx_reader import CellBounds, split_cell_ref, split_range_ref
+
+_AUDIT_ID = re.compile(r"[0-9a-f]{32}")
+# Bytes leídos por vez al recorrer el NDJSON
+READ_CHUNK = 64 * 1024
+# Líneas escritas entre cada flush (para que un lector en curso las vea pronto)
+FLUSH_EVERY = 500
+
+
+class InvalidCursor(ValueError):
+    """El cursor no corresponde al inicio de una línea de la auditoría"""
+
+
+def _json_default(valor):
+    # Mismo formato que la respuesta JSON de FastAPI
+    if isinstance(valor, (datetime, date, dt_time)):
+        return valor.isoformat()
+    if isinstance(valor, timedelta):
+        return valor.total_seconds()
+    raise TypeError(f"Valor no serializable: {type(valor).__name__}")
+
+
+def encode_change(cambio: Dict) -> bytes:
+    return json.dumps(cambio, ensure_ascii=False, default=_json_default).encode("utf-8")
+
+
+def write_changes(cambios: Iterable[Dict], changes_path: str, summary_path: str) -> Dict:
+    """
+    Escribe los cambios (agrupados por hoja, como los entrega la auditoría)
+    en `changes_path` y al final el resumen en `summary_path`. Retorna el resumen.
+    """
+    hojas: List[Dict] = []
+    posicion = 0
+    with open(changes_path, "wb") as fh:
+        for n, cambio in enumerate(cambios, 1):
+            if not hojas or hojas[-1]["hoja"] != cambio["hoja"]:
+                fh.flush()
+                hojas.append({"hoja": cambio["hoja"], "cambios": 0, "inicio": posicion, "fin": posicion})
+            linea = encode_change(cambio) + b"\n"
+            fh.write(linea)
+            posicion += len(linea)
+            hojas[-1]["cambios"] += 1
+            hojas[-1]["fin"] = posicion
+            if n % FLUSH_EVERY == 0:
+                fh.flush()
+
+    resumen = {"total_cambios": sum(h["cambios"] for h in hojas), "hojas": hojas}
+    tmp_path = f"{summary_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(resumen, fh, ensure_ascii=False)
+    os.replace(tmp_path, summary_path)
+    return resumen
+
+
+def parse_range(ref: str) -> CellBounds:
+    """"B2:D5" o "C7" -> (min_fila, min_col, max_fila, max_col); ValueError si no es válido"""
+    if not re.fullmatch(r"\$?[A-Za-z]{1,3}\$?[0-9]+(:\$?[A-Za-z]{1,3}\$?[0-9]+)?", ref):
+        raise ValueError(f"Rango inválido: {ref}")
+    return split_range_ref(ref)
+
+
+def change_filter(sheet: Optional[str] = None,
+                  bounds: Optional[CellBounds] = None) -> Optional[Callable[[Dict], bool]]:
+    """Predicado sobre un cambio decodificado (None si no hay filtros)"""
+    if sheet is None and bounds is None:
+        return None
+
+    def coincide(cambio: Dict) -> bool:
+        if sheet is not None and cambio["hoja"] != sheet:
+            return False
+        if bounds is not None:
+            fila, col = split_cell_ref(cambio["celda"])
+            return bounds[0] <= fila <= bounds[2] and bounds[1] <= col <= bounds[3]
+        return True
+
+    return coincide
+
+
+def iter_lines(path: str, start: int = 0, end: Optional[int] = None,
+               finished: Optional[Callable[[], bool]] = None,
+               poll_interval: float = 0.05) -> Iterator[List[bytes]]:
+    """
+    Líneas completas de `path` entre `start` y `end`, en lotes (sin el salto
+    de línea final). Si se pasa `finished`, el archivo se sigue leyendo a
+    medida que crece hasta que `finished()` sea verdadero y no quede nada.
+    """
+    resto = b""
+    posicion = start
+    with open(path, "rb") as fh:
+        fh.seek(start)
+        while end is None or posicion < end:
+            # Se consulta antes de leer: si ya terminó, esta lectura ve todo lo escrito
+            terminado = finished is None or finished()
+            datos = fh.read(READ_CHUNK if end is None else min(READ_CHUNK, end - posicion))
+            if not datos:
+                if terminado:
+                    break
+                time.sleep(poll_interval)
+                continue
+            posicion += len(datos)
+            lineas = (resto + datos).split(b"\n")
+            resto = lineas.pop()
+            if lineas:
+                yield lineas
+
+
+class AuditStore:
+    def __init__(self, folder: str, ttl_seconds: float = 3600.0):
+        self.folder = folder
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def valid_id(audit_id: str) -> bool:
+        return bool(_AUDIT_ID.fullmatch(audit_id))
+
+    def changes_path(self, audit_id: str) -> str:
+        return os.path.join(self.folder, f"{audit_id}.ndjson")
+
+    def summary_path(self, audit_id: str) -> str:
+        return os.path.join(self.folder, f"{audit_id}.json")
+
+    def exists(self, audit_id: str) -> bool:
+        return self.valid_id(audit_id) and os.path.exists(self.changes_path(audit_id))
+
+    def load_summary(self, audit_id: str) -> Optional[Dict]:
+        """Resumen de la auditoría, o None si no existe o sigue en curso"""
+        if not self.valid_id(audit_id):
+            return None
+        try:
+            with open(self.summary_path(audit_id), encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def remove(self, audit_id: str):
+        for path in (self.changes_path(audit_id), self.summary_path(audit_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def prune(self) -> int:
+        """Borra las auditorías más viejas que el TTL; retorna cuántas"""
+        limite = time.time() - self.ttl_seconds
+        borradas = 0
+        for nombre in os.listdir(self.folder):
+            audit_id, ext = os.path.splitext(nombre)
+            if ext != ".ndjson" or not self.valid_id(audit_id):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.folder, nombre)) < limite:
+                    self.remove(audit_id)
+                    borradas += 1
+            except OSError:
+                pass
+        return borradas
+
+    def _sheet_span(self, resumen: Dict, sheet: Optional[str]) -> Tuple[int, int]:
+        """Rango de bytes a recorrer: el de la hoja, o todo el NDJSON"""
+        if sheet is None:
+            return 0, resumen["hojas"][-1]["fin"] if resumen["hojas"] else 0
+        for hoja in resumen["hojas"]:
+            if hoja["hoja"] == sheet:
+                return hoja["inicio"], hoja["fin"]
+        return 0, 0
+
+    def read_page(self, audit_id: str, resumen: Dict, cursor: Optional[int], limit: int,
+                  sheet: Optional[str] = None,
+                  bounds: Optional[CellBounds] = None) -> Tuple[List[Dict], Optional[int]]:
+        """
+        Hasta `limit` cambios que cumplen los filtros a partir de `cursor`.
+        Retorna (cambios, cursor siguiente o None si no hay más).
+        """
+        inicio, fin = self._sheet_span(resumen, sheet)
+        if cursor is not None:
+            if not inicio <= cursor <= fin:
+                raise InvalidCursor("Cursor fuera de rango")
+            if cursor > 0:
+                with open(self.changes_path(audit_id), "rb") as fh:
+                    fh.seek(cursor - 1)
+                    if fh.read(1) != b"\n":
+                        raise InvalidCursor("El cursor no corresponde al inicio de un cambio")
+            inicio = cursor
+        if inicio >= fin:
+            return [], None
+
+        filtro = change_filter(None, bounds)  # la hoja ya se resolvió con el rango de bytes
+        cambios: List[Dict] = []
+        posicion = inicio
+        for lineas in iter_lines(self.changes_path(audit_id), inicio, fin):
+            for linea in lineas:
+                posicion += len(linea) + 1
+                cambio = json.loads(linea)
+                if filtro is None or filtro(cambio):
+                    cambios.append(cambio)
+                    if len(cambios) >= limit:
+                        return cambios, posicion if posicion < fin else None
+        return cambios, None
@@ -0,0 +1,43 @@
+"""
+Compara dos resultados de run_benchmarks.py por tamaño y etapa.
+
+Uso:
+    python benchmarks/compare.py results/bench_antes.json results/bench_despues.json
+"""
+import argparse
+import json
+from typing import Dict
+
+
+def _por_tamano(reporte: Dict) -> Dict[int, Dict]:
+    return {run["files"]: run["stages"] for run in reporte["runs"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara dos corridas del benchmark")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    with open(args.before) as fh:
+        antes = json.load(fh)
+    with open(args.after) as fh:
+        despues = json.load(fh)
+
+    print(f"antes:   {antes['meta'].get('git_commit')}  {antes['meta']['timestamp']}")
+    print(f"después: {despues['meta'].get('git_commit')}  {despues['meta']['timestamp']}")
+    a, d = _por_tamano(antes), _por_tamano(despues)
+    for n in sorted(set(a) & set(d)):
+        print(f"\n{n} archivos")
+        print(f"  {'etapa':16s} {'antes (s)':>10s} {'después (s)':>12s} {'cambio':>8s} {'RSS antes':>10s} {'RSS después':>12s}")
+        for etapa in a[n]:
+            if etapa not in d[n]:
+                continue
+            s0, s1 = a[n][etapa]["seconds"], d[n][etapa]["seconds"]
+            cambio = f"{(s1 - s0) / s0 * 100:+.1f}%" if s0 else "-"
+            r0, r1 = a[n][etapa]["peak_rss_mb"]["api"], d[n][etapa]["peak_rss_mb"]["api"]
+            print(f"  {etapa:16s} {s0:10.3f} {s1:12.3f} {cambio:>8s} {r0:10.1f} {r1:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Latencia de /api/health mientras corren auditorías.
+
+Levanta la API con uvicorn en una carpeta de trabajo vacía, mide la latencia
+de /api/health sin carga y luego con `--audits` auditorías simultáneas en
+curso (cada cliente repite POST /api/consolidate/audit en bucle). Reporta
+p50/p95/p99/máximo de ambas fases y termina con código 1 si el p99 con carga
+supera `--max-p99-ms`.
+
+Uso:
+    python benchmarks/latency_health.py --audits 4 --duration 20 --max-p99-ms 100
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic import generate_workbooks  # noqa: E402
+
+TEMPLATE_NAME = "SA_26_V1.1.xlsm"
+XLSM_TYPE = "application/vnd.ms-excel.sheet.macroEnabled.12"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _multipart(campo: str, filename: str, contenido: bytes):
+    limite = uuid.uuid4().hex
+    cuerpo = (
+        f"--{limite}\r\nContent-Disposition: form-data; name=\"{campo}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: {XLSM_TYPE}\r\n\r\n"
+    ).encode() + contenido + f"\r\n--{limite}--\r\n".encode()
+    return cuerpo, f"multipart/form-data; boundary={limite}"
+
+
+def percentiles(muestras: List[float]) -> Dict[str, float]:
+    if not muestras:
+        return {"count": 0}
+    ordenadas = sorted(muestras)
+
+    def p(q: float) -> float:
+        return round(ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))] * 1000, 2)
+
+    return {"count": len(ordenadas), "p50_ms": p(0.50), "p95_ms": p(0.95),
+            "p99_ms": p(0.99), "max_ms": round(ordenadas[-1] * 1000, 2)}
+
+
+def poll_health(base: str, duracion: float, intervalo: float) -> List[float]:
+    """Latencias (s) de /api/health, una petición cada `intervalo` segundos"""
+    latencias = []
+    fin = time.monotonic() + duracion
+    while time.monotonic() < fin:
+        inicio = time.perf_counter()
+        with urllib.request.urlopen(f"{base}/api/health", timeout=30) as respuesta:
+            respuesta.read()
+        latencias.append(time.perf_counter() - inicio)
+        time.sleep(max(0.0, intervalo - (time.perf_counter() - inicio)))
+    return latencias
+
+
+def audit_loop(base: str, contenido: bytes, detener: threading.Event, resultados: Dict[str, int]):
+    cuerpo, tipo = _multipart("file", "auditoria.xlsm", contenido)
+    while not detener.is_set():
+        peticion = urllib.request.Request(
+            f"{base}/api/consolidate/audit", data=cuerpo, headers={"Content-Type": tipo}, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(peticion, timeout=600) as respuesta:
+                respuesta.read()
+                codigo = respuesta.status
+        except urllib.error.HTTPError as e:
+            codigo = e.code
+        resultados[str(codigo)] = resultados.get(str(codigo), 0) + 1
+
+
+def measure(template: str, audits: int, duration: float, interval: float,
+            workdir: Optional[str] = None) -> Dict:
+    """
+    Levanta la API en `workdir` (por defecto benchmarks/.work/latency) y mide
+    /api/health sin carga y con `audits` auditorías en curso
+    """
+    workdir = workdir or os.path.join(BENCH_DIR, ".work", "latency")
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    # La auditoría compara contra la plantilla maestra en el directorio de la API
+    shutil.copy(template, os.path.join(workdir, TEMPLATE_NAME))
+    libro = generate_workbooks(template, os.path.join(BENCH_DIR, ".work", "data"), 1)[0]
+    with open(libro, "rb") as fh:
+        contenido = fh.read()
+
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, LOG_LEVEL="WARNING")
+    servidor = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=workdir, env=env,
+    )
+    try:
+        for _ in range(300):
+            try:
+                urllib.request.urlopen(f"{base}/api/health", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("La API no respondió al iniciar")
+
+        print(f"Sin carga ({duration:g}s)...")
+        sin_carga = percentiles(poll_health(base, duration, interval))
+        print(f"  {sin_carga}")
+
+        print(f"Con {audits} auditorías en paralelo ({duration:g}s)...")
+        detener = threading.Event()
+        codigos: Dict[str, int] = {}
+        clientes = [threading.Thread(target=audit_loop, args=(base, contenido, detener, codigos), daemon=True)
+                    for _ in range(audits)]
+        for cliente in clientes:
+            cliente.start()
+        time.sleep(1.0)  # que las auditorías estén en curso antes de medir
+        con_carga = percentiles(poll_health(base, duration, interval))
+        detener.set()
+        print(f"  {con_carga}")
+        print(f"  respuestas de auditoría terminadas durante la medición: {codigos}")
+    finally:
+        servidor.terminate()
+        try:
+            servidor.wait(30)
+        except subprocess.TimeoutExpired:
+            # Un event loop bloqueado no atiende la señal a tiempo
+            servidor.kill()
+            servidor.wait()
+
+    return {"audits": audits, "idle": sin_carga, "loaded": con_carga, "audit_status_codes": codigos}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia de /api/health con auditorías en curso")
+    parser.add_argument("--template", default=os.path.join(REPO_DIR, TEMPLATE_NAME))
+    parser.add_argument("--audits", type=int, default=4, help="Clientes auditando en paralelo")
+    parser.add_argument("--duration", type=float, default=20.0, help="Segundos de medición por fase")
+    parser.add_argument("--interval", type=float, default=0.05, help="Segundos entre consultas de health")
+    parser.add_argument("--max-p99-ms", type=float, default=100.0, help="p99 máximo aceptado con carga")
+    parser.add_argument("--output", help="Archivo JSON de resultados")
+    args = parser.parse_args()
+
+    reporte = {**measure(args.template, args.audits, args.duration, args.interval), "max_p99_ms": args.max_p99_ms}
+    con_carga = reporte["loaded"]
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(reporte, fh, indent=2)
+
+    if con_carga.get("p99_ms", 0) > args.max_p99_ms:
+        print(f"FALLA: p99 con carga {con_carga['p99_ms']} ms > {args.max_p99_ms:g} ms")
+        sys.exit(1)
+    print(f"OK: p99 con carga {con_carga['p99_ms']} ms <= {args.max_p99_ms:g} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Benchmark de la API completa con libros sintéticos.
+
+Para cada tamaño (por defecto 10, 100 y 1000 archivos) levanta la API en un
+proceso propio, con una carpeta de trabajo vacía (sin cachés), y mide cada
+etapa: subida de la plantilla, subida de archivos, validación, auditoría,
+consolidación y descarga. Reporta segundos, archivos por segundo, MB por
+segundo y RSS máximo por etapa, y guarda todo en un JSON para comparar
+corridas (ver benchmarks/compare.py).
+
+Uso:
+    python benchmarks/run_benchmarks.py --sizes 10,100 --density 0.02
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic import generate_workbooks  # noqa: E402
+
+TEMPLATE_NAME = "SA_26_V1.1.xlsm"
+XLSM_TYPE = "application/vnd.ms-excel.sheet.macroEnabled.12"
+# Archivos por petición de subida
+UPLOAD_BATCH = 50
+
+
+# ---------- Memoria ----------
+
+def _read_hwm_kb(pid: str = "self") -> Optional[int]:
+    """VmHWM (pico de RSS) de un proceso en KB, si /proc está disponible"""
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for linea in fh:
+                if linea.startswith("VmHWM:"):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reinicia el pico de RSS del proceso y de los trabajadores (solo Linux)"""
+    for pid in ["self"] + [str(p.pid) for p in multiprocessing.active_children()]:
+        try:
+            with open(f"/proc/{pid}/clear_refs", "w") as fh:
+                fh.write("5")
+        except OSError:
+            pass
+
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Pico de RSS del proceso de la API y suma de los trabajadores del pool"""
+    propio = _read_hwm_kb()
+    if propio is None:
+        propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    trabajadores = sum(_read_hwm_kb(str(p.pid)) or 0 for p in multiprocessing.active_children())
+    return {"api": round(propio / 1024, 1), "workers": round(trabajadores / 1024, 1)}
+
+
+# ---------- Corrida de un tamaño (proceso hijo) ----------
+
+class StageTimer:
+    def __init__(self):
+        self.stages: Dict[str, Dict] = {}
+
+    def measure(self, nombre: str, func, files: int = 0, nbytes: int = 0, **extra):
+        reset_peak_rss()
+        inicio = time.perf_counter()
+        resultado = func()
+        segundos = time.perf_counter() - inicio
+        self.stages[nombre] = {
+            "seconds": round(segundos, 4),
+            "files": files,
+            "files_per_second": round(files / segundos, 3) if files and segundos else None,
+            "mb_per_second": round(nbytes / 1e6 / segundos, 3) if nbytes and segundos else None,
+            "peak_rss_mb": peak_rss_mb(),
+            **extra,
+        }
+        return resultado
+
+
+def _check(response, esperado: int = 200):
+    if response.status_code != esperado:
+        raise RuntimeError(f"{response.request.method} {response.request.url}: "
+                           f"{response.status_code} {response.text[:300]}")
+    return response
+
+
+def run_size(files: List[str], template_path: str, sample: int) -> Dict:
+    """Ejecuta todas las etapas con la API en este proceso (cwd = carpeta de trabajo)"""
+    from fastapi.testclient import TestClient
+    import main
+
+    client = TestClient(main.app)
+    timer = StageTimer()
+    total_bytes = sum(os.path.getsize(f) for f in files)
+    muestra = files[:sample] if sample else files
+
+    def subir_plantilla():
+        with open(template_path, "rb") as fh:
+            _check(client.post("/api/template/upload", files={"template": (TEMPLATE_NAME, fh, XLSM_TYPE)}))
+
+    timer.measure("template_upload", subir_plantilla, 1, os.path.getsize(template_path))
+
+    def subir_archivos():
+        # Por lotes: el primero crea la sesión y el resto se agrega a ella
+        session_id = None
+        for i in range(0, len(files), UPLOAD_BATCH):
+            lote = files[i:i + UPLOAD_BATCH]
+            handles = [open(f, "rb") for f in lote]
+            try:
+                payload = [("files", (os.path.basename(f), fh, XLSM_TYPE)) for f, fh in zip(lote, handles)]
+                if session_id is None:
+                    respuesta = client.post("/api/consolidate/upload", files=payload)
+                    session_id = _check(respuesta).json()["session_id"]
+                else:
+                    _check(client.post(f"/api/consolidate/session/{session_id}/files", files=payload))
+            finally:
+                for fh in handles:
+                    fh.close()
+        return session_id
+
+    session_id = timer.measure("upload", subir_archivos, len(files), total_bytes)
+
+    def por_archivo(endpoint: str):
+        def correr():
+            for f in muestra:
+                with open(f, "rb") as fh:
+                    _check(client.post(endpoint, files={"file": (os.path.basename(f), fh, XLSM_TYPE)}))
+        return correr
+
+    muestra_bytes = sum(os.path.getsize(f) for f in muestra)
+    timer.measure("validate", por_archivo("/api/consolidate/validate"), len(muestra), muestra_bytes)
+    timer.measure("audit", por_archivo("/api/consolidate/audit"), len(muestra), muestra_bytes)
+
+    def consolidar():
+        tarea = _check(client.post("/api/consolidate/process", data={"session_id": session_id})).json()
+        while True:
+            estado = _check(client.get(f"/api/consolidate/status/{tarea['task_id']}")).json()
+            if estado["status"] == "completed":
+                return estado
+            if estado["status"] == "error":
+                raise RuntimeError(f"La consolidación falló: {estado['error']}")
+            time.sleep(0.05)
+
+    estado = timer.measure("consolidate", consolidar, len(files), total_bytes)
+    timer.stages["consolidate"]["task_metrics"] = {
+        k: v for k, v in (estado.get("metrics") or {}).items() if k != "files"
+    }
+
+    def descargar():
+        return len(_check(client.get(f"/api/consolidate/download/{estado['result_id']}")).content)
+
+    tamano = timer.measure("download", descargar, 1)
+    timer.stages["download"]["mb_per_second"] = round(
+        tamano / 1e6 / timer.stages["download"]["seconds"], 3
+    ) if timer.stages["download"]["seconds"] else None
+
+    main.job_workers.stop()
+    return {
+        "files": len(files),
+        "input_bytes": total_bytes,
+        "sample_files": len(muestra),
+        "output_bytes": tamano,
+        "stages": timer.stages,
+    }
+
+
+def child_main(args):
+    """Punto de entrada del proceso hijo: una corrida en una carpeta limpia"""
+    workdir = args.workdir
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    template_path = os.path.join(workdir, TEMPLATE_NAME)
+    # La auditoría compara contra la plantilla maestra en el directorio actual
+    shutil.copy(args.template, template_path)
+    os.chdir(workdir)
+    os.environ["STATE_DB"] = os.path.join(workdir, "state.db")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    with open(args.files_list) as fh:
+        files = [linea.strip() for linea in fh if linea.strip()]
+    resultado = run_size(files, template_path, args.sample)
+    with open(args.result_file, "w") as fh:
+        json.dump(resultado, fh)
+
+
+# ---------- Orquestación ----------
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la API con libros sintéticos")
+    parser.add_argument("--template", default=os.path.join(REPO_DIR, TEMPLATE_NAME))
+    parser.add_argument("--sizes", default="10,100,1000", help="Cantidades de archivos separadas por coma")
+    parser.add_argument("--density", type=float, default=0.02, help="Fracción de celdas de entrada con valor")
+    parser.add_argument("--seed", type=int, default=26)
+    parser.add_argument("--sample", type=int, default=5,
+                        help="Archivos a validar y auditar por tamaño (0 = todos)")
+    parser.add_argument("--data-dir", default=os.path.join(BENCH_DIR, ".work", "data"),
+                        help="Carpeta de los libros generados (se reutilizan entre corridas)")
+    parser.add_argument("--output", help="Archivo JSON de resultados")
+    # Uso interno: corrida de un tamaño en un proceso hijo
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--files-list", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child_main(args)
+        return
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output = args.output or os.path.join(BENCH_DIR, "results", f"bench_{stamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    print(f"Generando {max(sizes)} libros (densidad {args.density}, semilla {args.seed})...")
+    inicio = time.perf_counter()
+    todos = generate_workbooks(args.template, args.data_dir, max(sizes), args.density, args.seed)
+    print(f"  listo en {time.perf_counter() - inicio:.1f}s")
+
+    reporte = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "density": args.density,
+            "seed": args.seed,
+            "sample": args.sample,
+            "env": {k: v for k, v in os.environ.items()
+                    if k.startswith(("CONSOLIDATION_", "JOB_", "MAX_QUEUED_", "RESULTS_QUOTA"))},
+        },
+        "runs": [],
+    }
+
+    for n in sizes:
+        run_dir = os.path.join(BENCH_DIR, ".work", f"run_{n}")
+        lista = os.path.join(BENCH_DIR, ".work", f"files_{n}.txt")
+        resultado_path = os.path.join(BENCH_DIR, ".work", f"result_{n}.json")
+        with open(lista, "w") as fh:
+            fh.write("\n".join(todos[:n]))
+        print(f"Corrida con {n} archivos...")
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--workdir", run_dir,
+             "--files-list", lista, "--result-file", resultado_path,
+             "--template", args.template, "--sample", str(args.sample)],
+            check=True,
+        )
+        with open(resultado_path) as fh:
+            corrida = json.load(fh)
+        reporte["runs"].append(corrida)
+        for etapa, datos in corrida["stages"].items():
+            rate = f"{datos['files_per_second']} archivos/s" if datos["files_per_second"] else ""
+            print(f"  {etapa:16s} {datos['seconds']:9.3f}s  {rate:22s} "
+                  f"RSS {datos['peak_rss_mb']['api']} MB (+{datos['peak_rss_mb']['workers']} MB)")
+
+    with open(output, "w") as fh:
+        json.dump(reporte, fh, indent=2)
+    print(f"Resultados en {output}")
+
+
+if __name__ == "__main__":
+    main()
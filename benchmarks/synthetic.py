@@ -0,0 +1,96 @@
+"""
+Generador de libros SA_26 rellenos con datos sintéticos.
+
+Parte de la plantilla y escribe valores numéricos en una fracción
+(`density`) de sus celdas de entrada (las que no tienen fórmula ni texto),
+con la misma escritura por parcheo del XML que usa la API para el
+consolidado. Con la misma semilla se generan exactamente los mismos
+archivos, de modo que las corridas son comparables.
+
+Uso:
+    python benchmarks/synthetic.py SA_26_V1.1.xlsm salida/ --count 100 --density 0.02
+"""
+import argparse
+import os
+import random
+import sys
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from template_analysis import TemplateAnalysis, analyze_template  # noqa: E402
+from xlsx_writer import write_patched_workbook  # noqa: E402
+
+# Los formularios REM registran conteos: la mayoría enteros pequeños
+INTEGER_SHARE = 0.9
+MAX_INTEGER = 60
+
+
+def _random_value(rng: random.Random):
+    if rng.random() < INTEGER_SHARE:
+        # Sesgado hacia valores chicos, como los conteos reales
+        return int(rng.expovariate(1 / 8)) % (MAX_INTEGER + 1)
+    return round(rng.uniform(0, 100), 2)
+
+
+def input_cells(analisis: TemplateAnalysis,
+                sheets: Optional[List[str]] = None) -> Dict[str, List[Tuple[int, int]]]:
+    """Celdas de entrada de la plantilla por hoja"""
+    hojas = sheets or analisis.sheetnames
+    return {hoja: list(analisis.sheets[hoja].iter_input_cells()) for hoja in hojas if hoja in analisis.sheets}
+
+
+def generate_workbook(template_path: str, output_path: str,
+                      celdas: Dict[str, List[Tuple[int, int]]],
+                      density: float, seed: int) -> int:
+    """Genera un libro relleno; retorna la cantidad de celdas escritas"""
+    rng = random.Random(seed)
+    valores = {}
+    escritas = 0
+    for hoja, posiciones in celdas.items():
+        elegidas = [(row, col, _random_value(rng)) for row, col in posiciones if rng.random() < density]
+        valores[hoja] = elegidas
+        escritas += len(elegidas)
+    write_patched_workbook(template_path, output_path, valores)
+    return escritas
+
+
+def generate_workbooks(template_path: str, output_dir: str, count: int,
+                       density: float = 0.02, seed: int = 26,
+                       sheets: Optional[List[str]] = None) -> List[str]:
+    """
+    Genera `count` libros en `output_dir` (reutiliza los que ya existen con
+    la misma semilla y densidad). Retorna sus rutas.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    celdas = None
+    rutas = []
+    for i in range(count):
+        ruta = os.path.join(output_dir, f"sintetico_s{seed}_d{density:g}_{i:05d}.xlsm")
+        if not os.path.exists(ruta):
+            if celdas is None:
+                celdas = input_cells(analyze_template(template_path), sheets)
+            tmp = f"{ruta}.tmp"
+            generate_workbook(template_path, tmp, celdas, density, seed * 1_000_003 + i)
+            os.replace(tmp, ruta)
+        rutas.append(ruta)
+    return rutas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera libros SA_26 con datos sintéticos")
+    parser.add_argument("template", help="Plantilla base (SA_26_V1.1.xlsm)")
+    parser.add_argument("output_dir", help="Carpeta de salida")
+    parser.add_argument("--count", type=int, default=10, help="Cantidad de libros")
+    parser.add_argument("--density", type=float, default=0.02, help="Fracción de celdas de entrada con valor")
+    parser.add_argument("--seed", type=int, default=26, help="Semilla (misma semilla, mismos archivos)")
+    parser.add_argument("--sheets", help="Hojas a rellenar separadas por coma (por defecto todas)")
+    args = parser.parse_args()
+
+    sheets = [s.strip() for s in args.sheets.split(",")] if args.sheets else None
+    rutas = generate_workbooks(args.template, args.output_dir, args.count, args.density, args.seed, sheets)
+    print(f"{len(rutas)} libros en {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Lectura de archivos a sumas parciales y reducción en paralelo.
+
+Cada archivo se convierte en una suma parcial compacta por hoja: índices
+planos de celda ((fila - 1) * max_col + (columna - 1), según las dimensiones
+de la hoja en la plantilla), sus valores y la cantidad de archivos que
+aportaron a cada celda. Los archivos se reparten en bloques entre procesos
+trabajadores, las parciales se combinan con una reducción en árbol y el
+total se acumula en arreglos NumPy densos por hoja.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from upload_archive import open_workbook_source
+from template_analysis import SheetAnalysis, TemplateAnalysis, get_template_analysis
+from xlsx_reader import Number, XlsxReader, cast_number
+
+FileError = Tuple[str, str]
+ProgressCallback = Callable[[int, int, str], None]
+
+# Configuración del modo paralelo
+CONSOLIDATION_WORKERS = int(os.environ.get("CONSOLIDATION_WORKERS", os.cpu_count() or 1))
+CONSOLIDATION_CHUNK_SIZE = int(os.environ.get("CONSOLIDATION_CHUNK_SIZE", "4"))
+# Modo exacto por defecto (Decimal en lugar de float64)
+CONSOLIDATION_EXACT = os.environ.get("CONSOLIDATION_EXACT", "").lower() in ("1", "true", "yes")
+
+
+def _value_dtype(exact: bool):
+    return object if exact else np.float64
+
+
+class SheetPartial(NamedTuple):
+    """Suma parcial dispersa de una hoja (índices planos únicos y ordenados)"""
+    index: np.ndarray   # int64
+    values: np.ndarray  # float64, u object (Decimal) en modo exacto
+    counts: np.ndarray  # int32: archivos que aportaron un valor a la celda
+
+    @classmethod
+    def from_cells(cls, index: List[int], values: List[Number], exact: bool = False) -> "SheetPartial":
+        idx = np.asarray(index, dtype=np.int64)
+        vals = np.asarray(values, dtype=_value_dtype(exact))
+        return _reduce_sheet(idx, vals, np.ones(len(idx), dtype=np.int32))
+
+    @property
+    def exact(self) -> bool:
+        return self.values.dtype == object
+
+
+def _reduce_sheet(index: np.ndarray, values: np.ndarray, counts: np.ndarray) -> SheetPartial:
+    """Suma las entradas con el mismo índice y las deja ordenadas"""
+    unicos, inversa = np.unique(index, return_inverse=True)
+    if len(unicos) == len(index):
+        orden = np.argsort(index, kind="stable")
+        return SheetPartial(index[orden], values[orden], counts[orden])
+    vals = np.zeros(len(unicos), dtype=values.dtype)
+    cnts = np.zeros(len(unicos), dtype=np.int32)
+    np.add.at(vals, inversa, values)
+    np.add.at(cnts, inversa, counts)
+    return SheetPartial(unicos, vals, cnts)
+
+
+Partial = Dict[str, SheetPartial]
+# (ruta, parcial, error, segundos de lectura): exactamente uno de parcial/error es None
+FileResult = Tuple[str, Optional[Partial], Optional[str], float]
+FileCallback = Callable[[str, Optional[Partial], Optional[str], float], None]
+
+
+def read_file_partial(file_path: str, hojas: List[str], analisis: TemplateAnalysis,
+                      exact: bool = False) -> Partial:
+    """
+    Lee las celdas de entrada de un archivo (o de un libro dentro de un ZIP,
+    ver upload_archive) y retorna sus sumas por hoja
+    """
+    parse = Decimal if exact else cast_number
+    parcial: Partial = {}
+    with XlsxReader(open_workbook_source(file_path)) as wb:
+        for hoja in hojas:
+            if hoja not in wb.sheet_parts:
+                continue
+            sheet = analisis.sheets[hoja]
+            max_col = sheet.max_col
+            indices: List[int] = []
+            valores: List[Number] = []
+            for row, col, valor in wb.iter_numeric_cells(hoja, sheet.is_input, parse):
+                indices.append((row - 1) * max_col + col - 1)
+                valores.append(valor)
+            if indices:
+                parcial[hoja] = SheetPartial.from_cells(indices, valores, exact)
+    return parcial
+
+
+def partial_cells(parcial: Partial) -> int:
+    """Cantidad de celdas con valor en una parcial"""
+    return sum(len(parte.index) for parte in parcial.values())
+
+
+def merge_partials(destino: Partial, origen: Partial) -> Partial:
+    """Suma `origen` sobre `destino` y retorna `destino`"""
+    for hoja, parte in origen.items():
+        actual = destino.get(hoja)
+        if actual is None:
+            destino[hoja] = parte
+            continue
+        destino[hoja] = _reduce_sheet(
+            np.concatenate([actual.index, parte.index]),
+            np.concatenate([actual.values, parte.values]),
+            np.concatenate([actual.counts, parte.counts]),
+        )
+    return destino
+
+
+def tree_reduce(parciales: List[Partial]) -> Partial:
+    """Combina las parciales por pares, nivel a nivel (sin modificar las recibidas)"""
+    if not parciales:
+        return {}
+    # merge_partials escribe en su primer argumento: las parciales de cada
+    # archivo se siguen usando después (caché, sumas por archivo)
+    nivel = [dict(parcial) for parcial in parciales]
+    while len(nivel) > 1:
+        siguiente = [merge_partials(nivel[i], nivel[i + 1]) for i in range(0, len(nivel) - 1, 2)]
+        if len(nivel) % 2:
+            siguiente.append(nivel[-1])
+        nivel = siguiente
+    return nivel[0]
+
+
+def _bits_to_mask(bits: bytearray, size: int) -> np.ndarray:
+    return np.unpackbits(np.frombuffer(bytes(bits), dtype=np.uint8), bitorder="little")[:size].astype(bool)
+
+
+def _to_number(valor) -> Number:
+    """Entero si el valor es integral (como los aportes originales), si no float"""
+    if isinstance(valor, Decimal):
+        return int(valor) if valor == valor.to_integral_value() else float(valor)
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+
+class SheetAccumulator:
+    """Sumas densas de una hoja, indexadas por (fila, columna) de la plantilla"""
+
+    def __init__(self, sheet: SheetAnalysis, exact: bool = False):
+        self.sheet = sheet
+        size = sheet.max_row * sheet.max_col
+        self.sums = np.zeros(size, dtype=_value_dtype(exact))
+        self.counts = np.zeros(size, dtype=np.int32)
+
+    def add(self, parte: SheetPartial, sign: int = 1):
+        # Los índices de una parcial son únicos: basta con indexación vectorial
+        if sign >= 0:
+            self.sums[parte.index] += parte.values
+            self.counts[parte.index] += parte.counts
+        else:
+            self.sums[parte.index] -= parte.values
+            self.counts[parte.index] -= parte.counts
+            # Celdas sin aportes vuelven a cero exacto (sin residuo de redondeo)
+            vacias = parte.index[self.counts[parte.index] == 0]
+            self.sums[vacias] = 0
+
+    def to_partial(self) -> SheetPartial:
+        """Las sumas como parcial (celdas con aportes), para sumarlas en otra consolidación"""
+        index = np.flatnonzero(self.counts > 0)
+        return SheetPartial(index, self.sums[index], self.counts[index])
+
+    def written_index(self) -> np.ndarray:
+        """Índices con algún aporte, descartando celdas con fórmula en un solo paso"""
+        formulas = _bits_to_mask(self.sheet.formula_bits, len(self.counts))
+        return np.flatnonzero((self.counts > 0) & ~formulas)
+
+    def iter_cells(self) -> Iterator[Tuple[int, int, Number]]:
+        max_col = self.sheet.max_col
+        index = self.written_index()
+        for i, valor in zip(index.tolist(), self.sums[index].tolist()):
+            yield i // max_col + 1, i % max_col + 1, _to_number(valor)
+
+
+class ConsolidationAccumulator:
+    """Acumulador por hoja para todas las hojas incluidas en la consolidación"""
+
+    def __init__(self, analisis: TemplateAnalysis, hojas: List[str], exact: bool = False):
+        self.exact = exact
+        self.sheets = {hoja: SheetAccumulator(analisis.sheets[hoja], exact) for hoja in hojas}
+
+    def add_partial(self, parcial: Partial, sign: int = 1):
+        for hoja, parte in parcial.items():
+            acumulador = self.sheets.get(hoja)
+            if acumulador is not None:
+                acumulador.add(parte, sign)
+
+    def iter_cells(self, hoja: str) -> Iterator[Tuple[int, int, Number]]:
+        return self.sheets[hoja].iter_cells()
+
+    def to_partial(self) -> Partial:
+        return {hoja: acumulador.to_partial() for hoja, acumulador in self.sheets.items()}
+
+
+def process_chunk(file_paths: List[str], hojas: List[str], template_path: str,
+                  template_hash: str, analysis_folder: str,
+                  exact: bool = False) -> List[FileResult]:
+    """
+    Trabajo de un proceso: lee un bloque de archivos y retorna la parcial de
+    cada uno, o su error (un archivo con error no detiene el bloque).
+    """
+    analisis = get_template_analysis(template_path, analysis_folder, template_hash)
+    resultados: List[FileResult] = []
+    for file_path in file_paths:
+        inicio = time.perf_counter()
+        try:
+            parcial = read_file_partial(file_path, hojas, analisis, exact)
+            resultados.append((file_path, parcial, None, time.perf_counter() - inicio))
+        except Exception as e:
+            resultados.append((file_path, None, str(e), time.perf_counter() - inicio))
+    return resultados
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+# Varias tareas (hilos) pueden pedir el pool a la vez
+_pool_lock = threading.Lock()
+
+
+def get_process_pool(workers: int) -> ProcessPoolExecutor:
+    """Pool de procesos compartido entre tareas (se crea una sola vez)"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn evita heredar hilos y locks del servidor al hacer fork
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pool_workers = workers
+        return _pool
+
+
+def _reset_process_pool():
+    """Descarta un pool roto para que la siguiente tarea cree uno nuevo"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+
+def consolidate_partials(file_paths: List[str], hojas: List[str], template_path: str,
+                         template_hash: str, analysis_folder: str,
+                         workers: int = CONSOLIDATION_WORKERS,
+                         chunk_size: int = CONSOLIDATION_CHUNK_SIZE,
+                         exact: bool = False,
+                         on_progress: Optional[ProgressCallback] = None,
+                         on_file: Optional[FileCallback] = None,
+                         reduce: bool = True) -> Tuple[Partial, List[FileError]]:
+    """
+    Map/reduce de los archivos: cada bloque de `chunk_size` archivos se lee
+    en un proceso del pool y las parciales se combinan con `tree_reduce`.
+    Con `workers <= 1` se procesa secuencialmente en el hilo actual.
+    `on_file` recibe el resultado de cada archivo: (ruta, parcial, error,
+    segundos de lectura), para cachear la parcial y registrar métricas.
+    Con `reduce=False` las parciales no se retienen ni se combinan (quien
+    llama las recibe por `on_file`) y se retorna una parcial vacía.
+    """
+    total = len(file_paths)
+    chunk_size = max(1, chunk_size)
+    chunks = [file_paths[i:i + chunk_size] for i in range(0, total, chunk_size)]
+    parciales: List[Partial] = []
+    errores: List[FileError] = []
+    done = 0
+
+    def recibir(resultados: List[FileResult]):
+        for file_path, parcial, error, segundos in resultados:
+            if on_file:
+                on_file(file_path, parcial, error, segundos)
+            if error is not None:
+                errores.append((file_path, error))
+                continue
+            if reduce:
+                parciales.append(parcial)
+
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            for file_path in chunk:
+                if on_progress:
+                    on_progress(done + 1, total, os.path.basename(file_path))
+                recibir(process_chunk(
+                    [file_path], hojas, template_path, template_hash, analysis_folder, exact
+                ))
+                done += 1
+        return tree_reduce(parciales), errores
+
+    pool = get_process_pool(workers)
+    pendientes = {
+        pool.submit(process_chunk, chunk, hojas, template_path, template_hash, analysis_folder, exact): chunk
+        for chunk in chunks
+    }
+    while pendientes:
+        terminados, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+        for future in terminados:
+            chunk = pendientes.pop(future)
+            try:
+                recibir(future.result())
+            except Exception as e:
+                # Un proceso caído solo descarta su bloque
+                for file_path in chunk:
+                    if on_file:
+                        on_file(file_path, None, str(e), 0.0)
+                    errores.append((file_path, str(e)))
+                if isinstance(e, BrokenProcessPool):
+                    _reset_process_pool()
+            done += len(chunk)
+            if on_progress:
+                on_progress(done, total, os.path.basename(chunk[-1]))
+    return tree_reduce(parciales), errores
@@ -0,0 +1,469 @@
+"""
+Consolidación repartida entre varias máquinas.
+
+El coordinador divide los archivos en grupos (shards) y los publica en una
+cola; cada trabajador toma un grupo, lo suma a un agregado parcial (ver
+partial_format.py) y lo devuelve por la misma cola. El coordinador combina
+los agregados de a pares y los finaliza sobre la plantilla. Los grupos
+llevan rutas, no archivos: coordinador y trabajadores deben ver los libros
+y la plantilla en un almacenamiento compartido (NFS, un volumen montado).
+Cada trabajador verifica el hash de la plantilla antes de sumar.
+
+La cola es intercambiable (`WorkQueue`); `FilesystemQueue` usa una carpeta
+(compartida entre nodos, o local para probar en una sola máquina):
+
+    cola/pending/   grupos por tomar            {job}.{shard}.json
+    cola/claimed/   grupos tomados; el mtime es el último latido
+    cola/done/      grupos terminados, con su agregado en cola/parts/
+    cola/failed/    grupos que fallaron más de `max_attempts` veces
+
+Tomar un grupo es un rename atómico; un grupo sin latido por más de
+`stale_after` segundos (trabajador caído) vuelve a pending.
+
+Uso:
+    python distributed.py coordinator --queue /compartido/cola --template plantilla.xlsm \\
+        --output REM_Consolidado.xlsm /compartido/rem/
+    python distributed.py worker --queue /compartido/cola
+    python distributed.py produce --template plantilla.xlsm --output parte.npz archivos...
+    python distributed.py merge --output total.npz parte1.npz parte2.npz
+    python distributed.py finalize --template plantilla.xlsm --aggregate total.npz --output REM.xlsm
+"""
+import abc
+import argparse
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from consolidation import CONSOLIDATION_WORKERS
+from partial_format import (
+    PartialAggregate, aggregate_files, finalize_aggregate, merge_aggregates, read_aggregate, write_aggregate
+)
+from template_analysis import file_sha256, get_template_analysis
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_FOLDER = os.path.join("templates", "analysis")
+SHARD_SIZE = int(os.environ.get("DISTRIBUTED_SHARD_SIZE", "200"))
+# Segundos sin latido tras los que un grupo tomado se da por abandonado
+STALE_AFTER = float(os.environ.get("DISTRIBUTED_STALE_AFTER", "120"))
+MAX_ATTEMPTS = int(os.environ.get("DISTRIBUTED_MAX_ATTEMPTS", "3"))
+
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+
+
+class ShardFailed(RuntimeError):
+    """Un grupo falló en todos sus intentos"""
+
+
+class WorkQueue(abc.ABC):
+    """
+    Cola entre coordinador y trabajadores. Un grupo es un dict con al menos
+    "job_id" y "shard_id"; el agregado de cada grupo viaja por la cola.
+    """
+
+    @abc.abstractmethod
+    def submit(self, task: Dict):
+        """Publica un grupo pendiente"""
+
+    @abc.abstractmethod
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        """Toma un grupo pendiente (None si no hay)"""
+
+    @abc.abstractmethod
+    def heartbeat(self, task: Dict):
+        """Renueva el latido de un grupo tomado"""
+
+    @abc.abstractmethod
+    def complete(self, task: Dict, part_path: str):
+        """Entrega el agregado del grupo (la cola se queda con el archivo)"""
+
+    @abc.abstractmethod
+    def fail(self, task: Dict, error: str):
+        """Devuelve el grupo a pending o, agotados los intentos, lo marca fallido"""
+
+    @abc.abstractmethod
+    def status(self, job_id: str) -> Dict[str, Dict]:
+        """shard_id -> grupo con su "state" (pending, claimed, done o failed)"""
+
+    @abc.abstractmethod
+    def requeue_stale(self, stale_after: float) -> int:
+        """Devuelve a pending los grupos sin latido por `stale_after` segundos; retorna cuántos"""
+
+    @abc.abstractmethod
+    def part_path(self, job_id: str, shard_id: str) -> str:
+        """Ruta local del agregado de un grupo terminado"""
+
+    @abc.abstractmethod
+    def cleanup(self, job_id: str):
+        """Borra los grupos y agregados del trabajo"""
+
+
+class FilesystemQueue(WorkQueue):
+    def __init__(self, root: str, max_attempts: int = MAX_ATTEMPTS):
+        self.root = root
+        self.max_attempts = max_attempts
+        for estado in (PENDING, CLAIMED, DONE, FAILED, "parts"):
+            os.makedirs(os.path.join(root, estado), exist_ok=True)
+
+    @staticmethod
+    def _name(task: Dict) -> str:
+        return f"{task['job_id']}.{task['shard_id']}.json"
+
+    def _path(self, estado: str, task: Dict) -> str:
+        return os.path.join(self.root, estado, self._name(task))
+
+    def _write(self, path: str, task: Dict):
+        tmp_path = f"{path}.{uuid.uuid4().hex[:6]}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(task, fh)
+        os.replace(tmp_path, path)
+
+    def submit(self, task: Dict):
+        self._write(self._path(PENDING, task), {**task, "attempts": task.get("attempts", 0)})
+
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        carpeta = os.path.join(self.root, PENDING)
+        for nombre in sorted(n for n in os.listdir(carpeta) if n.endswith(".json")):
+            destino = os.path.join(self.root, CLAIMED, nombre)
+            try:
+                os.rename(os.path.join(carpeta, nombre), destino)
+            except FileNotFoundError:
+                # Otro trabajador lo tomó primero
+                continue
+            try:
+                with open(destino) as fh:
+                    task = json.load(fh)
+            except (OSError, ValueError):
+                # Requeue por un coordinador entre el rename y la lectura
+                continue
+            task["worker"] = worker_id
+            task["attempts"] = task.get("attempts", 0) + 1
+            self._write(destino, task)
+            return task
+        return None
+
+    def heartbeat(self, task: Dict):
+        try:
+            os.utime(self._path(CLAIMED, task))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task: Dict, part_path: str):
+        os.replace(part_path, self.part_path(task["job_id"], task["shard_id"]))
+        # Si se reencoló por falta de latido, otro trabajador puede repetirlo: mismo agregado
+        self._write(self._path(DONE, task), task)
+        for estado in (CLAIMED, PENDING):
+            try:
+                os.remove(self._path(estado, task))
+            except FileNotFoundError:
+                pass
+
+    def fail(self, task: Dict, error: str):
+        task = {**task, "error": error}
+        estado = FAILED if task.get("attempts", 0) >= self.max_attempts else PENDING
+        self._write(self._path(estado, task), task)
+        try:
+            os.remove(self._path(CLAIMED, task))
+        except FileNotFoundError:
+            pass
+
+    def status(self, job_id: str) -> Dict[str, Dict]:
+        grupos: Dict[str, Dict] = {}
+        # DONE al final: un grupo terminado y a la vez reencolado cuenta como terminado
+        for estado in (FAILED, PENDING, CLAIMED, DONE):
+            for path in glob.glob(os.path.join(self.root, estado, f"{job_id}.*.json")):
+                try:
+                    with open(path) as fh:
+                        task = json.load(fh)
+                except (OSError, ValueError):
+                    continue
+                grupos[task["shard_id"]] = {**task, "state": estado}
+        return grupos
+
+    def requeue_stale(self, stale_after: float) -> int:
+        limite = time.time() - stale_after
+        reencolados = 0
+        carpeta = os.path.join(self.root, CLAIMED)
+        for nombre in os.listdir(carpeta):
+            path = os.path.join(carpeta, nombre)
+            try:
+                if nombre.endswith(".json") and os.path.getmtime(path) < limite:
+                    os.rename(path, os.path.join(self.root, PENDING, nombre))
+                    logger.warning("Grupo %s sin latido, vuelve a la cola", nombre)
+                    reencolados += 1
+            except FileNotFoundError:
+                pass
+        return reencolados
+
+    def part_path(self, job_id: str, shard_id: str) -> str:
+        return os.path.join(self.root, "parts", f"{job_id}.{shard_id}.npz")
+
+    def cleanup(self, job_id: str):
+        for estado in (PENDING, CLAIMED, DONE, FAILED, "parts"):
+            for path in glob.glob(os.path.join(self.root, estado, f"{job_id}.*")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class _Heartbeat:
+    """Hilo que renueva el latido del grupo mientras se suma"""
+
+    def __init__(self, queue: WorkQueue, task: Dict, interval: float):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(queue, task, interval), daemon=True)
+
+    def _run(self, queue: WorkQueue, task: Dict, interval: float):
+        while not self._stop.wait(interval):
+            queue.heartbeat(task)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def process_task(task: Dict, analysis_folder: str, templates: Optional[Dict[str, str]] = None,
+                 workers: int = CONSOLIDATION_WORKERS) -> PartialAggregate:
+    """
+    Suma los archivos de un grupo. `templates` (hash -> ruta local) permite
+    que el trabajador use su copia de la plantilla; si no, la ruta del grupo.
+    """
+    template_path = (templates or {}).get(task["template_hash"], task["template_path"])
+    if file_sha256(template_path) != task["template_hash"]:
+        raise ValueError(f"La plantilla {template_path} no es la del trabajo {task['job_id']}")
+    return aggregate_files(
+        task["files"], task["sheets"], template_path, analysis_folder,
+        exact=task.get("exact", False), template_hash=task["template_hash"], workers=workers,
+    )
+
+
+def run_worker(queue: WorkQueue, analysis_folder: str = ANALYSIS_FOLDER,
+               templates: Optional[Dict[str, str]] = None, workers: int = CONSOLIDATION_WORKERS,
+               poll_interval: float = 2.0, heartbeat_interval: float = STALE_AFTER / 4,
+               once: bool = False, stop: Optional[threading.Event] = None,
+               name: Optional[str] = None) -> int:
+    """
+    Toma y suma grupos hasta `stop` (o, con `once`, hasta vaciar la cola).
+    Retorna cuántos grupos terminó.
+    """
+    name = name or worker_id()
+    stop = stop or threading.Event()
+    terminados = 0
+    while not stop.is_set():
+        task = queue.claim(name)
+        if task is None:
+            if once:
+                break
+            stop.wait(poll_interval)
+            continue
+        logger.info("%s toma el grupo %s.%s (%d archivos)", name, task["job_id"], task["shard_id"],
+                    len(task["files"]))
+        try:
+            with _Heartbeat(queue, task, heartbeat_interval):
+                agregado = process_task(task, analysis_folder, templates, workers)
+                tmp_path = os.path.join(os.path.dirname(queue.part_path(task["job_id"], task["shard_id"])),
+                                        f"{task['job_id']}.{task['shard_id']}.{uuid.uuid4().hex[:6]}.tmp.npz")
+                write_aggregate(tmp_path, agregado)
+            queue.complete(task, tmp_path)
+            terminados += 1
+        except Exception as e:
+            logger.exception("Error en el grupo %s.%s", task["job_id"], task["shard_id"])
+            queue.fail(task, str(e))
+    return terminados
+
+
+def merge_parts(paths: List[str]) -> PartialAggregate:
+    """Combina agregados leyéndolos de a uno (en memoria, el total y el que se suma)"""
+    total = read_aggregate(paths[0])
+    for path in paths[1:]:
+        total = merge_aggregates([total, read_aggregate(path)])
+    return total
+
+
+def coordinate(queue: WorkQueue, file_paths: List[str], template_path: str, output_path: str,
+               hojas: Optional[List[str]] = None, exact: bool = False, shard_size: int = SHARD_SIZE,
+               analysis_folder: str = ANALYSIS_FOLDER, aggregate_path: Optional[str] = None,
+               data_path: Optional[str] = None, poll_interval: float = 1.0,
+               stale_after: float = STALE_AFTER, timeout: Optional[float] = None,
+               local_workers: int = 0) -> Dict:
+    """
+    Reparte los archivos en grupos, espera sus agregados, los combina y
+    escribe el consolidado en `output_path` (y el agregado total en
+    `aggregate_path`, si se indica). `local_workers` arranca trabajadores en
+    este mismo proceso. ShardFailed si un grupo falla en todos sus
+    intentos; TimeoutError si no termina en `timeout` segundos.
+    """
+    inicio = time.monotonic()
+    template_hash = file_sha256(template_path)
+    analisis = get_template_analysis(template_path, analysis_folder, template_hash)
+    hojas = [hoja for hoja in (hojas or list(analisis.sheets)) if hoja in analisis.sheets]
+    job_id = uuid.uuid4().hex[:12]
+    shard_size = max(1, shard_size)
+    grupos = [file_paths[i:i + shard_size] for i in range(0, len(file_paths), shard_size)]
+    for n, archivos in enumerate(grupos):
+        queue.submit({
+            "job_id": job_id,
+            "shard_id": f"{n:05d}",
+            "files": [os.path.abspath(path) for path in archivos],
+            "sheets": hojas,
+            "template_path": os.path.abspath(template_path),
+            "template_hash": template_hash,
+            "exact": exact,
+        })
+    logger.info("Trabajo %s: %d archivos en %d grupos", job_id, len(file_paths), len(grupos))
+
+    parar = threading.Event()
+    locales = [
+        threading.Thread(target=run_worker, args=(queue, analysis_folder),
+                         kwargs={"stop": parar, "poll_interval": poll_interval}, daemon=True)
+        for _ in range(local_workers)
+    ]
+    for hilo in locales:
+        hilo.start()
+    try:
+        while True:
+            estados = queue.status(job_id)
+            fallidos = [g for g in estados.values() if g["state"] == FAILED]
+            if fallidos:
+                raise ShardFailed(f"Grupo {fallidos[0]['shard_id']}: {fallidos[0].get('error')}")
+            terminados = sum(1 for g in estados.values() if g["state"] == DONE)
+            if terminados == len(grupos):
+                break
+            if timeout is not None and time.monotonic() - inicio > timeout:
+                raise TimeoutError(f"Trabajo {job_id}: {terminados} de {len(grupos)} grupos en {timeout:.0f}s")
+            queue.requeue_stale(stale_after)
+            time.sleep(poll_interval)
+        reparto = time.monotonic() - inicio
+
+        if grupos:
+            total = merge_parts([queue.part_path(job_id, f"{n:05d}") for n in range(len(grupos))])
+        else:
+            total = PartialAggregate.empty(analisis, hojas, exact)
+        if aggregate_path:
+            write_aggregate(aggregate_path, total)
+        resumen = finalize_aggregate(total, template_path, analysis_folder, output_path, data_path)
+    finally:
+        parar.set()
+        for hilo in locales:
+            hilo.join()
+        queue.cleanup(job_id)
+    resumen.update({
+        "job_id": job_id,
+        "shards": len(grupos),
+        "workers": sorted({g.get("worker") for g in estados.values() if g.get("worker")}),
+        "seconds_distributed": round(reparto, 3),
+        "seconds_total": round(time.monotonic() - inicio, 3),
+    })
+    return resumen
+
+
+def _expand(paths: List[str]) -> List[str]:
+    """Archivos tal cual; de las carpetas, sus .xlsm y .xlsx (recursivo, en orden)"""
+    archivos = []
+    for path in paths:
+        if os.path.isdir(path):
+            archivos.extend(sorted(
+                p for p in glob.glob(os.path.join(path, "**", "*"), recursive=True)
+                if p.lower().endswith((".xlsm", ".xlsx")) and os.path.isfile(p)
+            ))
+        else:
+            archivos.append(path)
+    return archivos
+
+
+def _sheets(template_path: str, analysis_folder: str, excluded: Optional[str]) -> List[str]:
+    excluidas = {s.strip() for s in (excluded or "").split(",") if s.strip()}
+    return [hoja for hoja in get_template_analysis(template_path, analysis_folder).sheets if hoja not in excluidas]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consolidación repartida con agregados parciales")
+    parser.add_argument("--analysis-folder", default=ANALYSIS_FOLDER)
+    parser.add_argument("--workers", type=int, default=CONSOLIDATION_WORKERS,
+                        help="Procesos de lectura por nodo")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("coordinator", help="Reparte los archivos, espera los grupos y finaliza")
+    p.add_argument("--queue", required=True, help="Carpeta de la cola")
+    p.add_argument("--template", required=True)
+    p.add_argument("--output", required=True, help="Consolidado .xlsm")
+    p.add_argument("--aggregate", help="Guardar también el agregado total (.npz)")
+    p.add_argument("--data", help="Guardar los datos del consolidado (.npz)")
+    p.add_argument("--excluded-sheets", help="Hojas a excluir separadas por coma")
+    p.add_argument("--exact", action="store_true", help="Suma decimal exacta")
+    p.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    p.add_argument("--local-workers", type=int, default=0, help="Trabajadores en este mismo proceso")
+    p.add_argument("--timeout", type=float)
+    p.add_argument("files", nargs="+", help="Archivos o carpetas")
+
+    p = sub.add_parser("worker", help="Toma grupos de la cola y devuelve sus agregados")
+    p.add_argument("--queue", required=True)
+    p.add_argument("--template", action="append", default=[],
+                   help="Copia local de una plantilla (se elige por hash; repetible)")
+    p.add_argument("--once", action="store_true", help="Terminar cuando la cola quede vacía")
+
+    p = sub.add_parser("produce", help="Agregado parcial de unos archivos")
+    p.add_argument("--template", required=True)
+    p.add_argument("--output", required=True)
+    p.add_argument("--excluded-sheets")
+    p.add_argument("--exact", action="store_true")
+    p.add_argument("files", nargs="+")
+
+    p = sub.add_parser("merge", help="Combina agregados parciales")
+    p.add_argument("--output", required=True)
+    p.add_argument("parts", nargs="+")
+
+    p = sub.add_parser("finalize", help="Vuelca un agregado sobre la plantilla")
+    p.add_argument("--template", required=True)
+    p.add_argument("--aggregate", required=True)
+    p.add_argument("--output", required=True)
+    p.add_argument("--data")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "coordinator":
+        resumen = coordinate(
+            FilesystemQueue(args.queue), _expand(args.files), args.template, args.output,
+            hojas=_sheets(args.template, args.analysis_folder, args.excluded_sheets), exact=args.exact,
+            shard_size=args.shard_size, analysis_folder=args.analysis_folder, aggregate_path=args.aggregate,
+            data_path=args.data, timeout=args.timeout, local_workers=args.local_workers,
+        )
+    elif args.command == "worker":
+        plantillas = {file_sha256(path): path for path in args.template}
+        terminados = run_worker(FilesystemQueue(args.queue), args.analysis_folder, plantillas, args.workers,
+                                once=args.once)
+        resumen = {"shards": terminados}
+    elif args.command == "produce":
+        agregado = aggregate_files(
+            _expand(args.files), _sheets(args.template, args.analysis_folder, args.excluded_sheets),
+            args.template, args.analysis_folder, exact=args.exact, workers=args.workers,
+        )
+        resumen = {"file_count": agregado.file_count, "errors": agregado.errors,
+                   "bytes": write_aggregate(args.output, agregado)}
+    elif args.command == "merge":
+        agregado = merge_parts(args.parts)
+        resumen = {"file_count": agregado.file_count, "errors": len(agregado.errors),
+                   "bytes": write_aggregate(args.output, agregado)}
+    else:
+        resumen = finalize_aggregate(read_aggregate(args.aggregate), args.template, args.analysis_folder,
+                                     args.output, args.data)
+    print(json.dumps(resumen, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Descarga de archivos con ETag y rangos de bytes.
+
+Los consolidados no cambian una vez escritos, así que su ETag (tamaño y
+mtime) sirve para responder `304` a un `If-None-Match` y para que un
+cliente retome una descarga cortada con `Range` (y `If-Range`, para no
+mezclar partes de dos archivos distintos). Se admite un solo rango por
+petición; varios rangos se responden con el archivo completo, como permite
+el RFC 9110.
+"""
+import os
+from email.utils import formatdate
+from typing import Iterator, Mapping, Optional, Tuple
+from urllib.parse import quote
+
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+# Bytes leídos por vez al enviar un rango
+RANGE_CHUNK_SIZE = 256 * 1024
+
+
+class RangeNotSatisfiable(ValueError):
+    """El rango pedido empieza después del final del archivo"""
+
+
+def entity_tag(stat: os.stat_result) -> str:
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Comparación débil de If-None-Match (lista de ETags o "*")"""
+    if header.strip() == "*":
+        return True
+    return any(candidato.strip().removeprefix("W/") == etag for candidato in header.split(","))
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    "bytes=inicio-fin", "bytes=inicio-" o "bytes=-últimos" -> (inicio, fin)
+    inclusive. None si el encabezado no se entiende o pide varios rangos (se
+    envía el archivo completo); RangeNotSatisfiable si no cae en el archivo.
+    """
+    unidad, _, rangos = header.partition("=")
+    if unidad.strip().lower() != "bytes" or "," in rangos:
+        return None
+    inicio, guion, fin = rangos.strip().partition("-")
+    if not guion:
+        return None
+    try:
+        if not inicio:
+            sufijo = int(fin)
+            if sufijo <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(0, size - sufijo), size - 1
+        inicio = int(inicio)
+        fin = int(fin) if fin else size - 1
+    except ValueError:
+        return None
+    if inicio >= size:
+        raise RangeNotSatisfiable(header)
+    if fin < inicio:
+        return None
+    return inicio, min(fin, size - 1)
+
+
+def _iter_file(path: str, inicio: int, fin: int) -> Iterator[bytes]:
+    with open(path, "rb") as fh:
+        fh.seek(inicio)
+        pendientes = fin - inicio + 1
+        while pendientes > 0:
+            bloque = fh.read(min(RANGE_CHUNK_SIZE, pendientes))
+            if not bloque:
+                break
+            pendientes -= len(bloque)
+            yield bloque
+
+
+def _content_disposition(filename: str) -> str:
+    # Igual que FileResponse: filename* cuando el nombre no es ASCII
+    citado = quote(filename)
+    if citado != filename:
+        return f"attachment; filename*=utf-8''{citado}"
+    return f'attachment; filename="{filename}"'
+
+
+def file_download(path: str, filename: str, media_type: str, request_headers: Mapping[str, str]) -> Response:
+    """
+    Respuesta para descargar `path`: 200 con el archivo, 304 si el cliente ya
+    lo tiene (If-None-Match), 206 con el rango pedido o 416 si el rango no es
+    válido para el tamaño del archivo. OSError si el archivo no existe.
+    """
+    stat = os.stat(path)
+    etag = entity_tag(stat)
+    encabezados = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+    }
+
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=encabezados)
+
+    rango = request_headers.get("range")
+    if_range = request_headers.get("if-range")
+    # Con If-Range, el rango solo vale si el archivo es el mismo que el cliente ya tiene
+    if rango and (not if_range or if_range.strip() in (etag, encabezados["Last-Modified"])):
+        try:
+            limites = parse_byte_range(rango, stat.st_size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**encabezados, "Content-Range": f"bytes */{stat.st_size}"})
+        if limites is not None:
+            inicio, fin = limites
+            return StreamingResponse(
+                _iter_file(path, inicio, fin),
+                status_code=206,
+                media_type=media_type,
+                headers={
+                    **encabezados,
+                    "Content-Range": f"bytes {inicio}-{fin}/{stat.st_size}",
+                    "Content-Length": str(fin - inicio + 1),
+                    "Content-Disposition": _content_disposition(filename),
+                },
+            )
+
+    return FileResponse(path=path, filename=filename, media_type=media_type, headers=encabezados,
+                        stat_result=stat)
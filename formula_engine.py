@@ -0,0 +1,1064 @@
+"""
+Evaluación en el servidor de las fórmulas de la plantilla consolidada.
+
+`FormulaModel` se arma una vez por plantilla: lee las fórmulas de todas las
+hojas, las compila a un árbol con referencias relativas a la celda (como
+R1C1, así todas las celdas de una fórmula compartida usan el mismo árbol) y
+arma el grafo de dependencias entre las celdas que pueden cambiar (fórmulas
+y celdas de entrada). El orden de calcChain.xml se usa como orden preferido
+de evaluación.
+
+`FormulaState` guarda, por sesión, los valores de entrada y de fórmulas de
+la última consolidación: en la siguiente solo se evalúan las fórmulas
+alcanzables desde las entradas que cambiaron. Una fórmula que no se puede
+evaluar (función no soportada, ciclo) y las que dependen de ella conservan
+el valor guardado en la plantilla; el libro igual se marca para recalcular
+al abrirlo en Excel.
+"""
+import logging
+import math
+import os
+import re
+from decimal import Decimal
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from openpyxl.utils import get_column_letter
+
+from template_analysis import TemplateAnalysis, template_cache
+from xlsx_reader import Number, XlsxReader, split_cell_ref
+
+logger = logging.getLogger(__name__)
+
+# Evaluar las fórmulas al consolidar (si no, quedan para que Excel las calcule al abrir)
+EVALUATE_FORMULAS = os.environ.get("EVALUATE_FORMULAS", "1").lower() in ("1", "true", "yes")
+
+CellKey = Tuple[str, int, int]
+CellValues = Iterable[Tuple[int, int, Number]]
+
+
+class UnsupportedFormula(Exception):
+    """La fórmula usa algo que el motor no evalúa (se conserva el valor de la plantilla)"""
+
+
+class XlError:
+    """Valor de error de Excel (#DIV/0!, #VALUE!, ...)"""
+    __slots__ = ("code",)
+
+    def __init__(self, code: str):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, XlError) and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return self.code
+
+
+ERROR_CODES = ("#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A")
+DIV0, VALUE, REF, NUM, NA = (XlError(code) for code in ("#DIV/0!", "#VALUE!", "#REF!", "#NUM!", "#N/A"))
+
+
+class _Array:
+    """Valores de un rango o de una operación matricial, por filas"""
+    __slots__ = ("rows",)
+
+    def __init__(self, rows: List[List]):
+        self.rows = rows
+
+    def values(self) -> Iterator:
+        for fila in self.rows:
+            yield from fila
+
+    def first(self):
+        return self.rows[0][0] if self.rows and self.rows[0] else None
+
+
+_MISSING = object()  # argumento omitido: IF(A1,,2)
+
+
+# ---------- Lectura de la fórmula ----------
+
+_TOKEN = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<str>"(?:[^"]|"")*")
+  | (?P<err>\#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A))
+  | (?P<ref>(?:(?P<sheet>'(?:[^']|'')+'|[A-Za-z_][\w.]*)!)?
+        \$?[A-Za-z]{1,3}\$?[0-9]+(?::\$?[A-Za-z]{1,3}\$?[0-9]+)?)(?![\w(])
+  | (?P<num>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)
+  | (?P<func>[A-Za-z_][\w.]*)\(
+  | (?P<name>[A-Za-z_][\w.]*)
+  | (?P<op><>|<=|>=|[-+*/^&=<>%(),])
+""", re.VERBOSE)
+
+_CELL = re.compile(r"(\$?)([A-Za-z]{1,3})(\$?)([0-9]+)")
+
+_COMPARISONS = ("=", "<>", "<", ">", "<=", ">=")
+
+
+def _tokenize(texto: str) -> List[Tuple[str, str, Optional[str]]]:
+    tokens = []
+    pos = 0
+    while pos < len(texto):
+        match = _TOKEN.match(texto, pos)
+        if match is None:
+            raise UnsupportedFormula(f"No se reconoce '{texto[pos:pos + 10]}'")
+        pos = match.end()
+        tipo = match.lastgroup if match.lastgroup != "sheet" else "ref"
+        if tipo == "ws":
+            continue
+        tokens.append((tipo, match.group(tipo), match.group("sheet") if tipo == "ref" else None))
+    return tokens
+
+
+def _coordinate(ref: str, row0: int, col0: int):
+    """("$", col, "", fila) -> ((absoluta, fila u offset), (absoluta, columna u offset))"""
+    match = _CELL.fullmatch(ref)
+    row, col = split_cell_ref(match.group(2) + match.group(4))
+    fila = (True, row) if match.group(3) else (False, row - row0)
+    columna = (True, col) if match.group(1) else (False, col - col0)
+    return fila, columna
+
+
+class _Parser:
+    """
+    Precedencia de Excel, de menor a mayor: comparación, &, + -, * /, ^,
+    signo, %. Las referencias quedan relativas a (row0, col0).
+    """
+
+    def __init__(self, texto: str, row0: int, col0: int):
+        self.tokens = _tokenize(texto)
+        self.pos = 0
+        self.row0 = row0
+        self.col0 = col0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, op: str):
+        tipo, valor, _ = self.take()
+        if tipo != "op" or valor != op:
+            raise UnsupportedFormula(f"Se esperaba '{op}'")
+
+    def parse(self):
+        nodo = self.comparison()
+        if self.pos != len(self.tokens):
+            raise UnsupportedFormula("Fórmula con texto sobrante")
+        return nodo
+
+    def _binary(self, siguiente, operadores):
+        nodo = siguiente()
+        while True:
+            tipo, valor, _ = self.peek()
+            if tipo != "op" or valor not in operadores:
+                return nodo
+            self.take()
+            nodo = ("bin", valor, nodo, siguiente())
+
+    def comparison(self):
+        return self._binary(self.concat, _COMPARISONS)
+
+    def concat(self):
+        return self._binary(self.additive, ("&",))
+
+    def additive(self):
+        return self._binary(self.multiplicative, ("+", "-"))
+
+    def multiplicative(self):
+        return self._binary(self.power, ("*", "/"))
+
+    def power(self):
+        return self._binary(self.unary, ("^",))
+
+    def unary(self):
+        tipo, valor, _ = self.peek()
+        if tipo == "op" and valor in ("-", "+"):
+            self.take()
+            operando = self.unary()
+            return ("neg", operando) if valor == "-" else ("plus", operando)
+        nodo = self.primary()
+        while self.peek()[:2] == ("op", "%"):
+            self.take()
+            nodo = ("pct", nodo)
+        return nodo
+
+    def primary(self):
+        tipo, valor, hoja = self.take()
+        if tipo == "num":
+            numero = float(valor)
+            return ("val", int(numero) if numero.is_integer() and "." not in valor and "e" not in valor.lower()
+                    else numero)
+        if tipo == "str":
+            return ("val", valor[1:-1].replace('""', '"'))
+        if tipo == "err":
+            return ("val", XlError(valor))
+        if tipo == "name":
+            if valor.upper() in ("TRUE", "FALSE"):
+                return ("val", valor.upper() == "TRUE")
+            raise UnsupportedFormula(f"Nombre no soportado: {valor}")
+        if tipo == "ref":
+            return self.reference(valor, hoja)
+        if tipo == "func":
+            return self.call(valor)
+        if tipo == "op" and valor == "(":
+            nodo = self.comparison()
+            self.expect(")")
+            return nodo
+        raise UnsupportedFormula(f"Token inesperado: {valor}")
+
+    def reference(self, texto: str, hoja: Optional[str]):
+        nombre = None
+        if hoja is not None:
+            texto = texto[len(hoja) + 1:]
+            nombre = hoja[1:-1].replace("''", "'") if hoja.startswith("'") else hoja
+        inicio, _, fin = texto.partition(":")
+        fila1, col1 = _coordinate(inicio, self.row0, self.col0)
+        if not fin:
+            return ("ref", nombre, fila1, col1)
+        fila2, col2 = _coordinate(fin, self.row0, self.col0)
+        return ("range", nombre, fila1, col1, fila2, col2)
+
+    def call(self, nombre: str):
+        nombre = nombre.upper()
+        for prefijo in ("_XLFN.", "_XLWS."):
+            if nombre.startswith(prefijo):
+                nombre = nombre[len(prefijo):]
+        if nombre not in FUNCTIONS:
+            raise UnsupportedFormula(f"Función no soportada: {nombre}")
+        args = []
+        if self.peek()[:2] == ("op", ")"):
+            self.take()
+            return ("call", nombre, args)
+        while True:
+            if self.peek()[:2] in (("op", ","), ("op", ")")):
+                args.append(("val", _MISSING))
+            else:
+                args.append(self.comparison())
+            tipo, valor, _ = self.take()
+            if tipo == "op" and valor == ")":
+                return ("call", nombre, args)
+            if tipo != "op" or valor != ",":
+                raise UnsupportedFormula("Argumentos mal formados")
+
+
+def compile_formula(texto: str, row: int, col: int):
+    """Árbol de la fórmula con referencias relativas a (row, col)"""
+    return _Parser(texto, row, col).parse()
+
+
+def _resolve(spec, base: int) -> int:
+    absoluta, valor = spec
+    return valor if absoluta else base + valor
+
+
+def iter_references(nodo, sheet: str, row: int, col: int) -> Iterator[Tuple[str, int, int, int, int]]:
+    """Rangos (hoja, fila1, col1, fila2, col2) que lee la fórmula ubicada en (sheet, row, col)"""
+    tipo = nodo[0]
+    if tipo == "ref":
+        fila, columna = _resolve(nodo[2], row), _resolve(nodo[3], col)
+        yield nodo[1] or sheet, fila, columna, fila, columna
+    elif tipo == "range":
+        f1, c1 = _resolve(nodo[2], row), _resolve(nodo[3], col)
+        f2, c2 = _resolve(nodo[4], row), _resolve(nodo[5], col)
+        yield nodo[1] or sheet, min(f1, f2), min(c1, c2), max(f1, f2), max(c1, c2)
+    elif tipo == "bin":
+        yield from iter_references(nodo[2], sheet, row, col)
+        yield from iter_references(nodo[3], sheet, row, col)
+    elif tipo in ("neg", "plus", "pct"):
+        yield from iter_references(nodo[1], sheet, row, col)
+    elif tipo == "call":
+        for arg in nodo[2]:
+            yield from iter_references(arg, sheet, row, col)
+
+
+# ---------- Semántica de valores de Excel ----------
+
+def _is_number(valor) -> bool:
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
+
+
+def to_number(valor):
+    """Número para una operación aritmética (vacío = 0, TRUE = 1); XlError si no aplica"""
+    if isinstance(valor, _Array):
+        valor = valor.first()
+    if valor is None or valor is _MISSING:
+        return 0
+    if isinstance(valor, bool):
+        return int(valor)
+    if _is_number(valor) or isinstance(valor, XlError):
+        return valor
+    try:
+        return float(valor.strip())
+    except ValueError:
+        return VALUE
+
+
+def format_general(numero) -> str:
+    """Texto de un número con el formato General de Excel (15 dígitos significativos)"""
+    if isinstance(numero, int):
+        return str(numero)
+    if numero.is_integer() and abs(numero) < 1e15:
+        return str(int(numero))
+    texto = "%.15g" % numero
+    return texto.replace("e+", "E+").replace("e-", "E-")
+
+
+def to_text(valor):
+    if isinstance(valor, _Array):
+        valor = valor.first()
+    if valor is None:
+        return ""
+    if isinstance(valor, bool):
+        return "TRUE" if valor else "FALSE"
+    if _is_number(valor):
+        return format_general(valor)
+    return valor
+
+
+def to_bool(valor):
+    if isinstance(valor, _Array):
+        valor = valor.first()
+    if valor is None or valor is _MISSING:
+        return False
+    if isinstance(valor, (bool, XlError)):
+        return valor
+    if _is_number(valor):
+        return valor != 0
+    if valor.upper() in ("TRUE", "FALSE"):
+        return valor.upper() == "TRUE"
+    return VALUE
+
+
+def _rank(valor) -> int:
+    # Orden de Excel entre tipos: números < texto < lógicos
+    return 2 if isinstance(valor, bool) else 1 if isinstance(valor, str) else 0
+
+
+def compare(op: str, a, b):
+    if isinstance(a, XlError):
+        return a
+    if isinstance(b, XlError):
+        return b
+    # Una celda vacía se compara como el "cero" del tipo del otro lado
+    if a is None:
+        a = "" if isinstance(b, str) else False if isinstance(b, bool) else 0
+    if b is None:
+        b = "" if isinstance(a, str) else False if isinstance(a, bool) else 0
+    ra, rb = _rank(a), _rank(b)
+    if ra != rb:
+        a, b = ra, rb
+    elif ra == 1:
+        a, b = a.lower(), b.lower()
+    if op == "=":
+        return a == b
+    if op == "<>":
+        return a != b
+    if op == "<":
+        return a < b
+    if op == ">":
+        return a > b
+    if op == "<=":
+        return a <= b
+    return a >= b
+
+
+def _arithmetic(op: str, a, b):
+    a, b = to_number(a), to_number(b)
+    if isinstance(a, XlError):
+        return a
+    if isinstance(b, XlError):
+        return b
+    if op == "+":
+        return a + b
+    if op == "-":
+        return a - b
+    if op == "*":
+        return a * b
+    if op == "/":
+        return DIV0 if b == 0 else a / b
+    try:
+        resultado = a ** b
+    except (OverflowError, ZeroDivisionError):
+        return NUM
+    return NUM if isinstance(resultado, complex) else resultado
+
+
+def _scalar_op(op: str, a, b):
+    if op in _COMPARISONS:
+        return compare(op, a, b)
+    if op == "&":
+        a, b = to_text(a), to_text(b)
+        if isinstance(a, XlError):
+            return a
+        if isinstance(b, XlError):
+            return b
+        return a + b
+    return _arithmetic(op, a, b)
+
+
+def _broadcast(op: str, a, b):
+    """Operación elemento a elemento cuando algún operando es un rango (fórmulas matriciales)"""
+    filas_a = a.rows if isinstance(a, _Array) else None
+    filas_b = b.rows if isinstance(b, _Array) else None
+    if filas_a is None:
+        return _Array([[_scalar_op(op, a, y) for y in fila] for fila in filas_b])
+    if filas_b is None:
+        return _Array([[_scalar_op(op, x, b) for x in fila] for fila in filas_a])
+    if len(filas_a) == len(filas_b) and all(len(x) == len(y) for x, y in zip(filas_a, filas_b)):
+        return _Array([[_scalar_op(op, x, y) for x, y in zip(fx, fy)] for fx, fy in zip(filas_a, filas_b)])
+    return NA
+
+
+# ---------- Evaluación ----------
+
+class _Evaluator:
+    def __init__(self, get: Callable[[str, int, int], object], sheets: Set[str]):
+        self.get = get
+        self.sheets = sheets
+        self.sheet = ""
+        self.row = 0
+        self.col = 0
+
+    def eval(self, nodo):
+        tipo = nodo[0]
+        if tipo == "val":
+            return nodo[1]
+        if tipo == "ref":
+            hoja = nodo[1] or self.sheet
+            if hoja not in self.sheets:
+                return REF
+            return self.get(hoja, _resolve(nodo[2], self.row), _resolve(nodo[3], self.col))
+        if tipo == "bin":
+            a = self.eval(nodo[2])
+            b = self.eval(nodo[3])
+            if isinstance(a, _Array) or isinstance(b, _Array):
+                return _broadcast(nodo[1], a, b)
+            return _scalar_op(nodo[1], a, b)
+        if tipo == "call":
+            return FUNCTIONS[nodo[1]](self, nodo[2])
+        if tipo == "range":
+            hoja = nodo[1] or self.sheet
+            if hoja not in self.sheets:
+                return REF
+            f1, c1 = _resolve(nodo[2], self.row), _resolve(nodo[3], self.col)
+            f2, c2 = _resolve(nodo[4], self.row), _resolve(nodo[5], self.col)
+            return _Array([
+                [self.get(hoja, fila, col) for col in range(min(c1, c2), max(c1, c2) + 1)]
+                for fila in range(min(f1, f2), max(f1, f2) + 1)
+            ])
+        if tipo == "neg":
+            return _arithmetic("-", 0, self.eval(nodo[1]))
+        if tipo == "plus":
+            return self.eval(nodo[1])
+        if tipo == "pct":
+            return _arithmetic("/", self.eval(nodo[1]), 100)
+        raise UnsupportedFormula(tipo)
+
+    def evaluate_cell(self, nodo, sheet: str, row: int, col: int):
+        """Valor final de la celda (un rango da su primer valor; una celda vacía, 0)"""
+        self.sheet, self.row, self.col = sheet, row, col
+        valor = self.eval(nodo)
+        if isinstance(valor, _Array):
+            valor = valor.first()
+        if valor is None or valor is _MISSING:
+            return 0
+        if isinstance(valor, float) and not math.isfinite(valor):
+            return NUM
+        return valor
+
+    def aggregate(self, args) -> Iterator:
+        """
+        Valores para SUM/MAX/...: de rangos y referencias solo cuentan los
+        números; un argumento directo se convierte (texto numérico, TRUE = 1)
+        """
+        for arg in args:
+            valor = self.eval(arg)
+            if valor is _MISSING:
+                continue
+            if arg[0] in ("ref", "range") or isinstance(valor, _Array):
+                valores = valor.values() if isinstance(valor, _Array) else (valor,)
+                for v in valores:
+                    if isinstance(v, XlError) or _is_number(v):
+                        yield v
+            else:
+                yield to_number(valor)
+
+
+FUNCTIONS: Dict[str, Callable[[_Evaluator, list], object]] = {}
+
+
+def _function(*nombres: str):
+    def registrar(func):
+        for nombre in nombres:
+            FUNCTIONS[nombre] = func
+        return func
+    return registrar
+
+
+def _numbers(ev: _Evaluator, args):
+    numeros = []
+    for valor in ev.aggregate(args):
+        if isinstance(valor, XlError):
+            return valor
+        numeros.append(valor)
+    return numeros
+
+
+@_function("SUM")
+def _sum(ev, args):
+    numeros = _numbers(ev, args)
+    return numeros if isinstance(numeros, XlError) else sum(numeros)
+
+
+@_function("MAX")
+def _max(ev, args):
+    numeros = _numbers(ev, args)
+    return numeros if isinstance(numeros, XlError) else max(numeros, default=0)
+
+
+@_function("MIN")
+def _min(ev, args):
+    numeros = _numbers(ev, args)
+    return numeros if isinstance(numeros, XlError) else min(numeros, default=0)
+
+
+@_function("AVERAGE")
+def _average(ev, args):
+    numeros = _numbers(ev, args)
+    if isinstance(numeros, XlError):
+        return numeros
+    return sum(numeros) / len(numeros) if numeros else DIV0
+
+
+@_function("COUNT")
+def _count(ev, args):
+    return sum(1 for valor in ev.aggregate(args) if _is_number(valor))
+
+
+@_function("COUNTA")
+def _counta(ev, args):
+    total = 0
+    for arg in args:
+        valor = ev.eval(arg)
+        valores = valor.values() if isinstance(valor, _Array) else (valor,)
+        total += sum(1 for v in valores if v is not None and v is not _MISSING)
+    return total
+
+
+def _logical(ev: _Evaluator, args):
+    """Valores lógicos de AND/OR: en rangos se ignoran texto y vacíos"""
+    valores = []
+    for arg in args:
+        valor = ev.eval(arg)
+        if arg[0] in ("ref", "range") or isinstance(valor, _Array):
+            for v in (valor.values() if isinstance(valor, _Array) else (valor,)):
+                if isinstance(v, XlError):
+                    return v
+                if isinstance(v, bool) or _is_number(v):
+                    valores.append(bool(v))
+        elif valor is not _MISSING:
+            logico = to_bool(valor)
+            if isinstance(logico, XlError):
+                return logico
+            valores.append(logico)
+    return valores if valores else VALUE
+
+
+@_function("AND")
+def _and(ev, args):
+    valores = _logical(ev, args)
+    return valores if isinstance(valores, XlError) else all(valores)
+
+
+@_function("OR")
+def _or(ev, args):
+    valores = _logical(ev, args)
+    return valores if isinstance(valores, XlError) else any(valores)
+
+
+@_function("NOT")
+def _not(ev, args):
+    valor = to_bool(ev.eval(args[0]))
+    return valor if isinstance(valor, XlError) else not valor
+
+
+@_function("TRUE")
+def _true(ev, args):
+    return True
+
+
+@_function("FALSE")
+def _false(ev, args):
+    return False
+
+
+@_function("IF")
+def _if(ev, args):
+    condicion = to_bool(ev.eval(args[0]))
+    if isinstance(condicion, XlError):
+        return condicion
+    if condicion:
+        valor = ev.eval(args[1]) if len(args) > 1 else True
+    else:
+        valor = ev.eval(args[2]) if len(args) > 2 else False
+    return 0 if valor is _MISSING else valor
+
+
+@_function("IFERROR")
+def _iferror(ev, args):
+    valor = ev.eval(args[0])
+    if isinstance(valor, _Array):
+        valor = valor.first()
+    if isinstance(valor, XlError):
+        valor = ev.eval(args[1])
+    return 0 if valor is None or valor is _MISSING else valor
+
+
+@_function("ISBLANK")
+def _isblank(ev, args):
+    valor = ev.eval(args[0])
+    if isinstance(valor, _Array):
+        valor = valor.first()
+    return valor is None
+
+
+@_function("ISNUMBER")
+def _isnumber(ev, args):
+    valor = ev.eval(args[0])
+    return _is_number(valor.first() if isinstance(valor, _Array) else valor)
+
+
+@_function("ISTEXT")
+def _istext(ev, args):
+    valor = ev.eval(args[0])
+    return isinstance(valor.first() if isinstance(valor, _Array) else valor, str)
+
+
+@_function("ISERROR")
+def _iserror(ev, args):
+    valor = ev.eval(args[0])
+    return isinstance(valor.first() if isinstance(valor, _Array) else valor, XlError)
+
+
+def _texts(ev: _Evaluator, args):
+    textos = []
+    for arg in args:
+        texto = to_text(ev.eval(arg))
+        if isinstance(texto, XlError):
+            return texto
+        textos.append(texto)
+    return textos
+
+
+def _int_arg(ev: _Evaluator, args, i: int, defecto: int):
+    if len(args) <= i:
+        return defecto
+    valor = ev.eval(args[i])
+    if valor is _MISSING:
+        return defecto
+    numero = to_number(valor)
+    if isinstance(numero, XlError):
+        return numero
+    return int(numero) if math.isfinite(numero) else NUM
+
+
+@_function("CONCATENATE")
+def _concatenate(ev, args):
+    textos = _texts(ev, args)
+    return textos if isinstance(textos, XlError) else "".join(textos)
+
+
+@_function("LEN")
+def _len(ev, args):
+    texto = to_text(ev.eval(args[0]))
+    return texto if isinstance(texto, XlError) else len(texto)
+
+
+def _make_side(derecha: bool):
+    def lado(ev, args):
+        texto = to_text(ev.eval(args[0]))
+        cantidad = _int_arg(ev, args, 1, 1)
+        for valor in (texto, cantidad):
+            if isinstance(valor, XlError):
+                return valor
+        if cantidad < 0:
+            return VALUE
+        if derecha:
+            return texto[len(texto) - cantidad:] if cantidad else ""
+        return texto[:cantidad]
+    return lado
+
+
+FUNCTIONS["LEFT"] = _make_side(False)
+FUNCTIONS["RIGHT"] = _make_side(True)
+
+
+@_function("MID")
+def _mid(ev, args):
+    texto = to_text(ev.eval(args[0]))
+    inicio = _int_arg(ev, args, 1, 1)
+    cantidad = _int_arg(ev, args, 2, 0)
+    for valor in (texto, inicio, cantidad):
+        if isinstance(valor, XlError):
+            return valor
+    if inicio < 1 or cantidad < 0:
+        return VALUE
+    return texto[inicio - 1:inicio - 1 + cantidad]
+
+
+@_function("FIND")
+def _find(ev, args):
+    buscado = to_text(ev.eval(args[0]))
+    texto = to_text(ev.eval(args[1]))
+    inicio = _int_arg(ev, args, 2, 1)
+    for valor in (buscado, texto, inicio):
+        if isinstance(valor, XlError):
+            return valor
+    if inicio < 1 or inicio > len(texto) + 1:
+        return VALUE
+    posicion = texto.find(buscado, inicio - 1)
+    return VALUE if posicion < 0 else posicion + 1
+
+
+@_function("VLOOKUP")
+def _vlookup(ev, args):
+    buscado = ev.eval(args[0])
+    if isinstance(buscado, _Array):
+        buscado = buscado.first()
+    if isinstance(buscado, XlError):
+        return buscado
+    tabla = ev.eval(args[1])
+    columna = _int_arg(ev, args, 2, 1)
+    if isinstance(tabla, XlError) or isinstance(columna, XlError):
+        return tabla if isinstance(tabla, XlError) else columna
+    if not isinstance(tabla, _Array):
+        return NA
+    aproximado = True
+    if len(args) > 3:
+        modo = ev.eval(args[3])
+        aproximado = False if modo is _MISSING else to_bool(modo)
+        if isinstance(aproximado, XlError):
+            return aproximado
+    if columna < 1 or any(columna > len(fila) for fila in tabla.rows):
+        return REF
+    encontrada = None
+    for fila in tabla.rows:
+        clave = fila[0]
+        if compare("=", clave, buscado) is True and _rank(clave) == _rank(buscado):
+            encontrada = fila
+            break
+        # Búsqueda aproximada (primera columna ordenada): la última fila <= buscado
+        if aproximado and clave is not None and _rank(clave) == _rank(buscado) \
+                and compare("<=", clave, buscado) is True:
+            encontrada = fila
+        elif aproximado and encontrada is not None:
+            break
+    if encontrada is None:
+        return NA
+    valor = encontrada[columna - 1]
+    return 0 if valor is None else valor
+
+
+@_function("ROUND")
+def _round(ev, args):
+    numero = to_number(ev.eval(args[0]))
+    digitos = _int_arg(ev, args, 1, 0)
+    for valor in (numero, digitos):
+        if isinstance(valor, XlError):
+            return valor
+    if not math.isfinite(numero):
+        return NUM
+    # Excel redondea la mitad alejándose de cero
+    try:
+        factor = 10.0 ** digitos
+        escalado = abs(numero) * factor + 0.5
+    except OverflowError:
+        return numero  # más decimales de los que tiene un float: queda igual
+    if not math.isfinite(escalado):
+        return numero
+    if factor == 0:
+        return 0
+    redondeado = math.floor(escalado) / factor
+    return math.copysign(redondeado, numero) if numero else 0
+
+
+@_function("ABS")
+def _abs(ev, args):
+    numero = to_number(ev.eval(args[0]))
+    return numero if isinstance(numero, XlError) else abs(numero)
+
+
+@_function("INT")
+def _int(ev, args):
+    numero = to_number(ev.eval(args[0]))
+    if isinstance(numero, XlError):
+        return numero
+    return math.floor(numero) if math.isfinite(numero) else NUM
+
+
+@_function("MOD")
+def _mod(ev, args):
+    numero, divisor = to_number(ev.eval(args[0])), to_number(ev.eval(args[1]))
+    for valor in (numero, divisor):
+        if isinstance(valor, XlError):
+            return valor
+    if divisor == 0:
+        return DIV0
+    cociente = numero / divisor
+    if not math.isfinite(cociente) or not math.isfinite(divisor):
+        return NUM
+    return numero - divisor * math.floor(cociente)
+
+
+# ---------- Modelo de la plantilla ----------
+
+def same_value(a, b) -> bool:
+    """Igualdad de valores de celda que distingue tipos (1 == 1.0, pero 1 != "1" != TRUE)"""
+    if _is_number(a) and _is_number(b):
+        return a == b
+    return type(a) is type(b) and a == b
+
+
+@dataclass
+class FormulaState:
+    """Entradas y valores de fórmulas de la última evaluación de una sesión"""
+    inputs: Dict[CellKey, Number] = field(default_factory=dict)
+    values: Dict[CellKey, object] = field(default_factory=dict)
+    stale: Set[CellKey] = field(default_factory=set)
+
+
+@dataclass
+class Recalculation:
+    changed_inputs: int = 0
+    evaluated: int = 0
+    skipped: int = 0       # no soportadas, en ciclo o dependientes de ellas
+    failed: int = 0        # el evaluador lanzó un error (queda en el log)
+
+
+class FormulaModel:
+    def __init__(self, template_path: str, analisis: TemplateAnalysis):
+        self.sha256 = analisis.sha256
+        self.formulas: Dict[CellKey, tuple] = {}         # árbol compilado por celda
+        self.unsupported: Dict[CellKey, str] = {}
+        self.precedents: Dict[CellKey, List[CellKey]] = {}  # fórmulas que lee cada fórmula
+        self.dependents: Dict[CellKey, List[CellKey]] = {}  # fórmulas que leen cada celda variable
+        self.values: Dict[CellKey, object] = {}          # valores guardados en la plantilla
+        self.chain: Dict[CellKey, int] = {}              # posición en calcChain.xml
+
+        with XlsxReader(template_path) as wb:
+            self.sheets = set(wb.sheetnames)
+            for hoja in wb.sheetnames:
+                celdas, _ = wb.read_sheet_values(hoja, serial_dates=True)
+                for row, col, valor in celdas:
+                    if valor is not None:
+                        if isinstance(valor, str) and valor in ERROR_CODES:
+                            valor = XlError(valor)
+                        self.values[(hoja, row, col)] = valor
+                self._compile_sheet(hoja, wb.read_sheet_formulas(hoja))
+            self.chain = {key: i for i, key in enumerate(wb.read_calc_chain())}
+
+        self._build_graph(analisis)
+
+    def approx_size(self) -> int:
+        """
+        Bytes aproximados en memoria: ~1 KB por fórmula (árbol, precedentes) y
+        ~110 bytes por entrada de los demás diccionarios (medido en SA_26)
+        """
+        fijas = len(self.formulas) + len(self.unsupported)
+        return 1024 * fijas + 110 * (len(self.dependents) + len(self.values) + len(self.chain))
+
+    def _compile_sheet(self, hoja: str, formulas):
+        # Las celdas de una fórmula compartida usan el árbol de la celda maestra
+        compartidas: Dict[int, tuple] = {}
+        errores_compartidas: Dict[int, str] = {}
+        for formula in formulas:
+            key = (hoja, formula.row, formula.col)
+            try:
+                if formula.kind == "shared" and not formula.text:
+                    if formula.shared_index in errores_compartidas:
+                        raise UnsupportedFormula(errores_compartidas[formula.shared_index])
+                    if formula.shared_index not in compartidas:
+                        raise UnsupportedFormula("Fórmula compartida sin celda maestra")
+                    self.formulas[key] = compartidas[formula.shared_index]
+                    continue
+                if formula.kind == "dataTable":
+                    raise UnsupportedFormula("Tabla de datos")
+                if formula.kind == "array" and formula.ref and ":" in formula.ref:
+                    raise UnsupportedFormula("Fórmula matricial de varias celdas")
+                arbol = compile_formula(formula.text, formula.row, formula.col)
+                self.formulas[key] = arbol
+                if formula.kind == "shared" and formula.shared_index is not None:
+                    compartidas[formula.shared_index] = arbol
+            except UnsupportedFormula as e:
+                self.unsupported[key] = str(e)
+                if formula.kind == "shared" and formula.text and formula.shared_index is not None:
+                    errores_compartidas[formula.shared_index] = str(e)
+
+    def _build_graph(self, analisis: TemplateAnalysis):
+        """Aristas entre celdas que pueden cambiar: fórmulas y celdas de entrada"""
+        variables: Dict[str, Dict[int, List[int]]] = {}
+        for hoja, row, col in list(self.formulas) + list(self.unsupported):
+            variables.setdefault(hoja, {}).setdefault(row, []).append(col)
+        for hoja, sheet in analisis.sheets.items():
+            filas = variables.setdefault(hoja, {})
+            for row, col in sheet.iter_input_cells():
+                filas.setdefault(row, []).append(col)
+
+        for key, arbol in self.formulas.items():
+            hoja, row, col = key
+            lee: Set[CellKey] = set()
+            for ref_hoja, f1, c1, f2, c2 in iter_references(arbol, hoja, row, col):
+                filas = variables.get(ref_hoja)
+                if not filas:
+                    continue
+                if (f2 - f1 + 1) < len(filas):
+                    candidatas = ((fila, filas.get(fila)) for fila in range(f1, f2 + 1))
+                else:
+                    candidatas = ((fila, cols) for fila, cols in filas.items() if f1 <= fila <= f2)
+                for fila, cols in candidatas:
+                    if cols:
+                        lee.update((ref_hoja, fila, c) for c in cols if c1 <= c <= c2)
+            lee.discard(key)
+            for celda in lee:
+                self.dependents.setdefault(celda, []).append(key)
+            self.precedents[key] = [celda for celda in lee if celda in self.formulas or celda in self.unsupported]
+
+    def _dirty(self, cambiadas: Iterable[CellKey], hojas: Set[str]) -> Set[CellKey]:
+        """Fórmulas de las hojas incluidas alcanzables desde las celdas que cambiaron"""
+        sucias: Set[CellKey] = set()
+        pendientes = list(cambiadas)
+        while pendientes:
+            for dependiente in self.dependents.get(pendientes.pop(), ()):
+                if dependiente[0] in hojas and dependiente not in sucias:
+                    sucias.add(dependiente)
+                    pendientes.append(dependiente)
+        return sucias
+
+    def _order(self, sucias: Set[CellKey]) -> Tuple[List[CellKey], Set[CellKey]]:
+        """
+        Orden topológico de las fórmulas sucias (recorriendo en el orden de
+        calcChain) y las que quedan en un ciclo
+        """
+        fin = len(self.chain)
+        raices = sorted(sucias, key=lambda key: (self.chain.get(key, fin), key))
+        orden: List[CellKey] = []
+        estado: Dict[CellKey, int] = {}  # 1 = en curso, 2 = lista
+        en_ciclo: Set[CellKey] = set()
+        for raiz in raices:
+            if raiz in estado:
+                continue
+            pila = [(raiz, iter(self.precedents.get(raiz, ())))]
+            estado[raiz] = 1
+            while pila:
+                key, precedentes = pila[-1]
+                for precedente in precedentes:
+                    if precedente not in sucias:
+                        continue
+                    marca = estado.get(precedente)
+                    if marca == 1:
+                        en_ciclo.add(precedente)
+                        en_ciclo.add(key)
+                    elif marca is None:
+                        estado[precedente] = 1
+                        pila.append((precedente, iter(self.precedents.get(precedente, ()))))
+                        break
+                else:
+                    pila.pop()
+                    estado[key] = 2
+                    orden.append(key)
+        return orden, en_ciclo
+
+    def recalculate(self, state: FormulaState, hojas: Iterable[str],
+                    cells_by_sheet: Dict[str, CellValues]) -> Recalculation:
+        """
+        Actualiza `state` con las entradas consolidadas y evalúa solo las
+        fórmulas afectadas por las entradas que cambiaron desde la última vez
+        (o respecto de la plantilla, si `state` está vacío).
+        """
+        hojas = set(hojas) & self.sheets
+        entradas: Dict[CellKey, Number] = {}
+        for hoja, celdas in cells_by_sheet.items():
+            for row, col, valor in celdas:
+                # Las sumas exactas (Decimal) se evalúan en doble precisión, como Excel
+                entradas[(hoja, row, col)] = float(valor) if isinstance(valor, Decimal) else valor
+
+        plantilla = self.values
+        anteriores = state.inputs
+        cambiadas = [
+            key for key in entradas.keys() | anteriores.keys()
+            if not same_value(entradas.get(key, plantilla.get(key)), anteriores.get(key, plantilla.get(key)))
+        ]
+        resumen = Recalculation(changed_inputs=len(cambiadas))
+        state.inputs = entradas
+
+        sucias = self._dirty(cambiadas, hojas)
+        orden, en_ciclo = self._order(sucias)
+        valores = state.values
+
+        def get(hoja: str, row: int, col: int):
+            key = (hoja, row, col)
+            if key in valores:
+                return valores[key]
+            if key in entradas:
+                return entradas[key]
+            return plantilla.get(key)
+
+        evaluador = _Evaluator(get, self.sheets)
+        for key in orden:
+            if key in self.unsupported or key in en_ciclo or any(
+                    p in state.stale for p in self.precedents.get(key, ()) if p in sucias):
+                # Sin valor confiable: se deja el de la plantilla
+                state.stale.add(key)
+                valores.pop(key, None)
+                resumen.skipped += 1
+                continue
+            try:
+                valores[key] = evaluador.evaluate_cell(self.formulas[key], *key)
+            except (ArithmeticError, TypeError, ValueError, RecursionError):
+                # Un caso que el evaluador no contempla no detiene la consolidación:
+                # la celda queda con el valor de la plantilla, como una no soportada
+                logger.warning("No se pudo evaluar %s!%s%d", key[0], get_column_letter(key[2]), key[1],
+                               exc_info=True)
+                state.stale.add(key)
+                valores.pop(key, None)
+                resumen.failed += 1
+                continue
+            state.stale.discard(key)
+            resumen.evaluated += 1
+        return resumen
+
+    def formula_cells(self, state: FormulaState, hojas: Iterable[str]) -> Dict[str, List[Tuple[int, int, object]]]:
+        """Valores de fórmulas a escribir por hoja: los que difieren de los guardados en la plantilla"""
+        hojas = set(hojas)
+        por_hoja: Dict[str, List[Tuple[int, int, object]]] = {}
+        for (hoja, row, col), valor in state.values.items():
+            if hoja in hojas and not same_value(valor, self.values.get((hoja, row, col))):
+                por_hoja.setdefault(hoja, []).append((row, col, valor))
+        return por_hoja
+
+    def numeric_values(self, state: FormulaState, hojas: Iterable[str]) -> Dict[str, List[Tuple[int, int, Number]]]:
+        """Valor numérico actual de cada fórmula de las hojas (el calculado o el de la plantilla)"""
+        hojas = set(hojas)
+        por_hoja: Dict[str, List[Tuple[int, int, Number]]] = {hoja: [] for hoja in hojas}
+        for key in self.formulas.keys() | self.unsupported.keys():
+            if key[0] not in hojas or key in state.stale:
+                continue
+            valor = state.values[key] if key in state.values else self.values.get(key)
+            if _is_number(valor):
+                por_hoja[key[0]].append((key[1], key[2], valor))
+        return por_hoja
+
+
+def get_formula_model(template_path: str, analisis: TemplateAnalysis) -> FormulaModel:
+    """Modelo de la plantilla, armado una vez por proceso y conservado en template_cache"""
+    return template_cache.get_or_build(
+        ("formulas", analisis.sha256), lambda: FormulaModel(template_path, analisis), FormulaModel.approx_size
+    )
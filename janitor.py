@@ -0,0 +1,198 @@
+"""
+Limpieza periódica de lo que vence: sesiones, archivos subidos, consolidados
+y cachés en disco.
+
+Un hilo por proceso despierta cada `interval` segundos, pero solo uno de
+todos los procesos trabaja a la vez (permiso en la base compartida). Cada
+pasada hace a lo sumo `batch` borrados de cada tipo, tomando primero lo
+que venció antes (índices por vencimiento en SQLite), así nunca recorre
+todo el estado de una vez:
+
+1. sesiones vencidas sin tareas activas, con sus archivos subidos
+2. sesiones inactivas de a una, mientras uploads/ supere su cuota
+3. consolidados vencidos, y los menos usados sobre la cuota de resultados
+4. archivos huérfanos (sin sesión ni resultado que los use) más viejos que
+   `orphan_grace`, por ejemplo de un proceso que se cortó a mitad de camino
+5. parciales de la caché sin uso por `partials_ttl`, y las menos usadas
+   sobre su cuota
+6. auditorías vencidas, y carpetas de derrame de tareas que ya no están
+   activas (de un proceso que se cortó)
+"""
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from audit_store import AuditStore
+from partial_cache import PartialCache
+from result_store import ResultStore
+from state_store import ACTIVE_STATUSES, StateStore
+
+logger = logging.getLogger(__name__)
+
+
+def _folder_size(folder: str) -> int:
+    total = 0
+    with os.scandir(folder) as entradas:
+        for entrada in entradas:
+            if entrada.is_file(follow_symlinks=False):
+                total += entrada.stat().st_size
+    return total
+
+
+class Janitor:
+    def __init__(self, store: StateStore, results: ResultStore, upload_folder: str, uploads_quota_bytes: int,
+                 interval: float = 300.0, batch: int = 100, orphan_grace: float = 3600.0,
+                 job_ttl: float = 24 * 3600.0,
+                 on_session_removed: Optional[Callable[[str, List[str]], None]] = None,
+                 partials: Optional[PartialCache] = None, partials_quota_bytes: int = 0,
+                 partials_ttl: float = 7 * 24 * 3600.0, audits: Optional[AuditStore] = None,
+                 spill_folder: Optional[str] = None):
+        self.store = store
+        self.results = results
+        self.upload_folder = upload_folder
+        self.uploads_quota_bytes = uploads_quota_bytes
+        self.interval = interval
+        self.batch = batch
+        self.orphan_grace = orphan_grace
+        self.job_ttl = job_ttl
+        # Recibe el session_id y las rutas de sus archivos (para borrarlos y olvidar sus totales)
+        self.on_session_removed = on_session_removed
+        self.partials = partials
+        self.partials_quota_bytes = partials_quota_bytes
+        self.partials_ttl = partials_ttl
+        self.audits = audits
+        # Una carpeta por tarea (su task_id) con las parciales derramadas a disco
+        self.spill_folder = spill_folder
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Arranca el hilo (idempotente; con interval <= 0 no se limpia en segundo plano)"""
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="janitor", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            self._stop.set()
+            if self._thread is not None:
+                self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                # El permiso dura algo más que una pasada: ningún otro proceso limpia a la vez
+                if self.store.acquire_lease("janitor", self.owner, self.interval * 2):
+                    self.run_once()
+            except Exception:
+                logger.exception("Error en la limpieza periódica")
+
+    def _remove_session(self, session_id: str) -> Tuple[int, int]:
+        """Borra la sesión y sus archivos; retorna (archivos, bytes liberados)"""
+        archivos = self.store.delete_session(session_id)
+        # Los libros de un mismo ZIP comparten la ruta
+        rutas = list(dict.fromkeys(info["path"] for info in archivos.values()))
+        liberado = 0
+        for ruta in rutas:
+            try:
+                liberado += os.path.getsize(ruta)
+            except OSError:
+                pass
+        if self.on_session_removed is not None:
+            self.on_session_removed(session_id, rutas)
+        return len(rutas), liberado
+
+    def _remove_orphans(self, folder: str, en_uso: Set[str], limite: float) -> int:
+        borrados = 0
+        with os.scandir(folder) as entradas:
+            for entrada in entradas:
+                if borrados >= self.batch:
+                    break
+                if not entrada.is_file(follow_symlinks=False) or entrada.name in en_uso:
+                    continue
+                try:
+                    if entrada.stat().st_mtime < limite:
+                        os.remove(entrada.path)
+                        borrados += 1
+                except OSError:
+                    pass
+        return borrados
+
+    def _remove_spill(self, limite: float) -> int:
+        """Carpetas de derrame más viejas que `limite` cuya tarea ya no está activa"""
+        if self.spill_folder is None or not os.path.isdir(self.spill_folder):
+            return 0
+        borradas = 0
+        with os.scandir(self.spill_folder) as entradas:
+            for entrada in entradas:
+                if borradas >= self.batch:
+                    break
+                try:
+                    if not entrada.is_dir(follow_symlinks=False) or entrada.stat().st_mtime >= limite:
+                        continue
+                except OSError:
+                    continue
+                tarea = self.store.get_job(entrada.name)
+                if tarea is not None and tarea["status"] in ACTIVE_STATUSES:
+                    continue
+                shutil.rmtree(entrada.path, ignore_errors=True)
+                borradas += 1
+        return borradas
+
+    def run_once(self, now: Optional[float] = None) -> Dict[str, int]:
+        """Una pasada de limpieza; retorna cuántas cosas se borraron de cada tipo"""
+        now = time.time() if now is None else now
+        limpiado = {"sessions": 0, "uploads": 0, "results": 0, "orphans": 0, "tasks": 0,
+                    "partials": 0, "audits": 0, "spill": 0}
+
+        for session_id in self.store.idle_sessions(expired_before=now, limit=self.batch):
+            limpiado["uploads"] += self._remove_session(session_id)[0]
+            limpiado["sessions"] += 1
+
+        if self.uploads_quota_bytes > 0:
+            exceso = _folder_size(self.upload_folder) - self.uploads_quota_bytes
+            # Primero las que vencen antes
+            for session_id in self.store.idle_sessions(limit=self.batch) if exceso > 0 else ():
+                logger.info("Sesión %s eliminada por cuota de uploads", session_id)
+                archivos, liberado = self._remove_session(session_id)
+                limpiado["uploads"] += archivos
+                limpiado["sessions"] += 1
+                exceso -= liberado
+                if exceso <= 0:
+                    break
+
+        borrados = self.results.expire(now, limit=self.batch) + self.results.enforce_quota()
+        if borrados:
+            self.store.delete_lineage(borrados)
+        limpiado["results"] += len(borrados)
+
+        limite = now - self.orphan_grace
+        subidas = {os.path.basename(path) for path in self.store.upload_paths()}
+        limpiado["orphans"] += self._remove_orphans(self.upload_folder, subidas, limite)
+        limpiado["orphans"] += self._remove_orphans(self.results.folder, self.results.known_files(), limite)
+
+        if self.partials is not None:
+            limpiado["partials"] += self.partials.evict(
+                self.partials_quota_bytes, expired_before=now - self.partials_ttl, limit=self.batch
+            )
+        if self.audits is not None:
+            limpiado["audits"] += self.audits.prune()
+        limpiado["spill"] += self._remove_spill(limite)
+
+        # jobs.created_at es un isoformat local
+        limpiado["tasks"] += self.store.delete_finished_jobs(datetime.fromtimestamp(now - self.job_ttl).isoformat())
+        if any(limpiado.values()):
+            logger.info("Limpieza: %s", " ".join(f"{tipo}={n}" for tipo, n in limpiado.items()))
+        return limpiado
@@ -0,0 +1,98 @@
+"""
+Pool acotado de hilos que ejecutan los trabajos de la cola persistente.
+
+Cada proceso de la API arranca `workers` hilos que toman trabajos de la
+base compartida; un hilo aparte renueva el latido de los trabajos propios y
+devuelve a la cola los de procesos que dejaron de responder (por ejemplo,
+tras un reinicio o un deploy). Con `memory_budget` un hilo solo toma un
+trabajo si su memoria estimada cabe junto a la de los que ya corren en el
+nodo (ver memory_budget).
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Callable, Dict, List
+
+from state_store import StateStore
+
+JobHandler = Callable[[str, Dict], None]
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorkerPool:
+    def __init__(self, store: StateStore, handler: JobHandler, workers: int,
+                 poll_interval: float = 1.0, stale_after: float = 60.0, memory_budget: int = 0):
+        self.store = store
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.memory_budget = memory_budget
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Arranca los hilos (idempotente)"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            self.store.requeue_stale(self.stale_after)
+            for i in range(self.workers):
+                hilo = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                hilo.start()
+                self._threads.append(hilo)
+            hilo = threading.Thread(target=self._keepalive, name="job-heartbeat", daemon=True)
+            hilo.start()
+            self._threads.append(hilo)
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            self._stop.set()
+            self._wake.set()
+            for hilo in self._threads:
+                hilo.join(timeout)
+            self._threads = []
+
+    def notify(self):
+        """Avisa que hay un trabajo nuevo en la cola"""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                trabajo = self.store.claim_job(self.owner, self.memory_budget)
+            except Exception as e:
+                logger.warning("No se pudo leer la cola de trabajos: %s", e)
+                trabajo = None
+            if trabajo is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            task_id, params = trabajo
+            try:
+                self.handler(task_id, params)
+            except Exception as e:
+                logger.exception("Error inesperado en la tarea %s", task_id)
+                self.store.update_job(task_id, status="error", error=f"Error inesperado: {e}")
+            if self.memory_budget > 0:
+                # Se liberó memoria: otro hilo puede tomar un trabajo que esperaba
+                self._wake.set()
+
+    def _keepalive(self):
+        while not self._stop.wait(self.stale_after / 3):
+            try:
+                self.store.heartbeat(self.owner)
+                reencoladas = self.store.requeue_stale(self.stale_after)
+                if reencoladas:
+                    logger.warning("%d tareas reencoladas (su proceso dejó de responder)", reencoladas)
+                    self._wake.set()
+            except Exception as e:
+                logger.warning("No se pudo renovar el latido de los trabajos: %s", e)
@@ -1,15 +1,55 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Form
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set, Tuple
 from pydantic import BaseModel
+import asyncio
+import hashlib
+import io
 import os
-import openpyxl
-from openpyxl.utils import get_column_letter
+import posixpath
 import shutil
+import threading
 from pathlib import Path
 import uuid
+import json
+import logging
+import math
+import time
 from datetime import datetime
+from collections import Counter
+
+from audit_store import AuditStore, InvalidCursor, change_filter, encode_change, iter_lines, parse_range
+from consolidation import CONSOLIDATION_EXACT, ConsolidationAccumulator, Partial, consolidate_partials, partial_cells
+from file_download import file_download
+from formula_engine import EVALUATE_FORMULAS, FormulaState, get_formula_model
+from janitor import Janitor
+from memory_budget import JOB_MEMORY_MB, MEMORY_BUDGET_MB, BoundedPartials, estimate_job_memory
+from job_queue import JobWorkerPool
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry, TaskTimings
+from offload import BlockingExecutor, ExecutorBusy, ExecutorTimeout
+from partial_cache import PartialCache
+from partial_format import InvalidAggregate, PartialAggregate, aggregate_filename, read_aggregate, \
+    read_aggregate_meta, write_aggregate
+from progress_stream import ProgressBroker, format_sse, task_updates
+from provenance import OUTLIER_THRESHOLD as PROVENANCE_OUTLIER_THRESHOLD, PROVENANCE_DEFAULT, ProvenanceIndex, \
+    provenance_filename, write_provenance
+from result_data import ResultDataCache, iter_csv, parse_data_ref, result_data_filename, select_cells, \
+    valid_result_id, write_result_data
+from result_store import ResultStore, consolidation_key
+from state_store import StateStore
+from template_checks import (
+    EXPECTED_VERSION, InvalidWorkbook, check_workbook, read_template_version, validate_files, write_audit
+)
+from upload_archive import ArchiveRejected, iter_archive_workbooks, workbook_source
+from template_analysis import file_sha256, get_template_analysis, template_cache
+from xlsx_writer import write_patched_workbook
+
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s"
+)
+logger = logging.getLogger("consolidador")
 
 app = FastAPI(title="Consolidador Excel API")
 
@@ -26,21 +66,146 @@ app.add_middleware(
 UPLOAD_FOLDER = "uploads"
 TEMPLATE_FOLDER = "templates"
 RESULTS_FOLDER = "results"
+ANALYSIS_FOLDER = os.path.join(TEMPLATE_FOLDER, "analysis")
+CACHE_FOLDER = os.path.join("cache", "partials")
+AUDIT_FOLDER = os.path.join("cache", "audits")
+# Parciales que una tarea derrama a disco al superar JOB_MEMORY_MB (una carpeta por tarea)
+SPILL_FOLDER = os.path.join("cache", "spill")
 ALLOWED_EXTENSIONS = {'xlsm', 'xlsx'}
+# Bytes copiados por vez al guardar una subida (el hash se calcula en la misma pasada)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Cuota de disco para los consolidados (MB); al superarla se borran los menos usados
+RESULTS_QUOTA_MB = int(os.environ.get("RESULTS_QUOTA_MB", "2048"))
+# Horas sin uso tras las que vencen un consolidado y una sesión (con sus archivos subidos)
+RESULTS_TTL_HOURS = float(os.environ.get("RESULTS_TTL_HOURS", "168"))
+SESSION_TTL_HOURS = float(os.environ.get("SESSION_TTL_HOURS", "24"))
+# Cuota de disco para los archivos subidos (MB); al superarla se borran las sesiones inactivas
+UPLOADS_QUOTA_MB = int(os.environ.get("UPLOADS_QUOTA_MB", "4096"))
+# Cuota (MB) y horas sin uso de la caché de parciales; se borran primero las menos usadas
+PARTIALS_QUOTA_MB = int(os.environ.get("PARTIALS_QUOTA_MB", "2048"))
+PARTIALS_TTL_HOURS = float(os.environ.get("PARTIALS_TTL_HOURS", "168"))
+# Limpieza en segundo plano: segundos entre pasadas (0 = desactivada) y borrados por pasada
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", "300"))
+JANITOR_BATCH = int(os.environ.get("JANITOR_BATCH", "100"))
+# Antigüedad desde la que un archivo sin sesión ni resultado que lo use se borra
+ORPHAN_GRACE_SECONDS = float(os.environ.get("ORPHAN_GRACE_SECONDS", "3600"))
+# Base SQLite compartida por todos los procesos (tareas, sesiones y plantilla)
+STATE_DB = os.environ.get("STATE_DB", "state.db")
+# Consolidaciones simultáneas por proceso y máximo de tareas en espera
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", "50"))
+# Trabajo bloqueante de los endpoints (lectura de libros, copias a disco),
+# fuera del event loop: por tipo, (concurrencia máxima, timeout en segundos)
+BLOCKING_LIMITS = {
+    "upload": (int(os.environ.get("UPLOAD_CONCURRENCY", "4")), float(os.environ.get("UPLOAD_TIMEOUT", "120"))),
+    "template": (1, float(os.environ.get("TEMPLATE_TIMEOUT", "120"))),
+    "validate": (int(os.environ.get("VALIDATE_CONCURRENCY", "2")), float(os.environ.get("VALIDATE_TIMEOUT", "60"))),
+    "audit": (int(os.environ.get("AUDIT_CONCURRENCY", "1")), float(os.environ.get("AUDIT_TIMEOUT", "120"))),
+    "audit_page": (4, 30.0),
+    "data": (4, 30.0),
+    "cleanup": (1, 300.0),
+}
+BLOCKING_WORKERS = int(os.environ.get("BLOCKING_WORKERS", str(sum(c for c, _ in BLOCKING_LIMITS.values()))))
+# Espera máxima por un cupo antes de responder 503
+BLOCKING_QUEUE_TIMEOUT = float(os.environ.get("BLOCKING_QUEUE_TIMEOUT", "30"))
+
+# Plantillas registradas que se cargan en memoria al arrancar (las usadas más recientemente)
+TEMPLATE_WARM_COUNT = int(os.environ.get("TEMPLATE_WARM_COUNT", "2"))
+
+# Auditorías guardadas para paginarlas (segundos que se conservan) y tamaño de página
+AUDIT_TTL_SECONDS = float(os.environ.get("AUDIT_TTL_SECONDS", "3600"))
+AUDIT_PAGE_LIMIT = 500
+AUDIT_PAGE_MAX = 5000
 
 # Crear directorios
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(TEMPLATE_FOLDER, exist_ok=True)
 os.makedirs(RESULTS_FOLDER, exist_ok=True)
+os.makedirs(ANALYSIS_FOLDER, exist_ok=True)
+
+# Caché de sumas parciales por archivo (hash del archivo + hash de plantilla)
+partial_cache = PartialCache(CACHE_FOLDER)
+
+# Cambios de cada auditoría (NDJSON) y su resumen por hoja
+audit_store = AuditStore(AUDIT_FOLDER, AUDIT_TTL_SECONDS)
+
+# Datos y procedencia de los consolidados (.npz) ya leídos, para las consultas
+result_data_cache = ResultDataCache()
+provenance_cache = ResultDataCache(loader=ProvenanceIndex)
+
+# Estado persistente: plantillas, sesiones ({fileId: {"path", "filename", "sha256"}})
+# y tareas, visible para todos los procesos de uvicorn
+state_store = StateStore(STATE_DB, SESSION_TTL_HOURS * 3600)
+
+# Consolidados ya generados, por clave de contenido (plantilla + archivos + hojas)
+result_store = ResultStore(state_store, RESULTS_FOLDER, RESULTS_QUOTA_MB * 1024 * 1024, RESULTS_TTL_HOURS * 3600)
+
+# Avisos de progreso a las conexiones SSE/WebSocket de este proceso
+progress_broker = ProgressBroker()
+
+# Métricas Prometheus de este proceso (GET /metrics)
+metrics = Registry()
+tasks_total = metrics.counter(
+    "consolidador_tasks_total", "Consolidaciones terminadas por estado", ["status"])
+task_seconds = metrics.histogram(
+    "consolidador_task_seconds", "Duración total de una consolidación")
+queue_wait_seconds = metrics.histogram(
+    "consolidador_queue_wait_seconds", "Tiempo en cola antes de empezar a procesar")
+stage_seconds = metrics.histogram(
+    "consolidador_stage_seconds", "Duración de cada etapa de una consolidación", ["stage"])
+file_parse_seconds = metrics.histogram(
+    "consolidador_file_parse_seconds", "Tiempo de lectura de un archivo a suma parcial")
+files_total = metrics.counter(
+    "consolidador_files_total", "Archivos por origen de la parcial", ["source"])
+cells_parsed_total = metrics.counter(
+    "consolidador_cells_parsed_total", "Celdas numéricas leídas de archivos")
+bytes_parsed_total = metrics.counter(
+    "consolidador_bytes_parsed_total", "Bytes de archivos leídos")
+upload_bytes_total = metrics.counter(
+    "consolidador_upload_bytes_total", "Bytes recibidos en subidas", ["kind"])
+uploads_rejected_total = metrics.counter(
+    "consolidador_uploads_rejected_total", "Archivos de sesión rechazados al subirlos")
+results_reused_total = metrics.counter(
+    "consolidador_results_reused_total", "Consolidaciones respondidas con un resultado existente")
+formulas_failed_total = metrics.counter(
+    "consolidador_formulas_failed_total", "Fórmulas que el evaluador no pudo calcular (error en el log)")
+rejected_total = metrics.counter(
+    "consolidador_rejected_total", "Consolidaciones rechazadas por cola llena")
+blocking_seconds = metrics.histogram(
+    "consolidador_blocking_seconds", "Duración del trabajo bloqueante de los endpoints", ["kind"])
+blocking_wait_seconds = metrics.histogram(
+    "consolidador_blocking_wait_seconds", "Espera por un cupo del pool bloqueante", ["kind"])
+blocking_rejected_total = metrics.counter(
+    "consolidador_blocking_rejected_total", "Peticiones sin cupo o que superaron su timeout", ["kind", "reason"])
+metrics.gauge(
+    "consolidador_queue_depth", "Tareas en cola (todas las instancias)",
+    lambda: state_store.count_jobs("queued"))
+metrics.gauge(
+    "consolidador_active_tasks", "Tareas en proceso (todas las instancias)",
+    lambda: state_store.count_jobs("processing"))
+metrics.gauge(
+    "consolidador_sessions", "Sesiones con archivos subidos",
+    lambda: state_store.count_sessions())
+metrics.gauge(
+    "consolidador_template_cache_bytes", "Memoria estimada de análisis y modelos de plantillas en caché",
+    lambda: template_cache.stats()["bytes"])
+metrics.gauge(
+    "consolidador_memory_reserved_bytes", "Memoria estimada de las tareas en proceso en este nodo",
+    lambda: state_store.node_memory_reserved(job_workers.owner))
+
+def _observe_blocking(kind: str, espera: float, segundos: float):
+    blocking_wait_seconds.observe(espera, kind=kind)
+    blocking_seconds.observe(segundos, kind=kind)
+
+# Pool acotado para el trabajo bloqueante de los endpoints
+blocking_executor = BlockingExecutor(
+    BLOCKING_WORKERS, BLOCKING_LIMITS, queue_timeout=BLOCKING_QUEUE_TIMEOUT, observer=_observe_blocking,
+    process_workers=BLOCKING_LIMITS["audit"][0]
+)
 
-# Estado global de la aplicación
+# Estado en memoria de este proceso
 app_state = {
-    "template_path": None,
-    "template_name": None,
-    "template_id": None,
-    "sheet_names": [],
-    "uploaded_files": {},  # {sessionId: [file_paths]}
-    "tasks": {}  # {taskId: task_info}
+    "session_totals": {},  # {sessionId: totales de la última consolidación}
 }
 
 # Modelos Pydantic
@@ -48,6 +213,9 @@ class TemplateUploadResponse(BaseModel):
     template_id: str
     template_name: str
     sheet_names: List[str]
+    template_version: str = ""
+    template_hash: str = ""
+    cached: bool = False  # ya estaba registrada una plantilla con el mismo contenido
 
 class ConsolidateProcessRequest(BaseModel):
     session_id: str
@@ -55,136 +223,690 @@ class ConsolidateProcessRequest(BaseModel):
 
 class TaskStatusResponse(BaseModel):
     task_id: str
-    status: str  # "processing", "completed", "error"
+    status: str  # "queued", "processing", "completed", "error"
     progress: int
     current_file: str
     status_message: str
+    queue_position: Optional[int] = None
     result_id: Optional[str] = None
     error: Optional[str] = None
+    metrics: Optional[Dict] = None  # tiempos por etapa y por archivo (al terminar)
 
 def allowed_file(filename: str) -> bool:
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(".zip")
+
+def copy_upload(file: UploadFile, path: str, kind: str = "file"):
+    """Copia una subida por bloques calculando su SHA-256 en la misma pasada; retorna (sha256, bytes)"""
+    digest = hashlib.sha256()
+    tamano = 0
+    with open(path, "wb") as buffer:
+        for chunk in iter(lambda: file.file.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            buffer.write(chunk)
+            tamano += len(chunk)
+    upload_bytes_total.inc(tamano, kind=kind)
+    return digest.hexdigest(), tamano
+
+def save_session_file(session_id: str, file: UploadFile, file_id: Optional[str] = None,
+                      expected_sheets: Optional[List[str]] = None):
+    """
+    Guarda un archivo subido en la sesión y retorna (file_id, registro).
+    Se copia por bloques calculando el SHA-256 en la misma pasada y se revisa
+    antes de reemplazar el destino: si no es un libro válido (o le faltan
+    hojas de la plantilla) se descarta y se lanza InvalidWorkbook.
+    """
+    file_id = file_id or uuid.uuid4().hex[:8]
+    file_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_{file_id}_{file.filename}")
+    temp_path = f"{file_path}.part"
+    
+    sha256, tamano = copy_upload(file, temp_path)
+    try:
+        check_workbook(temp_path, expected_sheets)
+    except InvalidWorkbook:
+        remove_upload(temp_path)
+        raise
+    os.replace(temp_path, file_path)
+    
+    return file_id, {
+        "path": file_path,
+        "filename": file.filename,
+        "sha256": sha256,
+        "size": tamano
+    }
+
+def save_session_archive(session_id: str, file: UploadFile, expected_sheets: Optional[List[str]] = None):
+    """
+    Guarda un ZIP de libros en la sesión. Cada libro queda como referencia al
+    miembro (no se extrae a disco) con su carpeta dentro del ZIP como
+    procedencia; se descomprime de a uno en memoria para el hash y la
+    revisión. Retorna ({file_id: registro}, rechazados) o lanza ArchiveRejected.
+    """
+    # El nombre original no va en la ruta: así no puede contener MEMBER_SEPARATOR
+    archive_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_{uuid.uuid4().hex[:8]}.zip")
+    copy_upload(file, archive_path, kind="archive")
+    
+    guardados = {}
+    rechazados = []
+    try:
+        for member, datos, motivo in iter_archive_workbooks(archive_path):
+            procedencia = {
+                "filename": posixpath.basename(member),
+                "folder": posixpath.dirname(member),
+                "archive": file.filename
+            }
+            if motivo is None:
+                try:
+                    check_workbook(io.BytesIO(datos), expected_sheets)
+                except InvalidWorkbook as e:
+                    motivo = str(e)
+            if motivo is not None:
+                rechazados.append({**procedencia, "detail": motivo})
+                continue
+            guardados[uuid.uuid4().hex[:8]] = {
+                "path": archive_path,
+                "member": member,
+                **procedencia,
+                "sha256": hashlib.sha256(datos).hexdigest(),
+                "size": len(datos)
+            }
+    except BaseException:
+        remove_upload(archive_path)
+        raise
+    if not guardados:
+        remove_upload(archive_path)
+    return guardados, rechazados
+
+async def save_session_files(session_id: str, files: List[UploadFile], hojas: Optional[List[str]]):
+    """
+    Guarda los archivos permitidos de una subida (libros o ZIP de libros),
+    revisando que tengan las `hojas` de la plantilla si se indican.
+    Retorna ({file_id: registro}, [{"filename", "detail", ...}] de los rechazados).
+    """
+    guardados = {}
+    rechazados = []
+    for file in files:
+        if not file or not file.filename:
+            continue
+        if is_archive(file.filename):
+            try:
+                agregados, descartados = await run_blocking("upload", save_session_archive, session_id, file, hojas)
+            except ArchiveRejected as e:
+                agregados, descartados = {}, [{"filename": file.filename, "detail": str(e)}]
+            guardados.update(agregados)
+            rechazados.extend(descartados)
+            uploads_rejected_total.inc(len(descartados))
+            continue
+        if not allowed_file(file.filename):
+            continue
+        try:
+            file_id, info = await run_blocking("upload", save_session_file, session_id, file, None, hojas)
+        except InvalidWorkbook as e:
+            uploads_rejected_total.inc()
+            rechazados.append({"filename": file.filename, "detail": str(e)})
+            continue
+        guardados[file_id] = info
+    return guardados, rechazados
+
+def release_upload(session_id: str, file_path: str):
+    """Borra un archivo subido si ningún archivo de la sesión lo usa (un ZIP lo comparten sus libros)"""
+    archivos = state_store.get_session(session_id) or {}
+    if not any(info["path"] == file_path for info in archivos.values()):
+        remove_upload(file_path)
+
+def rejected_detail(mensaje: str, rechazados: List[Dict]) -> str:
+    if not rechazados:
+        return mensaje
+    return f"{mensaje}. Rechazados: " + "; ".join(f"{r['filename']} ({r['detail']})" for r in rechazados)
+
+def remove_upload(file_path: str):
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    except:
+        pass
+
+def remove_uploads(file_paths: List[str]):
+    for file_path in file_paths:
+        remove_upload(file_path)
+
+async def run_blocking(kind: str, func, *args):
+    """
+    Ejecuta `func(*args)` en el pool bloqueante sin detener el event loop.
+    Responde 503 si no hay cupo para el tipo de trabajo y 504 si supera su timeout.
+    """
+    try:
+        return await blocking_executor.run(kind, func, *args)
+    except ExecutorBusy:
+        blocking_rejected_total.inc(kind=kind, reason="busy")
+        raise HTTPException(
+            status_code=503,
+            detail="El servidor está procesando demasiadas solicitudes de este tipo. Intente nuevamente más tarde.",
+            headers={"Retry-After": str(math.ceil(BLOCKING_QUEUE_TIMEOUT))}
+        )
+    except ExecutorTimeout as e:
+        blocking_rejected_total.inc(kind=kind, reason="timeout")
+        raise HTTPException(
+            status_code=504,
+            detail=f"La operación superó el tiempo máximo de {e.timeout:g} segundos"
+        )
+
+def current_template() -> Dict:
+    """Plantilla por defecto ({"template_path", "template_name", ...}) o {} si no hay"""
+    return state_store.get_template() or {}
+
+def resolve_template(template_id: Optional[str] = None, template_version: Optional[str] = None) -> Dict:
+    """
+    Plantilla registrada con ese template_id o esa versión (texto de A9) o,
+    si no se indica ninguna, la plantilla por defecto. 404 si la pedida no
+    está registrada y 400 si no hay plantilla.
+    """
+    if template_id:
+        plantilla = state_store.get_template_record(template_id)
+        if plantilla is None:
+            raise HTTPException(status_code=404, detail=f"No se encontró la plantilla {template_id}")
+    elif template_version:
+        plantilla = state_store.find_template_by_version(template_version.strip())
+        if plantilla is None:
+            raise HTTPException(
+                status_code=404, detail=f"No hay una plantilla registrada con la versión '{template_version}'"
+            )
+    else:
+        plantilla = current_template()
+    if not plantilla.get("template_path") or not os.path.exists(plantilla["template_path"]):
+        raise HTTPException(
+            status_code=400,
+            detail="No hay plantilla cargada. Primero sube una plantilla usando POST /api/template/upload"
+        )
+    return plantilla
+
+def session_template_sheets(template_id: Optional[str]) -> Optional[List[str]]:
+    """Hojas contra las que se revisan las subidas: las de la plantilla indicada o las de la por defecto"""
+    if template_id:
+        return resolve_template(template_id)["sheet_names"]
+    return current_template().get("sheet_names")
+
+def template_info(plantilla: Dict) -> Dict:
+    """Registro de una plantilla para las respuestas (sin la ruta en disco)"""
+    return {
+        "template_id": plantilla["template_id"],
+        "template_name": plantilla["template_name"],
+        "template_version": plantilla.get("template_version", ""),
+        "template_hash": plantilla["template_hash"],
+        "sheet_names": plantilla["sheet_names"],
+        "created_at": plantilla.get("created_at"),
+        "last_used": plantilla.get("last_used"),
+        "default": plantilla["template_id"] == current_template().get("template_id"),
+    }
+
 def update_task_progress(task_id: str, progress: int, current_file: str = "", message: str = ""):
-    if task_id in app_state["tasks"]:
-        app_state["tasks"][task_id].update({
-            "progress": progress,
-            "current_file": current_file,
-            "status_message": message
-        })
+    state_store.update_job(task_id, progress=progress, current_file=current_file, status_message=message)
+    progress_broker.publish(task_id)
 
 def mark_task_complete(task_id: str, result_id: str):
-    if task_id in app_state["tasks"]:
-        app_state["tasks"][task_id].update({
-            "status": "completed",
-            "progress": 100,
-            "result_id": result_id
-        })
+    state_store.update_job(
+        task_id, status="completed", progress=100, result_id=result_id, finished_at=time.time()
+    )
+    progress_broker.publish(task_id)
 
 def mark_task_error(task_id: str, error_msg: str):
-    if task_id in app_state["tasks"]:
-        app_state["tasks"][task_id].update({
-            "status": "error",
-            "error": error_msg
-        })
+    state_store.update_job(task_id, status="error", error=error_msg, finished_at=time.time())
+    progress_broker.publish(task_id)
+
+def get_task_status(task_id: str) -> Optional[Dict]:
+    """Estado público de una tarea (el de TaskStatusResponse) o None si no existe"""
+    task_info = state_store.get_job(task_id)
+    if task_info is None:
+        return None
+    return TaskStatusResponse(
+        task_id=task_info["task_id"],
+        status=task_info["status"],
+        progress=task_info["progress"],
+        current_file=task_info["current_file"],
+        status_message=task_info["status_message"],
+        queue_position=state_store.queue_position(task_id) if task_info["status"] == "queued" else None,
+        result_id=task_info["result_id"],
+        error=task_info["error"],
+        metrics=json.loads(task_info["metrics"]) if task_info["metrics"] else None
+    ).model_dump()
+
+def _collect_partials(task_id: str, archivos: List[Dict], hojas: List[str], template_path: str,
+                      template_hash: str, exact: bool, tiempos: TaskTimings, parciales: BoundedPartials):
+    """
+    Obtiene la parcial de cada archivo (por hash): desde la caché si ya fue
+    leído con esta plantilla, o leyéndolo con el map/reduce y cacheándolo.
+    De un archivo ya leído con menos hojas solo se leen las que faltan.
+    Registra en `tiempos` el tiempo, las celdas y los bytes de cada archivo.
+    Las parciales se guardan en `parciales` (que derrama a disco sobre el
+    presupuesto de la tarea). Retorna ({sha256: parcial}, [(ruta, error)]).
+    """
+    por_leer = {}
+    faltantes: Dict[str, List[str]] = {}
+    previas: Dict[str, Partial] = {}
+    for info in archivos:
+        sha = info["sha256"]
+        if sha in parciales or sha in por_leer:
+            continue
+        parcial, faltan = partial_cache.get_with_missing(sha, template_hash, hojas, exact)
+        if not faltan:
+            parciales[sha] = parcial
+            tiempos.add_file(
+                filename=info["filename"], sha256=sha, source="cache",
+                seconds=0.0, cells=partial_cells(parcial), bytes=None, error=None
+            )
+            files_total.inc(source="cache")
+        else:
+            por_leer[sha] = info
+            faltantes[sha] = faltan
+            previas[sha] = parcial
+    
+    # Ruta de cada libro (o ZIP + miembro, ver upload_archive)
+    hash_por_ruta = {workbook_source(info["path"], info.get("member")): sha for sha, info in por_leer.items()}
+    
+    def registrar_archivo(file_path: str, parcial, error: Optional[str], segundos: float):
+        sha = hash_por_ruta[file_path]
+        info = por_leer[sha]
+        tamano = info.get("size")
+        if tamano is None:
+            try:
+                tamano = os.path.getsize(file_path)
+            except OSError:
+                pass
+        celdas = partial_cells(parcial) if parcial is not None else 0
+        tiempos.add_file(
+            filename=info["filename"], sha256=sha, source="parsed" if error is None else "error",
+            seconds=round(segundos, 4), cells=celdas, bytes=tamano, error=error
+        )
+        files_total.inc(source="parsed" if error is None else "error")
+        file_parse_seconds.observe(segundos)
+        cells_parsed_total.inc(celdas)
+        bytes_parsed_total.inc(tamano or 0)
+        if error is not None:
+            logger.warning("Tarea %s: error procesando %s: %s", task_id, info["filename"], error)
+            return
+        # Las hojas leídas ahora no se cruzan con las que venían de la caché
+        parciales[sha] = {**previas[sha], **parcial}
+        try:
+            partial_cache.put(sha, template_hash, faltantes[sha], parcial, exact)
+        except Exception as e:
+            logger.warning("Tarea %s: no se pudo cachear %s: %s", task_id, info["filename"], e)
+    
+    # Un map/reduce por cada conjunto de hojas faltantes (normalmente uno solo)
+    grupos: Dict[Tuple[str, ...], List[str]] = {}
+    for ruta, sha in hash_por_ruta.items():
+        grupos.setdefault(tuple(faltantes[sha]), []).append(ruta)
+    errores = []
+    leidos = 0
+    for faltan, rutas in grupos.items():
+        def reportar_archivo(n: int, total: int, filename: str, inicio: int = leidos):
+            update_task_progress(
+                task_id,
+                int(5 + (inicio + n) / len(hash_por_ruta) * 85),
+                filename,
+                f"Procesando archivo {inicio + n} de {len(hash_por_ruta)}"
+            )
+        
+        # Map/reduce: cada archivo se lee a una suma parcial (en paralelo
+        # según CONSOLIDATION_WORKERS)
+        _, errores_grupo = consolidate_partials(
+            rutas, list(faltan), template_path, template_hash, ANALYSIS_FOLDER,
+            exact=exact, on_progress=reportar_archivo, on_file=registrar_archivo, reduce=False
+        )
+        errores += errores_grupo
+        leidos += len(rutas)
+    return parciales, errores
+
 
-def consolidate_xlsm_files(task_id: str, template_path: str, file_paths: List[str], 
-                          output_path: str, included_sheets: List[str], result_id: str):
-    """Función que realiza la consolidación de archivos Excel"""
+def job_memory_estimate(plantilla: Dict, hojas: List[str], files: int, exact: bool, provenance: bool) -> int:
+    """Bytes que reservará la consolidación (cota: ningún archivo se reutiliza)"""
+    analisis = get_template_analysis(plantilla["template_path"], ANALYSIS_FOLDER, plantilla["template_hash"])
+    return estimate_job_memory(analisis, hojas, files, exact, provenance).reserved(JOB_MEMORY_MB * 1024 * 1024)
+
+
+def consolidate_xlsm_files(task_id: str, template_path: str, archivos: List[Dict], 
+                          output_path: str, included_sheets: List[str], result_id: str,
+                          template_hash: Optional[str] = None, exact: bool = False,
+                          session_id: Optional[str] = None, result_key: Optional[str] = None,
+                          data_path: Optional[str] = None, write_workbook: bool = True,
+                          provenance_path: Optional[str] = None, inputs: Optional[List[str]] = None):
+    """
+    Función que realiza la consolidación de archivos Excel.
+    
+    `inputs` son consolidados anteriores (result_id) que se suman como un
+    archivo más, desde su agregado guardado y sin releer sus libros. Todo
+    consolidado guarda su agregado y su linaje (ver partial_format y
+    StateStore.add_lineage) para servir de entrada a un nivel superior.
+    
+    Con JOB_MEMORY_MB las parciales que no caben en el presupuesto de la
+    tarea se derraman a disco (ver memory_budget).
+    
+    Además del xlsm se guardan los valores en `data_path` (ver result_data);
+    con `write_workbook=False` solo se guardan esos datos. Con
+    `provenance_path` se guarda además el aporte de cada archivo a cada celda.
+    `archivos` son los registros de la sesión ({"path", "filename", "sha256"}).
+    Si la sesión ya se consolidó con la misma plantilla, hojas y modo, solo se
+    restan las parciales de los archivos quitados y se suman las de los nuevos.
+    Si se indica `result_key` y se sumaron todos los archivos, el resultado queda registrado
+    para reutilizarlo cuando se pida la misma consolidación.
+    """
+    tiempos = TaskTimings()
+    sumar = None
+    inputs = inputs or []
+    # Los totales en memoria de la sesión no incluyen consolidados de entrada
+    sesion_totales = session_id if not inputs else None
     try:
         update_task_progress(task_id, 5, "Cargando plantilla", "Iniciando proceso...")
-        wb_plantilla = openpyxl.load_workbook(template_path, keep_vba=True)
+        # Análisis precompilado de la plantilla (celdas de fórmula y de entrada)
+        with tiempos.stage("template"):
+            analisis = get_template_analysis(template_path, ANALYSIS_FOLDER, template_hash)
+        
+        hojas = [hoja for hoja in included_sheets if hoja in analisis.sheets]
+        clave = (analisis.sha256, tuple(hojas), exact)
+        actuales = Counter(info["sha256"] for info in archivos)
         
-        hojas = [hoja for hoja in included_sheets if hoja in wb_plantilla.sheetnames]
+        # Se toman los totales de la sesión (otra tarea simultánea de la misma
+        # sesión no los encuentra y recalcula desde la caché)
+        previo = app_state["session_totals"].pop(sesion_totales, None) if sesion_totales else None
+        quitar = Counter()
+        # Los valores de fórmulas dependen solo de las entradas: sirven aunque las sumas se rehagan
+        formulas = previo.get("formulas") if previo is not None and previo["key"] == clave else None
+        if previo is not None and previo["key"] == clave:
+            quitar = previo["members"] - actuales
+            agregar = actuales - previo["members"]
+            miembros = previo["members"] - quitar
+        else:
+            previo = None
+            agregar = actuales
+            miembros = Counter()
         
-        # Identificar celdas con fórmulas
-        formula_cells = set()
-        for hoja in hojas:
-            ws = wb_plantilla[hoja]
-            for row in ws.iter_rows():
-                for cell in row:
-                    if cell.data_type == 'f':
-                        coord = f"{get_column_letter(cell.column)}{cell.row}"
-                        formula_cells.add(f"{hoja}||{coord}")
+        # Las parciales a restar solo pueden venir de la caché; si falta
+        # alguna se recalcula la sesión completa (también desde la caché).
+        # En punto flotante restar deja residuo, así que solo se resta en
+        # modo exacto y si no se vuelve a sumar lo cacheado
+        restar = {sha: partial_cache.get(sha, analisis.sha256, hojas, exact) for sha in quitar}
+        if (quitar and not exact) or any(parcial is None for parcial in restar.values()):
+            previo, restar, quitar = None, {}, Counter()
+            agregar, miembros = actuales, Counter()
         
-        # Diccionario para acumular sumas
-        sumas = {hoja: {} for hoja in hojas}
-        total_files = len(file_paths)
+        nuevos = [info for info in archivos if info["sha256"] in agregar]
+        estimacion = estimate_job_memory(analisis, hojas, len(nuevos), exact, provenance_path is not None)
+        spill_folder = os.path.join(SPILL_FOLDER, task_id)
+        # Restos de una ejecución anterior de la tarea (reencolada tras un corte)
+        shutil.rmtree(spill_folder, ignore_errors=True)
+        sumar = BoundedPartials(estimacion.spill_limit(JOB_MEMORY_MB * 1024 * 1024), spill_folder)
+        with tiempos.stage("partials"):
+            sumar, errores = _collect_partials(
+                task_id, nuevos, hojas, template_path, analisis.sha256, exact, tiempos, sumar
+            )
+        if inputs:
+            with tiempos.stage("inputs"):
+                entradas = [
+                    (entrada, load_input_aggregate(entrada, analisis.sha256, exact, hojas)) for entrada in inputs
+                ]
+        else:
+            entradas = []
         
-        # Procesar cada archivo
-        for i, file_path in enumerate(file_paths):
-            try:
-                filename = os.path.basename(file_path)
-                update_task_progress(
-                    task_id,
-                    int(5 + (i + 1) / total_files * 85), 
-                    filename, 
-                    f"Procesando archivo {i + 1} de {total_files}"
-                )
-                
-                wb = openpyxl.load_workbook(file_path, data_only=True)
-                
-                for hoja in hojas:
-                    if hoja not in wb.sheetnames:
-                        continue
-                    
-                    ws = wb[hoja]
-                    for row in ws.iter_rows():
-                        for cell in row:
-                            coord = f"{get_column_letter(cell.column)}{cell.row}"
-                            cell_key = f"{hoja}||{coord}"
-                            
-                            if isinstance(cell.value, (int, float)) and cell_key not in formula_cells:
-                                if coord in sumas[hoja]:
-                                    sumas[hoja][coord] += cell.value
-                                else:
-                                    sumas[hoja][coord] = cell.value
-                
-                wb.close()
-                
-            except Exception as e:
-                print(f"Error procesando {file_path}: {e}")
-                continue
+        # Acumulación densa por hoja (float64, o Decimal en modo exacto)
+        with tiempos.stage("accumulate"):
+            sumas = previo["sumas"] if previo is not None else ConsolidationAccumulator(analisis, hojas, exact)
+            for sha, veces in quitar.items():
+                for _ in range(veces):
+                    sumas.add_partial(restar[sha], -1)
+            for sha, veces in agregar.items():
+                if sha not in sumar:
+                    continue  # archivo con error: se reintenta en la próxima ejecución
+                for _ in range(veces):
+                    sumas.add_partial(sumar[sha])
+                miembros[sha] += veces
+            for _, agregado in entradas:
+                sumas.add_partial(agregado.sheets)
+        
+        celdas = {hoja: list(sumas.iter_cells(hoja)) for hoja in hojas}
+        
+        if provenance_path:
+            with tiempos.stage("provenance"):
+                aportes = provenance_contributions(archivos, miembros, sumar, analisis.sha256, hojas, exact)
+                if aportes is not None:
+                    # Cada consolidado de entrada aporta como un archivo
+                    aportes += [
+                        ({"filename": f"resultado {entrada}", "sha256": entrada}, agregado.sheets)
+                        for entrada, agregado in entradas
+                    ]
+                if aportes is None:
+                    logger.warning("Tarea %s: faltan parciales en caché, no se registra la procedencia", task_id)
+                    provenance_path = None
+                else:
+                    write_provenance(provenance_path, aportes, analisis, hojas)
+        
+        # Fórmulas afectadas por las entradas que cambiaron desde la última
+        # consolidación de la sesión (o respecto de la plantilla)
+        calculadas = None
+        if EVALUATE_FORMULAS:
+            update_task_progress(task_id, 92, "Calculando fórmulas", "Evaluando fórmulas afectadas...")
+            with tiempos.stage("formulas"):
+                modelo = get_formula_model(template_path, analisis)
+                formulas = formulas if formulas is not None else FormulaState()
+                recalculo = modelo.recalculate(formulas, hojas, celdas)
+                calculadas = modelo.formula_cells(formulas, hojas)
+            tiempos.counts.update({
+                "inputs_changed": recalculo.changed_inputs,
+                "formulas_evaluated": recalculo.evaluated,
+                "formulas_skipped": recalculo.skipped,
+                "formulas_failed": recalculo.failed,
+            })
+            formulas_failed_total.inc(recalculo.failed)
         
-        # Aplicar sumas a la plantilla
+        if sesion_totales:
+            app_state["session_totals"][sesion_totales] = {
+                "key": clave, "members": miembros, "sumas": sumas, "formulas": formulas
+            }
+        
+        # Aplicar sumas parchando el XML de la plantilla (sin cargarla en openpyxl)
         update_task_progress(task_id, 95, "Generando resultado", "Aplicando sumas a la plantilla...")
-        for hoja in hojas:
-            if hoja not in wb_plantilla.sheetnames:
-                continue
-            
-            ws = wb_plantilla[hoja]
-            for coord, valor in sumas[hoja].items():
-                cell_key = f"{hoja}||{coord}"
-                if cell_key not in formula_cells:
-                    try:
-                        ws[coord].value = valor
-                    except:
-                        continue
         
         # Guardar con la extensión correcta
         if template_path.endswith('.xlsm'):
             output_path = output_path.replace('.xlsx', '.xlsm')
         
-        wb_plantilla.save(output_path)
-        wb_plantilla.close()
+        if data_path:
+            with tiempos.stage("data"):
+                valores = modelo.numeric_values(formulas, hojas) if calculadas is not None else {}
+                write_result_data(data_path, {hoja: celdas[hoja] + valores.get(hoja, []) for hoja in hojas})
+        
+        if write_workbook:
+            with tiempos.stage("write"):
+                faltantes = write_patched_workbook(template_path, output_path, celdas, calculadas)
+            if faltantes:
+                logger.warning("Tarea %s: %d celdas no existen en la plantilla y no se escribieron", task_id, faltantes)
+        else:
+            output_path = data_path
+        
+        # Sumas y conteos por celda, para usar el resultado como entrada de otra consolidación
+        aggregate_path = os.path.join(RESULTS_FOLDER, aggregate_filename(result_id))
+        with tiempos.stage("aggregate"):
+            write_aggregate(aggregate_path, PartialAggregate(
+                analisis.sha256, exact, {hoja: analisis.sheets[hoja].max_col for hoja in hojas}, sumas.to_partial(),
+                files=list(miembros.elements()) + [sha for _, agregado in entradas for sha in agregado.files],
+                errors=[(os.path.basename(ruta), error) for ruta, error in errores]
+                + [error for _, agregado in entradas for error in agregado.errors],
+            ))
+        sumar.sample_rss()
+        
+        # Todo resultado queda en el índice (para descargarlo y que venza), pero
+        # uno con archivos fallidos no representa la clave completa
+        desalojados = result_store.add(
+            result_key if miembros == actuales else None, result_id, os.path.basename(output_path),
+            data_path and os.path.basename(data_path), provenance_path and os.path.basename(provenance_path),
+            os.path.basename(aggregate_path)
+        )
+        for desalojado in desalojados:
+            logger.info("Resultado %s eliminado por cuota de disco", desalojado)
+        if desalojados:
+            state_store.delete_lineage(desalojados)
+        # Cómo se armó, para rehacerlo si cambia una de sus entradas
+        state_store.add_lineage(result_id, {
+            "template_hash": analisis.sha256,
+            "included_sheets": included_sheets,
+            "exact": exact,
+            "write_workbook": write_workbook,
+            "provenance": provenance_path is not None,
+            "session_id": session_id,
+            "archivos": archivos,
+        }, inputs)
         
+        tiempos.counts.update({
+            "files_total": len(archivos),
+            "files_reused": len(archivos) - len(nuevos),
+            "files_failed": len(errores),
+            "inputs_total": len(entradas),
+            "cells_written": sum(len(celdas[hoja]) for hoja in hojas),
+            "output_bytes": os.path.getsize(output_path),
+            "memory_estimate_bytes": estimacion.reserved(JOB_MEMORY_MB * 1024 * 1024),
+            **sumar.stats(),
+        })
+        _record_task_metrics(task_id, tiempos, "completed")
         update_task_progress(task_id, 100, "Completado", "Archivo consolidado listo para descargar")
         mark_task_complete(task_id, result_id)
         
-        # Limpiar archivos temporales subidos
-        for file_path in file_paths:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except:
-                pass
-        
         return True
     
     except Exception as e:
-        print(f"Error en consolidación: {e}")
+        logger.exception("Tarea %s: error en consolidación", task_id)
+        if sesion_totales:
+            # Los totales pueden haber quedado a medio actualizar
+            app_state["session_totals"].pop(sesion_totales, None)
+        _record_task_metrics(task_id, tiempos, "error")
         mark_task_error(task_id, f"Error durante la consolidación: {str(e)}")
         return False
+    
+    finally:
+        if sumar is not None:
+            sumar.close()
+
+
+def load_input_aggregate(result_id: str, template_hash: str, exact: bool, hojas: List[str]) -> PartialAggregate:
+    """Agregado guardado de un consolidado de entrada; ValueError si ya no está o no combina"""
+    entrada = result_store.get(result_id)
+    if entrada is None or not entrada.get("aggregate_filename"):
+        raise ValueError(f"El resultado de entrada {result_id} ya no está disponible")
+    agregado = read_aggregate(os.path.join(RESULTS_FOLDER, entrada["aggregate_filename"]))
+    if agregado.template_hash != template_hash or agregado.exact != exact:
+        raise ValueError(f"El resultado de entrada {result_id} es de otra plantilla o modo de suma")
+    faltantes = [hoja for hoja in hojas if hoja not in agregado.max_cols]
+    if faltantes:
+        raise ValueError(f"El resultado de entrada {result_id} no incluye las hojas {', '.join(faltantes)}")
+    return agregado
+
+
+def provenance_contributions(archivos: List[Dict], miembros: Counter, sumar: Dict, template_hash: str,
+                             hojas: List[str], exact: bool) -> Optional[List]:
+    """
+    [(registro, parcial)] de cada archivo sumado, con las parciales recién
+    leídas o las de la caché; None si alguna ya no está en caché
+    """
+    aportes = []
+    for info in archivos:
+        if info["sha256"] not in miembros:
+            continue  # archivo con error: no está en la suma
+        parcial = sumar.get(info["sha256"])
+        if parcial is None:
+            parcial = partial_cache.get(info["sha256"], template_hash, hojas, exact)
+        if parcial is None:
+            return None
+        aportes.append((info, parcial))
+    return aportes
+
+
+def _record_task_metrics(task_id: str, tiempos: TaskTimings, status: str):
+    """Guarda los tiempos en la tarea y los agrega a las métricas del proceso"""
+    resumen = tiempos.as_dict()
+    state_store.update_job(task_id, metrics=json.dumps(resumen))
+    tasks_total.inc(status=status)
+    task_seconds.observe(resumen["total_seconds"])
+    for etapa, segundos in tiempos.stages.items():
+        stage_seconds.observe(segundos, stage=etapa)
+    logger.info(
+        "Tarea %s: %s en %.2fs %s", task_id, status, resumen["total_seconds"],
+        " ".join(f"{etapa}={segundos:.3f}s" for etapa, segundos in resumen["stages"].items())
+    )
+
+
+def run_consolidation_job(task_id: str, params: Dict):
+    """Ejecuta un trabajo tomado de la cola (los parámetros vienen de la base)"""
+    progress_broker.publish(task_id)  # pasó de "queued" a "processing"
+    task_info = state_store.get_job(task_id)
+    if task_info is not None:
+        espera = time.time() - datetime.fromisoformat(task_info["created_at"]).timestamp()
+        queue_wait_seconds.observe(max(0.0, espera))
+    consolidate_xlsm_files(task_id, **params)
+
+
+job_workers = JobWorkerPool(state_store, run_consolidation_job, JOB_WORKERS,
+                            memory_budget=MEMORY_BUDGET_MB * 1024 * 1024)
+
+
+def forget_session(session_id: str, rutas: List[str]):
+    """Borra los archivos de una sesión ya quitada de la base y sus totales en memoria"""
+    app_state["session_totals"].pop(session_id, None)
+    remove_uploads(rutas)
+
+
+# Sesiones, subidas, consolidados y cachés vencidos o sobre la cuota
+janitor = Janitor(
+    state_store, result_store, UPLOAD_FOLDER, UPLOADS_QUOTA_MB * 1024 * 1024,
+    interval=JANITOR_INTERVAL, batch=JANITOR_BATCH, orphan_grace=ORPHAN_GRACE_SECONDS,
+    job_ttl=RESULTS_TTL_HOURS * 3600, on_session_removed=forget_session,
+    partials=partial_cache, partials_quota_bytes=PARTIALS_QUOTA_MB * 1024 * 1024,
+    partials_ttl=PARTIALS_TTL_HOURS * 3600, audits=audit_store, spill_folder=SPILL_FOLDER
+)
+
+
+def warm_templates():
+    """
+    Arranque en caliente: registra la plantilla por defecto de una base
+    anterior al registro y carga en memoria las TEMPLATE_WARM_COUNT
+    plantillas usadas más recientemente (el análisis se lee de disco y el
+    modelo de fórmulas se rearma), para que la primera consolidación no espere.
+    """
+    plantilla = current_template()
+    if plantilla.get("template_hash") and os.path.exists(plantilla.get("template_path") or ""):
+        if state_store.find_template_by_hash(plantilla["template_hash"]) is None:
+            state_store.add_template({
+                **plantilla, "template_version": read_template_version(plantilla["template_path"])
+            })
+    for plantilla in state_store.list_templates()[:TEMPLATE_WARM_COUNT]:
+        if not os.path.exists(plantilla["template_path"]):
+            continue
+        try:
+            analisis = get_template_analysis(plantilla["template_path"], ANALYSIS_FOLDER, plantilla["template_hash"])
+            if EVALUATE_FORMULAS:
+                get_formula_model(plantilla["template_path"], analisis)
+        except Exception as e:
+            logger.warning("No se pudo precargar la plantilla %s: %s", plantilla["template_id"], e)
+
+
+@app.on_event("startup")
+def start_job_workers():
+    # Retoma los trabajos pendientes (también los de un proceso anterior)
+    job_workers.start()
+    janitor.start()
+    # Las plantillas se precargan en segundo plano: la API responde de inmediato
+    threading.Thread(target=warm_templates, name="template-warmup", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    job_workers.stop()
+    janitor.stop()
+    blocking_executor.shutdown()
+
+
+def queue_retry_after() -> int:
+    """Segundos estimados hasta que se libere espacio en la cola"""
+    promedio = state_store.average_duration() or 30.0
+    return max(1, min(3600, math.ceil(promedio / job_workers.workers)))
 
 
 # ==================== ENDPOINTS ====================
@@ -200,6 +922,7 @@ async def root():
             "consolidate_upload": "POST /api/consolidate/upload",
             "consolidate_process": "POST /api/consolidate/process",
             "consolidate_status": "GET /api/consolidate/status/{taskId}",
+            "consolidate_events": "GET /api/consolidate/events/{taskId}",
             "consolidate_download": "GET /api/consolidate/download/{resultId}"
         }
     }
@@ -207,10 +930,19 @@ async def root():
 # ==================== TEMPLATE ENDPOINTS ====================
 
 @app.get("/api/template/download")
-async def download_template():
+async def download_template(template_id: Optional[str] = None):
     """
-    Descarga el archivo SA_26_V1.1.xlsm ubicado en la raíz del proyecto.
+    Descarga el archivo SA_26_V1.1.xlsm ubicado en la raíz del proyecto,
+    o la plantilla registrada `template_id` si se indica.
     """
+    if template_id:
+        plantilla = resolve_template(template_id)
+        return FileResponse(
+            path=plantilla["template_path"],
+            filename=plantilla["template_name"],
+            media_type='application/vnd.ms-excel.sheet.macroEnabled.12'
+        )
+
     # Nombre del archivo fijo en la raíz
     root_file_name = "SA_26_V1.1.xlsm"
     root_file_path = os.path.join(os.getcwd(), root_file_name)
@@ -224,11 +956,12 @@ async def download_template():
             media_type='application/vnd.ms-excel.sheet.macroEnabled.12'
         )
     
-    # 2. Si no existe en la raíz, intentar con lo que esté en app_state (tu lógica original)
-    if app_state["template_path"] and os.path.exists(app_state["template_path"]):
+    # 2. Si no existe en la raíz, intentar con la plantilla cargada (tu lógica original)
+    plantilla = current_template()
+    if plantilla.get("template_path") and os.path.exists(plantilla["template_path"]):
         return FileResponse(
-            path=app_state["template_path"],
-            filename=app_state["template_name"],
+            path=plantilla["template_path"],
+            filename=plantilla["template_name"],
             media_type='application/vnd.ms-excel.sheet.macroEnabled.12'
         )
     
@@ -239,16 +972,63 @@ async def download_template():
     )
 
 
+def store_template(template: UploadFile, template_path: str, template_id: str):
+    """
+    Guarda la plantilla subida y la registra (bloqueante). Si ya hay una
+    registrada con el mismo contenido se descarta la copia y se retorna esa,
+    sin volver a analizarla. Retorna (registro, si ya estaba registrada).
+    """
+    with open(template_path, "wb") as buffer:
+        shutil.copyfileobj(template.file, buffer)
+    upload_bytes_total.inc(os.path.getsize(template_path), kind="template")
+    
+    sha256 = file_sha256(template_path)
+    existente = state_store.find_template_by_hash(sha256)
+    if existente is not None:
+        if os.path.exists(existente["template_path"]):
+            os.remove(template_path)
+            return existente, True
+        # Registrada, pero su archivo ya no está: se registra la nueva copia
+        state_store.delete_template(existente["template_id"])
+    
+    # El análisis se persiste por hash para no repetirlo
+    analisis = get_template_analysis(template_path, ANALYSIS_FOLDER, sha256)
+    registrada = state_store.add_template({
+        "template_id": template_id,
+        "template_hash": sha256,
+        "template_version": read_template_version(template_path),
+        "template_name": template.filename,
+        "template_path": template_path,
+        "sheet_names": analisis.sheetnames,
+    })
+    if registrada["template_id"] != template_id:
+        # Otro proceso registró el mismo contenido al mismo tiempo
+        os.remove(template_path)
+        return registrada, True
+    if EVALUATE_FORMULAS:
+        # El grafo de fórmulas queda listo para la primera consolidación
+        get_formula_model(template_path, analisis)
+    return registrada, False
+
+
 @app.post("/api/template/upload", response_model=TemplateUploadResponse)
-async def upload_template(template: UploadFile = File(...)):
+async def upload_template(template: UploadFile = File(...), set_default: bool = Form(True)):
     """
     POST /api/template/upload
-    Sube la plantilla maestra y retorna las hojas disponibles
+    Sube una plantilla al registro y retorna las hojas disponibles. Las
+    plantillas anteriores se conservan; subir una ya registrada (mismo
+    contenido) retorna la existente.
+    
+    Parameters:
+    - set_default: Usarla cuando una petición no indica template_id (por defecto sí)
     
     Returns:
     - template_id: ID único de la plantilla
     - template_name: Nombre del archivo
     - sheet_names: Lista de todas las hojas disponibles
+    - template_version: Versión leída de la plantilla (celda A9)
+    - template_hash: SHA-256 del contenido
+    - cached: Si ya estaba registrada
     """
     
     # Validar tipo de archivo
@@ -259,103 +1039,318 @@ async def upload_template(template: UploadFile = File(...)):
         )
     
     try:
-        # Limpiar plantilla anterior si existe
-        if app_state["template_path"] and os.path.exists(app_state["template_path"]):
-            try:
-                os.remove(app_state["template_path"])
-            except:
-                pass
-        
         # Generar ID único para la plantilla
         template_id = uuid.uuid4().hex
         
-        # Guardar nueva plantilla
+        # Guardar, analizar y registrar la nueva plantilla (fuera del event loop)
         template_filename = f"template_{template_id}_{template.filename}"
         template_path = os.path.join(TEMPLATE_FOLDER, template_filename)
+        plantilla, existente = await run_blocking("template", store_template, template, template_path, template_id)
         
-        with open(template_path, "wb") as buffer:
-            shutil.copyfileobj(template.file, buffer)
-        
-        # Leer nombres de hojas
-        wb = openpyxl.load_workbook(template_path, read_only=True)
-        sheet_names = wb.sheetnames
-        wb.close()
-        
-        # Actualizar estado
-        app_state["template_path"] = template_path
-        app_state["template_name"] = template.filename
-        app_state["template_id"] = template_id
-        app_state["sheet_names"] = sheet_names
+        # Plantilla por defecto
+        if set_default or not current_template():
+            state_store.set_template(plantilla)
         
         return TemplateUploadResponse(
-            template_id=template_id,
-            template_name=template.filename,
-            sheet_names=sheet_names
+            template_id=plantilla["template_id"],
+            template_name=plantilla["template_name"],
+            sheet_names=plantilla["sheet_names"],
+            template_version=plantilla["template_version"],
+            template_hash=plantilla["template_hash"],
+            cached=existente
         )
     
+    except HTTPException:
+        raise
     except Exception as e:
         if 'template_path' in locals() and os.path.exists(template_path):
-            os.remove(template_path)
+            if state_store.get_template_record(template_id) is None:
+                os.remove(template_path)
         raise HTTPException(
             status_code=500, 
             detail=f"Error al procesar la plantilla: {str(e)}"
         )
 
 
+@app.get("/api/templates")
+async def list_templates():
+    """
+    GET /api/templates
+    Plantillas registradas, de la usada más recientemente a la menos
+    """
+    return {
+        "default_template_id": current_template().get("template_id"),
+        "templates": [template_info(plantilla) for plantilla in state_store.list_templates()],
+    }
+
+
+@app.get("/api/templates/{template_id}")
+async def get_template(template_id: str):
+    """
+    GET /api/templates/{templateId}
+    Datos de una plantilla registrada
+    """
+    plantilla = state_store.get_template_record(template_id)
+    if plantilla is None:
+        raise HTTPException(status_code=404, detail=f"No se encontró la plantilla {template_id}")
+    return template_info(plantilla)
+
+
+@app.delete("/api/templates/{template_id}")
+async def delete_template(template_id: str):
+    """
+    DELETE /api/templates/{templateId}
+    Quita la plantilla del registro y borra su archivo. Si era la plantilla
+    por defecto, queda sin plantilla por defecto. 409 si hay una
+    consolidación en cola o en curso con ella.
+    """
+    plantilla = state_store.get_template_record(template_id)
+    if plantilla is None:
+        raise HTTPException(status_code=404, detail=f"No se encontró la plantilla {template_id}")
+    if state_store.template_in_use(plantilla["template_hash"]):
+        raise HTTPException(
+            status_code=409, detail="La plantilla está en uso por una consolidación en cola o en curso"
+        )
+    state_store.delete_template(template_id)
+    template_cache.discard(plantilla["template_hash"])
+    try:
+        os.remove(plantilla["template_path"])
+    except OSError:
+        pass
+    return {
+        "success": True,
+        "message": "Plantilla eliminada"
+    }
+
+
 # ==================== CONSOLIDATE ENDPOINTS ====================
 
 @app.post("/api/consolidate/upload")
-async def upload_files_to_consolidate(files: List[UploadFile] = File(...)):
+async def upload_files_to_consolidate(
+    files: List[UploadFile] = File(...),
+    template_id: Optional[str] = Form(None)
+):
     """
     POST /api/consolidate/upload
     Sube los archivos que serán consolidados
     
+    Parameters:
+    - template_id: Plantilla contra cuyas hojas se revisan (opcional; por defecto la última subida)
+    
     Returns:
     - session_id: ID de sesión para referenciar estos archivos
     - files_count: Cantidad de archivos subidos
     - files: Lista de nombres de archivos
+    - rejected: Archivos descartados por no ser libros válidos o no tener
+      las hojas de la plantilla ({"filename", "detail"})
     """
     
     # Generar ID de sesión único
     session_id = uuid.uuid4().hex
     
-    # Guardar archivos
-    saved_files = []
-    file_names = []
-    
-    for file in files:
-        if file and allowed_file(file.filename):
-            file_id = uuid.uuid4().hex[:8]
-            file_path = os.path.join(UPLOAD_FOLDER, f"{session_id}_{file_id}_{file.filename}")
-            
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            saved_files.append(file_path)
-            file_names.append(file.filename)
+    # Guardar y revisar archivos
+    saved_files, rechazados = await save_session_files(session_id, files, session_template_sheets(template_id))
     
     if not saved_files:
         raise HTTPException(
             status_code=400,
-            detail="No se encontraron archivos válidos para consolidar"
+            detail=rejected_detail("No se encontraron archivos válidos para consolidar", rechazados)
         )
     
     # Guardar en estado
-    app_state["uploaded_files"][session_id] = saved_files
+    for file_id, info in saved_files.items():
+        state_store.put_session_file(session_id, file_id, info)
     
     return {
         "session_id": session_id,
         "files_count": len(saved_files),
-        "files": file_names,
+        "files": [info["filename"] for info in saved_files.values()],
+        "file_ids": list(saved_files),
+        "rejected": rechazados,
         "message": "Archivos subidos correctamente. Use POST /api/consolidate/process para iniciar la consolidación."
     }
 
 
+def get_session_files(session_id: str) -> Dict[str, Dict]:
+    archivos = state_store.get_session(session_id)
+    if archivos is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No se encontraron archivos para el session_id: {session_id}"
+        )
+    return archivos
+
+
+def session_files_response(session_id: str) -> Dict:
+    archivos = get_session_files(session_id)
+    return {
+        "session_id": session_id,
+        "files_count": len(archivos),
+        "files": [
+            {
+                "file_id": file_id, "filename": info["filename"], "sha256": info["sha256"],
+                # Libros subidos dentro de un ZIP: nombre del ZIP y carpeta dentro de él
+                **({"archive": info["archive"], "folder": info["folder"]} if "member" in info else {})
+            }
+            for file_id, info in archivos.items()
+        ]
+    }
+
+
+@app.get("/api/consolidate/session/{session_id}")
+async def get_session(session_id: str):
+    """
+    GET /api/consolidate/session/{sessionId}
+    Lista los archivos de una sesión con su file_id y hash
+    """
+    return session_files_response(session_id)
+
+
+@app.post("/api/consolidate/session/{session_id}/files")
+async def add_session_files(
+    session_id: str,
+    files: List[UploadFile] = File(...),
+    template_id: Optional[str] = Form(None)
+):
+    """
+    POST /api/consolidate/session/{sessionId}/files
+    Agrega archivos a una sesión existente
+    """
+    get_session_files(session_id)
+    agregados, rechazados = await save_session_files(session_id, files, session_template_sheets(template_id))
+    for file_id, info in agregados.items():
+        state_store.put_session_file(session_id, file_id, info)
+    
+    if not agregados:
+        raise HTTPException(
+            status_code=400,
+            detail=rejected_detail("No se encontraron archivos válidos para agregar", rechazados)
+        )
+    return {**session_files_response(session_id), "rejected": rechazados}
+
+
+@app.put("/api/consolidate/session/{session_id}/files/{file_id}")
+async def replace_session_file(
+    session_id: str,
+    file_id: str,
+    file: UploadFile = File(...),
+    template_id: Optional[str] = Form(None)
+):
+    """
+    PUT /api/consolidate/session/{sessionId}/files/{fileId}
+    Reemplaza un archivo de la sesión (por ejemplo, después de corregirlo)
+    """
+    archivos = get_session_files(session_id)
+    if file_id not in archivos:
+        raise HTTPException(status_code=404, detail=f"No se encontró el archivo {file_id} en la sesión")
+    if not allowed_file(file.filename):
+        raise HTTPException(
+            status_code=400,
+            detail="Tipo de archivo no permitido. Use archivos .xlsx o .xlsm"
+        )
+    
+    anterior = archivos[file_id]
+    try:
+        _, info = await run_blocking(
+            "upload", save_session_file, session_id, file, file_id, session_template_sheets(template_id)
+        )
+    except InvalidWorkbook as e:
+        uploads_rejected_total.inc()
+        raise HTTPException(status_code=400, detail=f"Archivo rechazado: {e}")
+    state_store.put_session_file(session_id, file_id, info)
+    if anterior["path"] != info["path"]:
+        release_upload(session_id, anterior["path"])
+    return session_files_response(session_id)
+
+
+@app.delete("/api/consolidate/session/{session_id}/files/{file_id}")
+async def remove_session_file(session_id: str, file_id: str):
+    """
+    DELETE /api/consolidate/session/{sessionId}/files/{fileId}
+    Quita un archivo de la sesión
+    """
+    archivos = get_session_files(session_id)
+    if file_id not in archivos:
+        raise HTTPException(status_code=404, detail=f"No se encontró el archivo {file_id} en la sesión")
+    release_upload(session_id, state_store.remove_session_file(session_id, file_id)["path"])
+    return session_files_response(session_id)
+
+
+def load_result_aggregate_meta(result_id: str) -> Dict:
+    """Meta del agregado guardado de un consolidado (bloqueante); 404 o 400 si no sirve como entrada"""
+    entrada = result_store.get(result_id) if valid_result_id(result_id) else None
+    if entrada is None:
+        raise HTTPException(status_code=404, detail=f"No se encontró el resultado con ID: {result_id}")
+    if not entrada.get("aggregate_filename"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"El resultado {result_id} no guardó sus sumas; vuelva a consolidarlo para usarlo como entrada"
+        )
+    try:
+        return read_aggregate_meta(os.path.join(RESULTS_FOLDER, entrada["aggregate_filename"]))
+    except InvalidAggregate as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def enqueue_consolidation(plantilla: Dict, archivos: List[Dict], included_sheets: List[str], exact: bool,
+                          solo_datos: bool, procedencia: bool, memoria: int, session_id: Optional[str] = None,
+                          result_key: Optional[str] = None, inputs: Optional[List[str]] = None,
+                          depends_on: Optional[List[str]] = None) -> Tuple[str, str]:
+    """
+    Encola una consolidación; los parámetros quedan en la base para que
+    cualquier proceso pueda ejecutarla (o retomarla tras un reinicio).
+    Retorna (task_id, result_id).
+    """
+    task_id = uuid.uuid4().hex
+    result_id = uuid.uuid4().hex
+    
+    # Preparar salida
+    output_filename = f'REM_Consolidado_{result_id}_{plantilla["template_name"]}'
+    output_path = os.path.join(RESULTS_FOLDER, output_filename)
+    data_path = os.path.join(RESULTS_FOLDER, result_data_filename(result_id))
+    if solo_datos:
+        output_filename = os.path.basename(data_path)
+    
+    state_store.insert_job({
+        "task_id": task_id,
+        "session_id": session_id,
+        "status": "queued",
+        "progress": 0,
+        "current_file": "",
+        "status_message": "En cola",
+        "result_id": None,
+        "result_filename": output_filename,
+        "result_key": result_key,
+        "error": None,
+        "created_at": datetime.now().isoformat()
+    }, params={
+        "template_path": plantilla["template_path"],
+        "archivos": archivos,
+        "output_path": output_path,
+        "included_sheets": included_sheets,
+        "result_id": result_id,
+        "template_hash": plantilla["template_hash"],
+        "exact": exact,
+        "session_id": session_id,
+        "result_key": result_key,
+        "data_path": data_path,
+        "write_workbook": not solo_datos,
+        "provenance_path": os.path.join(RESULTS_FOLDER, provenance_filename(result_id)) if procedencia else None,
+        "inputs": inputs or [],
+    }, memory_bytes=memoria, depends_on=depends_on)
+    return task_id, result_id
+
+
 @app.post("/api/consolidate/process")
 async def process_consolidation(
-    background_tasks: BackgroundTasks,
-    session_id: str = Form(...),
-    excluded_sheets: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    inputs: Optional[str] = Form(None),
+    excluded_sheets: Optional[str] = Form(None),
+    exact: Optional[bool] = Form(None),
+    output: str = Form("workbook"),
+    provenance: Optional[bool] = Form(None),
+    template_id: Optional[str] = Form(None),
+    template_version: Optional[str] = Form(None)
 ):
     """
     POST /api/consolidate/process
@@ -363,28 +1358,61 @@ async def process_consolidation(
     
     Parameters:
     - session_id: ID de sesión de los archivos subidos
+    - inputs: result_id de consolidados anteriores separados por coma (opcional; ver abajo)
     - excluded_sheets: Hojas a excluir separadas por coma (opcional)
+    - exact: Sumar con Decimal en lugar de punto flotante (opcional)
+    - output: "workbook" (xlsm y datos) o "data" (solo datos para /api/consolidate/data, sin xlsm)
+    - provenance: Registrar el aporte de cada archivo a cada celda (ver /api/consolidate/provenance)
+    - template_id: Plantilla registrada con la que consolidar (opcional; ver GET /api/templates)
+    - template_version: O la última plantilla registrada con esa versión (texto de A9)
+    
+    Sin template_id ni template_version se usa la plantilla por defecto.
+    
+    Consolidación jerárquica (establecimiento → comuna → región → país): con
+    `inputs` se suman las sumas guardadas de esos consolidados sin releer sus
+    libros, solos o junto con los archivos de la sesión. Sin plantilla ni
+    `exact` se usan los de las entradas; dos entradas no pueden compartir un
+    consolidado ni una sesión (se sumarían dos veces).
     
     Returns:
     - task_id: ID único de la tarea para consultar el estado
     - message: Mensaje de confirmación
+    
+    Si la cola está llena responde 429 con el encabezado Retry-After.
     """
     
-    # Validar que exista plantilla
-    if not app_state["template_path"] or not os.path.exists(app_state["template_path"]):
-        raise HTTPException(
-            status_code=400,
-            detail="No hay plantilla cargada. Primero sube una plantilla usando POST /api/template/upload"
-        )
+    if output not in ("workbook", "data"):
+        raise HTTPException(status_code=400, detail="output debe ser 'workbook' o 'data'")
+    solo_datos = output == "data"
+    entradas = list(dict.fromkeys(s.strip() for s in inputs.split(',') if s.strip())) if inputs else []
+    if not session_id and not entradas:
+        raise HTTPException(status_code=400, detail="Indique session_id, inputs o ambos")
     
-    # Validar que existan archivos para el session_id
-    if session_id not in app_state["uploaded_files"]:
-        raise HTTPException(
-            status_code=404,
-            detail=f"No se encontraron archivos para el session_id: {session_id}"
-        )
+    # Agregados de los consolidados de entrada
+    metas = [await run_blocking("data", load_result_aggregate_meta, entrada) for entrada in entradas]
     
-    file_paths = app_state["uploaded_files"][session_id]
+    # Validar que exista la plantilla (sin indicarla, con entradas, la de ellas)
+    if metas and not template_id and not template_version:
+        plantilla = state_store.find_template_by_hash(metas[0]["template_hash"]) or {}
+        if not plantilla.get("template_path") or not os.path.exists(plantilla["template_path"]):
+            raise HTTPException(
+                status_code=400,
+                detail=f"La plantilla del resultado {entradas[0]} ya no está registrada"
+            )
+    else:
+        plantilla = resolve_template(template_id, template_version)
+    state_store.touch_template(plantilla["template_id"])
+    
+    # Validar que existan archivos para el session_id
+    archivos = []
+    if session_id:
+        archivos = list(get_session_files(session_id).values())
+        state_store.touch_session(session_id)
+        if not archivos:
+            raise HTTPException(
+                status_code=400,
+                detail=f"La sesión {session_id} no tiene archivos para consolidar"
+            )
     
     # Procesar hojas excluidas
     excluded_list = []
@@ -392,48 +1420,280 @@ async def process_consolidation(
         excluded_list = [s.strip() for s in excluded_sheets.split(',') if s.strip()]
     
     included_sheets = [
-        sheet for sheet in app_state["sheet_names"] 
+        sheet for sheet in plantilla["sheet_names"] 
         if sheet not in excluded_list
     ]
     
-    # Generar IDs únicos
-    task_id = uuid.uuid4().hex
-    result_id = uuid.uuid4().hex
+    if exact is None:
+        exact = metas[0]["exact"] if metas else CONSOLIDATION_EXACT
+    procedencia = PROVENANCE_DEFAULT if provenance is None else provenance
     
-    # Preparar salida
-    output_filename = f'REM_Consolidado_{result_id}_{app_state["template_name"]}'
-    output_path = os.path.join(RESULTS_FOLDER, output_filename)
+    # Las entradas deben combinar con esta consolidación y no compartir
+    # consolidados ni sesiones (libros iguales de establecimientos distintos sí se suman)
+    vistos = {f"session:{session_id}"} if session_id else set()
+    for entrada, meta in zip(entradas, metas):
+        if meta["template_hash"] != plantilla["template_hash"]:
+            raise HTTPException(status_code=400, detail=f"El resultado {entrada} es de otra plantilla")
+        if meta["exact"] != exact:
+            raise HTTPException(status_code=400, detail=f"El resultado {entrada} usa otro modo de suma (exact)")
+        linaje = state_store.get_lineage(entrada)
+        faltantes = [hoja for hoja in included_sheets if linaje and hoja not in linaje["recipe"]["included_sheets"]]
+        if faltantes:
+            raise HTTPException(
+                status_code=400,
+                detail=f"El resultado {entrada} no incluye las hojas {', '.join(faltantes)}; exclúyalas"
+            )
+        miembros = lineage_members(entrada)
+        if miembros & vistos:
+            raise HTTPException(
+                status_code=400,
+                detail=f"El resultado {entrada} comparte consolidados o sesiones con otra entrada; se sumarían dos veces"
+            )
+        vistos |= miembros
     
-    # Crear tarea
-    app_state["tasks"][task_id] = {
-        "task_id": task_id,
-        "status": "processing",
-        "progress": 0,
-        "current_file": "",
-        "status_message": "Iniciando consolidación...",
-        "result_id": None,
-        "result_filename": output_filename,
-        "error": None,
-        "created_at": datetime.now().isoformat()
-    }
+    # Misma plantilla, mismos archivos (por contenido) y mismas hojas:
+    # se reutiliza el consolidado existente sin volver a procesar. Un
+    # consolidado completo también sirve cuando solo se piden los datos, y
+    # uno con procedencia cuando no se pide. Las entradas cuentan por su result_id
+    hashes = [info["sha256"] for info in archivos] + [f"result:{entrada}" for entrada in entradas]
+    claves = [consolidation_key(
+        plantilla["template_hash"], hashes, included_sheets, exact,
+        EVALUATE_FORMULAS, data_only, con_procedencia
+    ) for data_only in ((False, True) if solo_datos else (False,))
+        for con_procedencia in ((True,) if procedencia else (True, False))]
+    result_key = claves[-1]
+    existente = None
+    for clave in claves:
+        existente = result_store.lookup(clave)
+        if existente is not None:
+            break
+    if existente is not None:
+        results_reused_total.inc()
+        task_id = uuid.uuid4().hex
+        state_store.insert_job({
+            "task_id": task_id,
+            "session_id": session_id,
+            "status": "completed",
+            "progress": 100,
+            "current_file": "",
+            "status_message": "Resultado existente reutilizado",
+            "result_id": existente["result_id"],
+            "result_filename": existente["filename"],
+            "result_key": clave,
+            "error": None,
+            "created_at": datetime.now().isoformat()
+        })
+        return {
+            "task_id": task_id,
+            "message": "Consolidación ya disponible",
+            "status_url": f"/api/consolidate/status/{task_id}",
+            "result_id": existente["result_id"],
+            "cached": True,
+            "included_sheets": included_sheets,
+            "excluded_sheets": excluded_list,
+            "template_id": plantilla["template_id"]
+        }
+    
+    # Si la misma consolidación ya está en cola o en curso, se comparte esa tarea
+    en_curso = None
+    for clave in claves:
+        en_curso = en_curso or state_store.find_active_job(clave)
+    if en_curso is not None:
+        return {
+            "task_id": en_curso["task_id"],
+            "message": "Consolidación ya en curso",
+            "status_url": f"/api/consolidate/status/{en_curso['task_id']}",
+            "cached": True,
+            "included_sheets": included_sheets,
+            "excluded_sheets": excluded_list,
+            "template_id": plantilla["template_id"]
+        }
+    
+    # Control de admisión: la cola persistente tiene un máximo de tareas en espera
+    if state_store.count_jobs("queued") >= MAX_QUEUED_JOBS:
+        rejected_total.inc()
+        raise HTTPException(
+            status_code=429,
+            detail="La cola de consolidaciones está llena. Intente nuevamente más tarde.",
+            headers={"Retry-After": str(queue_retry_after())}
+        )
+    
+    # Memoria que la tarea reservará en el nodo que la tome (con MEMORY_BUDGET_MB);
+    # cada entrada cuenta como un archivo
+    memoria = await run_blocking(
+        "data", job_memory_estimate, plantilla, included_sheets, len(archivos) + len(entradas), exact, procedencia
+    )
     
-    # Ejecutar consolidación en background
-    background_tasks.add_task(
-        consolidate_xlsm_files,
-        task_id,
-        app_state["template_path"],
-        file_paths,
-        output_path,
-        included_sheets,
-        result_id
+    task_id, _ = enqueue_consolidation(
+        plantilla, archivos, included_sheets, exact, solo_datos, procedencia, memoria,
+        session_id=session_id, result_key=result_key, inputs=entradas
     )
+    job_workers.notify()
     
     return {
         "task_id": task_id,
         "message": "Consolidación iniciada",
         "status_url": f"/api/consolidate/status/{task_id}",
+        "cached": False,
         "included_sheets": included_sheets,
-        "excluded_sheets": excluded_list
+        "excluded_sheets": excluded_list,
+        "template_id": plantilla["template_id"]
+    }
+
+
+def lineage_members(result_id: str) -> Set[str]:
+    """El resultado, los consolidados bajo él y sus sesiones ("session:{id}")"""
+    miembros = set()
+    pendientes = [result_id]
+    while pendientes:
+        actual = pendientes.pop()
+        if actual in miembros:
+            continue
+        miembros.add(actual)
+        linaje = state_store.get_lineage(actual)
+        if linaje is not None:
+            if linaje["recipe"]["session_id"]:
+                miembros.add(f"session:{linaje['recipe']['session_id']}")
+            pendientes.extend(linaje["inputs"])
+    return miembros
+
+
+def lineage_tree(result_id: str) -> Dict:
+    """Linaje del resultado con el de sus entradas, recursivo (bloqueante)"""
+    linaje = state_store.get_lineage(result_id)
+    entrada = result_store.get(result_id)
+    nodo = {"result_id": result_id, "available": entrada is not None}
+    if linaje is None:
+        return nodo
+    receta = linaje["recipe"]
+    nodo.update({
+        "created_at": linaje["created_at"],
+        "template_hash": receta["template_hash"],
+        "included_sheets": receta["included_sheets"],
+        "exact": receta["exact"],
+        "session_id": receta["session_id"],
+        "files": len(receta["archivos"]),
+    })
+    if entrada is not None and entrada.get("aggregate_filename"):
+        try:
+            meta = read_aggregate_meta(os.path.join(RESULTS_FOLDER, entrada["aggregate_filename"]))
+            nodo["leaf_files"] = meta["file_count"]
+        except InvalidAggregate:
+            pass
+    # Un resultado siempre es posterior a sus entradas: el árbol no tiene ciclos
+    nodo["inputs"] = [lineage_tree(hijo) for hijo in linaje["inputs"]]
+    return nodo
+
+
+@app.get("/api/consolidate/lineage/{result_id}")
+async def get_result_lineage(result_id: str):
+    """
+    GET /api/consolidate/lineage/{resultId}
+    Cómo se armó un consolidado: sesión y archivos propios, y los
+    consolidados que usó como entrada (con su propio linaje); `parents` son
+    los consolidados que lo usaron como entrada
+    """
+    if not valid_result_id(result_id) or state_store.get_lineage(result_id) is None:
+        raise HTTPException(status_code=404, detail=f"No hay linaje del resultado con ID: {result_id}")
+    arbol = await run_blocking("data", lineage_tree, result_id)
+    return {**arbol, "parents": state_store.result_parents(result_id)}
+
+
+def affected_results(result_id: str) -> List[str]:
+    """Consolidados que usan el resultado, directa o indirectamente, de abajo hacia arriba"""
+    afectados = {}
+    pendientes = [result_id]
+    while pendientes:
+        for padre in state_store.result_parents(pendientes.pop()):
+            if padre not in afectados:
+                afectados[padre] = state_store.get_lineage(padre)
+                pendientes.append(padre)
+    # Un resultado se registra después de sus entradas
+    return sorted(afectados, key=lambda padre: afectados[padre]["created_at"])
+
+
+@app.post("/api/consolidate/propagate")
+async def propagate_result(
+    result_id: str = Form(...),
+    replacement_id: str = Form(...),
+    output: str = Form("workbook")
+):
+    """
+    POST /api/consolidate/propagate
+    Rehace los niveles superiores cuando cambió un consolidado intermedio
+    
+    Parameters:
+    - result_id: Consolidado anterior (por ejemplo, el de un establecimiento o una comuna)
+    - replacement_id: Consolidado que lo reemplaza (la misma sesión reconsolidada)
+    - output: "workbook" o "data" para los niveles rehechos
+    
+    Solo se rehacen los consolidados que lo usaron como entrada, directa o
+    indirectamente (el camino hasta la raíz), cada uno con las mismas
+    entradas salvo la reemplazada y sin releer libros: las demás entradas
+    se suman desde su agregado guardado. Cada nivel espera al de abajo.
+    
+    Returns:
+    - tasks: [{"task_id", "replaces", "result_id"}] de abajo hacia arriba
+    """
+    if output not in ("workbook", "data"):
+        raise HTTPException(status_code=400, detail="output debe ser 'workbook' o 'data'")
+    anterior = await run_blocking("data", load_result_aggregate_meta, result_id)
+    nuevo = await run_blocking("data", load_result_aggregate_meta, replacement_id)
+    if (anterior["template_hash"], anterior["exact"]) != (nuevo["template_hash"], nuevo["exact"]):
+        raise HTTPException(
+            status_code=400, detail="El reemplazo es de otra plantilla o modo de suma que el resultado anterior"
+        )
+    
+    afectados = affected_results(result_id)
+    if state_store.count_jobs("queued") + len(afectados) > MAX_QUEUED_JOBS:
+        rejected_total.inc()
+        raise HTTPException(
+            status_code=429,
+            detail="La cola de consolidaciones está llena. Intente nuevamente más tarde.",
+            headers={"Retry-After": str(queue_retry_after())}
+        )
+    
+    # Se valida todo el camino antes de encolar
+    recetas = {}
+    for padre in afectados:
+        receta = state_store.get_lineage(padre)["recipe"]
+        plantilla = state_store.find_template_by_hash(receta["template_hash"]) or {}
+        if not plantilla.get("template_path") or not os.path.exists(plantilla["template_path"]):
+            raise HTTPException(status_code=400, detail=f"La plantilla del resultado {padre} ya no está registrada")
+        recetas[padre] = (receta, plantilla)
+    
+    reemplazos = {result_id: replacement_id}
+    tareas = {}
+    respuesta = []
+    for padre in afectados:
+        receta, plantilla = recetas[padre]
+        entradas = state_store.get_lineage(padre)["inputs"]
+        memoria = await run_blocking(
+            "data", job_memory_estimate, plantilla, receta["included_sheets"],
+            len(receta["archivos"]) + len(entradas), receta["exact"], receta["provenance"]
+        )
+        nuevas = [reemplazos.get(entrada, entrada) for entrada in entradas]
+        result_key = consolidation_key(
+            receta["template_hash"], [info["sha256"] for info in receta["archivos"]]
+            + [f"result:{entrada}" for entrada in nuevas],
+            receta["included_sheets"], receta["exact"], EVALUATE_FORMULAS, output == "data", receta["provenance"]
+        )
+        task_id, nuevo_id = enqueue_consolidation(
+            plantilla, receta["archivos"], receta["included_sheets"], receta["exact"], output == "data",
+            receta["provenance"], memoria, session_id=receta["session_id"], result_key=result_key, inputs=nuevas,
+            depends_on=[tareas[entrada] for entrada in entradas if entrada in tareas]
+        )
+        reemplazos[padre] = nuevo_id
+        tareas[padre] = task_id
+        respuesta.append({"task_id": task_id, "replaces": padre, "result_id": nuevo_id})
+    if respuesta:
+        job_workers.notify()
+    
+    return {
+        "message": f"{len(respuesta)} consolidados por rehacer" if respuesta else "Ningún consolidado usa el resultado",
+        "result_id": result_id,
+        "replacement_id": replacement_id,
+        "tasks": respuesta
     }
 
 
@@ -445,93 +1705,252 @@ async def get_consolidation_status(task_id: str):
     
     Returns:
     - task_id: ID de la tarea
-    - status: Estado actual ("processing", "completed", "error")
+    - status: Estado actual ("queued", "processing", "completed", "error")
     - progress: Porcentaje de progreso (0-100)
     - current_file: Archivo que se está procesando
     - status_message: Mensaje descriptivo del estado
+    - queue_position: Posición en la cola (solo cuando status="queued")
     - result_id: ID para descargar el resultado (solo cuando status="completed")
     - error: Mensaje de error (solo cuando status="error")
     """
     
-    if task_id not in app_state["tasks"]:
+    estado = get_task_status(task_id)
+    if estado is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"No se encontró la tarea con ID: {task_id}"
+        )
+    
+    return TaskStatusResponse(**estado)
+
+
+@app.get("/api/consolidate/events/{task_id}")
+async def stream_consolidation_status(task_id: str):
+    """
+    GET /api/consolidate/events/{taskId}
+    Server-Sent Events con el estado de la tarea (mismo contenido que /status)
+    
+    Se envía un evento cada vez que cambia el progreso, el archivo o el
+    estado (como máximo cada 250 ms; los cambios intermedios se fusionan).
+    El nombre del evento es el estado ("queued", "processing", "completed",
+    "error") y la conexión se cierra después del evento final.
+    """
+    if get_task_status(task_id) is None:
         raise HTTPException(
             status_code=404,
             detail=f"No se encontró la tarea con ID: {task_id}"
         )
     
-    task_info = app_state["tasks"][task_id]
+    async def eventos():
+        async for estado in task_updates(task_id, get_task_status, progress_broker):
+            yield format_sse(estado)
     
-    return TaskStatusResponse(
-        task_id=task_info["task_id"],
-        status=task_info["status"],
-        progress=task_info["progress"],
-        current_file=task_info["current_file"],
-        status_message=task_info["status_message"],
-        result_id=task_info["result_id"],
-        error=task_info["error"]
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 
+@app.websocket("/api/consolidate/ws/{task_id}")
+async def consolidation_status_ws(websocket: WebSocket, task_id: str):
+    """
+    WS /api/consolidate/ws/{taskId}
+    Igual que /events pero por WebSocket: un mensaje JSON por cambio de estado
+    """
+    await websocket.accept()
+    if get_task_status(task_id) is None:
+        await websocket.close(code=4404, reason=f"No se encontró la tarea con ID: {task_id}")
+        return
+    try:
+        async for estado in task_updates(task_id, get_task_status, progress_broker):
+            if estado is not None:
+                await websocket.send_json(estado)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
 @app.get("/api/consolidate/download/{result_id}")
-async def download_consolidated_file(result_id: str):
+async def download_consolidated_file(result_id: str, request: Request):
     """
     GET /api/consolidate/download/{resultId}
     Descarga el archivo consolidado
     
     Parameters:
     - result_id: ID del resultado generado
+    
+    Responde con ETag: `If-None-Match` da 304 si el archivo no cambió, y
+    `Range` (con `If-Range`) permite retomar una descarga cortada (206).
     """
+    if not valid_result_id(result_id):
+        raise HTTPException(status_code=404, detail=f"No se encontró el resultado con ID: {result_id}")
     
-    # Buscar el archivo en la carpeta de resultados
-    result_files = [f for f in os.listdir(RESULTS_FOLDER) if result_id in f]
+    # Búsqueda directa en el índice de resultados (también marca el uso para
+    # el desalojo LRU); los anteriores al índice se buscan por su tarea
+    entrada = await run_blocking("data", result_store.get, result_id)
+    if entrada is not None:
+        filename = entrada["filename"]
+    else:
+        tarea = state_store.find_job_by_result(result_id)
+        filename = tarea and tarea["result_filename"]
     
-    if not result_files:
+    # El .npz de un resultado solo de datos no se descarga aquí
+    if not filename or not allowed_file(filename):
         raise HTTPException(
             status_code=404,
             detail=f"No se encontró el resultado con ID: {result_id}"
         )
     
-    file_path = os.path.join(RESULTS_FOLDER, result_files[0])
-    
-    if not os.path.exists(file_path):
+    try:
+        return file_download(
+            os.path.join(RESULTS_FOLDER, filename), filename,
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', request.headers
+        )
+    except OSError:
         raise HTTPException(
             status_code=404,
             detail="Archivo no encontrado o ya fue eliminado"
         )
+
+def load_result_cells(data_path: str, refs: List[str]) -> Dict[str, Dict[str, object]]:
+    """Celdas pedidas del .npz del resultado (bloqueante; ValueError si una referencia no es válida)"""
+    datos = result_data_cache.get(data_path)
+    seleccion = []
+    for ref in refs or list(datos.sheets):
+        hoja, bounds = parse_data_ref(ref, datos.sheets)
+        if hoja not in datos.sheets:
+            raise ValueError(f"La hoja {hoja} no está en el resultado")
+        seleccion.append((hoja, bounds))
+    return select_cells(datos, seleccion)
+
+
+@app.get("/api/consolidate/data/{result_id}")
+async def get_consolidated_data(
+    result_id: str,
+    ref: Optional[List[str]] = Query(None),
+    formato: str = Query("json", alias="format")
+):
+    """
+    GET /api/consolidate/data/{resultId}?ref=A01!B10:D20&ref=A02&format=json
+    Valores del consolidado (celdas sumadas y fórmulas numéricas) sin descargar el xlsm
     
-    return FileResponse(
-        path=file_path,
-        filename=result_files[0],
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
+    Parameters:
+    - ref: Hoja completa ("A01"), rango ("A01!B10:D20") o celda ("A01!C5"); se puede repetir.
+      Sin ref se retornan todas las hojas incluidas
+    - format: "json" ({"hojas": {hoja: {celda: valor}}}) o "csv" (hoja,celda,valor)
+    """
+    if formato not in ("json", "csv"):
+        raise HTTPException(status_code=400, detail="format debe ser 'json' o 'csv'")
+    data_path = os.path.join(RESULTS_FOLDER, result_data_filename(result_id))
+    if not valid_result_id(result_id) or not os.path.exists(data_path):
+        raise HTTPException(
+            status_code=404,
+            detail=f"No se encontraron datos del resultado con ID: {result_id}"
+        )
+    
+    try:
+        hojas = await run_blocking("data", load_result_cells, data_path, ref)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OSError:
+        raise HTTPException(status_code=404, detail="Datos no encontrados o ya fueron eliminados")
+    result_store.touch(result_id)
+    
+    if formato == "csv":
+        return PlainTextResponse("".join(iter_csv(hojas)), media_type="text/csv")
+    return {"result_id": result_id, "hojas": hojas}
+
+
+def provenance_index_path(result_id: str) -> str:
+    """Ruta de la procedencia del resultado; 404 si no se registró"""
+    path = os.path.join(RESULTS_FOLDER, provenance_filename(result_id))
+    if not valid_result_id(result_id) or not os.path.exists(path):
+        raise HTTPException(
+            status_code=404,
+            detail=f"El resultado {result_id} no existe o se consolidó sin provenance"
+        )
+    return path
+
+
+def load_cell_provenance(path: str, sheet: str, cell: str, top: Optional[int], threshold: float) -> Dict:
+    indice = provenance_cache.get(path)
+    if sheet not in indice.sheets:
+        raise ValueError(f"La hoja {sheet} no está en el resultado")
+    fila, col, _, _ = parse_range(cell)
+    return indice.cell(sheet, fila, col, top, threshold)
+
+
+def load_outliers(path: str, sheet: str, rango: Optional[str], threshold: float, limit: int) -> List[Dict]:
+    indice = provenance_cache.get(path)
+    if sheet not in indice.sheets:
+        raise ValueError(f"La hoja {sheet} no está en el resultado")
+    return list(indice.outliers(sheet, parse_range(rango) if rango else None, threshold, limit))
+
+
+@app.get("/api/consolidate/provenance/{result_id}")
+async def get_cell_provenance(
+    result_id: str,
+    sheet: str = Query(...),
+    cell: str = Query(...),
+    top: Optional[int] = Query(None, ge=1),
+    threshold: float = Query(PROVENANCE_OUTLIER_THRESHOLD, gt=0)
+):
+    """
+    GET /api/consolidate/provenance/{resultId}?sheet=A01&cell=C11&top=10
+    Qué archivos aportaron a una celda y cuánto, sin volver a leer los libros
+    
+    Parameters:
+    - sheet, cell: Hoja y celda del consolidado
+    - top: Solo los `top` aportes de mayor valor absoluto (opcional)
+    - threshold: Puntaje z modificado desde el que un aporte es atípico
+    """
+    path = provenance_index_path(result_id)
+    try:
+        detalle = await run_blocking("data", load_cell_provenance, path, sheet, cell.upper(), top, threshold)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result_store.touch(result_id)
+    return {"result_id": result_id, "hoja": sheet, "celda": cell.upper(), **detalle}
+
+
+@app.get("/api/consolidate/provenance/{result_id}/outliers")
+async def get_provenance_outliers(
+    result_id: str,
+    sheet: str = Query(...),
+    range_ref: Optional[str] = Query(None, alias="range"),
+    threshold: float = Query(PROVENANCE_OUTLIER_THRESHOLD, gt=0),
+    limit: int = Query(100, ge=1, le=5000)
+):
+    """
+    GET /api/consolidate/provenance/{resultId}/outliers?sheet=A01&range=B10:Z40
+    Celdas de la hoja (o del rango) con archivos de aporte atípico
+    """
+    path = provenance_index_path(result_id)
+    try:
+        celdas = await run_blocking("data", load_outliers, path, sheet, range_ref, threshold, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result_store.touch(result_id)
+    return {"result_id": result_id, "hoja": sheet, "celdas": celdas}
+
+
+def save_temp_upload(file: UploadFile, prefix: str) -> str:
+    """Copia una subida a un archivo temporal en uploads/ y retorna su ruta"""
+    temp_path = os.path.join(UPLOAD_FOLDER, f"{prefix}_{uuid.uuid4().hex}_{file.filename}")
+    with open(temp_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    return temp_path
+
 
 @app.post("/api/consolidate/validate")
 async def validate_template_version(file: UploadFile = File(...)):
     try:
-        # 1. Guardar temporalmente
-        temp_path = os.path.join(UPLOAD_FOLDER, f"val_{uuid.uuid4().hex}_{file.filename}")
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # 2. Cargar con data_only=True para leer el texto final
-        # keep_vba=True es opcional pero recomendado para archivos .xlsm
-        wb = openpyxl.load_workbook(temp_path, data_only=True, keep_vba=True)
-        
-        # 3. Acceder específicamente a la primera pestaña por nombre o índice
-        # Tu archivo tiene la pestaña "IDENTIFICACIÓN" como la primera
-        sheet = wb.worksheets[0] 
-        
-        # 4. Leer A9 (Celda maestra de la combinación A9:B9)
-        valor_celda = sheet["A9"].value
-        version_encontrada = str(valor_celda).strip() if valor_celda else ""
+        # Leer solo A9 de la primera hoja, directo del temporal de la subida
+        version_encontrada = await run_blocking("validate", read_template_version, file.file)
 
-        wb.close()
-        os.remove(temp_path)
-
-        # 5. Comparación exacta
-        VERSION_ESPERADA = "Versión 1.1: Febrero 2026"
-        
-        if version_encontrada == VERSION_ESPERADA:
+        # Comparación exacta
+        if version_encontrada == EXPECTED_VERSION:
             return {
                 "status": "success",
                 "message": "Validación exitosa: La plantilla es la correcta.",
@@ -544,17 +1963,195 @@ async def validate_template_version(file: UploadFile = File(...)):
                     "status": "error",
                     "detail": "La versión del documento no coincide.",
                     "encontrado": version_encontrada,
-                    "esperado": VERSION_ESPERADA
+                    "esperado": EXPECTED_VERSION
                 }
             )
 
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'temp_path' in locals() and os.path.exists(temp_path):
-            os.remove(temp_path)
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+
+@app.post("/api/consolidate/session/{session_id}/validate")
+async def validate_session_files(session_id: str):
+    """
+    POST /api/consolidate/session/{sessionId}/validate
+    Valida la versión de todos los archivos de la sesión (en paralelo)
+    
+    Returns:
+    - valid_count / invalid_count: archivos con y sin la versión esperada
+    - files: por archivo, status ("success" o "error"), versión encontrada
+      y, si corresponde, el detalle del error
+    """
+    archivos = get_session_files(session_id)
+    resultados = await run_blocking(
+        "validate", validate_files,
+        [workbook_source(info["path"], info.get("member")) for info in archivos.values()]
+    )
+    
+    detalle = []
+    for (file_id, info), (version, error) in zip(archivos.items(), resultados):
+        if error is None and version != EXPECTED_VERSION:
+            error = "La versión del documento no coincide."
+        detalle.append({
+            "file_id": file_id,
+            "filename": info["filename"],
+            "status": "success" if error is None else "error",
+            "version": version,
+            "detail": error
+        })
     
+    validos = sum(1 for item in detalle if item["status"] == "success")
+    return {
+        "session_id": session_id,
+        "esperado": EXPECTED_VERSION,
+        "files_count": len(detalle),
+        "valid_count": validos,
+        "invalid_count": len(detalle) - validos,
+        "files": detalle
+    }
+
+
+AUDIT_MODES = ("full", "summary", "page", "ndjson")
+
+
+def run_audit(temp_path: str, master_template_path: str, audit_id: str) -> Dict:
+    """Audita una subida en un proceso aparte guardando los cambios en audit_store"""
+    audit_store.prune()
+    try:
+        return blocking_executor.call_in_process(
+            write_audit, temp_path, master_template_path,
+            audit_store.changes_path(audit_id), audit_store.summary_path(audit_id)
+        )
+    finally:
+        remove_upload(temp_path)
+
+
+def audit_error_detail(e: BaseException) -> str:
+    return e.detail if isinstance(e, HTTPException) else f"Error en la auditoría: {str(e)}"
+
+
+def audit_summary_response(audit_id: str, resumen: Dict) -> Dict:
+    return {
+        "status": "success",
+        "audit_id": audit_id,
+        "total_cambios": resumen["total_cambios"],
+        "hojas": [{"hoja": h["hoja"], "cambios": h["cambios"]} for h in resumen["hojas"]]
+    }
+
+
+def parse_audit_filters(cursor: Optional[str], limit: int, range_ref: Optional[str]):
+    """Valida cursor, límite y rango de una página; retorna (cursor, rango)"""
+    if not 1 <= limit <= AUDIT_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit debe estar entre 1 y {AUDIT_PAGE_MAX}")
+    try:
+        posicion = int(cursor) if cursor is not None else None
+        if posicion is not None and posicion < 0:
+            raise ValueError(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    try:
+        bounds = parse_range(range_ref) if range_ref else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return posicion, bounds
+
+
+async def audit_page_response(audit_id: str, resumen: Dict, cursor: Optional[int], limit: int,
+                              sheet: Optional[str], bounds) -> Dict:
+    try:
+        cambios, siguiente = await run_blocking(
+            "audit_page", audit_store.read_page, audit_id, resumen, cursor, limit, sheet, bounds
+        )
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=f"Cursor inválido: {e}")
+    return {
+        "status": "success",
+        "audit_id": audit_id,
+        "total_cambios": resumen["total_cambios"],
+        "cambios": cambios,
+        "next_cursor": str(siguiente) if siguiente is not None else None
+    }
+
+
+def stream_audit_lines(audit_id: str, filtro=None, finished=None, errores: Optional[List[str]] = None):
+    """NDJSON de una auditoría en lotes de líneas (lo sigue leyendo mientras crece, con `finished`)"""
+    for lineas in iter_lines(audit_store.changes_path(audit_id), finished=finished):
+        if filtro is not None:
+            lineas = [linea for linea in lineas if filtro(json.loads(linea))]
+        if lineas:
+            yield b"\n".join(lineas) + b"\n"
+    if errores:
+        yield encode_change({"error": errores[0]}) + b"\n"
+
+
+def stream_audit_json(audit_id: str, resumen: Dict):
+    """Respuesta completa ({"status", "total_cambios", "cambios"}) armada desde el NDJSON"""
+    yield json.dumps({"status": "success", "audit_id": audit_id,
+                      "total_cambios": resumen["total_cambios"]}, ensure_ascii=False)[:-1].encode("utf-8")
+    yield b', "cambios": ['
+    separador = b""
+    for lineas in iter_lines(audit_store.changes_path(audit_id)):
+        yield separador + b",".join(lineas)
+        separador = b","
+    yield b"]}"
+
+
+NDJSON_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+async def stream_running_audit(audit_id: str, trabajo: "asyncio.Future", filtro) -> StreamingResponse:
+    """
+    Responde el NDJSON mientras la auditoría corre. Se espera a que el
+    proceso cree el archivo (o falle) para que 503/504 lleguen como estado
+    HTTP; un error posterior se informa en la última línea ({"error": ...}).
+    """
+    changes_path = audit_store.changes_path(audit_id)
+    while not trabajo.done() and not os.path.exists(changes_path):
+        await asyncio.sleep(0.02)
+    if trabajo.done():
+        trabajo.result()  # propaga el error, si lo hubo
+
+    terminado = threading.Event()
+    errores: List[str] = []
+
+    def al_terminar(t: "asyncio.Future"):
+        if not t.cancelled() and t.exception() is not None:
+            errores.append(audit_error_detail(t.exception()))
+        terminado.set()
+
+    trabajo.add_done_callback(al_terminar)
+    return StreamingResponse(
+        stream_audit_lines(audit_id, filtro, terminado.is_set, errores),
+        media_type="application/x-ndjson",
+        headers={"X-Audit-Id": audit_id, **NDJSON_HEADERS}
+    )
+
+
 @app.post("/api/consolidate/audit")
-async def audit_template_changes(file: UploadFile = File(...)):
+async def audit_template_changes(
+    file: UploadFile = File(...),
+    mode: str = "full",
+    limit: int = AUDIT_PAGE_LIMIT,
+    sheet: Optional[str] = None,
+    range_ref: Optional[str] = Query(None, alias="range")
+):
+    """
+    POST /api/consolidate/audit?mode=full|summary|page|ndjson
+    
+    - full: {"status", "audit_id", "total_cambios", "cambios"} (se transmite por partes)
+    - summary: solo la cantidad de cambios por hoja
+    - page: primera página (`limit`, `sheet`, `range`) y `next_cursor`
+    - ndjson: un cambio por línea a medida que se detectan (filtros `sheet`, `range`)
+    
+    Los cambios quedan guardados `AUDIT_TTL_SECONDS` para paginarlos con
+    GET /api/consolidate/audit/{auditId}.
+    """
+    if mode not in AUDIT_MODES:
+        raise HTTPException(status_code=400, detail=f"mode debe ser uno de: {', '.join(AUDIT_MODES)}")
+    _, bounds = parse_audit_filters(None, limit, range_ref)
+
     # 1. Ruta de la plantilla original (ajusta la ruta si es necesario)
     master_template_path = os.path.join(os.getcwd(), "SA_26_V1.1.xlsm")
     
@@ -562,66 +2159,105 @@ async def audit_template_changes(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail="No se encuentra la plantilla maestra en el servidor para comparar.")
 
     try:
-        # 2. Leer el archivo subido por el usuario en memoria
-        user_contents = await file.read()
-        from io import BytesIO
-        wb_user = openpyxl.load_workbook(BytesIO(user_contents), data_only=True)
-        
-        # 3. Leer la plantilla maestra
-        wb_master = openpyxl.load_workbook(master_template_path, data_only=True)
-        
-        cambios = []
+        temp_path = await run_blocking("upload", save_temp_upload, file, "audit")
+        audit_id = audit_store.new_id()
 
-        # 4. Recorrer las hojas (puedes limitar a las que te interesen)
-        # Por ahora recorremos todas las hojas que existan en ambos
-        for sheet_name in wb_master.sheetnames:
-            if sheet_name not in wb_user.sheetnames:
-                continue
-                
-            ws_master = wb_master[sheet_name]
-            ws_user = wb_user[sheet_name]
-
-            # Recorrer el rango usado en la plantilla maestra
-            for row in ws_master.iter_rows(min_row=1, max_col=ws_master.max_column, max_row=ws_master.max_row):
-                for cell in row:
-                    coord = cell.coordinate
-                    valor_maestro = cell.value
-                    valor_usuario = ws_user[coord].value
-
-                    # Comparar valores (ignorando espacios en blanco extra)
-                    if str(valor_usuario).strip() != str(valor_maestro).strip():
-                        # Solo registrar si el usuario escribió algo donde antes no había nada 
-                        # o si cambió un valor existente
-                        if valor_usuario is not None:
-                            cambios.append({
-                                "hoja": sheet_name,
-                                "celda": coord,
-                                "valor_original": valor_maestro,
-                                "valor_nuevo": valor_usuario
-                            })
-
-        wb_user.close()
-        wb_master.close()
+        # 2. Comparar el archivo subido con la plantilla maestra, fuera del event loop
+        trabajo = asyncio.ensure_future(run_blocking("audit", run_audit, temp_path, master_template_path, audit_id))
 
-        return {
-            "status": "success",
-            "total_cambios": len(cambios),
-            "cambios": cambios
-        }
+        def descartar_si_falla(t: "asyncio.Future"):
+            if t.cancelled() or t.exception() is not None:
+                audit_store.remove(audit_id)
+                remove_upload(temp_path)
+
+        trabajo.add_done_callback(descartar_si_falla)
+
+        if mode == "ndjson":
+            return await stream_running_audit(audit_id, trabajo, change_filter(sheet, bounds))
+
+        resumen = await trabajo
+        if mode == "summary":
+            return audit_summary_response(audit_id, resumen)
+        if mode == "page":
+            return await audit_page_response(audit_id, resumen, None, limit, sheet, bounds)
+        return StreamingResponse(stream_audit_json(audit_id, resumen), media_type="application/json")
 
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error en la auditoría: {str(e)}")
+        raise HTTPException(status_code=500, detail=audit_error_detail(e))
+
+
+def get_audit_summary(audit_id: str) -> Dict:
+    """Resumen guardado de la auditoría; 404 si no existe y 409 si sigue en curso"""
+    resumen = audit_store.load_summary(audit_id)
+    if resumen is None:
+        if audit_store.exists(audit_id):
+            raise HTTPException(status_code=409, detail="La auditoría aún está en curso")
+        raise HTTPException(status_code=404, detail=f"No se encontró la auditoría con ID: {audit_id}")
+    return resumen
+
+
+@app.get("/api/consolidate/audit/{audit_id}")
+async def get_audit_page(
+    audit_id: str,
+    cursor: Optional[str] = None,
+    limit: int = AUDIT_PAGE_LIMIT,
+    sheet: Optional[str] = None,
+    range_ref: Optional[str] = Query(None, alias="range")
+):
+    """
+    GET /api/consolidate/audit/{auditId}?cursor=&limit=&sheet=&range=
+    Página de cambios; `next_cursor` es null en la última página
+    """
+    posicion, bounds = parse_audit_filters(cursor, limit, range_ref)
+    resumen = get_audit_summary(audit_id)
+    return await audit_page_response(audit_id, resumen, posicion, limit, sheet, bounds)
+
+
+@app.get("/api/consolidate/audit/{audit_id}/summary")
+async def get_audit_summary_endpoint(audit_id: str):
+    """Cantidad de cambios por hoja de una auditoría guardada"""
+    return audit_summary_response(audit_id, get_audit_summary(audit_id))
+
+
+@app.get("/api/consolidate/audit/{audit_id}/ndjson")
+async def get_audit_ndjson(
+    audit_id: str,
+    sheet: Optional[str] = None,
+    range_ref: Optional[str] = Query(None, alias="range")
+):
+    """Cambios de una auditoría guardada, uno por línea (filtros `sheet`, `range`)"""
+    _, bounds = parse_audit_filters(None, 1, range_ref)
+    get_audit_summary(audit_id)
+    return StreamingResponse(
+        stream_audit_lines(audit_id, change_filter(sheet, bounds)),
+        media_type="application/x-ndjson",
+        headers={"X-Audit-Id": audit_id, **NDJSON_HEADERS}
+    )
+
 # ==================== UTILITY ENDPOINTS ====================
 
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/api/health")
 async def health_check():
     """Verifica el estado de la API"""
+    plantilla = current_template()
     return {
         "status": "healthy",
-        "template_loaded": app_state["template_path"] is not None,
-        "template_name": app_state["template_name"],
-        "active_sessions": len(app_state["uploaded_files"]),
-        "active_tasks": len([t for t in app_state["tasks"].values() if t["status"] == "processing"])
+        "template_loaded": plantilla.get("template_path") is not None,
+        "template_name": plantilla.get("template_name"),
+        "templates_registered": state_store.count_templates(),
+        "active_sessions": state_store.count_sessions(),
+        "active_tasks": state_store.count_jobs("processing"),
+        "queued_tasks": state_store.count_jobs("queued"),
+        "memory_budget_mb": MEMORY_BUDGET_MB,
+        "memory_reserved_mb": round(state_store.node_memory_reserved(job_workers.owner) / (1024 * 1024), 1)
     }
 
 
@@ -641,31 +2277,29 @@ async def cleanup_old_files():
     from datetime import datetime, timedelta
     cutoff_time = datetime.now() - timedelta(hours=1)
     
-    tasks_to_remove = []
-    for task_id, task_info in app_state["tasks"].items():
-        if task_info["status"] in ["completed", "error"]:
-            task_time = datetime.fromisoformat(task_info["created_at"])
-            if task_time < cutoff_time:
-                tasks_to_remove.append(task_id)
-    
-    for task_id in tasks_to_remove:
-        del app_state["tasks"][task_id]
-        cleaned["tasks"] += 1
+    cleaned["tasks"] = state_store.delete_finished_jobs(cutoff_time.isoformat())
     
     # Limpiar sesiones sin tareas asociadas
-    sessions_to_remove = []
-    for session_id in app_state["uploaded_files"].keys():
-        # Si no hay tareas activas para esta sesión, limpiar
-        has_active_task = any(
-            session_id in str(task_info) 
-            for task_info in app_state["tasks"].values()
-        )
-        if not has_active_task:
-            sessions_to_remove.append(session_id)
+    sessions_to_remove = [
+        session_id for session_id in state_store.list_sessions()
+        if not state_store.session_has_jobs(session_id)
+    ]
     
+    por_borrar = []
     for session_id in sessions_to_remove:
-        del app_state["uploaded_files"][session_id]
+        # Los archivos subidos se conservan mientras exista la sesión
+        por_borrar.extend(info["path"] for info in state_store.delete_session(session_id).values())
+        app_state["session_totals"].pop(session_id, None)
         cleaned["sessions"] += 1
+    # Los libros de un mismo ZIP comparten la ruta
+    por_borrar = list(dict.fromkeys(por_borrar))
+    await run_blocking("cleanup", remove_uploads, por_borrar)
+    cleaned["uploads"] = len(por_borrar)
+    
+    # Además, una pasada de la limpieza periódica: vencidos, cuotas y huérfanos
+    pasada = await run_blocking("cleanup", janitor.run_once)
+    for tipo, cantidad in pasada.items():
+        cleaned[tipo] = cleaned.get(tipo, 0) + cantidad
     
     return {
         "success": True,
@@ -678,29 +2312,28 @@ async def cleanup_old_files():
 async def reset_state():
     """Reinicia completamente el estado de la aplicación"""
     
-    # Limpiar plantilla
-    if app_state["template_path"] and os.path.exists(app_state["template_path"]):
-        try:
-            os.remove(app_state["template_path"])
-        except:
-            pass
-    
-    # Limpiar archivos subidos
-    for session_files in app_state["uploaded_files"].values():
-        for file_path in session_files:
+    # Limpiar plantillas
+    template_paths = {plantilla["template_path"] for plantilla in state_store.list_templates()}
+    template_paths.add(current_template().get("template_path"))
+    for template_path in template_paths:
+        if template_path and os.path.exists(template_path):
             try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+                os.remove(template_path)
             except:
                 pass
     
+    # Limpiar archivos subidos
+    por_borrar = []
+    for session_id in state_store.list_sessions():
+        por_borrar.extend(info["path"] for info in state_store.delete_session(session_id).values())
+    await run_blocking("cleanup", remove_uploads, por_borrar)
+    
+    # Limpiar consolidados (con sus datos, procedencia y agregados)
+    await run_blocking("cleanup", result_store.clear)
+    
     # Resetear estado
-    app_state["template_path"] = None
-    app_state["template_name"] = None
-    app_state["template_id"] = None
-    app_state["sheet_names"] = []
-    app_state["uploaded_files"] = {}
-    app_state["tasks"] = {}
+    state_store.reset()
+    app_state["session_totals"] = {}
     
     return {
         "success": True,
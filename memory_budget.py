@@ -0,0 +1,273 @@
+"""
+Presupuesto de memoria de las consolidaciones.
+
+Cada tarea se encola con una estimación de la memoria que usará (sumas
+densas de la plantilla, listas de celdas a escribir y las parciales de sus
+archivos). Con `MEMORY_BUDGET_MB` un nodo solo toma una tarea si la suma de
+las que ya corren en él (en todos sus procesos, ver StateStore.claim_job)
+más la nueva cabe en el presupuesto; una tarea que por sí sola no cabe corre
+cuando el nodo está libre.
+
+Con `JOB_MEMORY_MB` la tarea además se ajusta a ese presupuesto: las
+parciales por archivo se guardan en memoria hasta llenar lo que queda tras
+la parte fija, y las siguientes se derraman a disco (`SpillStore`: archivos
+de solo agregar, leídos con mmap), de donde el sistema puede descartarlas
+y releerlas según haga falta. Los libros ya se leen en streaming y la
+plantilla se escribe parchando su XML, así que ninguno se carga completo.
+
+El modelo de fórmulas no entra en la estimación: vive en template_cache,
+compartido por las tareas y acotado por `TEMPLATE_CACHE_MB`.
+"""
+import mmap
+import os
+import resource
+import shutil
+from collections.abc import MutableMapping
+from decimal import Decimal
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from consolidation import CONSOLIDATION_CHUNK_SIZE, CONSOLIDATION_WORKERS, Partial, SheetPartial
+from template_analysis import TemplateAnalysis
+
+# Memoria para consolidaciones por nodo y por tarea (MB, 0 = sin límite)
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", "0"))
+JOB_MEMORY_MB = int(os.environ.get("JOB_MEMORY_MB", "0"))
+
+# Bytes por celda con valor: índice, valor y conteo de una parcial; un Decimal suelto
+_PARTIAL_CELL_BYTES = 8 + 8 + 4
+_DECIMAL_BYTES = 104
+# Una celda escrita en las listas (fila, columna, valor) que van al libro y al .npz
+_WRITTEN_CELL_BYTES = 120
+
+
+def rss_bytes() -> int:
+    """Memoria residente actual del proceso"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Sin /proc: el máximo histórico es la mejor cota disponible (KB en Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def partial_nbytes(parcial: Partial) -> int:
+    total = 0
+    for parte in parcial.values():
+        total += parte.index.nbytes + parte.counts.nbytes
+        total += len(parte.values) * (8 + _DECIMAL_BYTES) if parte.exact else parte.values.nbytes
+    return total
+
+
+def _bit_count(bits: bytearray) -> int:
+    return int(np.unpackbits(np.frombuffer(bytes(bits), dtype=np.uint8)).sum())
+
+
+class MemoryEstimate(NamedTuple):
+    fixed: int      # sumas densas, celdas a escribir y parciales en tránsito
+    per_file: int   # cota de la parcial de un archivo
+    files: int
+
+    @property
+    def partials(self) -> int:
+        return self.per_file * self.files
+
+    def spill_limit(self, job_budget: int) -> Optional[int]:
+        """Bytes de parciales que la tarea retiene en memoria (None = todas)"""
+        if job_budget <= 0:
+            return None
+        return max(0, job_budget - self.fixed)
+
+    def reserved(self, job_budget: int) -> int:
+        """Memoria que la tarea reserva en el nodo"""
+        limite = self.spill_limit(job_budget)
+        return self.fixed + (self.partials if limite is None else min(self.partials, limite))
+
+
+def estimate_job_memory(analisis: TemplateAnalysis, hojas: List[str], files: int, exact: bool = False,
+                        provenance: bool = False, workers: int = CONSOLIDATION_WORKERS,
+                        chunk_size: int = CONSOLIDATION_CHUNK_SIZE) -> MemoryEstimate:
+    """
+    Cota de la memoria de una consolidación: cada archivo aporta a lo sumo
+    las celdas de entrada de la plantilla, y el total escribe a lo sumo esas.
+    """
+    hojas = [analisis.sheets[hoja] for hoja in hojas if hoja in analisis.sheets]
+    celdas = sum(hoja.max_row * hoja.max_col for hoja in hojas)
+    entradas = sum(_bit_count(hoja.input_bits) for hoja in hojas)
+    por_archivo = entradas * (_PARTIAL_CELL_BYTES + (_DECIMAL_BYTES if exact else 0))
+    fijo = celdas * (8 + 4) + entradas * (_WRITTEN_CELL_BYTES + (_DECIMAL_BYTES if exact else 0))
+    # Resultados de los bloques que llegan del pool antes de guardarlos
+    fijo += min(files, max(1, workers) * max(1, chunk_size)) * por_archivo
+    if provenance:
+        # La matriz de aportes se arma en memoria con todas las parciales
+        fijo += files * entradas * (8 + 4 + 8) * 2
+    return MemoryEstimate(fijo, por_archivo, files)
+
+
+class SpillStore:
+    """
+    Parciales en disco: un archivo de solo agregar por arreglo (índices,
+    valores, conteos), leído con mmap. En modo exacto los valores se guardan
+    como texto y se convierten a Decimal al leerlos.
+    """
+
+    _ARRAYS = ("index", "values", "counts")
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._paths = {nombre: os.path.join(folder, f"{nombre}.bin") for nombre in self._ARRAYS}
+        self._handles = {nombre: open(path, "wb") for nombre, path in self._paths.items()}
+        self._sizes = dict.fromkeys(self._ARRAYS, 0)
+        self._maps: Dict[str, mmap.mmap] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def _append(self, nombre: str, data: bytes) -> Tuple[int, int]:
+        inicio = self._sizes[nombre]
+        self._handles[nombre].write(data)
+        self._sizes[nombre] += len(data)
+        return inicio, len(data)
+
+    def put(self, parcial: Partial) -> Dict[str, Tuple]:
+        """Agrega la parcial; retorna su ubicación en los archivos, por hoja"""
+        ubicacion = {}
+        for hoja, parte in parcial.items():
+            if parte.exact:
+                valores = "\n".join(str(v) for v in parte.values.tolist()).encode()
+            else:
+                valores = np.ascontiguousarray(parte.values, dtype=np.float64).tobytes()
+            ubicacion[hoja] = (
+                len(parte.index), parte.exact,
+                self._append("index", np.ascontiguousarray(parte.index, dtype=np.int64).tobytes()),
+                self._append("values", valores),
+                self._append("counts", np.ascontiguousarray(parte.counts, dtype=np.int32).tobytes()),
+            )
+        return ubicacion
+
+    def _buffer(self, nombre: str):
+        if not self._sizes[nombre]:
+            return b""
+        mapa = self._maps.get(nombre)
+        if mapa is None or len(mapa) < self._sizes[nombre]:
+            # El archivo creció: se vuelve a mapear (los arreglos ya entregados
+            # mantienen vivo el mapa anterior hasta que se liberan)
+            self._handles[nombre].flush()
+            with open(self._paths[nombre], "rb") as fh:
+                mapa = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[nombre] = mapa
+        return mapa
+
+    def get(self, ubicacion: Dict[str, Tuple]) -> Partial:
+        parcial: Partial = {}
+        for hoja, (n, exact, (i_ini, _), (v_ini, v_len), (c_ini, _)) in ubicacion.items():
+            index = np.frombuffer(self._buffer("index"), dtype=np.int64, count=n, offset=i_ini)
+            if exact:
+                texto = self._buffer("values")[v_ini:v_ini + v_len].decode() if n else ""
+                values = np.array([Decimal(v) for v in texto.split("\n")] if n else [], dtype=object)
+            else:
+                values = np.frombuffer(self._buffer("values"), dtype=np.float64, count=n, offset=v_ini)
+            counts = np.frombuffer(self._buffer("counts"), dtype=np.int32, count=n, offset=c_ini)
+            parcial[hoja] = SheetPartial(index, values, counts)
+        return parcial
+
+    def close(self):
+        for fh in self._handles.values():
+            fh.close()
+        # Los mapas se cierran cuando se liberan los arreglos que los usan
+        self._maps.clear()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class BoundedPartials(MutableMapping):
+    """
+    Parciales de una tarea por hash de archivo. Se retienen en memoria
+    mientras no superen `limit_bytes` (None = sin límite); las siguientes se
+    derraman a un SpillStore en `spill_folder` y se leen mapeadas al usarlas.
+    También registra el pico de memoria residente del proceso durante la
+    tarea (al guardar cada parcial y en cada `sample_rss`).
+    """
+
+    def __init__(self, limit_bytes: Optional[int], spill_folder: str):
+        self.limit_bytes = limit_bytes
+        self.spill_folder = spill_folder
+        self._memoria: Dict[str, Partial] = {}
+        self._tamanos: Dict[str, int] = {}
+        self._derramadas: Dict[str, Dict[str, Tuple]] = {}
+        self._store: Optional[SpillStore] = None
+        self.held_bytes = 0
+        self.peak_held_bytes = 0
+        self.start_rss = self.peak_rss = rss_bytes()
+
+    def sample_rss(self) -> int:
+        actual = rss_bytes()
+        self.peak_rss = max(self.peak_rss, actual)
+        return actual
+
+    def __setitem__(self, clave: str, parcial: Partial):
+        self.pop(clave, None)
+        self.sample_rss()
+        tamano = partial_nbytes(parcial)
+        if self.limit_bytes is None or self.held_bytes + tamano <= self.limit_bytes:
+            self._memoria[clave] = parcial
+            self._tamanos[clave] = tamano
+            self.held_bytes += tamano
+            self.peak_held_bytes = max(self.peak_held_bytes, self.held_bytes)
+            return
+        if self._store is None:
+            self._store = SpillStore(self.spill_folder)
+        self._derramadas[clave] = self._store.put(parcial)
+
+    def __getitem__(self, clave: str) -> Partial:
+        if clave in self._memoria:
+            return self._memoria[clave]
+        if clave not in self._derramadas:
+            raise KeyError(clave)
+        return self._store.get(self._derramadas[clave])
+
+    def __delitem__(self, clave: str):
+        if clave in self._memoria:
+            del self._memoria[clave]
+            self.held_bytes -= self._tamanos.pop(clave)
+        else:
+            # Lo derramado queda en disco hasta close()
+            del self._derramadas[clave]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._memoria
+        yield from self._derramadas
+
+    def __len__(self) -> int:
+        return len(self._memoria) + len(self._derramadas)
+
+    def __contains__(self, clave) -> bool:
+        return clave in self._memoria or clave in self._derramadas
+
+    @property
+    def spilled(self) -> int:
+        return len(self._derramadas)
+
+    @property
+    def spilled_bytes(self) -> int:
+        return self._store.nbytes if self._store is not None else 0
+
+    def stats(self) -> Dict[str, int]:
+        """Métricas de memoria de la tarea (se agregan a las de la tarea)"""
+        return {
+            "memory_partials_peak_bytes": self.peak_held_bytes,
+            "memory_spilled_files": self.spilled,
+            "memory_spilled_bytes": self.spilled_bytes,
+            "memory_rss_start_bytes": self.start_rss,
+            "memory_rss_peak_bytes": self.peak_rss,
+        }
+
+    def close(self):
+        self._memoria.clear()
+        self._derramadas.clear()
+        self.held_bytes = 0
+        if self._store is not None:
+            self._store.close()
+            self._store = None
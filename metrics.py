@@ -0,0 +1,181 @@
+"""
+Métricas en formato de texto de Prometheus, sin dependencias externas.
+
+Contadores e histogramas con etiquetas, más gauges que se calculan al
+momento de exponerlos (por ejemplo, la profundidad de la cola en SQLite).
+Cada proceso de la API expone sus propios contadores. `TaskTimings` registra
+los tiempos por etapa de una consolidación para el estado de la tarea.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Segundos: desde lecturas de archivos pequeños hasta consolidaciones largas
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_value(valor: float) -> str:
+    if math.isinf(valor):
+        return "+Inf" if valor > 0 else "-Inf"
+    if float(valor).is_integer():
+        return str(int(valor))
+    return repr(float(valor))
+
+
+def _escape(valor: str) -> str:
+    return valor.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(nombres: Sequence[str], valores: LabelValues, extra: str = "") -> str:
+    partes = [f'{nombre}="{_escape(valor)}"' for nombre, valor in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(nombre, "")) for nombre in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.labelnames:
+            values = {(): 0}
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, key)} {_format_value(valor)}"
+            for key, valor in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # {etiquetas: ([conteo por bucket], suma, total)}
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, valor: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            conteos, suma, total = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    conteos[i] += 1
+                    break
+            self._values[key] = (conteos, suma + valor, total + 1)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = {key: (list(c), s, t) for key, (c, s, t) in self._values.items()}
+        if not values and not self.labelnames:
+            values = {(): ([0] * len(self.buckets), 0.0, 0)}
+        lineas = self.header()
+        for key, (conteos, suma, total) in sorted(values.items()):
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, conteos):
+                acumulado += conteo
+                le = f'le="{_format_value(limite)}"'
+                lineas.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {acumulado}")
+            lineas.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format_value(suma)}")
+            lineas.append(f"{self.name}_count{_labels(self.labelnames, key)} {total}")
+        return lineas
+
+
+class Gauge(_Metric):
+    """Gauge calculado al exponer las métricas"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name} {_format_value(self.callback())}"]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, documentation, callback))
+
+    def render(self) -> str:
+        lineas: List[str] = []
+        for metric in self._metrics:
+            lineas.extend(metric.render())
+        return "\n".join(lineas) + "\n"
+
+
+class TaskTimings:
+    """Tiempos por etapa y estadísticas por archivo de una tarea"""
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.files: List[Dict] = []
+        self.counts: Dict[str, int] = {}
+        self._inicio = time.perf_counter()
+
+    @contextmanager
+    def stage(self, nombre: str):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[nombre] = self.stages.get(nombre, 0.0) + time.perf_counter() - inicio
+
+    def add_file(self, **stats):
+        self.files.append(stats)
+
+    def as_dict(self) -> Dict:
+        return {
+            "total_seconds": round(time.perf_counter() - self._inicio, 4),
+            "stages": {nombre: round(segundos, 4) for nombre, segundos in self.stages.items()},
+            **self.counts,
+            "files": self.files,
+        }
@@ -0,0 +1,185 @@
+"""
+Ejecución del trabajo bloqueante de los endpoints fuera del event loop.
+
+Leer un libro con openpyxl, copiar una subida a disco o calcular un hash
+bloquean el hilo que los ejecuta; si eso ocurre dentro de un `async def`, se
+detienen todas las peticiones del proceso (incluidas las consultas de
+estado). `BlockingExecutor` los corre en un pool de hilos propio y acotado,
+con un límite de concurrencia y un timeout por tipo de trabajo:
+
+- si no hay cupo para el tipo dentro de `queue_timeout`, se lanza `ExecutorBusy`;
+- si el trabajo no termina dentro de su timeout, se lanza `ExecutorTimeout`.
+
+Un hilo no se puede interrumpir: tras un timeout el trabajo sigue hasta
+terminar y su cupo se libera recién entonces, para que el límite refleje el
+trabajo que realmente está corriendo.
+
+El trabajo de CPU puro (leer un libro completo con openpyxl) conviene
+pasarlo a `call_in_process` desde el hilo: en un hilo retiene el GIL y
+sigue compitiendo con el event loop. Los procesos son persistentes: así
+conservan entre tareas lo que cachean en memoria (por ejemplo, el snapshot
+de la plantilla maestra de la auditoría).
+"""
+import asyncio
+import multiprocessing
+import threading
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# (concurrencia máxima, timeout en segundos) por tipo de trabajo
+Limits = Dict[str, Tuple[int, float]]
+# observer(tipo, segundos esperando cupo, segundos de ejecución)
+Observer = Callable[[str, float, float], None]
+
+
+class ExecutorBusy(Exception):
+    """No hubo cupo para el tipo de trabajo dentro del tiempo de espera"""
+
+    def __init__(self, kind: str):
+        super().__init__(f"Demasiados trabajos '{kind}' en curso")
+        self.kind = kind
+
+
+class ExecutorTimeout(Exception):
+    """El trabajo superó su timeout (sigue corriendo hasta terminar)"""
+
+    def __init__(self, kind: str, timeout: float):
+        super().__init__(f"El trabajo '{kind}' superó {timeout:g}s")
+        self.kind = kind
+        self.timeout = timeout
+
+
+class BlockingExecutor:
+    def __init__(self, max_workers: int, limits: Limits, default: Tuple[int, float] = (1, 60.0),
+                 queue_timeout: float = 30.0, observer: Optional[Observer] = None,
+                 process_workers: int = 1):
+        self.max_workers = max(1, max_workers)
+        self.process_workers = max(1, process_workers)
+        self.limits = dict(limits)
+        self.default = default
+        self.queue_timeout = queue_timeout
+        self.observer = observer
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._processes: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # Los semáforos de asyncio pertenecen a un event loop: uno por loop y tipo
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._running: Dict[str, int] = {}
+
+    def limit(self, kind: str) -> Tuple[int, float]:
+        return self.limits.get(kind, self.default)
+
+    def running(self, kind: str) -> int:
+        """Trabajos del tipo que ocupan un hilo (incluye los que superaron su timeout)"""
+        with self._lock:
+            return self._running.get(kind, 0)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="blocking")
+            return self._executor
+
+    def _get_processes(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._processes is None:
+                # spawn evita heredar hilos y locks del servidor al hacer fork
+                self._processes = ProcessPoolExecutor(
+                    self.process_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._processes
+
+    def call_in_process(self, func: Callable[..., T], *args) -> T:
+        """
+        Ejecuta `func(*args)` en un proceso aparte y espera el resultado
+        (bloqueante: se llama desde una función que ya corre en el pool).
+        `func` debe estar en un módulo importable sin efectos (no en main).
+        """
+        procesos = self._get_processes()
+        try:
+            return procesos.submit(func, *args).result()
+        except BrokenProcessPool:
+            # Un proceso murió (por ejemplo, por memoria): la próxima vez se crea otro pool
+            with self._lock:
+                if self._processes is procesos:
+                    self._processes = None
+            procesos.shutdown(wait=False)
+            raise
+
+    def _semaphore(self, kind: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            por_tipo = self._semaphores.setdefault(loop, {})
+            if kind not in por_tipo:
+                por_tipo[kind] = asyncio.Semaphore(max(1, self.limit(kind)[0]))
+            return por_tipo[kind]
+
+    def _track(self, kind: str, delta: int):
+        with self._lock:
+            self._running[kind] = self._running.get(kind, 0) + delta
+
+    async def run(self, kind: str, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Ejecuta `func(*args, **kwargs)` en el pool y espera su resultado sin
+        bloquear el event loop. Retorna su resultado o lanza la excepción de
+        `func`, `ExecutorBusy` o `ExecutorTimeout`.
+        """
+        _, timeout = self.limit(kind)
+        semaforo = self._semaphore(kind)
+        inicio = time.perf_counter()
+        try:
+            await asyncio.wait_for(semaforo.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise ExecutorBusy(kind) from None
+
+        loop = asyncio.get_running_loop()
+        espera = time.perf_counter() - inicio
+        self._track(kind, 1)
+
+        def medido():
+            comienzo = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if self.observer is not None:
+                    self.observer(kind, espera, time.perf_counter() - comienzo)
+
+        def terminado(_):
+            self._track(kind, -1)
+            try:
+                loop.call_soon_threadsafe(semaforo.release)
+            except RuntimeError:
+                pass  # el loop ya se cerró
+
+        try:
+            futuro = self._get_executor().submit(medido)
+        except BaseException:
+            self._track(kind, -1)
+            semaforo.release()
+            raise
+        futuro.add_done_callback(terminado)
+        resultado = asyncio.wrap_future(futuro)
+        try:
+            # shield: cancelar la espera no debe cancelar el futuro (el cupo
+            # se libera cuando el hilo termina, en `terminado`)
+            return await asyncio.wait_for(asyncio.shield(resultado), timeout)
+        except asyncio.TimeoutError:
+            # Nadie leerá el resultado; se consume para que asyncio no lo reporte
+            resultado.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise ExecutorTimeout(kind, timeout) from None
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            procesos, self._processes = self._processes, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if procesos is not None:
+            procesos.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,148 @@
+"""
+Caché en disco de sumas parciales por archivo.
+
+La clave es el hash SHA-256 del archivo más el hash de la plantilla (y el
+modo exacto): el mismo archivo subido de nuevo, en la misma u otra sesión,
+no se vuelve a leer. Cada entrada recuerda qué hojas se leyeron, de modo que
+una consolidación con más hojas solo lee las que faltan.
+
+Cada lectura renueva la fecha de modificación de la entrada, así `evict`
+puede borrar primero las que llevan más tiempo sin usarse.
+"""
+import json
+import os
+import threading
+from decimal import Decimal
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from consolidation import Partial, SheetPartial
+
+# Se incrementa cuando cambia qué celdas suma el lector: las parciales de una
+# versión anterior se descartan y el archivo se vuelve a leer
+PARTIAL_VERSION = 2
+
+
+class PartialCache:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, file_hash: str, template_hash: str, exact: bool) -> str:
+        modo = "exact" if exact else "float"
+        return os.path.join(self.folder, template_hash[:16], f"{file_hash}.{modo}.npz")
+
+    def _load(self, path: str) -> Tuple[List[str], Partial]:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("version") != PARTIAL_VERSION:
+                raise ValueError(f"Parcial de otra versión: {meta.get('version')}")
+            parcial: Partial = {}
+            for i, hoja in enumerate(meta["sheets"]):
+                values = data[f"v{i}"]
+                if meta["exact"]:
+                    values = np.array([Decimal(v) for v in values.tolist()], dtype=object)
+                parcial[hoja] = SheetPartial(data[f"i{i}"], values, data[f"c{i}"])
+        return meta["parsed"], parcial
+
+    def get(self, file_hash: str, template_hash: str, hojas: Iterable[str],
+            exact: bool = False) -> Optional[Partial]:
+        """Parcial del archivo restringida a `hojas`, o None si falta alguna hoja"""
+        parcial, faltan = self.get_with_missing(file_hash, template_hash, hojas, exact)
+        return None if faltan else parcial
+
+    def get_with_missing(self, file_hash: str, template_hash: str, hojas: Iterable[str],
+                         exact: bool = False) -> Tuple[Partial, List[str]]:
+        """
+        (parcial de las hojas de `hojas` ya leídas, hojas que aún no se han
+        leído para este archivo); sin entrada en caché, ({}, todas las hojas)
+        """
+        hojas = list(hojas)
+        path = self._path(file_hash, template_hash, exact)
+        try:
+            leidas, parcial = self._load(path)
+        except (OSError, ValueError, KeyError):
+            return {}, hojas
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        faltan = [hoja for hoja in hojas if hoja not in leidas]
+        return {hoja: parcial[hoja] for hoja in hojas if hoja in parcial}, faltan
+
+    def put(self, file_hash: str, template_hash: str, hojas_leidas: Iterable[str],
+            parcial: Partial, exact: bool = False):
+        """Guarda la parcial; se combina con las hojas ya guardadas del archivo"""
+        path = self._path(file_hash, template_hash, exact)
+        with self._lock:
+            leidas = list(hojas_leidas)
+            combinada = dict(parcial)
+            try:
+                anteriores, previa = self._load(path)
+                leidas = sorted(set(anteriores) | set(leidas))
+                for hoja, parte in previa.items():
+                    combinada.setdefault(hoja, parte)
+            except (OSError, ValueError, KeyError):
+                pass
+
+            arrays = {}
+            hojas = list(combinada)
+            for i, hoja in enumerate(hojas):
+                parte = combinada[hoja]
+                values = parte.values
+                if exact:
+                    values = np.array([str(v) for v in values.tolist()], dtype=np.str_)
+                arrays[f"i{i}"] = parte.index
+                arrays[f"v{i}"] = values
+                arrays[f"c{i}"] = parte.counts
+            meta = {"version": PARTIAL_VERSION, "sheets": hojas, "parsed": leidas, "exact": exact}
+            arrays["meta"] = np.array(json.dumps(meta))
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as fh:
+                np.savez(fh, **arrays)
+            os.replace(tmp_path, path)
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """(último uso, bytes, ruta) de cada archivo de la caché (también .tmp que quedaron a medias)"""
+        entradas = []
+        with os.scandir(self.folder) as carpetas:
+            for carpeta in carpetas:
+                if not carpeta.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(carpeta.path) as archivos:
+                    for archivo in archivos:
+                        try:
+                            if archivo.is_file(follow_symlinks=False):
+                                info = archivo.stat()
+                                entradas.append((info.st_mtime, info.st_size, archivo.path))
+                        except OSError:
+                            pass
+        return entradas
+
+    def evict(self, quota_bytes: int = 0, expired_before: Optional[float] = None,
+              limit: Optional[int] = None) -> int:
+        """
+        Borra las entradas sin uso desde `expired_before` y, mientras el total
+        supere `quota_bytes` (0: sin cuota), las menos usadas; a lo sumo
+        `limit`. Retorna cuántas se borraron
+        """
+        entradas = sorted(self._entries())
+        total = sum(tamano for _, tamano, _ in entradas)
+        borradas = 0
+        for usada, tamano, path in entradas:
+            if limit is not None and borradas >= limit:
+                break
+            vencida = expired_before is not None and usada < expired_before
+            if not vencida and not (quota_bytes > 0 and total > quota_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= tamano
+            borradas += 1
+        return borradas
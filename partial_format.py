@@ -0,0 +1,232 @@
+"""
+Agregado parcial: las sumas de un grupo de archivos en un archivo que se
+puede combinar con otros y volcar sobre la plantilla.
+
+Sirve para repartir una consolidación grande entre varias máquinas (ver
+distributed.py): cada nodo produce el agregado de sus archivos, los
+agregados se combinan en cualquier orden y agrupación (sumas y conteos por
+celda: la combinación es asociativa y conmutativa) y el total se finaliza
+sobre la plantilla como cualquier consolidado.
+
+Formato (versión 1): un .npz sin pickle con
+
+- `meta`: JSON {"format": "rem-partial", "version": 1, "template_hash",
+  "exact", "file_count", "files": [sha256 de cada archivo sumado, con
+  repeticiones], "errors": [[archivo, error]], "sheets": [hoja, ...],
+  "max_cols": {hoja: columnas de la hoja en la plantilla}}
+- por hoja i (en el orden de `sheets`), celdas ordenadas por fila y columna:
+  `rows_i` y `cols_i` (int32, desde 1), `values_i` (float64; en modo exacto,
+  el Decimal como texto) y `counts_i` (int32: archivos con valor en la celda)
+
+Un lector rechaza un `format` o una `version` que no conoce. Combinar no
+quita archivos repetidos: los nodos deben recibir grupos disjuntos.
+
+La API guarda el agregado de cada consolidado junto al resultado
+(`aggregate_filename`), para usarlo como entrada de un nivel superior
+(comuna → región → país) sin volver a leer ningún libro.
+"""
+import json
+import os
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from consolidation import (
+    CONSOLIDATION_WORKERS, ConsolidationAccumulator, Partial, ProgressCallback, SheetPartial,
+    consolidate_partials, partial_cells, tree_reduce
+)
+from formula_engine import EVALUATE_FORMULAS, FormulaState, get_formula_model
+from result_data import write_result_data
+from template_analysis import TemplateAnalysis, file_sha256, get_template_analysis
+from xlsx_writer import write_patched_workbook
+
+AGGREGATE_FORMAT = "rem-partial"
+AGGREGATE_VERSION = 1
+
+
+class InvalidAggregate(ValueError):
+    """El archivo no es un agregado parcial legible o no combina con otro"""
+
+
+def aggregate_filename(result_id: str) -> str:
+    return f"REM_Agregado_{result_id}.npz"
+
+
+@dataclass
+class PartialAggregate:
+    template_hash: str
+    exact: bool
+    max_cols: Dict[str, int]
+    # Índices planos por hoja, como las parciales de consolidation
+    sheets: Partial = field(default_factory=dict)
+    files: List[str] = field(default_factory=list)
+    errors: List[Tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def file_count(self) -> int:
+        return len(self.files)
+
+    @classmethod
+    def empty(cls, analisis: TemplateAnalysis, hojas: Iterable[str], exact: bool = False) -> "PartialAggregate":
+        return cls(analisis.sha256, exact, {hoja: analisis.sheets[hoja].max_col for hoja in hojas})
+
+
+def aggregate_files(file_paths: List[str], hojas: List[str], template_path: str, analysis_folder: str,
+                    exact: bool = False, template_hash: Optional[str] = None,
+                    workers: int = CONSOLIDATION_WORKERS,
+                    on_progress: Optional[ProgressCallback] = None) -> PartialAggregate:
+    """Lee los archivos (map/reduce local, ver consolidate_partials) a un agregado"""
+    analisis = get_template_analysis(template_path, analysis_folder, template_hash)
+    hojas = [hoja for hoja in hojas if hoja in analisis.sheets]
+    agregado = PartialAggregate.empty(analisis, hojas, exact)
+
+    def registrar(file_path: str, parcial: Optional[Partial], error: Optional[str], _segundos: float):
+        if error is not None:
+            agregado.errors.append((os.path.basename(file_path), error))
+        else:
+            agregado.files.append(file_sha256(file_path))
+
+    agregado.sheets, _ = consolidate_partials(
+        file_paths, hojas, template_path, analisis.sha256, analysis_folder,
+        workers=workers, exact=exact, on_progress=on_progress, on_file=registrar
+    )
+    return agregado
+
+
+def merge_aggregates(agregados: List[PartialAggregate]) -> PartialAggregate:
+    """Combina agregados de la misma plantilla y modo (por pares, sin modificarlos)"""
+    if not agregados:
+        raise InvalidAggregate("No hay agregados para combinar")
+    primero = agregados[0]
+    for agregado in agregados[1:]:
+        if agregado.template_hash != primero.template_hash:
+            raise InvalidAggregate("Los agregados son de plantillas distintas")
+        if agregado.exact != primero.exact:
+            raise InvalidAggregate("Los agregados mezclan suma exacta y de punto flotante")
+    max_cols: Dict[str, int] = {}
+    for agregado in agregados:
+        max_cols.update(agregado.max_cols)
+    return PartialAggregate(
+        primero.template_hash, primero.exact, max_cols,
+        tree_reduce([agregado.sheets for agregado in agregados]),
+        [sha for agregado in agregados for sha in agregado.files],
+        [error for agregado in agregados for error in agregado.errors],
+    )
+
+
+def write_aggregate(path: str, agregado: PartialAggregate) -> int:
+    """Escribe el agregado de forma atómica; retorna su tamaño"""
+    hojas = list(agregado.max_cols)
+    arreglos = {"meta": np.array(json.dumps({
+        "format": AGGREGATE_FORMAT,
+        "version": AGGREGATE_VERSION,
+        "template_hash": agregado.template_hash,
+        "exact": agregado.exact,
+        "file_count": agregado.file_count,
+        "files": agregado.files,
+        "errors": [list(error) for error in agregado.errors],
+        "sheets": hojas,
+        "max_cols": agregado.max_cols,
+    }))}
+    for i, hoja in enumerate(hojas):
+        parte = agregado.sheets.get(hoja)
+        max_col = agregado.max_cols[hoja]
+        if parte is None:
+            parte = SheetPartial(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int32))
+        arreglos[f"rows_{i}"] = (parte.index // max_col + 1).astype(np.int32)
+        arreglos[f"cols_{i}"] = (parte.index % max_col + 1).astype(np.int32)
+        if agregado.exact:
+            arreglos[f"values_{i}"] = np.array([str(v) for v in parte.values.tolist()] or [], dtype=np.str_)
+        else:
+            arreglos[f"values_{i}"] = parte.values.astype(np.float64)
+        arreglos[f"counts_{i}"] = parte.counts.astype(np.int32)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez_compressed(fh, **arreglos)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _check_meta(path: str, meta: Dict):
+    if meta.get("format") != AGGREGATE_FORMAT:
+        raise InvalidAggregate(f"{os.path.basename(path)} no es un agregado parcial")
+    if meta.get("version") != AGGREGATE_VERSION:
+        raise InvalidAggregate(f"Versión de agregado no soportada: {meta.get('version')}")
+
+
+def read_aggregate_meta(path: str) -> Dict:
+    """Solo el `meta` del agregado (sin leer las celdas)"""
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+    except (OSError, ValueError, KeyError) as e:
+        raise InvalidAggregate(f"No se pudo leer el agregado {os.path.basename(path)}: {e}") from None
+    _check_meta(path, meta)
+    return meta
+
+
+def read_aggregate(path: str) -> PartialAggregate:
+    """Lee un agregado; InvalidAggregate si no es uno o es de una versión desconocida"""
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            _check_meta(path, meta)
+            agregado = PartialAggregate(
+                meta["template_hash"], meta["exact"], meta["max_cols"],
+                files=meta["files"], errors=[tuple(error) for error in meta["errors"]],
+            )
+            for i, hoja in enumerate(meta["sheets"]):
+                max_col = agregado.max_cols[hoja]
+                index = (npz[f"rows_{i}"].astype(np.int64) - 1) * max_col + npz[f"cols_{i}"] - 1
+                if not len(index):
+                    continue
+                values = npz[f"values_{i}"]
+                if agregado.exact:
+                    values = np.array([Decimal(v) for v in values.tolist()], dtype=object)
+                agregado.sheets[hoja] = SheetPartial(index, values, npz[f"counts_{i}"])
+    except InvalidAggregate:
+        raise
+    except (OSError, ValueError, KeyError) as e:
+        raise InvalidAggregate(f"No se pudo leer el agregado {os.path.basename(path)}: {e}") from None
+    if meta.get("file_count") != agregado.file_count:
+        raise InvalidAggregate(f"El agregado {os.path.basename(path)} está incompleto")
+    return agregado
+
+
+def finalize_aggregate(agregado: PartialAggregate, template_path: str, analysis_folder: str, output_path: str,
+                       data_path: Optional[str] = None, evaluate_formulas: bool = EVALUATE_FORMULAS) -> Dict:
+    """
+    Vuelca el agregado sobre la plantilla como un consolidado (sumas,
+    fórmulas evaluadas y, si se indica `data_path`, los datos en .npz).
+    Retorna un resumen; InvalidAggregate si la plantilla no es la del agregado.
+    """
+    template_hash = file_sha256(template_path)
+    if template_hash != agregado.template_hash:
+        raise InvalidAggregate("La plantilla no es la misma con la que se produjo el agregado")
+    analisis = get_template_analysis(template_path, analysis_folder, template_hash)
+    hojas = [hoja for hoja in agregado.max_cols if hoja in analisis.sheets]
+
+    sumas = ConsolidationAccumulator(analisis, hojas, agregado.exact)
+    sumas.add_partial(agregado.sheets)
+    celdas = {hoja: list(sumas.iter_cells(hoja)) for hoja in hojas}
+
+    calculadas = None
+    if evaluate_formulas:
+        modelo = get_formula_model(template_path, analisis)
+        estado = FormulaState()
+        modelo.recalculate(estado, hojas, celdas)
+        calculadas = modelo.formula_cells(estado, hojas)
+    if data_path:
+        valores = modelo.numeric_values(estado, hojas) if calculadas is not None else {}
+        write_result_data(data_path, {hoja: celdas[hoja] + valores.get(hoja, []) for hoja in hojas})
+    faltantes = write_patched_workbook(template_path, output_path, celdas, calculadas)
+    return {
+        "file_count": agregado.file_count,
+        "errors": agregado.errors,
+        "sheets": len(hojas),
+        "cells_in_aggregate": partial_cells(agregado.sheets),
+        "cells_written": sum(len(celdas[hoja]) for hoja in hojas),
+        "cells_missing_in_template": faltantes,
+    }
@@ -0,0 +1,93 @@
+"""
+Avisos de progreso para SSE y WebSocket.
+
+Las funciones que actualizan una tarea llaman a `ProgressBroker.publish`
+(desde el hilo de la consolidación); cada conexión abierta espera un
+`asyncio.Event` que se despierta con `call_soon_threadsafe`. Si la tarea se
+ejecuta en otro proceso no llega el aviso, así que además se relee el estado
+cada `poll_interval` segundos (una consulta local, no una petición HTTP).
+"""
+import asyncio
+import json
+import threading
+from typing import AsyncIterator, Callable, Dict, Optional, Set, Tuple
+
+FINAL_STATUSES = ("completed", "error")
+
+
+class ProgressBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+
+    def subscribe(self, task_id: str) -> Tuple[asyncio.AbstractEventLoop, asyncio.Event]:
+        sub = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._subs.setdefault(task_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, task_id: str, sub: Tuple[asyncio.AbstractEventLoop, asyncio.Event]):
+        with self._lock:
+            subs = self._subs.get(task_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subs[task_id]
+
+    def publish(self, task_id: str):
+        """Despierta a las conexiones de la tarea (seguro desde cualquier hilo)"""
+        with self._lock:
+            subs = list(self._subs.get(task_id, ()))
+        for loop, event in subs:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # el loop ya se cerró
+
+
+async def task_updates(task_id: str, get_state: Callable[[str], Optional[Dict]],
+                       broker: ProgressBroker, min_interval: float = 0.25,
+                       poll_interval: float = 1.0,
+                       keepalive: float = 15.0) -> AsyncIterator[Optional[Dict]]:
+    """
+    Entrega el estado de la tarea cada vez que cambia, como máximo una vez
+    por `min_interval` (los cambios intermedios se fusionan y solo se envía
+    el último). Entrega None si pasan `keepalive` segundos sin cambios. Termina
+    después de enviar un estado final o si la tarea deja de existir.
+    """
+    loop = asyncio.get_running_loop()
+    sub = broker.subscribe(task_id)
+    _, event = sub
+    try:
+        ultimo = None
+        ultimo_envio = loop.time()
+        while True:
+            event.clear()
+            estado = get_state(task_id)
+            if estado is None:
+                return
+            if estado != ultimo:
+                yield estado
+                ultimo = estado
+                ultimo_envio = loop.time()
+                if estado["status"] in FINAL_STATUSES:
+                    return
+                await asyncio.sleep(min_interval)
+                if event.is_set():
+                    continue
+            elif loop.time() - ultimo_envio >= keepalive:
+                yield None
+                ultimo_envio = loop.time()
+            try:
+                await asyncio.wait_for(event.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        broker.unsubscribe(task_id, sub)
+
+
+def format_sse(estado: Optional[Dict]) -> str:
+    """Mensaje SSE: evento con el estado como JSON, o comentario de keepalive"""
+    if estado is None:
+        return ": keepalive\n\n"
+    return f"event: {estado['status']}\ndata: {json.dumps(estado, ensure_ascii=False)}\n\n"
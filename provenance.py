@@ -0,0 +1,186 @@
+"""
+Procedencia por celda: qué archivo aportó cuánto a cada total.
+
+Al consolidar con `provenance` se guarda, junto al resultado, una matriz
+dispersa archivo × celda armada con las parciales de cada archivo (las
+mismas que se suman; no se vuelve a leer ningún libro). Por hoja se guarda
+en columnas ordenadas por celda, como CSR: claves únicas (fila << 15) |
+columna, `offsets` con el inicio de cada celda, y por aporte el índice del
+archivo y su valor. Así los aportes de una celda son un tramo contiguo que
+se ubica con una búsqueda binaria.
+
+Los atípicos de una celda se marcan con el puntaje z modificado (mediana y
+desviación absoluta mediana) sobre los aportes de los archivos que tienen
+valor en esa celda.
+"""
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from openpyxl.utils import get_column_letter
+
+from consolidation import Partial
+from template_analysis import TemplateAnalysis
+from xlsx_reader import CellBounds
+
+_COL_BITS = 15
+
+# Puntaje z modificado desde el que un aporte se considera atípico (Iglewicz y Hoaglin)
+OUTLIER_THRESHOLD = float(os.environ.get("PROVENANCE_OUTLIER_THRESHOLD", "3.5"))
+# Registrar la procedencia cuando `provenance` no se envía
+PROVENANCE_DEFAULT = os.environ.get("CONSOLIDATION_PROVENANCE", "").lower() in ("1", "true", "yes")
+
+
+def provenance_filename(result_id: str) -> str:
+    return f"REM_Procedencia_{result_id}.npz"
+
+
+def write_provenance(path: str, aportes: List[Tuple[Dict, Partial]], analisis: TemplateAnalysis,
+                     hojas: Iterable[str]) -> int:
+    """
+    Escribe la matriz de aportes. `aportes` es [(registro del archivo en la
+    sesión, parcial)] en el orden de la sesión. Retorna el tamaño del .npz.
+    """
+    hojas = [hoja for hoja in hojas if hoja in analisis.sheets]
+    arreglos = {
+        "sheets": np.array(hojas, dtype=str),
+        "filenames": np.array([info["filename"] for info, _ in aportes], dtype=str),
+        "folders": np.array([info.get("folder") or "" for info, _ in aportes], dtype=str),
+        "sha256": np.array([info["sha256"] for info, _ in aportes], dtype=str),
+    }
+    for i, hoja in enumerate(hojas):
+        max_col = analisis.sheets[hoja].max_col
+        claves, archivos, valores = [], [], []
+        for n, (_, parcial) in enumerate(aportes):
+            parte = parcial.get(hoja)
+            if parte is None or not len(parte.index):
+                continue
+            # Índice plano de la parcial -> clave (fila, columna)
+            claves.append(((parte.index // max_col + 1) << _COL_BITS) | (parte.index % max_col + 1))
+            archivos.append(np.full(len(parte.index), n, dtype=np.int32))
+            valores.append(parte.values.astype(np.float64))
+        if claves:
+            claves, archivos, valores = np.concatenate(claves), np.concatenate(archivos), np.concatenate(valores)
+        else:
+            claves, archivos, valores = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32),
+                                         np.zeros(0, dtype=np.float64))
+        orden = np.argsort(claves, kind="stable")
+        celdas, cantidades = np.unique(claves[orden], return_counts=True)
+        arreglos[f"cells_{i}"] = celdas
+        arreglos[f"offsets_{i}"] = np.concatenate([[0], np.cumsum(cantidades)]).astype(np.int64)
+        arreglos[f"files_{i}"] = archivos[orden]
+        arreglos[f"values_{i}"] = valores[orden]
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez_compressed(fh, **arreglos)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _modified_z(valores: np.ndarray) -> np.ndarray:
+    """Puntaje z modificado de cada valor (0 si los aportes no tienen dispersión)"""
+    mediana = np.median(valores)
+    desvios = np.abs(valores - mediana)
+    mad = np.median(desvios)
+    if mad > 0:
+        return 0.6745 * desvios / mad
+    # Más de la mitad de los aportes son iguales: se usa la desviación absoluta media
+    media = desvios.mean()
+    if media > 0:
+        return desvios / (1.253314 * media)
+    return np.zeros(len(valores))
+
+
+class ProvenanceIndex:
+    def __init__(self, path: str):
+        with np.load(path, allow_pickle=False) as npz:
+            self.filenames = [str(nombre) for nombre in npz["filenames"]]
+            self.folders = [str(carpeta) or None for carpeta in npz["folders"]]
+            self.hashes = [str(sha) for sha in npz["sha256"]]
+            self.sheets: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = {
+                str(hoja): (npz[f"cells_{i}"], npz[f"offsets_{i}"], npz[f"files_{i}"], npz[f"values_{i}"])
+                for i, hoja in enumerate(npz["sheets"])
+            }
+
+    @property
+    def file_count(self) -> int:
+        return len(self.filenames)
+
+    def _file(self, n: int) -> Dict:
+        archivo = {"archivo": self.filenames[n], "sha256": self.hashes[n]}
+        if self.folders[n]:
+            archivo["carpeta"] = self.folders[n]
+        return archivo
+
+    def _span(self, hoja: str, row: int, col: int) -> Tuple[np.ndarray, np.ndarray]:
+        celdas, offsets, archivos, valores = self.sheets[hoja]
+        clave = (row << _COL_BITS) | col
+        i = int(np.searchsorted(celdas, clave))
+        if i == len(celdas) or celdas[i] != clave:
+            return archivos[:0], valores[:0]
+        return archivos[offsets[i]:offsets[i + 1]], valores[offsets[i]:offsets[i + 1]]
+
+    def _describe(self, archivos: np.ndarray, valores: np.ndarray, indices: Iterable[int],
+                  total: float, puntajes: Optional[np.ndarray] = None) -> List[Dict]:
+        filas = []
+        for i in indices:
+            fila = self._file(int(archivos[i]))
+            fila["valor"] = float(valores[i])
+            fila["fraccion"] = float(valores[i] / total) if total else None
+            if puntajes is not None:
+                fila["puntaje"] = round(float(puntajes[i]), 2)
+            filas.append(fila)
+        return filas
+
+    def cell(self, hoja: str, row: int, col: int, top: Optional[int] = None,
+             threshold: float = OUTLIER_THRESHOLD) -> Dict:
+        """Aportes a una celda (de mayor a menor valor absoluto, hasta `top`) y los atípicos"""
+        archivos, valores = self._span(hoja, row, col)
+        total = float(valores.sum())
+        orden = np.argsort(-np.abs(valores), kind="stable")
+        if top is not None:
+            orden = orden[:top]
+        puntajes = _modified_z(valores) if len(valores) > 2 else np.zeros(len(valores))
+        atipicos = np.flatnonzero(puntajes > threshold)
+        atipicos = atipicos[np.argsort(-puntajes[atipicos], kind="stable")]
+        return {
+            "total": total,
+            "archivos_con_aporte": len(valores),
+            "archivos_sin_aporte": self.file_count - len(valores),
+            "aportes": self._describe(archivos, valores, orden, total),
+            "atipicos": self._describe(archivos, valores, atipicos, total, puntajes),
+        }
+
+    def outliers(self, hoja: str, bounds: Optional[CellBounds] = None,
+                 threshold: float = OUTLIER_THRESHOLD,
+                 limit: Optional[int] = None) -> Iterator[Dict]:
+        """Celdas de la hoja (o del rango) con algún aporte atípico, en orden de fila y columna"""
+        celdas, offsets, archivos, valores = self.sheets[hoja]
+        inicio, fin = 0, len(celdas)
+        if bounds is not None:
+            inicio, fin = np.searchsorted(celdas, [bounds[0] << _COL_BITS, (bounds[2] + 1) << _COL_BITS])
+        encontradas = 0
+        for i in range(int(inicio), int(fin)):
+            clave = int(celdas[i])
+            row, col = clave >> _COL_BITS, clave & ((1 << _COL_BITS) - 1)
+            if bounds is not None and not bounds[1] <= col <= bounds[3]:
+                continue
+            tramo = slice(offsets[i], offsets[i + 1])
+            if tramo.stop - tramo.start < 3:
+                continue
+            puntajes = _modified_z(valores[tramo])
+            atipicos = np.flatnonzero(puntajes > threshold)
+            if not len(atipicos):
+                continue
+            atipicos = atipicos[np.argsort(-puntajes[atipicos], kind="stable")]
+            total = float(valores[tramo].sum())
+            yield {
+                "celda": f"{get_column_letter(col)}{row}",
+                "total": total,
+                "mediana": float(np.median(valores[tramo])),
+                "atipicos": self._describe(archivos[tramo], valores[tramo], atipicos, total, puntajes),
+            }
+            encontradas += 1
+            if limit is not None and encontradas >= limit:
+                return
@@ -0,0 +1,140 @@
+"""
+Datos de un consolidado en binario, para consultarlos sin abrir el xlsm.
+
+Junto a cada resultado se guarda un .npz con, por hoja incluida, las celdas
+sumadas y los valores numéricos de sus fórmulas: claves ordenadas
+(fila << 15) | columna en int64 y valores en float64 (también en modo
+exacto: es lo que ve Excel). Se lee con np.load sin pickle y queda en
+memoria por proceso, así una consulta de unas pocas celdas no toca el disco.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from openpyxl.utils import get_column_letter
+
+from audit_store import parse_range
+from xlsx_reader import CellBounds, Number
+
+_COL_BITS = 15
+_RESULT_ID = re.compile(r"[0-9a-f]{32}")
+
+# Resultados cargados en memoria por proceso
+DATA_CACHE_ENTRIES = int(os.environ.get("RESULT_DATA_CACHE_ENTRIES", "64"))
+
+
+def result_data_filename(result_id: str) -> str:
+    return f"REM_Datos_{result_id}.npz"
+
+
+def valid_result_id(result_id: str) -> bool:
+    return bool(_RESULT_ID.fullmatch(result_id))
+
+
+def write_result_data(path: str, cells_by_sheet: Dict[str, Iterable[Tuple[int, int, Number]]]) -> int:
+    """Escribe el .npz (en orden de hojas) de forma atómica; retorna su tamaño"""
+    hojas = list(cells_by_sheet)
+    arreglos = {"sheets": np.array(hojas, dtype=str)}
+    for i, hoja in enumerate(hojas):
+        valores = {(row << _COL_BITS) | col: float(valor) for row, col, valor in cells_by_sheet[hoja]}
+        claves = np.fromiter(valores.keys(), dtype=np.int64, count=len(valores))
+        datos = np.fromiter(valores.values(), dtype=np.float64, count=len(valores))
+        orden = np.argsort(claves)
+        arreglos[f"keys_{i}"] = claves[orden]
+        arreglos[f"values_{i}"] = datos[orden]
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez(fh, **arreglos)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+class ResultData:
+    def __init__(self, path: str):
+        with np.load(path, allow_pickle=False) as npz:
+            self.sheets: Dict[str, Tuple[np.ndarray, np.ndarray]] = {
+                str(hoja): (npz[f"keys_{i}"], npz[f"values_{i}"]) for i, hoja in enumerate(npz["sheets"])
+            }
+
+    def select(self, hoja: str, bounds: Optional[CellBounds] = None) -> Iterator[Tuple[int, int, float]]:
+        """(fila, columna, valor) de la hoja, o solo del rango, en orden de fila y columna"""
+        claves, valores = self.sheets[hoja]
+        if bounds is not None:
+            min_fila, min_col, max_fila, max_col = bounds
+            # Las claves están ordenadas por fila: primero la franja de filas, luego las columnas
+            inicio, fin = np.searchsorted(
+                claves, [min_fila << _COL_BITS, ((max_fila + 1) << _COL_BITS)]
+            )
+            claves, valores = claves[inicio:fin], valores[inicio:fin]
+            columnas = claves & ((1 << _COL_BITS) - 1)
+            dentro = (columnas >= min_col) & (columnas <= max_col)
+            claves, valores = claves[dentro], valores[dentro]
+        for clave, valor in zip(claves.tolist(), valores.tolist()):
+            yield clave >> _COL_BITS, clave & ((1 << _COL_BITS) - 1), valor
+
+
+class ResultDataCache:
+    """
+    Últimos resultados leídos (los .npz no cambian una vez escritos).
+    `loader` arma el objeto a partir de la ruta (ResultData, ProvenanceIndex).
+    """
+
+    def __init__(self, max_entries: int = DATA_CACHE_ENTRIES, loader: Callable[[str], object] = None):
+        self.max_entries = max_entries
+        self.loader = loader or ResultData
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, object]" = OrderedDict()
+
+    def get(self, path: str):
+        with self._lock:
+            datos = self._entries.get(path)
+            if datos is not None:
+                self._entries.move_to_end(path)
+                return datos
+        datos = self.loader(path)
+        with self._lock:
+            self._entries[path] = datos
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return datos
+
+
+def parse_data_ref(ref: str, sheetnames: Iterable[str]) -> Tuple[str, Optional[CellBounds]]:
+    """
+    "A01" (hoja completa), "A01!B10:D20" o "'Hoja 1'!C5" -> (hoja, rango o None).
+    ValueError si el rango no es válido.
+    """
+    if ref in sheetnames:
+        return ref, None
+    hoja, separador, rango = ref.rpartition("!")
+    if not separador:
+        return ref, None
+    if len(hoja) > 1 and hoja.startswith("'") and hoja.endswith("'"):
+        hoja = hoja[1:-1].replace("''", "'")
+    return hoja, parse_range(rango)
+
+
+def _json_number(valor: float):
+    # Los enteros se entregan sin ".0"
+    return int(valor) if valor.is_integer() and abs(valor) < 2 ** 53 else valor
+
+
+def select_cells(datos: ResultData, refs: List[Tuple[str, Optional[CellBounds]]]) -> Dict[str, Dict[str, object]]:
+    """{hoja: {"B10": valor}} de las referencias pedidas (sin repetir celdas)"""
+    seleccion: Dict[str, Dict[str, object]] = {}
+    for hoja, bounds in refs:
+        celdas = seleccion.setdefault(hoja, {})
+        for row, col, valor in datos.select(hoja, bounds):
+            celdas[f"{get_column_letter(col)}{row}"] = _json_number(valor)
+    return seleccion
+
+
+def iter_csv(seleccion: Dict[str, Dict[str, object]]) -> Iterator[str]:
+    yield "hoja,celda,valor\n"
+    for hoja, celdas in seleccion.items():
+        nombre = '"' + hoja.replace('"', '""') + '"' if any(c in hoja for c in ',"\n') else hoja
+        for celda, valor in celdas.items():
+            yield f"{nombre},{celda},{valor!r}\n"
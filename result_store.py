@@ -0,0 +1,158 @@
+"""
+Índice de resultados direccionado por contenido.
+
+Cada consolidado se registra bajo una clave derivada del hash de la
+plantilla, los hashes de los archivos (ordenados) y las hojas incluidas.
+Si la misma consolidación se pide de nuevo se reutiliza el resultado
+existente. Los resultados vencen tras un tiempo sin uso y se desalojan por
+LRU cuando el total supera la cuota de disco.
+
+El índice vive en la base SQLite compartida por los procesos de la API
+(tabla `results` de StateStore, con índices por clave, vencimiento y
+último uso): cada cambio es una transacción y marcar un uso actualiza una
+sola fila.
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from state_store import RESULT_FILE_FIELDS, StateStore
+
+
+def consolidation_key(template_hash: str, file_hashes: Iterable[str],
+                      included_sheets: Iterable[str], exact: bool = False,
+                      formulas: bool = False, data_only: bool = False, provenance: bool = False) -> str:
+    """Clave estable de una consolidación (el orden de archivos y hojas no importa)"""
+    campos = {
+        "template": template_hash,
+        "files": sorted(file_hashes),
+        "sheets": sorted(included_sheets),
+        "exact": bool(exact),
+        # Un resultado con fórmulas evaluadas no equivale a uno sin evaluar
+        "formulas": bool(formulas),
+    }
+    if data_only:
+        # Sin xlsm: solo sirve para consultar datos
+        campos["output"] = "data"
+    if provenance:
+        campos["provenance"] = True
+    payload = json.dumps(campos, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultStore:
+    """
+    Consolidados de `folder` registrados en `store`. Cada entrada guarda su
+    clave de consolidación ("key"; None si no es reutilizable, por ejemplo si
+    fallaron archivos) y vence `ttl_seconds` después de su último uso
+    ("expires_at"). Un index.json de versiones anteriores se importa al crear
+    el índice.
+    """
+
+    def __init__(self, store: StateStore, folder: str, quota_bytes: int, ttl_seconds: float = 7 * 24 * 3600.0,
+                 legacy_index: str = "index.json"):
+        self.store = store
+        self.folder = folder
+        self.quota_bytes = quota_bytes
+        self.ttl_seconds = ttl_seconds
+        self._import_index(os.path.join(folder, legacy_index))
+
+    def _import_index(self, path: str):
+        """Pasa a la base las entradas de un index.json anterior y lo borra"""
+        try:
+            with open(path, encoding="utf-8") as fh:
+                indice = json.load(fh)
+        except (OSError, ValueError):
+            return
+        if indice and "key" not in next(iter(indice.values())):
+            # Índice por clave de consolidación
+            indice = {entry["result_id"]: {**entry, "key": key} for key, entry in indice.items()}
+        for result_id, entry in indice.items():
+            if self.store.get_result(result_id) is None:
+                entry.setdefault("expires_at", entry["last_access"] + self.ttl_seconds)
+                self.store.add_result({**entry, "result_id": result_id})
+        for nombre in (path, f"{path}.lock"):
+            try:
+                os.remove(nombre)
+            except OSError:
+                pass
+
+    def _entry_paths(self, entry: Dict) -> List[str]:
+        """El xlsm (o el .npz si el resultado es solo de datos), el .npz, la procedencia y el agregado"""
+        nombres = dict.fromkeys(entry.get(campo) for campo in RESULT_FILE_FIELDS)
+        return [os.path.join(self.folder, nombre) for nombre in nombres if nombre]
+
+    def _remove_files(self, entries: List[Dict]) -> List[str]:
+        for entry in entries:
+            for path in self._entry_paths(entry):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return [entry["result_id"] for entry in entries]
+
+    def _use(self, entry: Optional[Dict]) -> Optional[Dict]:
+        """Marca el uso de la entrada; None si no existe o su archivo ya no está en disco"""
+        if entry is None:
+            return None
+        if not os.path.exists(os.path.join(self.folder, entry["filename"])):
+            self.store.delete_results([entry["result_id"]])
+            return None
+        uso = self.store.touch_result(entry["result_id"], self.ttl_seconds)
+        if uso is None:
+            return None  # otro proceso lo quitó
+        entry["last_access"], entry["expires_at"] = uso
+        return entry
+
+    def lookup(self, key: str) -> Optional[Dict]:
+        """Entrada del resultado para la clave (y la marca como usada), o None"""
+        return self._use(self.store.find_result(key))
+
+    def get(self, result_id: str) -> Optional[Dict]:
+        """Entrada del resultado (y lo marca como usado), o None si no existe o ya no está en disco"""
+        return self._use(self.store.get_result(result_id))
+
+    def touch(self, result_id: str):
+        """Marca como usado el resultado (por ejemplo al consultar sus datos)"""
+        self.store.touch_result(result_id, self.ttl_seconds)
+
+    def add(self, key: Optional[str], result_id: str, filename: str, data_filename: Optional[str] = None,
+            provenance_filename: Optional[str] = None, aggregate_filename: Optional[str] = None) -> List[str]:
+        """
+        Registra un resultado (`key` None: no se reutiliza) y desaloja los
+        menos usados; retorna los result_id desalojados
+        """
+        now = time.time()
+        entry = {
+            "result_id": result_id,
+            "key": key,
+            "filename": filename,
+            "data_filename": data_filename,
+            "provenance_filename": provenance_filename,
+            "aggregate_filename": aggregate_filename,
+            "created_at": now,
+            "last_access": now,
+            "expires_at": now + self.ttl_seconds,
+        }
+        entry["size"] = sum(os.path.getsize(path) for path in self._entry_paths(entry))
+        self.store.add_result(entry)
+        return self._remove_files(self.store.take_lru_results(self.quota_bytes, keep=result_id))
+
+    def expire(self, now: Optional[float] = None, limit: int = 100) -> List[str]:
+        """Borra los resultados vencidos (hasta `limit`, por el índice de vencimiento); retorna sus result_id"""
+        now = time.time() if now is None else now
+        return self._remove_files(self.store.take_expired_results(now, limit))
+
+    def enforce_quota(self) -> List[str]:
+        """Desaloja los menos usados mientras el total supere la cuota"""
+        return self._remove_files(self.store.take_lru_results(self.quota_bytes))
+
+    def clear(self) -> List[str]:
+        """Borra todos los resultados con sus archivos; retorna sus result_id"""
+        return self._remove_files(self.store.take_all_results())
+
+    def known_files(self) -> Set[str]:
+        """Nombres de archivo de la carpeta que pertenecen a algún resultado registrado"""
+        return self.store.result_filenames()
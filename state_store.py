@@ -0,0 +1,697 @@
+"""
+Estado persistente compartido en SQLite: trabajos, sesiones y plantillas.
+
+Todos los procesos de uvicorn (`--workers N`) abren la misma base, por lo
+que ven las mismas tareas, sesiones y plantilla, y el estado sobrevive a un
+reinicio. La cola de trabajos se toma con `claim_job`, que marca el trabajo
+como propio dentro de una transacción inmediata (nunca lo toman dos).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT UNIQUE NOT NULL,
+    session_id TEXT,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    current_file TEXT NOT NULL DEFAULT '',
+    status_message TEXT NOT NULL DEFAULT '',
+    result_id TEXT,
+    result_filename TEXT,
+    result_key TEXT,
+    error TEXT,
+    params TEXT,
+    owner TEXT,
+    heartbeat REAL,
+    created_at TEXT NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    metrics TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq);
+CREATE INDEX IF NOT EXISTS jobs_result_key ON jobs (result_key);
+CREATE INDEX IF NOT EXISTS jobs_result_id ON jobs (result_id);
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS session_files (
+    session_id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (session_id, file_id)
+);
+CREATE TABLE IF NOT EXISTS templates (
+    template_id TEXT PRIMARY KEY,
+    sha256 TEXT UNIQUE NOT NULL,
+    version TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sheet_names TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS templates_version ON templates (version, created_at);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+-- Cómo se armó cada consolidado: parámetros (recipe) y resultados usados como entrada
+CREATE TABLE IF NOT EXISTS lineage (
+    result_id TEXT PRIMARY KEY,
+    recipe TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lineage_inputs (
+    result_id TEXT NOT NULL,
+    input_id TEXT NOT NULL,
+    PRIMARY KEY (result_id, input_id)
+);
+CREATE INDEX IF NOT EXISTS lineage_inputs_input ON lineage_inputs (input_id);
+-- Índice de consolidados (ver result_store): por clave, vencimiento y último uso
+CREATE TABLE IF NOT EXISTS results (
+    result_id TEXT PRIMARY KEY,
+    key TEXT,
+    filename TEXT NOT NULL,
+    data_filename TEXT,
+    provenance_filename TEXT,
+    aggregate_filename TEXT,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_key ON results (key);
+CREATE INDEX IF NOT EXISTS results_expires ON results (expires_at);
+CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+"""
+
+# Columnas de un trabajo que se exponen como tarea
+TASK_FIELDS = (
+    "task_id", "session_id", "status", "progress", "current_file", "status_message",
+    "result_id", "result_filename", "result_key", "error", "created_at", "metrics",
+)
+_UPDATABLE = set(TASK_FIELDS) | {"params", "owner", "heartbeat", "started_at", "finished_at"}
+
+ACTIVE_STATUSES = ("queued", "processing")
+
+# Columnas de un consolidado en el índice de resultados
+RESULT_FIELDS = (
+    "result_id", "key", "filename", "data_filename", "provenance_filename", "aggregate_filename",
+    "size", "created_at", "last_access", "expires_at",
+)
+RESULT_FILE_FIELDS = ("filename", "data_filename", "provenance_filename", "aggregate_filename")
+
+# Columnas agregadas después de crear las tablas, por tabla, en bases existentes
+_ADDED_COLUMNS = {
+    # Memoria estimada que la tarea reserva en el nodo que la toma (ver memory_budget)
+    # y tareas (separadas por coma) cuyos resultados usa como entrada: no se toma antes de que terminen
+    "jobs": {"metrics": "TEXT", "memory_bytes": "INTEGER", "depends_on": "TEXT"},
+    # Tamaño del libro y, si vino dentro de un ZIP, miembro, carpeta y nombre del ZIP
+    "session_files": {"size": "INTEGER", "member": "TEXT", "folder": "TEXT", "archive": "TEXT"},
+    # Momento en que la sesión vence si no se vuelve a usar
+    "sessions": {"expires_at": "REAL"},
+}
+# Índices sobre columnas agregadas (se crean después de agregarlas)
+_ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at);
+"""
+# Campos opcionales de un archivo de sesión (se omiten si son NULL)
+_OPTIONAL_FILE_FIELDS = tuple(_ADDED_COLUMNS["session_files"])
+
+
+class StateStore:
+    def __init__(self, db_path: str, session_ttl: float = 24 * 3600.0):
+        self.db_path = db_path
+        self.session_ttl = session_ttl
+        self._local = threading.local()
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+            for tabla, columnas in _ADDED_COLUMNS.items():
+                existentes = {row["name"] for row in conn.execute(f"PRAGMA table_info({tabla})")}
+                for columna, tipo in columnas.items():
+                    if columna not in existentes:
+                        try:
+                            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+                        except sqlite3.OperationalError:
+                            pass  # otro proceso la agregó al mismo tiempo
+            conn.executescript(_ADDED_INDEXES)
+            # Sesiones de antes de registrar el vencimiento: vencen según su creación
+            conn.execute(
+                "UPDATE sessions SET expires_at = created_at + ? WHERE expires_at IS NULL", (session_ttl,)
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        """Una conexión por hilo (sqlite3 no comparte conexiones entre hilos)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------- Plantillas ----------
+
+    @staticmethod
+    def _template_record(row: sqlite3.Row) -> Dict:
+        # Mismas claves que la plantilla por defecto guardada en `state`
+        return {
+            "template_id": row["template_id"],
+            "template_hash": row["sha256"],
+            "template_version": row["version"],
+            "template_name": row["name"],
+            "template_path": row["path"],
+            "sheet_names": json.loads(row["sheet_names"]),
+            "created_at": row["created_at"],
+            "last_used": row["last_used"],
+        }
+
+    def add_template(self, template: Dict) -> Dict:
+        """
+        Registra una plantilla. Si ya hay una con el mismo contenido, no se
+        agrega y se retorna la registrada (compárese su template_id).
+        """
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR IGNORE INTO templates (template_id, sha256, version, name, path, sheet_names, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (template["template_id"], template["template_hash"], template.get("template_version") or "",
+             template["template_name"], template["template_path"], json.dumps(template["sheet_names"]),
+             time.time()),
+        )
+        return self.find_template_by_hash(template["template_hash"])
+
+    def get_template_record(self, template_id: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT * FROM templates WHERE template_id = ?", (template_id,)).fetchone()
+        return self._template_record(row) if row else None
+
+    def find_template_by_hash(self, sha256: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT * FROM templates WHERE sha256 = ?", (sha256,)).fetchone()
+        return self._template_record(row) if row else None
+
+    def find_template_by_version(self, version: str) -> Optional[Dict]:
+        """La última plantilla subida con esa versión (texto de A9)"""
+        row = self._conn().execute(
+            "SELECT * FROM templates WHERE version = ? ORDER BY created_at DESC LIMIT 1", (version,)
+        ).fetchone()
+        return self._template_record(row) if row else None
+
+    def list_templates(self) -> List[Dict]:
+        """Plantillas registradas, de la usada más recientemente a la menos"""
+        rows = self._conn().execute(
+            "SELECT * FROM templates ORDER BY COALESCE(last_used, created_at) DESC"
+        ).fetchall()
+        return [self._template_record(row) for row in rows]
+
+    def count_templates(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) AS n FROM templates").fetchone()["n"]
+
+    def touch_template(self, template_id: str):
+        self._conn().execute("UPDATE templates SET last_used = ? WHERE template_id = ?", (time.time(), template_id))
+
+    def delete_template(self, template_id: str) -> Optional[Dict]:
+        """Quita la plantilla del registro (y como plantilla por defecto); retorna su registro"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM templates WHERE template_id = ?", (template_id,)).fetchone()
+            conn.execute("DELETE FROM templates WHERE template_id = ?", (template_id,))
+            por_defecto = conn.execute("SELECT value FROM state WHERE key = 'template'").fetchone()
+            if por_defecto and json.loads(por_defecto["value"]).get("template_id") == template_id:
+                conn.execute("DELETE FROM state WHERE key = 'template'")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return self._template_record(row) if row else None
+
+    def template_in_use(self, sha256: str) -> bool:
+        """Si alguna tarea en cola o en curso consolida con esa plantilla"""
+        return self._conn().execute(
+            f"SELECT 1 FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) "
+            "AND json_extract(params, '$.template_hash') = ? LIMIT 1",
+            (*ACTIVE_STATUSES, sha256),
+        ).fetchone() is not None
+
+    def get_template(self) -> Optional[Dict]:
+        """Plantilla por defecto (la que usan las peticiones que no indican template_id)"""
+        row = self._conn().execute("SELECT value FROM state WHERE key = 'template'").fetchone()
+        return json.loads(row["value"]) if row else None
+
+    def set_template(self, template: Dict):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('template', ?)", (json.dumps(template),)
+        )
+
+    def clear_template(self):
+        self._conn().execute("DELETE FROM state WHERE key = 'template'")
+
+    # ---------- Sesiones ----------
+
+    def get_session(self, session_id: str) -> Optional[Dict[str, Dict]]:
+        """
+        {file_id: {"path", "filename", "sha256"}} en orden de subida, o None.
+        Incluye "size", "member", "folder" y "archive" cuando se conocen.
+        """
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)).fetchone() is None:
+            return None
+        rows = conn.execute(
+            f"SELECT file_id, path, filename, sha256, {', '.join(_OPTIONAL_FILE_FIELDS)} "
+            "FROM session_files WHERE session_id = ? ORDER BY position",
+            (session_id,),
+        ).fetchall()
+        return {
+            row["file_id"]: {
+                "path": row["path"], "filename": row["filename"], "sha256": row["sha256"],
+                **{campo: row[campo] for campo in _OPTIONAL_FILE_FIELDS if row[campo] is not None}
+            }
+            for row in rows
+        }
+
+    def put_session_file(self, session_id: str, file_id: str, info: Dict):
+        """Agrega un archivo a la sesión, o lo reemplaza conservando su posición"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, created_at) VALUES (?, ?)", (session_id, time.time())
+            )
+            conn.execute(
+                "UPDATE sessions SET expires_at = ? WHERE session_id = ?", (time.time() + self.session_ttl, session_id)
+            )
+            row = conn.execute(
+                "SELECT position FROM session_files WHERE session_id = ? AND file_id = ?",
+                (session_id, file_id),
+            ).fetchone()
+            if row is None:
+                row = conn.execute(
+                    "SELECT COALESCE(MAX(position), -1) + 1 AS position FROM session_files WHERE session_id = ?",
+                    (session_id,),
+                ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO session_files (session_id, file_id, path, filename, sha256, position, "
+                f"{', '.join(_OPTIONAL_FILE_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, "
+                f"{', '.join('?' for _ in _OPTIONAL_FILE_FIELDS)})",
+                (session_id, file_id, info["path"], info["filename"], info["sha256"], row["position"],
+                 *(info.get(campo) for campo in _OPTIONAL_FILE_FIELDS)),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove_session_file(self, session_id: str, file_id: str) -> Optional[Dict]:
+        archivos = self.get_session(session_id) or {}
+        info = archivos.get(file_id)
+        if info is not None:
+            self._conn().execute(
+                "DELETE FROM session_files WHERE session_id = ? AND file_id = ?", (session_id, file_id)
+            )
+        return info
+
+    def delete_session(self, session_id: str) -> Dict[str, Dict]:
+        archivos = self.get_session(session_id) or {}
+        conn = self._conn()
+        conn.execute("DELETE FROM session_files WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return archivos
+
+    def list_sessions(self) -> List[str]:
+        rows = self._conn().execute("SELECT session_id FROM sessions").fetchall()
+        return [row["session_id"] for row in rows]
+
+    def count_sessions(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) AS n FROM sessions").fetchone()["n"]
+
+    def touch_session(self, session_id: str):
+        """Posterga el vencimiento de la sesión (se usó)"""
+        self._conn().execute(
+            "UPDATE sessions SET expires_at = ? WHERE session_id = ?", (time.time() + self.session_ttl, session_id)
+        )
+
+    def idle_sessions(self, expired_before: Optional[float] = None, limit: int = 100) -> List[str]:
+        """
+        Sesiones sin tareas en cola o en curso, de la que vence primero a la
+        última; con `expired_before`, solo las vencidas a ese momento
+        """
+        condicion = "" if expired_before is None else "AND s.expires_at <= ? "
+        return [row["session_id"] for row in self._conn().execute(
+            "SELECT s.session_id FROM sessions s WHERE NOT EXISTS (SELECT 1 FROM jobs j WHERE "
+            f"j.session_id = s.session_id AND j.status IN ({', '.join('?' * len(ACTIVE_STATUSES))})) "
+            f"{condicion}ORDER BY s.expires_at LIMIT ?",
+            (*ACTIVE_STATUSES, *(() if expired_before is None else (expired_before,)), limit),
+        )]
+
+    def upload_paths(self) -> Set[str]:
+        """Rutas de todos los archivos subidos que alguna sesión usa"""
+        return {row["path"] for row in self._conn().execute("SELECT DISTINCT path FROM session_files")}
+
+    # ---------- Trabajos ----------
+
+    def insert_job(self, task: Dict, params: Optional[Dict] = None, memory_bytes: Optional[int] = None,
+                   depends_on: Optional[List[str]] = None):
+        columnas = [campo for campo in TASK_FIELDS if campo in task]
+        valores = [task[campo] for campo in columnas]
+        if params is not None:
+            columnas.append("params")
+            valores.append(json.dumps(params))
+        if memory_bytes is not None:
+            columnas.append("memory_bytes")
+            valores.append(memory_bytes)
+        if depends_on:
+            columnas.append("depends_on")
+            valores.append(",".join(depends_on))
+        self._conn().execute(
+            f"INSERT INTO jobs ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))})", valores
+        )
+
+    def get_job(self, task_id: str) -> Optional[Dict]:
+        row = self._conn().execute(
+            f"SELECT {', '.join(TASK_FIELDS)} FROM jobs WHERE task_id = ?", (task_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def update_job(self, task_id: str, **fields):
+        desconocidos = set(fields) - _UPDATABLE
+        if desconocidos:
+            raise ValueError(f"Campos desconocidos: {sorted(desconocidos)}")
+        asignaciones = ", ".join(f"{campo} = ?" for campo in fields)
+        self._conn().execute(
+            f"UPDATE jobs SET {asignaciones} WHERE task_id = ?", (*fields.values(), task_id)
+        )
+
+    @staticmethod
+    def _node(owner: str) -> str:
+        # owner es "host:pid:sufijo" (ver JobWorkerPool)
+        return owner.split(":", 1)[0]
+
+    def _node_memory(self, conn: sqlite3.Connection, node: str) -> int:
+        return conn.execute(
+            "SELECT COALESCE(SUM(memory_bytes), 0) AS n FROM jobs "
+            "WHERE status = 'processing' AND substr(owner, 1, ?) = ?",
+            (len(node) + 1, f"{node}:"),
+        ).fetchone()["n"]
+
+    def node_memory_reserved(self, owner: str) -> int:
+        """Memoria estimada de las tareas en proceso en el nodo de `owner` (todos sus procesos)"""
+        return self._node_memory(self._conn(), self._node(owner))
+
+    def claim_job(self, owner: str, memory_budget: int = 0) -> Optional[Tuple[str, Dict]]:
+        """
+        Toma el trabajo en cola más antiguo y lo marca en proceso; (task_id, params).
+        Un trabajo que depende de otros (`depends_on`) espera a que terminen
+        (los demás lo pasan). Con `memory_budget` (bytes) no lo toma si, sumado a lo que ya corre en
+        el nodo, no cabe; espera sin saltárselo (una tarea mayor que el
+        presupuesto corre cuando el nodo no tiene otras).
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT task_id, params, memory_bytes FROM jobs j WHERE status = 'queued' AND "
+                "(depends_on IS NULL OR NOT EXISTS (SELECT 1 FROM jobs d WHERE "
+                "instr(',' || j.depends_on || ',', ',' || d.task_id || ',') > 0 "
+                f"AND d.status IN ({', '.join('?' * len(ACTIVE_STATUSES))}))) ORDER BY seq LIMIT 1",
+                ACTIVE_STATUSES,
+            ).fetchone()
+            if row is not None and memory_budget > 0:
+                en_uso = self._node_memory(conn, self._node(owner))
+                if en_uso and en_uso + (row["memory_bytes"] or 0) > memory_budget:
+                    row = None
+            if row is not None:
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = 'processing', owner = ?, heartbeat = ?, started_at = ? "
+                    "WHERE task_id = ?",
+                    (owner, now, now, row["task_id"]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row["task_id"], json.loads(row["params"] or "{}")
+
+    def heartbeat(self, owner: str):
+        self._conn().execute(
+            "UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'processing'", (time.time(), owner)
+        )
+
+    def requeue_stale(self, stale_after: float) -> int:
+        """Devuelve a la cola los trabajos cuyo proceso dejó de dar señales de vida"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, progress = 0, current_file = '', "
+            "status_message = 'Reencolada: el proceso que la ejecutaba se detuvo' "
+            "WHERE status = 'processing' AND (heartbeat IS NULL OR heartbeat < ?)",
+            (time.time() - stale_after,),
+        )
+        return cursor.rowcount
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """Posición (1 = siguiente) de un trabajo en cola; None si no está en cola"""
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS n FROM jobs WHERE status = 'queued' "
+            "AND seq <= (SELECT seq FROM jobs WHERE task_id = ? AND status = 'queued')",
+            (task_id,),
+        ).fetchone()
+        return row["n"] or None
+
+    def count_jobs(self, status: str) -> int:
+        return self._conn().execute("SELECT COUNT(*) AS n FROM jobs WHERE status = ?", (status,)).fetchone()["n"]
+
+    def find_active_job(self, result_key: str) -> Optional[Dict]:
+        """Trabajo en cola o en proceso con la misma clave de consolidación"""
+        row = self._conn().execute(
+            f"SELECT {', '.join(TASK_FIELDS)} FROM jobs WHERE result_key = ? "
+            f"AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) ORDER BY seq LIMIT 1",
+            (result_key, *ACTIVE_STATUSES),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def average_duration(self, last: int = 20) -> Optional[float]:
+        """Duración media (s) de los últimos trabajos terminados"""
+        row = self._conn().execute(
+            "SELECT AVG(finished_at - started_at) AS avg FROM (SELECT started_at, finished_at FROM jobs "
+            "WHERE status = 'completed' AND started_at IS NOT NULL AND finished_at IS NOT NULL "
+            "ORDER BY seq DESC LIMIT ?)",
+            (last,),
+        ).fetchone()
+        return row["avg"]
+
+    def delete_finished_jobs(self, created_before: str) -> int:
+        cursor = self._conn().execute(
+            "DELETE FROM jobs WHERE status IN ('completed', 'error') AND created_at < ?", (created_before,)
+        )
+        return cursor.rowcount
+
+    def find_job_by_result(self, result_id: str) -> Optional[Dict]:
+        """Tarea completada que generó (o reutilizó) el resultado"""
+        row = self._conn().execute(
+            f"SELECT {', '.join(TASK_FIELDS)} FROM jobs WHERE result_id = ? AND status = 'completed' LIMIT 1",
+            (result_id,),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def acquire_lease(self, name: str, owner: str, seconds: float) -> bool:
+        """
+        Toma (o renueva) un permiso exclusivo por `seconds` entre todos los
+        procesos; False si lo tiene otro dueño y no venció
+        """
+        conn = self._conn()
+        clave = f"lease:{name}"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM state WHERE key = ?", (clave,)).fetchone()
+            ahora = time.time()
+            if row is not None:
+                actual = json.loads(row["value"])
+                if actual["owner"] != owner and actual["until"] > ahora:
+                    conn.execute("COMMIT")
+                    return False
+            conn.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                (clave, json.dumps({"owner": owner, "until": ahora + seconds})),
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    # ---------- Índice de resultados ----------
+
+    def add_result(self, entry: Dict):
+        """Registra un consolidado; si otro tenía la misma clave, deja de ser reutilizable"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if entry.get("key"):
+                conn.execute("UPDATE results SET key = NULL WHERE key = ?", (entry["key"],))
+            conn.execute(
+                f"INSERT OR REPLACE INTO results ({', '.join(RESULT_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(RESULT_FIELDS))})",
+                [entry.get(campo) for campo in RESULT_FIELDS],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_result(self, result_id: str) -> Optional[Dict]:
+        row = self._conn().execute(
+            f"SELECT {', '.join(RESULT_FIELDS)} FROM results WHERE result_id = ?", (result_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def find_result(self, key: str) -> Optional[Dict]:
+        """Consolidado reutilizable con esa clave"""
+        row = self._conn().execute(
+            f"SELECT {', '.join(RESULT_FIELDS)} FROM results WHERE key = ? LIMIT 1", (key,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def touch_result(self, result_id: str, ttl: float) -> Optional[Tuple[float, float]]:
+        """Marca el uso del consolidado; (last_access, expires_at) o None si no está"""
+        now = time.time()
+        cursor = self._conn().execute(
+            "UPDATE results SET last_access = ?, expires_at = ? WHERE result_id = ?", (now, now + ttl, result_id)
+        )
+        return (now, now + ttl) if cursor.rowcount else None
+
+    def delete_results(self, result_ids: List[str]):
+        self._conn().executemany("DELETE FROM results WHERE result_id = ?", [(r,) for r in result_ids])
+
+    def _take_results(self, query: str, params: Tuple) -> List[Dict]:
+        """Quita del índice las filas de la consulta; las retorna"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tomados = [dict(row) for row in conn.execute(query, params).fetchall()]
+            conn.executemany("DELETE FROM results WHERE result_id = ?", [(r["result_id"],) for r in tomados])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return tomados
+
+    def take_expired_results(self, now: float, limit: int = 100) -> List[Dict]:
+        """Quita del índice los consolidados vencidos, del que venció primero en adelante"""
+        return self._take_results(
+            f"SELECT {', '.join(RESULT_FIELDS)} FROM results WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+            (now, limit),
+        )
+
+    def take_all_results(self) -> List[Dict]:
+        """Quita del índice todos los consolidados"""
+        return self._take_results(f"SELECT {', '.join(RESULT_FIELDS)} FROM results", ())
+
+    def take_lru_results(self, quota_bytes: int, keep: Optional[str] = None) -> List[Dict]:
+        """Quita del índice los menos usados mientras el total supere la cuota"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) AS n FROM results").fetchone()["n"]
+            tomados = []
+            if total > quota_bytes:
+                for row in conn.execute(
+                    f"SELECT {', '.join(RESULT_FIELDS)} FROM results ORDER BY last_access"
+                ):
+                    if total <= quota_bytes:
+                        break
+                    if row["result_id"] == keep:
+                        continue
+                    tomados.append(dict(row))
+                    total -= row["size"]
+                conn.executemany("DELETE FROM results WHERE result_id = ?", [(r["result_id"],) for r in tomados])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return tomados
+
+    def result_filenames(self) -> Set[str]:
+        """Nombres de todos los archivos de los consolidados registrados"""
+        nombres = set()
+        for row in self._conn().execute(f"SELECT {', '.join(RESULT_FILE_FIELDS)} FROM results"):
+            nombres.update(nombre for nombre in row if nombre)
+        return nombres
+
+    # ---------- Linaje de resultados ----------
+
+    def add_lineage(self, result_id: str, recipe: Dict, inputs: List[str]):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO lineage (result_id, recipe, created_at) VALUES (?, ?, ?)",
+                (result_id, json.dumps(recipe), time.time()),
+            )
+            conn.execute("DELETE FROM lineage_inputs WHERE result_id = ?", (result_id,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO lineage_inputs (result_id, input_id) VALUES (?, ?)",
+                [(result_id, input_id) for input_id in inputs],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_lineage(self, result_id: str) -> Optional[Dict]:
+        """{"result_id", "recipe", "inputs", "created_at"} o None si no se registró"""
+        row = self._conn().execute("SELECT * FROM lineage WHERE result_id = ?", (result_id,)).fetchone()
+        if row is None:
+            return None
+        entradas = self._conn().execute(
+            "SELECT input_id FROM lineage_inputs WHERE result_id = ? ORDER BY rowid", (result_id,)
+        )
+        return {
+            "result_id": row["result_id"],
+            "recipe": json.loads(row["recipe"]),
+            "inputs": [r["input_id"] for r in entradas],
+            "created_at": row["created_at"],
+        }
+
+    def result_parents(self, result_id: str) -> List[str]:
+        """Consolidados que usaron el resultado como entrada"""
+        return [row["result_id"] for row in self._conn().execute(
+            "SELECT l.result_id FROM lineage_inputs i JOIN lineage l ON l.result_id = i.result_id "
+            "WHERE i.input_id = ? ORDER BY l.created_at", (result_id,)
+        )]
+
+    def delete_lineage(self, result_ids: List[str]):
+        """Olvida el linaje de resultados eliminados (como entrada se conservan: los padres siguen ahí)"""
+        conn = self._conn()
+        conn.executemany("DELETE FROM lineage WHERE result_id = ?", [(r,) for r in result_ids])
+        conn.executemany("DELETE FROM lineage_inputs WHERE result_id = ?", [(r,) for r in result_ids])
+
+    def session_has_jobs(self, session_id: str) -> bool:
+        return self._conn().execute(
+            "SELECT 1 FROM jobs WHERE session_id = ? LIMIT 1", (session_id,)
+        ).fetchone() is not None
+
+    def reset(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM jobs")
+        conn.execute("DELETE FROM session_files")
+        conn.execute("DELETE FROM sessions")
+        conn.execute("DELETE FROM templates")
+        conn.execute("DELETE FROM results")
+        conn.execute("DELETE FROM lineage")
+        conn.execute("DELETE FROM lineage_inputs")
+        conn.execute("DELETE FROM state")
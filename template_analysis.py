@@ -0,0 +1,286 @@
+"""
+Análisis precompilado de la plantilla maestra.
+
+Se calcula una sola vez al subir la plantilla y se guarda en disco con el
+hash SHA-256 del archivo como clave. Contiene, por hoja, las dimensiones,
+el mapa de bits de celdas con fórmula y el de celdas candidatas a entrada
+(celdas presentes en la plantilla sin fórmula ni texto).
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from xlsx_reader import local_name, parse_xml, read_sheet_parts, split_cell_ref
+
+ANALYSIS_VERSION = 1
+
+# Tipos de celda que nunca son entrada numérica
+NON_INPUT_TYPES = {"s", "str", "inlineStr", "b", "e"}
+
+# Memoria (MB, estimada) para análisis y modelos de fórmulas de plantillas por proceso
+TEMPLATE_CACHE_MB = int(os.environ.get("TEMPLATE_CACHE_MB", "512"))
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class SheetAnalysis:
+    """Dimensiones y mapas de bits (fila-mayor) de una hoja de la plantilla"""
+    name: str
+    max_row: int
+    max_col: int
+    formula_bits: bytearray
+    input_bits: bytearray
+
+    def _index(self, row: int, col: int) -> int:
+        if row > self.max_row or col > self.max_col:
+            return -1
+        return (row - 1) * self.max_col + (col - 1)
+
+    def is_formula(self, row: int, col: int) -> bool:
+        i = self._index(row, col)
+        return i >= 0 and bool(self.formula_bits[i >> 3] & (1 << (i & 7)))
+
+    def is_input(self, row: int, col: int) -> bool:
+        i = self._index(row, col)
+        return i >= 0 and bool(self.input_bits[i >> 3] & (1 << (i & 7)))
+
+    def _iter_bits(self, bits: bytearray) -> Iterator[Tuple[int, int]]:
+        for byte_index, byte in enumerate(bits):
+            if not byte:
+                continue
+            for bit in range(8):
+                if byte & (1 << bit):
+                    i = (byte_index << 3) | bit
+                    yield i // self.max_col + 1, i % self.max_col + 1
+
+    def iter_formula_cells(self) -> Iterator[Tuple[int, int]]:
+        return self._iter_bits(self.formula_bits)
+
+    def iter_input_cells(self) -> Iterator[Tuple[int, int]]:
+        return self._iter_bits(self.input_bits)
+
+
+@dataclass
+class TemplateAnalysis:
+    sha256: str
+    sheets: Dict[str, SheetAnalysis] = field(default_factory=dict)
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return list(self.sheets)
+
+    def approx_size(self) -> int:
+        """Bytes aproximados en memoria (los mapas de bits más lo fijo por hoja)"""
+        return sum(len(s.formula_bits) + len(s.input_bits) + 1024 for s in self.sheets.values())
+
+
+def _scan_sheet(zf: zipfile.ZipFile, name: str, part: str) -> SheetAnalysis:
+    """Recorre el XML de una hoja clasificando cada celda presente"""
+    cells: List[Tuple[int, int, bool, bool]] = []
+    state = {"row": 0, "col": 0, "type": None, "formula": False, "open": False}
+
+    def close_cell():
+        if state["open"]:
+            is_formula = state["formula"]
+            is_input = not is_formula and state["type"] not in NON_INPUT_TYPES
+            cells.append((state["row"], state["col"], is_formula, is_input))
+            state["open"] = False
+
+    def start(tag, attrs):
+        tag = local_name(tag)
+        if tag == "c":
+            close_cell()
+            ref = attrs.get("r")
+            if ref:
+                state["row"], state["col"] = split_cell_ref(ref)
+            else:
+                state["col"] += 1
+            state["type"] = attrs.get("t")
+            state["formula"] = False
+            state["open"] = True
+        elif tag == "f":
+            state["formula"] = True
+        elif tag == "row":
+            close_cell()
+            ref = attrs.get("r")
+            state["row"] = int(ref) if ref else state["row"] + 1
+            state["col"] = 0
+
+    with zf.open(part) as fh:
+        parse_xml(fh, start)
+    close_cell()
+
+    max_row = max((c[0] for c in cells), default=0)
+    max_col = max((c[1] for c in cells), default=0)
+    size = (max_row * max_col + 7) // 8
+    formula_bits = bytearray(size)
+    input_bits = bytearray(size)
+    for row, col, is_formula, is_input in cells:
+        i = (row - 1) * max_col + (col - 1)
+        if is_formula:
+            formula_bits[i >> 3] |= 1 << (i & 7)
+        elif is_input:
+            input_bits[i >> 3] |= 1 << (i & 7)
+    return SheetAnalysis(name, max_row, max_col, formula_bits, input_bits)
+
+
+def analyze_template(path: str, sha256: Optional[str] = None) -> TemplateAnalysis:
+    """Analiza todas las hojas de la plantilla"""
+    analysis = TemplateAnalysis(sha256=sha256 or file_sha256(path))
+    with zipfile.ZipFile(path) as zf:
+        for name, part in read_sheet_parts(zf).items():
+            analysis.sheets[name] = _scan_sheet(zf, name, part)
+    return analysis
+
+
+def _encode_bits(bits: bytearray) -> str:
+    return base64.b64encode(zlib.compress(bytes(bits))).decode("ascii")
+
+
+def _decode_bits(data: str) -> bytearray:
+    return bytearray(zlib.decompress(base64.b64decode(data)))
+
+
+def analysis_path(folder: str, sha256: str) -> str:
+    return os.path.join(folder, f"{sha256}.json")
+
+
+def save_analysis(analysis: TemplateAnalysis, folder: str) -> str:
+    os.makedirs(folder, exist_ok=True)
+    path = analysis_path(folder, analysis.sha256)
+    payload = {
+        "version": ANALYSIS_VERSION,
+        "sha256": analysis.sha256,
+        "sheets": [
+            {
+                "name": sheet.name,
+                "max_row": sheet.max_row,
+                "max_col": sheet.max_col,
+                "formula_bits": _encode_bits(sheet.formula_bits),
+                "input_bits": _encode_bits(sheet.input_bits),
+            }
+            for sheet in analysis.sheets.values()
+        ],
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(payload, fh)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_analysis(folder: str, sha256: str) -> Optional[TemplateAnalysis]:
+    """Carga un análisis guardado; None si no existe o es de otra versión"""
+    path = analysis_path(folder, sha256)
+    try:
+        with open(path, encoding="utf-8") as fh:
+            payload = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if payload.get("version") != ANALYSIS_VERSION or payload.get("sha256") != sha256:
+        return None
+    analysis = TemplateAnalysis(sha256=sha256)
+    for sheet in payload["sheets"]:
+        analysis.sheets[sheet["name"]] = SheetAnalysis(
+            sheet["name"],
+            sheet["max_row"],
+            sheet["max_col"],
+            _decode_bits(sheet["formula_bits"]),
+            _decode_bits(sheet["input_bits"]),
+        )
+    return analysis
+
+
+class TemplateCache:
+    """
+    LRU de lo que se arma a partir de una plantilla (análisis, modelo de
+    fórmulas), acotado por el tamaño estimado de cada entrada. Siempre se
+    conserva la última entrada usada aunque sola supere el límite.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[object, int]]" = OrderedDict()
+        self._building: Dict[Hashable, threading.Lock] = {}
+        self.size = 0
+
+    def get(self, key: Hashable):
+        with self._lock:
+            entrada = self._entries.get(key)
+            if entrada is None:
+                return None
+            self._entries.move_to_end(key)
+            return entrada[0]
+
+    def put(self, key: Hashable, value, size: int):
+        with self._lock:
+            anterior = self._entries.pop(key, None)
+            if anterior is not None:
+                self.size -= anterior[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, liberado) = self._entries.popitem(last=False)
+                self.size -= liberado
+
+    def get_or_build(self, key: Hashable, build: Callable[[], object], sizeof: Callable[[object], int]):
+        """Valor en caché o armado una sola vez aunque lo pidan varios hilos a la vez"""
+        valor = self.get(key)
+        if valor is not None:
+            return valor
+        with self._lock:
+            armando = self._building.setdefault(key, threading.Lock())
+        with armando:
+            valor = self.get(key)
+            if valor is None:
+                valor = build()
+                self.put(key, valor, sizeof(valor))
+        with self._lock:
+            self._building.pop(key, None)
+        return valor
+
+    def discard(self, sha256: str):
+        """Quita todo lo derivado de una plantilla (claves (tipo, sha256))"""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == sha256]:
+                self.size -= self._entries.pop(key)[1]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes}
+
+
+# Análisis y modelos de fórmulas ya cargados en este proceso, por (tipo, sha256)
+template_cache = TemplateCache(TEMPLATE_CACHE_MB * 1024 * 1024)
+
+
+def get_template_analysis(path: str, folder: str, sha256: Optional[str] = None) -> TemplateAnalysis:
+    """
+    Retorna el análisis de la plantilla: primero desde memoria, luego desde
+    disco y, solo si no existe, analizando el archivo y persistiendo el resultado.
+    """
+    sha256 = sha256 or file_sha256(path)
+
+    def cargar() -> TemplateAnalysis:
+        analysis = load_analysis(folder, sha256)
+        if analysis is None:
+            analysis = analyze_template(path, sha256)
+            save_analysis(analysis, folder)
+        return analysis
+
+    return template_cache.get_or_build(("analysis", sha256), cargar, TemplateAnalysis.approx_size)
@@ -0,0 +1,246 @@
+"""
+Validación de versión, revisión de subidas y auditoría de cambios de un
+libro contra la plantilla.
+
+La validación lee una sola celda directo del zip (milisegundos). La
+auditoría compara el libro del usuario contra un snapshot de la plantilla
+maestra que se extrae una vez por proceso (y se rehace si el archivo
+cambia); aun así recorre todo el XML del usuario, por eso la API la ejecuta
+en procesos aparte (ver offload.py) y este módulo no depende de main.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import IO, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from openpyxl.utils import get_column_letter
+
+from audit_store import write_changes
+from template_analysis import file_sha256
+from upload_archive import open_workbook_source
+from xlsx_reader import CellBounds, CellValue, XlsxReader
+
+EXPECTED_VERSION = "Versión 1.1: Febrero 2026"
+# Celda maestra de la combinación A9:B9 en la primera hoja ("IDENTIFICACIÓN")
+VERSION_CELL = "A9"
+
+# Hojas faltantes que se nombran en el motivo de rechazo de una subida
+MAX_LISTED_SHEETS = 5
+
+# Archivos validados en paralelo por lote (la lectura es mayormente zlib y E/S)
+VALIDATE_BATCH_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def read_template_version(source: Union[str, IO[bytes]]) -> str:
+    """
+    Texto de A9 de la primera hoja (la versión de la plantilla). Lee solo el
+    XML de esa hoja hasta la fila 9 y, si A9 es texto compartido, solo esa
+    entrada de sharedStrings.xml.
+    """
+    with XlsxReader(source) as wb:
+        if not wb.sheetnames:
+            return ""
+        valor_celda = wb.read_cell(wb.sheetnames[0], VERSION_CELL)
+    return str(valor_celda).strip() if valor_celda else ""
+
+
+def validate_files(file_paths: List[str],
+                   workers: int = VALIDATE_BATCH_WORKERS) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Lee la versión de cada archivo (ruta, o ZIP + miembro) en paralelo. Retorna, en el mismo orden,
+    (versión, None) o (None, mensaje de error) si el archivo no se pudo leer.
+    """
+    def leer(file_path: str) -> Tuple[Optional[str], Optional[str]]:
+        try:
+            return read_template_version(open_workbook_source(file_path)), None
+        except Exception as e:
+            return None, f"No se pudo leer el archivo: {e}"
+
+    if len(file_paths) <= 1 or workers <= 1:
+        return [leer(file_path) for file_path in file_paths]
+    with ThreadPoolExecutor(min(workers, len(file_paths)), thread_name_prefix="validate") as pool:
+        return list(pool.map(leer, file_paths))
+
+
+class InvalidWorkbook(ValueError):
+    """El archivo subido no es un libro legible o no corresponde a la plantilla"""
+
+
+def check_workbook(path: Union[str, IO[bytes]], expected_sheets: Optional[List[str]] = None):
+    """
+    Revisión rápida de una subida: el directorio central del zip, la lista de
+    hojas de workbook.xml y que existan sus partes, y (si se indican) que
+    estén todas las hojas de la plantilla. No descomprime las hojas.
+    Lanza InvalidWorkbook con el motivo.
+    """
+    try:
+        with XlsxReader(path) as wb:
+            hojas = wb.sheetnames
+            partes = set(wb.zf.namelist())
+            faltan_partes = [part for part in wb.sheet_parts.values() if part not in partes]
+    except Exception as e:
+        raise InvalidWorkbook(f"No es un libro de Excel válido: {e}") from None
+
+    if not hojas:
+        raise InvalidWorkbook("El libro no tiene hojas")
+    if faltan_partes:
+        raise InvalidWorkbook(f"El libro está incompleto: falta {faltan_partes[0]}")
+    if expected_sheets:
+        presentes = set(hojas)
+        faltantes = [hoja for hoja in expected_sheets if hoja not in presentes]
+        if faltantes:
+            nombres = ", ".join(faltantes[:MAX_LISTED_SHEETS])
+            if len(faltantes) > MAX_LISTED_SHEETS:
+                nombres += f" y {len(faltantes) - MAX_LISTED_SHEETS} más"
+            raise InvalidWorkbook(f"Faltan hojas de la plantilla: {nombres}")
+
+
+# Clave de una celda en el snapshot: (fila << 15) | columna (columna <= 16384)
+_COL_BITS = 15
+
+
+@dataclass
+class SheetSnapshot:
+    """Celdas con valor de una hoja, en columnas ordenadas por (fila, columna)"""
+    keys: np.ndarray      # int64
+    texts: np.ndarray     # object: str(valor).strip(), lo que compara la auditoría
+    values: List          # valor original (para el detalle del cambio)
+    max_row: int          # rango usado, como ws.max_row / ws.max_column de openpyxl
+    max_col: int
+
+
+@dataclass
+class AuditSnapshot:
+    sha256: str
+    sheets: Dict[str, SheetSnapshot] = field(default_factory=dict)  # en orden del libro
+
+
+def _sheet_cells(celdas: List[Tuple[int, int, CellValue]], combinadas: List[CellBounds]) -> Dict[int, CellValue]:
+    """
+    {clave: valor} como las ve openpyxl: dentro de un rango combinado solo la
+    celda superior izquierda conserva su valor
+    """
+    valores = {(fila << _COL_BITS) | col: valor for fila, col, valor in celdas}
+    for min_fila, min_col, max_fila, max_col in combinadas:
+        for fila in range(min_fila, max_fila + 1):
+            for col in range(min_col, max_col + 1):
+                if fila != min_fila or col != min_col:
+                    valores.pop((fila << _COL_BITS) | col, None)
+    return valores
+
+
+def build_audit_snapshot(master_template_path: str, sha256: Optional[str] = None) -> AuditSnapshot:
+    """Extrae una sola vez los valores de la plantilla maestra"""
+    snapshot = AuditSnapshot(sha256 or file_sha256(master_template_path))
+    with XlsxReader(master_template_path) as wb:
+        for hoja in wb.sheetnames:
+            celdas, combinadas = wb.read_sheet_values(hoja)
+            # openpyxl crea una celda por cada <c> y por cada celda de un rango
+            # combinado: todas cuentan para el rango que recorre la auditoría
+            max_row = max([fila for fila, _, _ in celdas] + [r[2] for r in combinadas] + [1])
+            max_col = max([col for _, col, _ in celdas] + [r[3] for r in combinadas] + [1])
+            valores = {
+                clave: valor for clave, valor in sorted(_sheet_cells(celdas, combinadas).items())
+                if valor is not None
+            }
+            snapshot.sheets[hoja] = SheetSnapshot(
+                keys=np.fromiter(valores.keys(), dtype=np.int64, count=len(valores)),
+                texts=np.array([str(v).strip() for v in valores.values()] or [], dtype=object),
+                values=list(valores.values()),
+                max_row=max_row,
+                max_col=max_col,
+            )
+    return snapshot
+
+
+class SnapshotCache:
+    """
+    Snapshots en memoria por ruta. Se revalidan con mtime y tamaño del
+    archivo; si cambiaron, con su hash (un archivo copiado encima con el
+    mismo contenido no obliga a reconstruir).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[int, int, AuditSnapshot]] = {}
+
+    def get(self, path: str) -> AuditSnapshot:
+        path = os.path.abspath(path)
+        with self._lock:
+            stat = os.stat(path)
+            entrada = self._entries.get(path)
+            if entrada is not None and entrada[:2] == (stat.st_mtime_ns, stat.st_size):
+                return entrada[2]
+            sha256 = file_sha256(path)
+            if entrada is not None and entrada[2].sha256 == sha256:
+                snapshot = entrada[2]
+            else:
+                snapshot = build_audit_snapshot(path, sha256)
+            self._entries[path] = (stat.st_mtime_ns, stat.st_size, snapshot)
+            return snapshot
+
+
+_snapshots = SnapshotCache()
+
+
+def iter_audit_changes(user_source: Union[str, IO[bytes]], snapshot: AuditSnapshot) -> Iterator[Dict]:
+    """
+    Cambios del libro del usuario respecto del snapshot, hoja por hoja en el
+    orden de la plantilla y por fila y columna dentro de cada hoja. Solo se
+    leen las celdas del usuario que tienen valor; la comparación contra la
+    plantilla es un cruce de arreglos ordenados.
+    """
+    with XlsxReader(user_source) as wb:
+        for hoja, maestro in snapshot.sheets.items():
+            if hoja not in wb.sheet_parts:
+                continue
+            celdas, combinadas = wb.read_sheet_values(hoja, skip_empty=True)
+            valores = {
+                clave: valor for clave, valor in sorted(_sheet_cells(celdas, combinadas).items())
+                # Solo cuenta lo que el usuario escribió, dentro del rango de la plantilla
+                if valor is not None
+                and clave >> _COL_BITS <= maestro.max_row
+                and clave & ((1 << _COL_BITS) - 1) <= maestro.max_col
+            }
+            if not valores:
+                continue
+            claves = np.fromiter(valores.keys(), dtype=np.int64, count=len(valores))
+            textos = np.array([str(v).strip() for v in valores.values()], dtype=object)
+
+            # Posición de cada celda del usuario en la plantilla (si tiene valor allá)
+            posiciones = np.searchsorted(maestro.keys, claves)
+            if len(maestro.keys):
+                posiciones = np.minimum(posiciones, len(maestro.keys) - 1)
+                en_maestro = maestro.keys[posiciones] == claves
+                originales = np.where(en_maestro, maestro.texts[posiciones], "None")
+            else:
+                en_maestro = np.zeros(len(claves), dtype=bool)
+                originales = np.full(len(claves), "None", dtype=object)
+
+            # Comparar valores (ignorando espacios en blanco extra)
+            nuevos = list(valores.values())
+            for i in np.flatnonzero(textos != originales):
+                clave = int(claves[i])
+                yield {
+                    "hoja": hoja,
+                    "celda": f"{get_column_letter(clave & ((1 << _COL_BITS) - 1))}{clave >> _COL_BITS}",
+                    "valor_original": maestro.values[posiciones[i]] if en_maestro[i] else None,
+                    "valor_nuevo": nuevos[i]
+                }
+
+
+def audit_workbook(user_path: str, master_template_path: str) -> List[Dict]:
+    """Celdas con valor en el libro del usuario que difieren de la plantilla maestra"""
+    return list(iter_audit_changes(user_path, _snapshots.get(master_template_path)))
+
+
+def write_audit(user_path: str, master_template_path: str, changes_path: str, summary_path: str) -> Dict:
+    """
+    Audita el libro escribiendo los cambios a medida que se detectan (NDJSON,
+    ver audit_store) sin acumularlos en memoria. Retorna el resumen por hoja.
+    """
+    return write_changes(
+        iter_audit_changes(user_path, _snapshots.get(master_template_path)), changes_path, summary_path
+    )
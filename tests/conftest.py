@@ -0,0 +1,125 @@
+"""
+Fixtures compartidas. La API crea sus carpetas (uploads, results, cache,
+state.db) relativas al directorio actual al importarse, así que `main` se
+importa una sola vez dentro de una carpeta temporal.
+"""
+import os
+import shutil
+import sys
+import time
+from collections import defaultdict
+
+import openpyxl
+import pytest
+from openpyxl.utils import get_column_letter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_PATH = os.path.join(REPO_DIR, "SA_26_V1.1.xlsm")
+XLSM_TYPE = "application/vnd.ms-excel.sheet.macroEnabled.12"
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
+
+
+@pytest.fixture(scope="session")
+def workbooks(tmp_path_factory):
+    """Cuatro libros SA_26 sintéticos distintos"""
+    from synthetic import generate_workbooks
+    return generate_workbooks(TEMPLATE_PATH, str(tmp_path_factory.mktemp("libros")), 4, density=0.02, seed=26)
+
+
+@pytest.fixture(scope="session")
+def main_module(tmp_path_factory):
+    carpeta = tmp_path_factory.mktemp("api")
+    # La auditoría compara contra la plantilla maestra en el directorio de la API
+    shutil.copy(TEMPLATE_PATH, carpeta)
+    anterior = os.getcwd()
+    os.chdir(carpeta)
+    os.environ.update({"JANITOR_INTERVAL": "0", "EVALUATE_FORMULAS": "0", "LOG_LEVEL": "WARNING"})
+    import main
+    try:
+        yield main
+    finally:
+        main.job_workers.stop()
+        os.chdir(anterior)
+
+
+@pytest.fixture(scope="session")
+def client(main_module):
+    from fastapi.testclient import TestClient
+    with TestClient(main_module.app) as c:
+        with open(TEMPLATE_PATH, "rb") as fh:
+            r = c.post("/api/template/upload",
+                       files={"template": (os.path.basename(TEMPLATE_PATH), fh, XLSM_TYPE)})
+        assert r.status_code == 200, r.text
+        yield c
+
+
+def upload_session(client, paths):
+    """Sube los libros a una sesión nueva; retorna la respuesta"""
+    archivos = [("files", (os.path.basename(path), open(path, "rb"), XLSM_TYPE)) for path in paths]
+    try:
+        r = client.post("/api/consolidate/upload", files=archivos)
+    finally:
+        for _, (_, fh, _) in archivos:
+            fh.close()
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+def wait_task(client, task_id, timeout=120.0):
+    """Espera que la tarea termine; retorna su estado final"""
+    limite = time.time() + timeout
+    while time.time() < limite:
+        estado = client.get(f"/api/consolidate/status/{task_id}").json()
+        if estado["status"] in ("completed", "error"):
+            return estado
+        time.sleep(0.1)
+    raise AssertionError(f"La tarea {task_id} no terminó en {timeout:g}s")
+
+
+def process(client, session_id, **campos):
+    """Consolida la sesión y espera el resultado; retorna (respuesta de process, estado final)"""
+    r = client.post("/api/consolidate/process", data={"session_id": session_id, **campos})
+    assert r.status_code == 200, r.text
+    respuesta = r.json()
+    estado = wait_task(client, respuesta["task_id"])
+    assert estado["status"] == "completed", estado
+    return respuesta, estado
+
+
+def expected_sums(paths, hojas):
+    """
+    Suma de las celdas de entrada de los libros por hoja y referencia A1,
+    leída con openpyxl (independiente del lector en streaming de la API)
+    """
+    from synthetic import input_cells
+    from template_analysis import analyze_template
+    celdas = input_cells(analyze_template(TEMPLATE_PATH), hojas)
+    sumas = {hoja: defaultdict(float) for hoja in hojas}
+    for path in paths:
+        libro = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for hoja, posiciones in celdas.items():
+                entrada = set(posiciones)
+                for fila in libro[hoja].iter_rows():
+                    for celda in fila:
+                        if not hasattr(celda, "column") or not isinstance(celda.value, (int, float)):
+                            continue
+                        if (celda.row, celda.column) in entrada:
+                            sumas[hoja][f"{get_column_letter(celda.column)}{celda.row}"] += celda.value
+        finally:
+            libro.close()
+    return sumas
+
+
+def assert_data_matches(client, result_id, paths, hojas):
+    """Los datos del resultado coinciden con la suma de los libros en las celdas de entrada"""
+    r = client.get(f"/api/consolidate/data/{result_id}", params={"ref": hojas})
+    assert r.status_code == 200, r.text
+    datos = r.json()["hojas"]
+    sumas = expected_sums(paths, hojas)
+    assert any(sumas[hoja] for hoja in hojas)
+    for hoja in hojas:
+        for ref, valor in sumas[hoja].items():
+            assert abs(datos[hoja].get(ref, 0) - valor) < 1e-6, (hoja, ref)
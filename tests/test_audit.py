@@ -0,0 +1,83 @@
+"""Auditoría contra la plantilla maestra: resumen, páginas por cursor y NDJSON"""
+import json
+
+import pytest
+from openpyxl.utils import get_column_letter
+
+from conftest import TEMPLATE_PATH, XLSM_TYPE
+from synthetic import input_cells
+from template_analysis import analyze_template
+from xlsx_reader import XlsxReader
+from xlsx_writer import write_patched_workbook
+
+
+@pytest.fixture(scope="module")
+def changed_workbook(tmp_path_factory):
+    """Libro con valores en 30 celdas de A01 y 20 de A02; retorna (ruta, {(hoja, celda): valor})"""
+    celdas = input_cells(analyze_template(TEMPLATE_PATH), ["A01", "A02"])
+    # Fuera de rangos combinados: ahí solo cuenta la celda maestra
+    with XlsxReader(TEMPLATE_PATH) as wb:
+        for hoja in celdas:
+            combinadas = wb.read_sheet_values(hoja, skip_empty=True)[1]
+            celdas[hoja] = [(row, col) for row, col in celdas[hoja]
+                            if not any(r1 <= row <= r2 and c1 <= col <= c2 for r1, c1, r2, c2 in combinadas)]
+    valores = {"A01": [(row, col, 100 + i) for i, (row, col) in enumerate(celdas["A01"][:30])],
+               "A02": [(row, col, 500 + i) for i, (row, col) in enumerate(celdas["A02"][:20])]}
+    path = str(tmp_path_factory.mktemp("auditoria") / "usuario.xlsm")
+    write_patched_workbook(TEMPLATE_PATH, path, valores)
+    esperados = {(hoja, f"{get_column_letter(col)}{row}"): valor
+                 for hoja, escritas in valores.items() for row, col, valor in escritas}
+    return path, esperados
+
+
+def audit(client, path, **params):
+    with open(path, "rb") as fh:
+        return client.post("/api/consolidate/audit", params=params, files={"file": ("u.xlsm", fh, XLSM_TYPE)})
+
+
+def test_pages_cover_all_changes(client, changed_workbook):
+    path, esperados = changed_workbook
+    r = audit(client, path, mode="summary")
+    assert r.status_code == 200
+    resumen = r.json()
+    assert resumen["total_cambios"] == len(esperados)
+    assert {h["hoja"]: h["cambios"] for h in resumen["hojas"]} == {"A01": 30, "A02": 20}
+
+    vistos = []
+    cursor = None
+    while True:
+        params = {"limit": 7, **({"cursor": cursor} if cursor else {})}
+        pagina = client.get(f"/api/consolidate/audit/{resumen['audit_id']}", params=params).json()
+        assert len(pagina["cambios"]) <= 7
+        vistos += pagina["cambios"]
+        cursor = pagina["next_cursor"]
+        if cursor is None:
+            break
+    assert {(c["hoja"], c["celda"]): c["valor_nuevo"] for c in vistos} == esperados
+    assert len(vistos) == len(esperados)
+
+    # Filtro por hoja y por rango
+    solo_a02 = client.get(f"/api/consolidate/audit/{resumen['audit_id']}", params={"sheet": "A02"}).json()
+    assert {c["hoja"] for c in solo_a02["cambios"]} == {"A02"} and len(solo_a02["cambios"]) == 20
+    primera = vistos[0]
+    rango = client.get(f"/api/consolidate/audit/{resumen['audit_id']}",
+                       params={"sheet": primera["hoja"], "range": f"{primera['celda']}:{primera['celda']}"}).json()
+    assert rango["cambios"] == [primera]
+
+    assert client.get(f"/api/consolidate/audit/{resumen['audit_id']}", params={"cursor": "x"}).status_code == 400
+    assert client.get("/api/consolidate/audit/noexiste").status_code == 404
+
+
+def test_ndjson_stream(client, changed_workbook):
+    path, esperados = changed_workbook
+    r = audit(client, path, mode="ndjson")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    lineas = [json.loads(linea) for linea in r.text.splitlines() if linea]
+    assert {(c["hoja"], c["celda"]): c["valor_nuevo"] for c in lineas} == esperados
+
+    guardado = client.get(f"/api/consolidate/audit/{r.headers['X-Audit-Id']}/ndjson", params={"sheet": "A01"})
+    assert len(guardado.text.splitlines()) == 30
+
+    completo = audit(client, path).json()
+    assert completo["total_cambios"] == len(esperados) == len(completo["cambios"])
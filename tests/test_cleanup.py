@@ -0,0 +1,141 @@
+"""Limpieza periódica, reinicio y descargas de consolidados"""
+import os
+import time
+
+import numpy as np
+import pytest
+
+from audit_store import AuditStore
+from conftest import process, upload_session
+from consolidation import SheetPartial
+from janitor import Janitor
+from partial_cache import PartialCache
+from result_store import ResultStore
+from state_store import StateStore
+
+HORA = 3600.0
+
+
+@pytest.fixture
+def entorno(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    resultados = ResultStore(store, str(tmp_path / "results"), quota_bytes=10 ** 9)
+    os.makedirs(resultados.folder)
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    return store, resultados, str(uploads), tmp_path
+
+
+def parcial(valor):
+    return {"A01": SheetPartial(np.array([0, 5], dtype=np.int64), np.array([valor, 1.0]),
+                                np.array([1, 1], dtype=np.int32))}
+
+
+def envejecer(path, segundos):
+    antes = time.time() - segundos
+    os.utime(path, (antes, antes))
+
+
+def test_partial_cache_evicts_expired_then_least_used(tmp_path):
+    cache = PartialCache(str(tmp_path / "partials"))
+    plantilla = "f" * 64
+    for i, sha in enumerate(("a" * 64, "b" * 64, "c" * 64)):
+        cache.put(sha, plantilla, ["A01"], parcial(float(i)))
+        envejecer(cache._path(sha, plantilla, False), (3 - i) * HORA)
+
+    # Leer la más vieja la vuelve la más reciente
+    assert cache.get("a" * 64, plantilla, ["A01"]) is not None
+
+    assert cache.evict(expired_before=time.time() - 2.5 * HORA) == 0
+    assert cache.evict(expired_before=time.time() - 1.5 * HORA) == 1
+    assert cache.get("b" * 64, plantilla, ["A01"]) is None
+
+    tamano = os.path.getsize(cache._path("a" * 64, plantilla, False))
+    # Sobre la cuota se borra la menos usada: "c" (la "a" se acaba de leer)
+    assert cache.evict(quota_bytes=tamano) == 1
+    assert cache.get("c" * 64, plantilla, ["A01"]) is None
+    assert cache.get("a" * 64, plantilla, ["A01"]) is not None
+    assert cache.evict(quota_bytes=tamano) == 0
+
+
+def test_janitor_sweeps_partials_audits_and_spill(entorno):
+    store, resultados, uploads, tmp_path = entorno
+    cache = PartialCache(str(tmp_path / "partials"))
+    cache.put("a" * 64, "f" * 64, ["A01"], parcial(1.0))
+    envejecer(cache._path("a" * 64, "f" * 64, False), 10 * HORA)
+    cache.put("b" * 64, "f" * 64, ["A01"], parcial(2.0))
+
+    audits = AuditStore(str(tmp_path / "audits"), ttl_seconds=HORA)
+    for edad in (2 * HORA, 0):
+        audit_id = audits.new_id()
+        for path in (audits.changes_path(audit_id), audits.summary_path(audit_id)):
+            with open(path, "w") as fh:
+                fh.write("{}")
+            envejecer(path, edad)
+
+    # Carpetas de derrame: de una tarea terminada, de una en proceso y de una que ya no existe
+    spill = tmp_path / "spill"
+    for task_id in ("terminada", "activa", "perdida"):
+        (spill / task_id).mkdir(parents=True)
+        (spill / task_id / "A01.0.npz").write_bytes(b"x")
+        envejecer(spill / task_id, 2 * HORA)
+    for task_id, status in (("terminada", "completed"), ("activa", "processing")):
+        store.insert_job({"task_id": task_id, "status": status, "progress": 0, "current_file": "",
+                          "status_message": "", "result_key": None,
+                          "created_at": "2026-01-01T00:00:00"})
+
+    janitor = Janitor(store, resultados, uploads, 0, interval=0, orphan_grace=HORA, job_ttl=10 ** 9,
+                      partials=cache, partials_ttl=5 * HORA, audits=audits, spill_folder=str(spill))
+    limpiado = janitor.run_once()
+    assert (limpiado["partials"], limpiado["audits"], limpiado["spill"]) == (1, 1, 2)
+    assert cache.get("a" * 64, "f" * 64, ["A01"]) is None
+    assert cache.get("b" * 64, "f" * 64, ["A01"]) is not None
+    assert len(os.listdir(audits.folder)) == 2
+    assert sorted(os.listdir(spill)) == ["activa"]
+
+
+def test_clear_and_reset_remove_results(entorno):
+    store, resultados, _, _ = entorno
+    nombres = ("r1.xlsm", "r1.npz", "r1.agg.npz")
+    for nombre in nombres:
+        with open(os.path.join(resultados.folder, nombre), "wb") as fh:
+            fh.write(b"x")
+    resultados.add("k1", "r1", nombres[0], data_filename=nombres[1], aggregate_filename=nombres[2])
+    assert resultados.lookup("k1")["result_id"] == "r1"
+
+    assert resultados.clear() == ["r1"]
+    assert os.listdir(resultados.folder) == []
+    assert resultados.get("r1") is None
+
+    store.add_result({"result_id": "r2", "key": "k2", "filename": "r2.xlsm", "data_filename": None,
+                      "provenance_filename": None, "aggregate_filename": None, "size": 1,
+                      "created_at": 0, "last_access": 0, "expires_at": 10 ** 12})
+    store.reset()
+    assert store.get_result("r2") is None
+
+
+def test_download_etag_and_range(client, workbooks):
+    sesion = upload_session(client, workbooks[:1])
+    _, estado = process(client, sesion["session_id"], excluded_sheets="A03")
+    url = f"/api/consolidate/download/{estado['result_id']}"
+
+    completo = client.get(url)
+    assert completo.status_code == 200
+    etag = completo.headers["ETag"]
+    contenido = completo.content
+    assert completo.headers["Accept-Ranges"] == "bytes"
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    parcial = client.get(url, headers={"Range": "bytes=100-199"})
+    assert parcial.status_code == 206
+    assert parcial.headers["Content-Range"] == f"bytes 100-199/{len(contenido)}"
+    assert parcial.content == contenido[100:200]
+
+    # If-Range con otro ETag: el archivo cambió, se envía completo
+    cambiado = client.get(url, headers={"Range": "bytes=100-199", "If-Range": '"otro"'})
+    assert cambiado.status_code == 200 and cambiado.content == contenido
+
+    fuera = client.get(url, headers={"Range": f"bytes={len(contenido)}-"})
+    assert fuera.status_code == 416
+    assert fuera.headers["Content-Range"] == f"bytes */{len(contenido)}"
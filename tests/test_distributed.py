@@ -0,0 +1,145 @@
+"""Cola de grupos en disco compartido y agregados parciales"""
+import os
+import time
+from decimal import Decimal
+
+import openpyxl
+import pytest
+from openpyxl.utils.cell import coordinate_to_tuple
+
+from conftest import TEMPLATE_PATH, expected_sums
+from distributed import CLAIMED, DONE, PENDING, FilesystemQueue, WorkQueue
+from partial_format import (
+    InvalidAggregate, aggregate_files, finalize_aggregate, merge_aggregates, read_aggregate, write_aggregate
+)
+
+HOJAS = ["A01", "A02"]
+
+
+def test_work_queue_requires_every_method():
+    class Incompleta(WorkQueue):
+        def submit(self, task):
+            pass
+
+    with pytest.raises(TypeError):
+        Incompleta()
+
+
+def test_claim_is_exclusive(tmp_path):
+    cola = FilesystemQueue(str(tmp_path))
+    for shard in ("0", "1"):
+        cola.submit({"job_id": "j1", "shard_id": shard, "files": []})
+
+    primero = cola.claim("w1")
+    segundo = cola.claim("w2")
+    assert {primero["shard_id"], segundo["shard_id"]} == {"0", "1"}
+    assert (primero["worker"], segundo["worker"]) == ("w1", "w2")
+    assert primero["attempts"] == segundo["attempts"] == 1
+    assert cola.claim("w3") is None
+    assert {grupo["state"] for grupo in cola.status("j1").values()} == {CLAIMED}
+
+
+def test_requeue_stale_and_complete(tmp_path):
+    cola = FilesystemQueue(str(tmp_path))
+    cola.submit({"job_id": "j2", "shard_id": "0", "files": []})
+    tarea = cola.claim("w1")
+
+    # Con latido reciente no se reencola
+    assert cola.requeue_stale(60) == 0
+    viejo = time.time() - 120
+    os.utime(os.path.join(str(tmp_path), CLAIMED, "j2.0.json"), (viejo, viejo))
+    assert cola.requeue_stale(60) == 1
+    assert cola.status("j2")["0"]["state"] == PENDING
+
+    # Otro trabajador lo retoma como segundo intento
+    retomada = cola.claim("w2")
+    assert retomada["worker"] == "w2" and retomada["attempts"] == 2
+
+    parte = tmp_path / "parte.npz"
+    parte.write_bytes(b"agregado")
+    cola.complete(retomada, str(parte))
+    assert cola.status("j2")["0"]["state"] == DONE
+    with open(cola.part_path("j2", "0"), "rb") as fh:
+        assert fh.read() == b"agregado"
+    # El latido de la tarea original ya no la revive
+    cola.heartbeat(tarea)
+    assert cola.claim("w1") is None
+
+
+def merged_aggregate(workbooks, tmp_path, exact):
+    """Dos grupos de libros sumados por separado, escritos, leídos y combinados"""
+    analisis = str(tmp_path / "analysis")
+    partes = []
+    for i, grupo in enumerate((workbooks[:2], workbooks[2:])):
+        agregado = aggregate_files(grupo, HOJAS, TEMPLATE_PATH, analisis, exact=exact, workers=1)
+        path = str(tmp_path / f"parte{i}.npz")
+        write_aggregate(path, agregado)
+        partes.append(read_aggregate(path))
+    return merge_aggregates(partes), analisis
+
+
+def cell_value(agregado, hoja, ref):
+    parte = agregado.sheets[hoja]
+    fila, col = coordinate_to_tuple(ref)
+    posicion = (fila - 1) * agregado.max_cols[hoja] + col - 1
+    i = int(parte.index.searchsorted(posicion))
+    return parte.values[i] if i < len(parte.index) and parte.index[i] == posicion else 0
+
+
+def test_merge_and_finalize_match_openpyxl(workbooks, tmp_path):
+    agregado, analisis = merged_aggregate(workbooks, tmp_path, exact=False)
+    assert agregado.file_count == len(workbooks) and not agregado.errors
+
+    salida = str(tmp_path / "consolidado.xlsm")
+    resumen = finalize_aggregate(agregado, TEMPLATE_PATH, analisis, salida, evaluate_formulas=False)
+    assert resumen["file_count"] == len(workbooks)
+
+    sumas = expected_sums(workbooks, HOJAS)
+    libro = openpyxl.load_workbook(salida, read_only=True, data_only=True)
+    try:
+        for hoja in HOJAS:
+            assert sumas[hoja]
+            escritas = {
+                f"{celda.column_letter}{celda.row}": celda.value
+                for fila in libro[hoja].iter_rows() for celda in fila
+                if hasattr(celda, "column") and isinstance(celda.value, (int, float))
+            }
+            for ref, valor in sumas[hoja].items():
+                assert abs(cell_value(agregado, hoja, ref) - valor) < 1e-9, (hoja, ref)
+                assert abs(escritas.get(ref, 0) - valor) < 1e-9, (hoja, ref)
+    finally:
+        libro.close()
+
+
+def test_exact_aggregate_keeps_decimals(workbooks, tmp_path):
+    agregado, analisis = merged_aggregate(workbooks, tmp_path, exact=True)
+    assert agregado.exact
+    # Escribir, leer y combinar por partes no cambia ningún dígito
+    directo = aggregate_files(workbooks, HOJAS, TEMPLATE_PATH, analisis, exact=True, workers=1)
+
+    sumas = expected_sums(workbooks, HOJAS)
+    for hoja in HOJAS:
+        assert list(agregado.sheets[hoja].index) == list(directo.sheets[hoja].index)
+        assert list(agregado.sheets[hoja].values) == list(directo.sheets[hoja].values)
+        for ref, valor in sumas[hoja].items():
+            suma = cell_value(agregado, hoja, ref)
+            assert isinstance(suma, Decimal) and abs(float(suma) - valor) < 1e-9, (hoja, ref)
+
+
+def test_merge_rejects_mixed_aggregates(workbooks, tmp_path):
+    analisis = str(tmp_path / "analysis")
+    flotante = aggregate_files(workbooks[:1], HOJAS, TEMPLATE_PATH, analisis, workers=1)
+    exacto = aggregate_files(workbooks[:1], HOJAS, TEMPLATE_PATH, analisis, exact=True, workers=1)
+    with pytest.raises(InvalidAggregate):
+        merge_aggregates([flotante, exacto])
+    with pytest.raises(InvalidAggregate):
+        merge_aggregates([])
+
+    otro = tmp_path / "otro.npz"
+    otro.write_bytes(b"no es un agregado")
+    with pytest.raises(InvalidAggregate):
+        read_aggregate(str(otro))
+
+    flotante.template_hash = "0" * 64
+    with pytest.raises(InvalidAggregate):
+        finalize_aggregate(flotante, TEMPLATE_PATH, analisis, str(tmp_path / "x.xlsm"), evaluate_formulas=False)
@@ -0,0 +1,92 @@
+"""Evaluación de fórmulas de la plantilla con el grafo de dependencias"""
+import logging
+
+import openpyxl
+import pytest
+
+import formula_engine
+from formula_engine import DIV0, NUM, FormulaModel, FormulaState, compile_formula, _Evaluator
+from template_analysis import analyze_template
+
+
+@pytest.fixture
+def model(tmp_path):
+    libro = openpyxl.Workbook()
+    hoja = libro.active
+    hoja.title = "A01"
+    for ref in ("A1", "A2", "A3"):
+        hoja[ref] = 0
+    hoja["B1"] = "=SUM(A1:A2)"
+    hoja["B2"] = '=IF(B1>10,"alto","bajo")'
+    hoja["B3"] = "=ROUND(B1/3,2)"
+    hoja["B4"] = "=A3/0"
+    hoja["B5"] = '=WEBSERVICE("http://x")'
+    hoja["B6"] = "=B5+1"
+    hoja["B7"] = "=A3*2"
+    otra = libro.create_sheet("A02")
+    otra["A1"] = "=A01!B1*10"
+    path = str(tmp_path / "plantilla.xlsx")
+    libro.save(path)
+    return FormulaModel(path, analyze_template(path))
+
+
+def test_recalculate_and_incremental(model):
+    estado = FormulaState()
+    resumen = model.recalculate(estado, ["A01", "A02"], {"A01": [(1, 1, 4), (2, 1, 8.5), (3, 1, 2)]})
+    valores = estado.values
+    assert valores[("A01", 1, 2)] == 12.5
+    assert valores[("A01", 2, 2)] == "alto"
+    assert valores[("A01", 3, 2)] == 4.17
+    assert valores[("A01", 4, 2)] == DIV0
+    assert valores[("A01", 7, 2)] == 4
+    assert valores[("A02", 1, 1)] == 125
+    # La no soportada y la que depende de ella conservan el valor de la plantilla
+    assert ("A01", 5, 2) not in valores and ("A01", 6, 2) not in valores
+    assert resumen.changed_inputs == 3 and resumen.failed == 0
+
+    # Solo cambia A1: no se reevalúan las fórmulas que dependen de A3
+    resumen = model.recalculate(estado, ["A01", "A02"], {"A01": [(1, 1, 1), (2, 1, 8.5), (3, 1, 2)]})
+    assert resumen.changed_inputs == 1
+    assert resumen.evaluated == 4  # B1, B2, B3 y A02!A1
+    assert estado.values[("A01", 2, 2)] == "bajo"
+    assert estado.values[("A02", 1, 1)] == 95
+
+    # Hojas excluidas no se evalúan
+    resumen = model.recalculate(estado, ["A01"], {"A01": [(1, 1, 2), (2, 1, 8.5), (3, 1, 2)]})
+    assert estado.values[("A02", 1, 1)] == 95
+
+
+def test_evaluator_errors_are_logged_and_counted(model, monkeypatch, caplog):
+    def falla(ev, args):
+        raise TypeError("caso no contemplado")
+
+    monkeypatch.setitem(formula_engine.FUNCTIONS, "ROUND", falla)
+    estado = FormulaState()
+    with caplog.at_level(logging.WARNING, logger="formula_engine"):
+        resumen = model.recalculate(estado, ["A01"], {"A01": [(1, 1, 3)]})
+    assert resumen.failed == 1
+    assert ("A01", 3, 2) in estado.stale and ("A01", 3, 2) not in estado.values
+    assert estado.values[("A01", 1, 2)] == 3
+    assert "A01!B3" in caplog.text
+
+
+def evaluate(texto):
+    return _Evaluator(lambda hoja, row, col: None, {"A01"}).evaluate_cell(compile_formula(texto, 1, 1), "A01", 1, 1)
+
+
+@pytest.mark.parametrize("texto, esperado", [
+    ("ROUND(2.345,2)", 2.35),
+    ("ROUND(1E308*10,2)", NUM),
+    ("INT(1E308*10)", NUM),
+    ("MOD(7,0)", DIV0),
+    ("MOD(1E308*10,3)", NUM),
+    ("ROUND(1,1E308*10)", NUM),
+    ("SUM(Z1:Z3)+1", 1),
+    ("IF(Z1,1,2)", 2),
+    # Argumentos omitidos valen 0 / FALSE
+    ("ROUND(2.5,)", 3),
+    ("IF(,1,2)", 2),
+    ("1+IF(TRUE,,2)", 1),
+])
+def test_non_finite_and_missing_values(texto, esperado):
+    assert evaluate(texto) == esperado
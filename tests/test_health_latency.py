@@ -0,0 +1,14 @@
+"""/api/health sigue respondiendo rápido con auditorías en curso"""
+import pytest
+
+from conftest import TEMPLATE_PATH
+from latency_health import measure
+
+MAX_P99_MS = 250.0
+
+
+@pytest.mark.slow
+def test_health_latency_under_audits(tmp_path):
+    reporte = measure(TEMPLATE_PATH, audits=2, duration=3.0, interval=0.05, workdir=str(tmp_path / "api"))
+    assert reporte["loaded"]["count"] > 0
+    assert reporte["loaded"]["p99_ms"] <= MAX_P99_MS
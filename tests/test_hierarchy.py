@@ -0,0 +1,62 @@
+"""Consolidación jerárquica desde consolidados anteriores, linaje y propagación"""
+import os
+
+from conftest import XLSM_TYPE, assert_data_matches, process, upload_session, wait_task
+
+HOJAS = ["A01", "A02"]
+# Todas las consolidaciones del árbol con las mismas hojas (y distintas a las de otras pruebas)
+EXCLUIDAS = "A04"
+
+
+def test_consolidate_inputs_lineage_and_propagate(client, workbooks):
+    comuna_a = upload_session(client, workbooks[:2])
+    comuna_b = upload_session(client, workbooks[2:3])
+    _, hijo_a = process(client, comuna_a["session_id"], excluded_sheets=EXCLUIDAS)
+    _, hijo_b = process(client, comuna_b["session_id"], excluded_sheets=EXCLUIDAS)
+
+    # El nivel superior suma los agregados guardados, sin releer libros
+    _, region = process(client, None, inputs=f"{hijo_a['result_id']},{hijo_b['result_id']}",
+                        excluded_sheets=EXCLUIDAS)
+    assert region["metrics"]["inputs_total"] == 2
+    assert_data_matches(client, region["result_id"], workbooks[:3], HOJAS)
+
+    # Una entrada que ya está bajo otra, o la sesión de una entrada, se sumaría dos veces
+    for campos in (
+        {"inputs": f"{hijo_a['result_id']},{region['result_id']}"},
+        {"session_id": comuna_a["session_id"], "inputs": hijo_a["result_id"]},
+    ):
+        r = client.post("/api/consolidate/process", data={**campos, "excluded_sheets": EXCLUIDAS})
+        assert r.status_code == 400 and "dos veces" in r.json()["detail"]
+
+    linaje = client.get(f"/api/consolidate/lineage/{region['result_id']}").json()
+    assert {nodo["result_id"] for nodo in linaje["inputs"]} == {hijo_a["result_id"], hijo_b["result_id"]}
+    assert linaje["files"] == 0 and linaje["leaf_files"] == 3 and linaje["parents"] == []
+    assert {nodo["session_id"] for nodo in linaje["inputs"]} == {comuna_a["session_id"], comuna_b["session_id"]}
+    hijo = client.get(f"/api/consolidate/lineage/{hijo_a['result_id']}").json()
+    assert hijo["parents"] == [region["result_id"]] and hijo["inputs"] == []
+    assert client.get("/api/consolidate/lineage/" + "0" * 32).status_code == 404
+
+    # Se corrige una comuna: se reconsolida y se rehace solo el camino hacia arriba
+    with open(workbooks[3], "rb") as fh:
+        r = client.post(f"/api/consolidate/session/{comuna_b['session_id']}/files",
+                        files=[("files", (os.path.basename(workbooks[3]), fh, XLSM_TYPE))])
+    assert r.status_code == 200, r.text
+    _, hijo_b2 = process(client, comuna_b["session_id"], excluded_sheets=EXCLUIDAS)
+
+    r = client.post("/api/consolidate/propagate",
+                    data={"result_id": hijo_b["result_id"], "replacement_id": hijo_b2["result_id"]})
+    assert r.status_code == 200, r.text
+    tareas = r.json()["tasks"]
+    assert [tarea["replaces"] for tarea in tareas] == [region["result_id"]]
+    estado = wait_task(client, tareas[0]["task_id"])
+    assert estado["status"] == "completed", estado
+    assert estado["result_id"] == tareas[0]["result_id"]
+    assert_data_matches(client, estado["result_id"], workbooks, HOJAS)
+
+    nuevo = client.get(f"/api/consolidate/lineage/{estado['result_id']}").json()
+    assert {nodo["result_id"] for nodo in nuevo["inputs"]} == {hijo_a["result_id"], hijo_b2["result_id"]}
+
+    # Un resultado que nadie usa no rehace nada
+    r = client.post("/api/consolidate/propagate",
+                    data={"result_id": estado["result_id"], "replacement_id": estado["result_id"]})
+    assert r.status_code == 200 and r.json()["tasks"] == []
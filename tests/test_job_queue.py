@@ -0,0 +1,48 @@
+"""Cola persistente de trabajos y control de admisión"""
+import pytest
+
+from conftest import upload_session
+from state_store import StateStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StateStore(str(tmp_path / "state.db"))
+
+
+def job(task_id, key=None):
+    return {"task_id": task_id, "status": "queued", "progress": 0, "current_file": "",
+            "status_message": "En cola", "result_key": key, "created_at": "2026-01-01T00:00:00"}
+
+
+def test_claim_in_order_and_requeue_stale(store):
+    store.insert_job(job("t1"), {"n": 1})
+    store.insert_job(job("t2"), {"n": 2})
+    assert store.count_jobs("queued") == 2
+    assert store.queue_position("t2") == 2
+
+    assert store.claim_job("nodo:1:a") == ("t1", {"n": 1})
+    assert store.queue_position("t2") == 1
+    assert store.count_jobs("processing") == 1
+
+    # Sin latido el trabajo vuelve a la cola
+    assert store.requeue_stale(-1) == 1
+    assert store.claim_job("nodo:2:a")[0] == "t1"
+
+
+def test_find_active_job(store):
+    store.insert_job(job("t1", key="k"))
+    assert store.find_active_job("k")["task_id"] == "t1"
+    store.claim_job("nodo:1:a")
+    assert store.find_active_job("k")["task_id"] == "t1"
+    store.update_job("t1", status="completed")
+    assert store.find_active_job("k") is None
+    assert store.find_active_job("otra") is None
+
+
+def test_full_queue_returns_429(client, workbooks, monkeypatch, main_module):
+    sesion = upload_session(client, workbooks[:1])
+    monkeypatch.setattr(main_module, "MAX_QUEUED_JOBS", 0)
+    r = client.post("/api/consolidate/process", data={"session_id": sesion["session_id"], "excluded_sheets": "A02"})
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
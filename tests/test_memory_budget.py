@@ -0,0 +1,78 @@
+"""Parciales acotadas en memoria y derramadas a disco"""
+import os
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from conftest import assert_data_matches, process, upload_session
+from consolidation import SheetPartial
+from memory_budget import BoundedPartials, partial_nbytes
+
+
+def parcial(semilla, exact=False):
+    rng = np.random.default_rng(semilla)
+    index = np.sort(rng.choice(10_000, size=50, replace=False)).astype(np.int64)
+    values = rng.uniform(0, 100, size=50).round(2)
+    if exact:
+        values = np.array([Decimal(str(v)) for v in values.tolist()], dtype=object)
+    counts = np.ones(50, dtype=np.int32)
+    return {"A01": SheetPartial(index, values, counts), "A02": SheetPartial(index[:5], values[:5], counts[:5])}
+
+
+def assert_same(a, b):
+    assert list(a) == list(b)
+    for hoja in a:
+        assert np.array_equal(a[hoja].index, b[hoja].index)
+        assert list(a[hoja].values) == list(b[hoja].values)
+        assert np.array_equal(a[hoja].counts, b[hoja].counts)
+
+
+@pytest.mark.parametrize("exact", [False, True])
+def test_spills_past_the_limit_and_keeps_values(tmp_path, exact):
+    parciales = {f"sha{i}": parcial(i, exact) for i in range(4)}
+    carpeta = str(tmp_path / "spill")
+    # Caben dos en memoria; las otras dos van a disco
+    limite = partial_nbytes(parciales["sha0"]) * 2
+    sumar = BoundedPartials(limite, carpeta)
+    for clave, valor in parciales.items():
+        sumar[clave] = valor
+
+    assert len(sumar) == 4 and sumar.spilled == 2
+    assert sumar.held_bytes <= limite and sumar.spilled_bytes > 0
+    assert os.path.isdir(carpeta)
+    for clave, valor in parciales.items():
+        assert_same(sumar[clave], valor)
+    assert sumar.stats()["memory_spilled_files"] == 2
+
+    # Quitar una en memoria deja lugar para la siguiente
+    del sumar["sha0"]
+    sumar["sha4"] = parcial(4, exact)
+    assert "sha4" in sumar and sumar.spilled == 2
+    with pytest.raises(KeyError):
+        sumar["sha0"]
+
+    sumar.close()
+    assert len(sumar) == 0 and not os.path.exists(carpeta)
+
+
+def test_without_limit_nothing_spills(tmp_path):
+    sumar = BoundedPartials(None, str(tmp_path / "spill"))
+    for i in range(3):
+        sumar[f"sha{i}"] = parcial(i)
+    assert sumar.spilled == 0 and sumar.spilled_bytes == 0
+    assert not os.path.exists(tmp_path / "spill")
+    sumar.close()
+
+
+def test_consolidation_with_job_memory_limit(client, workbooks, main_module, monkeypatch):
+    # Un MB no alcanza ni para la parte fija: todas las parciales se derraman
+    monkeypatch.setattr(main_module, "JOB_MEMORY_MB", 1)
+    libros = workbooks[1:4]
+    sesion = upload_session(client, libros)
+    respuesta, estado = process(client, sesion["session_id"], excluded_sheets="A05")
+
+    assert estado["metrics"]["memory_spilled_files"] == len(libros)
+    assert estado["metrics"]["memory_spilled_bytes"] > 0
+    assert_data_matches(client, estado["result_id"], libros, ["A01", "A02"])
+    assert not os.path.exists(os.path.join(main_module.SPILL_FOLDER, respuesta["task_id"]))
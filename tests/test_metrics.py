@@ -0,0 +1,23 @@
+"""Endpoint /metrics (formato de texto de Prometheus)"""
+import re
+
+from conftest import process, upload_session
+
+
+def metric_value(texto, nombre):
+    coincidencia = re.search(rf"^{re.escape(nombre)} (\S+)$", texto, re.MULTILINE)
+    assert coincidencia, nombre
+    return float(coincidencia.group(1))
+
+
+def test_metrics_after_consolidation(client, workbooks, main_module):
+    sesion = upload_session(client, workbooks[:1])
+    process(client, sesion["session_id"], excluded_sheets="A04")
+
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    texto = r.text
+    assert metric_value(texto, "consolidador_sessions") == main_module.state_store.count_sessions()
+    assert metric_value(texto, "consolidador_queue_depth") >= 0
+    assert metric_value(texto, 'consolidador_tasks_total{status="completed"}') >= 1
+    assert 'consolidador_stage_seconds_count{stage="write"}' in texto
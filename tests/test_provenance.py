@@ -0,0 +1,64 @@
+"""Índice de procedencia por celda: aportes por archivo y atípicos"""
+import pytest
+from openpyxl.utils import get_column_letter
+
+from conftest import TEMPLATE_PATH, process, upload_session
+from synthetic import input_cells
+from template_analysis import analyze_template
+from xlsx_writer import write_patched_workbook
+
+VALORES = [10, 11, 12, 10, 500]
+
+
+@pytest.fixture(scope="module")
+def consolidated(client, tmp_path_factory):
+    """Cinco libros con aportes conocidos en dos celdas de A01; retorna (result_id, celda, otra)"""
+    celdas = input_cells(analyze_template(TEMPLATE_PATH), ["A01"])["A01"]
+    (r1, c1), (r2, c2) = celdas[100], celdas[101]
+    carpeta = tmp_path_factory.mktemp("procedencia")
+    libros = []
+    for i, valor in enumerate(VALORES):
+        path = str(carpeta / f"establecimiento_{i}.xlsm")
+        # El primero deja vacía la segunda celda
+        write_patched_workbook(TEMPLATE_PATH, path, {"A01": [(r1, c1, valor)] + [(r2, c2, i)] * (i > 0)})
+        libros.append(path)
+    sesion = upload_session(client, libros)
+    _, estado = process(client, sesion["session_id"], provenance="true", excluded_sheets="A03")
+    return estado["result_id"], f"{get_column_letter(c1)}{r1}", f"{get_column_letter(c2)}{r2}"
+
+
+def test_cell_contributions(client, consolidated):
+    result_id, celda, otra = consolidated
+    r = client.get(f"/api/consolidate/provenance/{result_id}", params={"sheet": "A01", "cell": celda})
+    assert r.status_code == 200, r.text
+    detalle = r.json()
+    assert detalle["total"] == sum(VALORES)
+    assert detalle["archivos_con_aporte"] == 5 and detalle["archivos_sin_aporte"] == 0
+    assert [a["valor"] for a in detalle["aportes"]] == sorted(VALORES, reverse=True)
+    assert detalle["aportes"][0]["archivo"] == "establecimiento_4.xlsm"
+    assert [a["archivo"] for a in detalle["atipicos"]] == ["establecimiento_4.xlsm"]
+
+    # El total coincide con los datos del consolidado
+    datos = client.get(f"/api/consolidate/data/{result_id}", params={"ref": f"A01!{celda}"}).json()
+    assert datos["hojas"]["A01"][celda] == sum(VALORES)
+
+    top = client.get(f"/api/consolidate/provenance/{result_id}",
+                     params={"sheet": "A01", "cell": celda, "top": 2}).json()
+    assert [a["valor"] for a in top["aportes"]] == [500, 12]
+
+    # El archivo sin valor en la celda no aporta
+    sin = client.get(f"/api/consolidate/provenance/{result_id}", params={"sheet": "A01", "cell": otra}).json()
+    assert (sin["total"], sin["archivos_con_aporte"], sin["archivos_sin_aporte"]) == (10, 4, 1)
+
+
+def test_outliers_and_errors(client, consolidated):
+    result_id, celda, _ = consolidated
+    r = client.get(f"/api/consolidate/provenance/{result_id}/outliers", params={"sheet": "A01"})
+    assert r.status_code == 200
+    assert [c["celda"] for c in r.json()["celdas"]] == [celda]
+    assert r.json()["celdas"][0]["mediana"] == 11
+
+    assert client.get(f"/api/consolidate/provenance/{result_id}",
+                      params={"sheet": "A03", "cell": celda}).status_code == 400
+    assert client.get("/api/consolidate/provenance/" + "0" * 32,
+                      params={"sheet": "A01", "cell": celda}).status_code == 404
@@ -0,0 +1,21 @@
+"""Reutilización de resultados por clave de consolidación"""
+from conftest import process, upload_session, wait_task
+
+
+def test_same_consolidation_reuses_result(client, workbooks):
+    sesion = upload_session(client, workbooks[:2])
+    primera, estado = process(client, sesion["session_id"], excluded_sheets="A01")
+    assert primera["cached"] is False
+
+    # Otra sesión con los mismos archivos, en otro orden: misma clave
+    otra = upload_session(client, list(reversed(workbooks[:2])))
+    r = client.post("/api/consolidate/process", data={"session_id": otra["session_id"], "excluded_sheets": "A01"})
+    assert r.status_code == 200
+    assert r.json()["cached"] is True
+    assert r.json()["result_id"] == estado["result_id"]
+    assert client.get(f"/api/consolidate/status/{r.json()['task_id']}").json()["status"] == "completed"
+
+    # Otras hojas: otra clave, otro resultado
+    r = client.post("/api/consolidate/process", data={"session_id": otra["session_id"], "excluded_sheets": "A02"})
+    assert r.status_code == 200 and r.json()["cached"] is False
+    assert wait_task(client, r.json()["task_id"])["result_id"] != estado["result_id"]
@@ -0,0 +1,57 @@
+"""Re-consolidación incremental de sesiones desde la caché de parciales"""
+import hashlib
+
+from conftest import TEMPLATE_PATH, assert_data_matches, process, upload_session
+from synthetic import generate_workbooks
+
+
+def sha256_of(path):
+    with open(path, "rb") as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def test_session_add_and_remove_files(client, workbooks):
+    sesion = upload_session(client, workbooks[:3])
+    session_id = sesion["session_id"]
+    # En modo exacto los archivos quitados se restan en lugar de resumar todo
+    _, primero = process(client, session_id, exact="true")
+    hojas = ["A01", "A02"]
+    assert_data_matches(client, primero["result_id"], workbooks[:3], hojas)
+
+    # Quitar uno y agregar otro: los archivos que quedan no se releen
+    archivos = client.get(f"/api/consolidate/session/{session_id}").json()["files"]
+    quitado = next(f["file_id"] for f in archivos if f["sha256"] == sha256_of(workbooks[2]))
+    r = client.delete(f"/api/consolidate/session/{session_id}/files/{quitado}")
+    assert r.status_code == 200 and r.json()["files_count"] == 2
+    with open(workbooks[3], "rb") as fh:
+        r = client.post(f"/api/consolidate/session/{session_id}/files", files=[("files", ("nuevo.xlsm", fh))])
+    assert r.status_code == 200 and r.json()["files_count"] == 3
+
+    _, segundo = process(client, session_id, exact="true")
+    assert segundo["result_id"] != primero["result_id"]
+    assert segundo["metrics"]["files_reused"] == 2
+    assert_data_matches(client, segundo["result_id"], workbooks[:2] + workbooks[3:], hojas)
+
+
+def test_only_missing_sheets_are_read(client, main_module, monkeypatch, tmp_path):
+    # Libros propios: los de la fixture ya pueden estar en la caché
+    libros = generate_workbooks(TEMPLATE_PATH, str(tmp_path), 2, seed=606)
+    hojas_leidas = []
+    original = main_module.consolidate_partials
+
+    def espia(rutas, hojas, *args, **kwargs):
+        hojas_leidas.append(list(hojas))
+        return original(rutas, hojas, *args, **kwargs)
+
+    monkeypatch.setattr(main_module, "consolidate_partials", espia)
+    todas = client.get("/api/templates").json()["templates"][0]["sheet_names"]
+    sesion = upload_session(client, libros)
+    excluidas = [hoja for hoja in todas if hoja not in ("A01", "A02")]
+    process(client, sesion["session_id"], excluded_sheets=",".join(excluidas + ["A02"]))
+    assert hojas_leidas == [["A01"]]
+
+    # Sumar A02 después: solo se lee A02 y el resultado incluye ambas hojas
+    otra = upload_session(client, libros)
+    _, estado = process(client, otra["session_id"], excluded_sheets=",".join(excluidas))
+    assert hojas_leidas[1:] == [["A02"]]
+    assert_data_matches(client, estado["result_id"], libros, ["A01", "A02"])
@@ -0,0 +1,48 @@
+"""Validación de versión leyendo solo la celda A9"""
+import io
+
+import openpyxl
+
+from conftest import TEMPLATE_PATH, XLSM_TYPE, upload_session
+from template_checks import EXPECTED_VERSION, read_template_version
+
+
+def workbook_with_a9(path, valor):
+    libro = openpyxl.Workbook()
+    libro.active.title = "IDENTIFICACIÓN"
+    libro.active["A9"] = valor
+    libro.create_sheet("A01")["A9"] = "otra hoja"
+    libro.save(path)
+    return path
+
+
+def test_reads_a9_of_first_sheet(tmp_path):
+    libro = openpyxl.load_workbook(TEMPLATE_PATH, read_only=True)
+    try:
+        esperado = str(libro.worksheets[0]["A9"].value).strip()
+    finally:
+        libro.close()
+    assert read_template_version(TEMPLATE_PATH) == esperado == EXPECTED_VERSION
+
+    assert read_template_version(workbook_with_a9(str(tmp_path / "v.xlsx"), "  Versión 0.9  ")) == "Versión 0.9"
+    with open(workbook_with_a9(str(tmp_path / "vacia.xlsx"), None), "rb") as fh:
+        assert read_template_version(io.BytesIO(fh.read())) == ""
+
+
+def test_validate_endpoint(client, tmp_path):
+    with open(TEMPLATE_PATH, "rb") as fh:
+        r = client.post("/api/consolidate/validate", files={"file": ("plantilla.xlsm", fh, XLSM_TYPE)})
+    assert r.status_code == 200 and r.json()["version"] == EXPECTED_VERSION
+
+    with open(workbook_with_a9(str(tmp_path / "vieja.xlsx"), "Versión 1.0"), "rb") as fh:
+        r = client.post("/api/consolidate/validate", files={"file": ("vieja.xlsx", fh)})
+    assert r.status_code == 400
+    assert r.json()["encontrado"] == "Versión 1.0" and r.json()["esperado"] == EXPECTED_VERSION
+
+
+def test_validate_session(client, workbooks):
+    sesion = upload_session(client, workbooks[:3])
+    r = client.post(f"/api/consolidate/session/{sesion['session_id']}/validate")
+    assert r.status_code == 200
+    assert (r.json()["valid_count"], r.json()["invalid_count"]) == (3, 0)
+    assert {item["version"] for item in r.json()["files"]} == {EXPECTED_VERSION}
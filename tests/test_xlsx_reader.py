@@ -0,0 +1,54 @@
+"""Lector en streaming de celdas numéricas, contrastado con openpyxl"""
+import openpyxl
+
+from conftest import TEMPLATE_PATH
+from synthetic import input_cells
+from template_analysis import analyze_template
+from xlsx_reader import XlsxReader
+
+
+def openpyxl_numbers(path, hoja, celdas=None):
+    """Celdas numéricas (booleanos incluidos) como las veía la consolidación con openpyxl"""
+    libro = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        valores = {}
+        for fila in libro[hoja].iter_rows():
+            for celda in fila:
+                if not hasattr(celda, "column") or not isinstance(celda.value, (int, float)):
+                    continue
+                if celdas is None or (celda.row, celda.column) in celdas:
+                    valores[(celda.row, celda.column)] = celda.value
+        return valores
+    finally:
+        libro.close()
+
+
+def test_reads_numbers_and_booleans_like_openpyxl(tmp_path):
+    libro = openpyxl.Workbook()
+    hoja = libro.active
+    hoja.title = "A01"
+    hoja["B2"] = 7
+    hoja["C2"] = 2.5
+    hoja["D2"] = True
+    hoja["E2"] = False
+    hoja["F2"] = "texto"
+    hoja["G2"] = "=B2+C2"
+    hoja["B5"] = -3
+    hoja["C5"] = 1e-7
+    path = str(tmp_path / "simple.xlsx")
+    libro.save(path)
+
+    with XlsxReader(path) as wb:
+        leidas = {(row, col): valor for row, col, valor in wb.iter_numeric_cells("A01")}
+    assert leidas == openpyxl_numbers(path, "A01")
+    assert leidas[(2, 4)] == 1 and leidas[(2, 5)] == 0
+
+
+def test_synthetic_sa26_matches_openpyxl(workbooks):
+    analisis = analyze_template(TEMPLATE_PATH)
+    for hoja, posiciones in input_cells(analisis, ["A01", "A02"]).items():
+        entrada = set(posiciones)
+        with XlsxReader(workbooks[0]) as wb:
+            leidas = {(row, col): valor for row, col, valor in wb.iter_numeric_cells(hoja, lambda r, c: (r, c) in entrada)}
+        esperadas = openpyxl_numbers(workbooks[0], hoja, entrada)
+        assert leidas and leidas == esperadas
@@ -0,0 +1,63 @@
+"""Escritura del consolidado parchando el zip de la plantilla SA_26"""
+import random
+import struct
+import zipfile
+
+import openpyxl
+
+from conftest import TEMPLATE_PATH
+from synthetic import input_cells
+from template_analysis import analyze_template
+from xlsx_reader import find_workbook_part, read_sheet_parts
+from xlsx_writer import write_patched_workbook
+
+
+def raw_member(path, info):
+    """Bytes comprimidos del miembro, tal como están en el archivo"""
+    with open(path, "rb") as fh:
+        fh.seek(info.header_offset)
+        campos = struct.unpack(zipfile.structFileHeader, fh.read(zipfile.sizeFileHeader))
+        fh.seek(campos[zipfile._FH_FILENAME_LENGTH] + campos[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+        return fh.read(info.compress_size)
+
+
+def sample_values(hojas, seed=7, por_hoja=200):
+    analisis = analyze_template(TEMPLATE_PATH)
+    rng = random.Random(seed)
+    return {
+        hoja: [(row, col, rng.choice([rng.randint(0, 500), round(rng.uniform(0, 100), 2)]))
+               for row, col in celdas[:por_hoja]]
+        for hoja, celdas in input_cells(analisis, hojas).items()
+    }
+
+
+def test_written_values_read_back_with_openpyxl(tmp_path):
+    valores = sample_values(["A01", "A02", "A03"])
+    salida = str(tmp_path / "consolidado.xlsm")
+    assert write_patched_workbook(TEMPLATE_PATH, salida, valores) == 0
+
+    libro = openpyxl.load_workbook(salida, read_only=True, keep_vba=True, data_only=True)
+    try:
+        for hoja, escritas in valores.items():
+            for row, col, valor in escritas:
+                assert libro[hoja].cell(row=row, column=col).value == valor, (hoja, row, col)
+    finally:
+        libro.close()
+
+
+def test_untouched_members_copied_compressed(tmp_path):
+    salida = str(tmp_path / "consolidado.xlsm")
+    write_patched_workbook(TEMPLATE_PATH, salida, sample_values(["A01"], por_hoja=10))
+
+    with zipfile.ZipFile(TEMPLATE_PATH) as zin, zipfile.ZipFile(salida) as zout:
+        cambiados = {read_sheet_parts(zin)["A01"], find_workbook_part(zin)}
+        assert zout.testzip() is None
+        assert [i.filename for i in zout.infolist()] == [i.filename for i in zin.infolist()]
+        for info in zin.infolist():
+            copia = zout.getinfo(info.filename)
+            assert (copia.date_time, copia.compress_type) == (info.date_time, info.compress_type)
+            if info.filename in cambiados:
+                assert zout.read(copia) != zin.read(info)
+            else:
+                assert copia.CRC == info.CRC
+                assert raw_member(salida, copia) == raw_member(TEMPLATE_PATH, info)
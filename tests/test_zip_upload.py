@@ -0,0 +1,57 @@
+"""Subida de libros dentro de un ZIP"""
+import os
+import zipfile
+
+import pytest
+
+import upload_archive
+from conftest import assert_data_matches, process
+
+
+def make_zip(path, miembros):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nombre, contenido in miembros:
+            if isinstance(contenido, bytes):
+                zf.writestr(nombre, contenido)
+            else:
+                zf.write(contenido, nombre)
+    return path
+
+
+def test_zip_members_are_consolidated(client, workbooks, tmp_path):
+    archivo = make_zip(str(tmp_path / "comuna.zip"), [
+        ("Centro/enero.xlsm", workbooks[0]),
+        ("Norte/enero.xlsm", workbooks[1]),
+        ("__MACOSX/Centro/._enero.xlsm", b"basura"),
+        ("Norte/~$enero.xlsm", b"bloqueo"),
+        ("Norte/notas.txt", b"no es libro"),
+        ("Sur/roto.xlsx", b"no es un zip"),
+    ])
+    with open(archivo, "rb") as fh:
+        r = client.post("/api/consolidate/upload", files=[("files", ("comuna.zip", fh, "application/zip"))])
+    assert r.status_code == 200, r.text
+    # Solo se revisan los libros; los de macOS, de bloqueo y otros archivos se ignoran
+    assert [(x["archive"], x["folder"], x["filename"]) for x in r.json()["rejected"]] == [("comuna.zip", "Sur", "roto.xlsx")]
+
+    sesion = client.get(f"/api/consolidate/session/{r.json()['session_id']}").json()
+    assert sesion["files_count"] == 2
+    assert {(f["archive"], f["folder"]) for f in sesion["files"]} == {("comuna.zip", "Centro"), ("comuna.zip", "Norte")}
+    # El ZIP no se desempaqueta en uploads/
+    propios = [nombre for nombre in os.listdir("uploads") if nombre.startswith(sesion["session_id"])]
+    assert len(propios) == 1 and propios[0].endswith(".zip")
+
+    _, estado = process(client, r.json()["session_id"], excluded_sheets="A05")
+    assert_data_matches(client, estado["result_id"], workbooks[:2], ["A01", "A02"])
+
+
+def test_zip_limits(tmp_path, monkeypatch, workbooks):
+    archivo = make_zip(str(tmp_path / "muchos.zip"), [(f"l{i}.xlsm", workbooks[0]) for i in range(3)])
+    monkeypatch.setattr(upload_archive, "ZIP_MAX_MEMBERS", 2)
+    with pytest.raises(upload_archive.ArchiveRejected):
+        list(upload_archive.iter_archive_workbooks(archivo))
+
+    # Razón de compresión de bomba: se descarta ese miembro, no el ZIP
+    monkeypatch.setattr(upload_archive, "ZIP_MAX_MEMBERS", 10)
+    bomba = make_zip(str(tmp_path / "bomba.zip"), [("bomba.xlsx", b"\0" * (5 * 1024 * 1024)), ("ok.xlsm", workbooks[0])])
+    resultados = list(upload_archive.iter_archive_workbooks(bomba))
+    assert [(nombre, datos is None) for nombre, datos, _ in resultados] == [("bomba.xlsx", True), ("ok.xlsm", False)]
@@ -0,0 +1,120 @@
+"""
+Subidas de un ZIP con muchos libros.
+
+El ZIP se guarda tal cual y cada libro queda en la sesión como una
+referencia al miembro (ruta del ZIP + nombre dentro del ZIP). Los miembros
+se descomprimen de a uno y en memoria cuando se leen (al subirlos, para el
+hash y la revisión, y al consolidarlos): el ZIP nunca se desempaqueta en
+uploads/. Las carpetas dentro del ZIP se conservan como procedencia.
+
+Antes de descomprimir nada se revisan, con el directorio central, la
+cantidad de libros, el tamaño descomprimido (por libro y total) y la razón
+de compresión, para descartar bombas ZIP. zipfile no entrega más bytes que
+el tamaño declarado de cada miembro, así que esos límites se respetan.
+"""
+import io
+import os
+import posixpath
+import zipfile
+from typing import IO, Iterator, List, Optional, Tuple, Union
+
+# Límites por ZIP
+ZIP_MAX_MEMBERS = int(os.environ.get("ZIP_MAX_MEMBERS", "2000"))
+ZIP_MAX_MEMBER_MB = int(os.environ.get("ZIP_MAX_MEMBER_MB", "100"))
+ZIP_MAX_TOTAL_MB = int(os.environ.get("ZIP_MAX_TOTAL_MB", "4096"))
+# Tamaño descomprimido / comprimido máximo de un libro (un .xlsx ya viene comprimido)
+ZIP_MAX_RATIO = int(os.environ.get("ZIP_MAX_RATIO", "200"))
+
+WORKBOOK_EXTENSIONS = (".xlsx", ".xlsm")
+# Separa la ruta del ZIP del nombre del miembro en una referencia. La ruta
+# del ZIP la genera la API (sin el nombre original), así que no lo contiene.
+MEMBER_SEPARATOR = "::"
+
+
+class ArchiveRejected(ValueError):
+    """El ZIP no se puede leer o supera los límites"""
+
+
+def workbook_source(path: str, member: Optional[str] = None) -> str:
+    """Referencia a un libro: su ruta, o ZIP + miembro"""
+    return f"{path}{MEMBER_SEPARATOR}{member}" if member else path
+
+
+def split_source(source: str) -> Tuple[str, Optional[str]]:
+    """Inverso de `workbook_source`: (ruta, miembro o None)"""
+    path, separador, member = source.partition(MEMBER_SEPARATOR)
+    return (path, member) if separador else (source, None)
+
+
+def read_member(zf: zipfile.ZipFile, member: Union[str, zipfile.ZipInfo]) -> bytes:
+    info = member if isinstance(member, zipfile.ZipInfo) else zf.getinfo(member)
+    if info.file_size > ZIP_MAX_MEMBER_MB * 1024 * 1024:
+        raise ArchiveRejected(f"{info.filename} supera {ZIP_MAX_MEMBER_MB} MB descomprimido")
+    return zf.read(info)
+
+
+def open_workbook_source(source: str) -> Union[str, IO[bytes]]:
+    """Lo que recibe XlsxReader: la ruta, o el miembro del ZIP descomprimido en memoria"""
+    path, member = split_source(source)
+    if member is None:
+        return path
+    with zipfile.ZipFile(path) as zf:
+        return io.BytesIO(read_member(zf, member))
+
+
+def _is_workbook(info: zipfile.ZipInfo) -> bool:
+    nombre = posixpath.basename(info.filename)
+    return (
+        not info.is_dir()
+        and not info.filename.startswith("__MACOSX/")
+        # Archivos de bloqueo de Excel (~$libro.xlsx) y ocultos
+        and not nombre.startswith(("~$", "."))
+        and nombre.lower().endswith(WORKBOOK_EXTENSIONS)
+    )
+
+
+def list_archive_workbooks(zf: zipfile.ZipFile) -> Tuple[List[zipfile.ZipInfo], List[Tuple[str, str]]]:
+    """
+    Libros del ZIP según el directorio central, en orden. Retorna
+    (aceptados, [(miembro, motivo)] de los que superan los límites por libro).
+    Lanza ArchiveRejected si el ZIP completo supera los límites.
+    """
+    libros = [info for info in zf.infolist() if _is_workbook(info)]
+    if len(libros) > ZIP_MAX_MEMBERS:
+        raise ArchiveRejected(f"El ZIP tiene {len(libros)} libros (máximo {ZIP_MAX_MEMBERS})")
+    if sum(info.file_size for info in libros) > ZIP_MAX_TOTAL_MB * 1024 * 1024:
+        raise ArchiveRejected(f"El ZIP supera {ZIP_MAX_TOTAL_MB} MB descomprimido")
+
+    aceptados = []
+    rechazados = []
+    for info in libros:
+        if info.file_size > ZIP_MAX_MEMBER_MB * 1024 * 1024:
+            rechazados.append((info.filename, f"Supera {ZIP_MAX_MEMBER_MB} MB descomprimido"))
+        elif info.file_size > max(info.compress_size, 1) * ZIP_MAX_RATIO:
+            rechazados.append((info.filename, "Razón de compresión sospechosa"))
+        else:
+            aceptados.append(info)
+    return aceptados, rechazados
+
+
+def iter_archive_workbooks(archive_path: str) -> Iterator[Tuple[str, Optional[bytes], Optional[str]]]:
+    """
+    (miembro, contenido, None) de cada libro del ZIP, descomprimiendo uno a
+    la vez, o (miembro, None, motivo) si se descarta.
+    """
+    try:
+        zf = zipfile.ZipFile(archive_path)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ArchiveRejected(f"No es un ZIP válido: {e}") from None
+    with zf:
+        aceptados, rechazados = list_archive_workbooks(zf)
+        for nombre, motivo in rechazados:
+            yield nombre, None, motivo
+        for info in aceptados:
+            try:
+                datos = read_member(zf, info)
+            except (zipfile.BadZipFile, NotImplementedError, OSError, RuntimeError) as e:
+                # CRC inválido, compresión no soportada o miembro cifrado
+                yield info.filename, None, f"No se pudo descomprimir: {e}"
+                continue
+            yield info.filename, datos, None
@@ -0,0 +1,813 @@
+"""
+Lectura directa de libros .xlsx/.xlsm desde el zip.
+
+Evita el modelo de objetos de openpyxl: las hojas se leen en streaming
+(expat) directamente desde el miembro `xl/worksheets/sheetN.xml`, y los
+nombres de hoja se resuelven a través de `workbook.xml` y sus relaciones.
+Para sumar nunca se cargan `styles.xml` ni `sharedStrings.xml`: `read_cell`
+lee una sola celda y, si es texto compartido, solo hasta su índice. Cuando
+hacen falta todos los valores tal como los entrega openpyxl con
+`data_only=True` (textos, fechas según el formato de la celda, celdas
+combinadas), `read_sheet_values` los lee con un `ValueContext` del libro.
+"""
+import posixpath
+import re
+import zipfile
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import IO, Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from xml.parsers import expat
+
+from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, WINDOWS_EPOCH, from_ISO8601, from_excel
+
+Number = Union[int, float]
+CellValue = Union[None, str, bool, Number, datetime, date, time, timedelta]
+# (fila mínima, columna mínima, fila máxima, columna máxima) de un rango combinado
+CellBounds = Tuple[int, int, int, int]
+CellFilter = Callable[[int, int], bool]
+
+# Tamaño de bloque al alimentar el parser (bytes descomprimidos)
+READ_CHUNK_SIZE = 64 * 1024
+
+REL_OFFICE_DOCUMENT = "/officeDocument"
+REL_WORKSHEET = "/worksheet"
+REL_SHARED_STRINGS = "/sharedStrings"
+REL_STYLES = "/styles"
+
+
+class _StopParsing(Exception):
+    """Corta el parseo en cuanto se tiene lo necesario"""
+
+
+class _CellWithoutRef(Exception):
+    """Una celda sin atributo r: su columna depende de las anteriores de la fila"""
+
+
+# Celda vacía autocerrada (solo estilo), como las escribe Excel: <c r="B9" s="3"/>
+_EMPTY_CELL = re.compile(rb'<c r="[A-Z]{1,3}[0-9]+"[^>]*/>')
+
+
+@lru_cache(maxsize=1 << 18)
+def split_cell_ref(ref: str) -> Tuple[int, int]:
+    """Convierte una referencia "AB12" en (fila, columna) 1-indexadas"""
+    col = 0
+    i = 0
+    for ch in ref:
+        code = ord(ch)
+        if 65 <= code <= 90:
+            col = col * 26 + code - 64
+        elif 97 <= code <= 122:
+            col = col * 26 + code - 96
+        elif ch != "$":
+            break
+        i += 1
+    return int(ref[i:]), col
+
+
+def cast_number(text: str) -> Number:
+    """Misma conversión que aplica openpyxl a los valores numéricos"""
+    if "." in text or "E" in text or "e" in text:
+        return float(text)
+    return int(text)
+
+
+def local_name(name: str) -> str:
+    return name.rpartition(":")[2] if ":" in name else name
+
+
+def parse_xml(fh: IO[bytes], start, end=None, data=None) -> None:
+    """
+    Alimenta un parser expat por bloques con los manejadores indicados. Un
+    manejador puede lanzar `_StopParsing` para dejar de leer el resto.
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    if end is not None:
+        parser.EndElementHandler = end
+    if data is not None:
+        parser.CharacterDataHandler = data
+    try:
+        while True:
+            chunk = fh.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+        parser.Parse(b"", True)
+    except _StopParsing:
+        pass
+
+
+def _read_relationships(zf: zipfile.ZipFile, part: str) -> Dict[str, Tuple[str, str]]:
+    """Lee el .rels de una parte y retorna {rId: (tipo, ruta absoluta en el zip)}"""
+    base_dir, name = posixpath.split(part)
+    rels_path = posixpath.join(base_dir, "_rels", f"{name}.rels")
+    rels: Dict[str, Tuple[str, str]] = {}
+    if rels_path not in zf.NameToInfo:
+        return rels
+
+    def start(tag, attrs):
+        if local_name(tag) != "Relationship" or attrs.get("TargetMode") == "External":
+            return
+        target = attrs.get("Target", "")
+        if target.startswith("/"):
+            path = target.lstrip("/")
+        else:
+            path = posixpath.normpath(posixpath.join(base_dir, target))
+        rels[attrs.get("Id")] = (attrs.get("Type", ""), path)
+
+    with zf.open(rels_path) as fh:
+        parse_xml(fh, start)
+    return rels
+
+
+def find_workbook_part(zf: zipfile.ZipFile) -> str:
+    """Ubica la parte del libro (normalmente xl/workbook.xml) vía _rels/.rels"""
+    for rel_type, path in _read_relationships(zf, "").values():
+        if rel_type.endswith(REL_OFFICE_DOCUMENT) and path in zf.NameToInfo:
+            return path
+    return "xl/workbook.xml"
+
+
+def read_sheet_parts(zf: zipfile.ZipFile) -> Dict[str, str]:
+    """Retorna {nombre de hoja: ruta del XML de la hoja}, en el orden del libro"""
+    workbook_part = find_workbook_part(zf)
+    rels = _read_relationships(zf, workbook_part)
+    sheets: List[Tuple[str, str]] = []
+
+    def start(tag, attrs):
+        if local_name(tag) != "sheet":
+            return
+        rel_id = next((v for k, v in attrs.items() if local_name(k) == "id"), None)
+        rel = rels.get(rel_id)
+        if rel and rel[0].endswith(REL_WORKSHEET):
+            sheets.append((attrs.get("name"), rel[1]))
+
+    with zf.open(workbook_part) as fh:
+        parse_xml(fh, start)
+    return dict(sheets)
+
+
+def find_shared_strings_part(zf: zipfile.ZipFile) -> Optional[str]:
+    """Ruta de sharedStrings.xml según las relaciones del libro, o None si no hay"""
+    return _workbook_part_path(zf, REL_SHARED_STRINGS)
+
+
+# Elemento raíz de sharedStrings.xml, para conocer su prefijo de espacio de nombres
+_SST_ROOT = re.compile(rb"<(?:([A-Za-z_][\w.-]*):)?sst[\s>]")
+
+
+def _shared_string_text(fragment: bytes) -> str:
+    """Texto de un <si> como lo arma openpyxl: los <t> fuera de <rPh>, concatenados"""
+    estado = {"rph": 0, "in_t": False}
+    texto: List[str] = []
+
+    def start(tag, attrs):
+        tag = local_name(tag)
+        if tag == "rPh":
+            estado["rph"] += 1
+        elif tag == "t" and not estado["rph"]:
+            estado["in_t"] = True
+
+    def end(tag):
+        tag = local_name(tag)
+        if tag == "t":
+            estado["in_t"] = False
+        elif tag == "rPh":
+            estado["rph"] -= 1
+
+    def data(text):
+        if estado["in_t"]:
+            texto.append(text)
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    parser.Parse(fragment, True)
+    return "".join(texto)
+
+
+def read_shared_string(zf: zipfile.ZipFile, index: int) -> Optional[str]:
+    """
+    Texto del elemento `index` de sharedStrings.xml. Las entradas anteriores
+    se saltan contando aperturas de <si> sobre los bytes (el texto nunca
+    contiene "<" sin escapar, así que no hace falta parsear XML) y solo la
+    entrada pedida pasa por expat; se deja de descomprimir al cerrarla.
+    """
+    part = find_shared_strings_part(zf)
+    if part is None or index < 0:
+        return None
+    apertura = cierre = None
+    largo = 0
+    buffer = b""
+    vistos = 0
+    encontrado = False
+    with zf.open(part) as fh:
+        while True:
+            chunk = fh.read(READ_CHUNK_SIZE)
+            buffer += chunk
+            if apertura is None:
+                raiz = _SST_ROOT.search(buffer)
+                if raiz is None:
+                    if not chunk:
+                        return None
+                    continue
+                prefijo = re.escape(raiz.group(1) + b":") if raiz.group(1) else b""
+                # "<si" seguido de espacio, "/" o ">": largo fijo, sin lookahead
+                apertura = re.compile(b"<" + prefijo + rb"si[\s/>]")
+                cierre = re.compile(b"</" + prefijo + rb"si\s*>")
+                largo = len(b"<" + (raiz.group(1) + b":" if raiz.group(1) else b"") + b"si") + 1
+            if not encontrado:
+                n = len(apertura.findall(buffer))
+                if vistos + n <= index:
+                    vistos += n
+                    # Una apertura incompleta al final se cuenta con el bloque siguiente
+                    buffer = buffer[len(buffer) - (largo - 1):] if chunk else b""
+                else:
+                    for match in apertura.finditer(buffer):
+                        if vistos == index:
+                            buffer = buffer[match.start():]
+                            encontrado = True
+                            break
+                        vistos += 1
+            if encontrado:
+                if buffer[largo - 1:largo] == b"/" and buffer[largo:largo + 1] == b">":
+                    return ""  # <si/>
+                fin = cierre.search(buffer)
+                if fin is not None:
+                    return _shared_string_text(buffer[:fin.end()])
+            if not chunk:
+                return None
+
+
+def read_cell(zf: zipfile.ZipFile, part: str, ref: str) -> CellValue:
+    """
+    Valor guardado de una celda (el que lee openpyxl con data_only=True):
+    texto, número, booleano, código de error o None si está vacía. El XML de
+    la hoja se lee solo hasta pasar la fila de la celda.
+    """
+    fila, columna = split_cell_ref(ref)
+    celda = {"found": False, "type": None, "value": None}
+    estado = {"row": 0, "col": 0, "in_cell": False, "capture": False}
+    texto: List[str] = []
+
+    def start(tag, attrs):
+        tag = local_name(tag)
+        if tag == "row":
+            r = attrs.get("r")
+            estado["row"] = int(r) if r else estado["row"] + 1
+            estado["col"] = 0
+            if estado["row"] > fila:
+                raise _StopParsing
+        elif tag == "c":
+            r = attrs.get("r")
+            if r:
+                estado["row"], estado["col"] = split_cell_ref(r)
+            else:
+                estado["col"] += 1
+            estado["in_cell"] = estado["row"] == fila and estado["col"] == columna
+            if estado["in_cell"]:
+                celda["found"] = True
+                celda["type"] = attrs.get("t", "n")
+        elif estado["in_cell"] and tag in ("v", "t"):
+            # <v> con el valor guardado, o <is><t> en texto en línea
+            estado["capture"] = tag == "v" or celda["type"] == "inlineStr"
+
+    def end(tag):
+        tag = local_name(tag)
+        if tag in ("v", "t"):
+            estado["capture"] = False
+        elif tag == "c" and estado["in_cell"]:
+            raise _StopParsing
+
+    def data(text):
+        if estado["capture"]:
+            texto.append(text)
+
+    with zf.open(part) as fh:
+        parse_xml(fh, start, end, data)
+
+    valor = "".join(texto)
+    tipo = celda["type"]
+    if not celda["found"] or not valor:
+        return None
+    if tipo == "s":
+        return read_shared_string(zf, int(valor))
+    if tipo in ("str", "inlineStr", "e", "d"):
+        return valor
+    if tipo == "b":
+        return valor.strip() == "1"
+    try:
+        return cast_number(valor.strip())
+    except ValueError:
+        return valor
+
+
+class ValueContext(NamedTuple):
+    """Datos del libro para convertir una celda en su valor (como openpyxl con data_only)"""
+    shared_strings: List[str]
+    date_styles: Set[int]
+    timedelta_styles: Set[int]
+    epoch: datetime
+
+
+def _workbook_part_path(zf: zipfile.ZipFile, rel_suffix: str) -> Optional[str]:
+    for rel_type, path in _read_relationships(zf, find_workbook_part(zf)).values():
+        if rel_type.endswith(rel_suffix) and path in zf.NameToInfo:
+            return path
+    return None
+
+
+def read_shared_strings(zf: zipfile.ZipFile) -> List[str]:
+    """Tabla completa de textos compartidos (mismo texto que arma openpyxl)"""
+    part = _workbook_part_path(zf, REL_SHARED_STRINGS)
+    if part is None:
+        return []
+    textos: List[str] = []
+    estado = {"rph": 0, "in_t": False}
+    actual: List[str] = []
+
+    def start(tag, attrs):
+        tag = local_name(tag)
+        if tag == "si":
+            actual.clear()
+        elif tag == "rPh":
+            estado["rph"] += 1
+        elif tag == "t" and not estado["rph"]:
+            estado["in_t"] = True
+
+    def end(tag):
+        tag = local_name(tag)
+        if tag == "t":
+            estado["in_t"] = False
+        elif tag == "rPh":
+            estado["rph"] -= 1
+        elif tag == "si":
+            textos.append("".join(actual))
+
+    def data(text):
+        if estado["in_t"]:
+            actual.append(text)
+
+    with zf.open(part) as fh:
+        parse_xml(fh, start, end, data)
+    return textos
+
+
+def read_date_styles(zf: zipfile.ZipFile) -> Tuple[Set[int], Set[int]]:
+    """
+    Índices de estilo de celda (cellXfs) con formato de fecha y de duración,
+    con el mismo criterio que openpyxl
+    """
+    part = _workbook_part_path(zf, REL_STYLES)
+    if part is None:
+        return set(), set()
+    propios: Dict[int, str] = {}
+    formatos: List[int] = []
+    estado = {"in_xfs": False}
+
+    def start(tag, attrs):
+        tag = local_name(tag)
+        if tag == "numFmt":
+            try:
+                propios[int(attrs.get("numFmtId"))] = attrs.get("formatCode", "")
+            except (TypeError, ValueError):
+                pass
+        elif tag == "cellXfs":
+            estado["in_xfs"] = True
+        elif tag == "xf" and estado["in_xfs"]:
+            try:
+                formatos.append(int(attrs.get("numFmtId", 0)))
+            except ValueError:
+                formatos.append(0)
+
+    def end(tag):
+        if local_name(tag) == "cellXfs":
+            raise _StopParsing
+
+    with zf.open(part) as fh:
+        parse_xml(fh, start, end)
+
+    fechas: Set[int] = set()
+    duraciones: Set[int] = set()
+    for idx, fmt_id in enumerate(formatos):
+        fmt = propios[fmt_id] if fmt_id in propios else builtin_format_code(fmt_id)
+        if is_date_format(fmt):
+            fechas.add(idx)
+        if is_timedelta_format(fmt):
+            duraciones.add(idx)
+    return fechas, duraciones
+
+
+def read_epoch(zf: zipfile.ZipFile) -> datetime:
+    """Fecha base del libro: 1904 si workbookPr tiene date1904, si no 1900"""
+    epoch = [WINDOWS_EPOCH]
+
+    def start(tag, attrs):
+        tag = local_name(tag)
+        if tag == "workbookPr":
+            if attrs.get("date1904", "").lower() in ("1", "true"):
+                epoch[0] = CALENDAR_MAC_1904
+            raise _StopParsing
+        if tag == "sheets":
+            raise _StopParsing
+
+    with zf.open(find_workbook_part(zf)) as fh:
+        parse_xml(fh, start)
+    return epoch[0]
+
+
+def read_value_context(zf: zipfile.ZipFile) -> ValueContext:
+    fechas, duraciones = read_date_styles(zf)
+    return ValueContext(read_shared_strings(zf), fechas, duraciones, read_epoch(zf))
+
+
+def split_range_ref(ref: str) -> CellBounds:
+    """"B2:D5" -> (2, 2, 5, 4); una sola celda da un rango de 1x1"""
+    inicio, _, fin = ref.partition(":")
+    fila1, col1 = split_cell_ref(inicio)
+    fila2, col2 = split_cell_ref(fin) if fin else (fila1, col1)
+    return min(fila1, fila2), min(col1, col2), max(fila1, fila2), max(col1, col2)
+
+
+class _CellValueCollector:
+    """
+    Manejadores expat que convierten cada <c> en (fila, columna, valor) como
+    openpyxl con data_only=True (valor None si la celda no tiene valor), y
+    recogen los rangos combinados de <mergeCells>.
+    """
+
+    def __init__(self, context: ValueContext, require_refs: bool = False):
+        self.context = context
+        self.require_refs = require_refs
+        self.cells: List[Tuple[int, int, CellValue]] = []
+        self.merged: List[CellBounds] = []
+        self.row = 0
+        self.col = 0
+        self.in_cell = False
+        self.cell_type = "n"
+        self.style = 0
+        self.capture = False
+        self.in_inline = False
+        self.has_inline = False
+        self.rph = 0
+        self.text: List[str] = []
+
+    def start(self, tag, attrs):
+        tag = local_name(tag)
+        if tag == "c":
+            ref = attrs.get("r")
+            if ref:
+                self.row, self.col = split_cell_ref(ref)
+            elif self.require_refs:
+                raise _CellWithoutRef
+            else:
+                self.col += 1
+            self.in_cell = True
+            self.cell_type = attrs.get("t", "n")
+            try:
+                self.style = int(attrs.get("s", 0))
+            except ValueError:
+                self.style = 0
+            self.has_inline = False
+            self.text = []
+        elif not self.in_cell:
+            if tag == "row":
+                ref = attrs.get("r")
+                self.row = int(ref) if ref else self.row + 1
+                self.col = 0
+            elif tag == "mergeCell" and attrs.get("ref"):
+                self.merged.append(split_range_ref(attrs["ref"]))
+        elif tag == "v" and not self.in_inline:
+            self.capture = True
+        elif tag == "is":
+            self.in_inline = True
+            self.has_inline = True
+        elif tag == "rPh":
+            self.rph += 1
+        elif tag == "t" and self.in_inline and not self.rph:
+            self.capture = True
+
+    def end(self, tag):
+        if not self.in_cell:
+            return
+        tag = local_name(tag)
+        if tag in ("v", "t"):
+            self.capture = False
+        elif tag == "rPh":
+            self.rph -= 1
+        elif tag == "is":
+            self.in_inline = False
+        elif tag == "c":
+            self.in_cell = False
+            self.cells.append((self.row, self.col, self._value()))
+
+    def data(self, text):
+        if self.capture:
+            self.text.append(text)
+
+    def _value(self) -> CellValue:
+        if self.cell_type == "inlineStr":
+            return "".join(self.text) if self.has_inline else None
+        valor = "".join(self.text) or None
+        if valor is None:
+            return None
+        tipo = self.cell_type
+        if tipo == "n":
+            numero = cast_number(valor)
+            if self.style in self.context.date_styles:
+                try:
+                    return from_excel(numero, self.context.epoch,
+                                      timedelta=self.style in self.context.timedelta_styles)
+                except (OverflowError, ValueError):
+                    return "#VALUE!"
+            return numero
+        if tipo == "s":
+            return self.context.shared_strings[int(valor)]
+        if tipo == "b":
+            return bool(int(valor))
+        if tipo == "d":
+            return from_ISO8601(valor)
+        return valor
+
+
+def _without_empty_cells(fh: IO[bytes]) -> Iterator[bytes]:
+    """Bloques del XML sin las celdas vacías autocerradas (corta siempre tras un ">")"""
+    resto = b""
+    while True:
+        chunk = fh.read(READ_CHUNK_SIZE)
+        if not chunk:
+            if resto:
+                yield _EMPTY_CELL.sub(b"", resto)
+            return
+        datos = resto + chunk
+        corte = datos.rfind(b">") + 1
+        resto = datos[corte:]
+        yield _EMPTY_CELL.sub(b"", datos[:corte])
+
+
+def read_sheet_values(zf: zipfile.ZipFile, part: str, context: ValueContext,
+                      skip_empty: bool = False) -> Tuple[List[Tuple[int, int, CellValue]], List[CellBounds]]:
+    """
+    Todas las celdas de una hoja, en orden, como (fila, columna, valor), más
+    los rangos combinados. Las celdas sin valor (solo estilo) se incluyen con
+    None porque cuentan para el rango usado de la hoja.
+
+    Con `skip_empty` las celdas vacías autocerradas se descartan sobre los
+    bytes, antes de parsear (la mayoría de las celdas de una plantilla con
+    formato): las demás dan los mismos valores, pero el rango usado ya no es
+    el de openpyxl. Si alguna celda no trae su referencia (su columna depende
+    de las anteriores), la hoja se vuelve a leer completa.
+    """
+    if skip_empty:
+        collector = _CellValueCollector(context, require_refs=True)
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = collector.start
+        parser.EndElementHandler = collector.end
+        parser.CharacterDataHandler = collector.data
+        try:
+            with zf.open(part) as fh:
+                for bloque in _without_empty_cells(fh):
+                    parser.Parse(bloque, False)
+                parser.Parse(b"", True)
+            return collector.cells, collector.merged
+        except _CellWithoutRef:
+            pass
+
+    collector = _CellValueCollector(context)
+    with zf.open(part) as fh:
+        parse_xml(fh, collector.start, collector.end, collector.data)
+    return collector.cells, collector.merged
+
+
+class _NumericCellCollector:
+    """Manejadores expat que recogen (fila, columna, valor) de celdas numéricas"""
+
+    def __init__(self, wanted: Optional[CellFilter] = None,
+                 parse: Callable[[str], Number] = cast_number):
+        self.wanted = wanted
+        self.parse = parse
+        self.cells: List[Tuple[int, int, Number]] = []
+        self.row = 0
+        self.col = 0
+        self.numeric = False
+        self.in_value = False
+        self.text: List[str] = []
+
+    def start(self, tag, attrs):
+        tag = local_name(tag)
+        if tag == "c":
+            ref = attrs.get("r")
+            if ref:
+                self.row, self.col = split_cell_ref(ref)
+            else:
+                self.col += 1
+            # Sin atributo t (o t="n") el valor es numérico; los booleanos
+            # (t="b", <v> 0 o 1) se suman como 0/1, igual que con openpyxl.
+            # s, str, inlineStr y e se descartan sin leer sharedStrings
+            cell_type = attrs.get("t")
+            self.numeric = cell_type is None or cell_type in ("n", "b")
+            if self.numeric and self.wanted is not None:
+                self.numeric = self.wanted(self.row, self.col)
+        elif tag == "v":
+            if self.numeric:
+                self.in_value = True
+                self.text = []
+        elif tag == "row":
+            ref = attrs.get("r")
+            self.row = int(ref) if ref else self.row + 1
+            self.col = 0
+
+    def end(self, tag):
+        if self.in_value and local_name(tag) == "v":
+            self.in_value = False
+            text = "".join(self.text).strip()
+            if text:
+                try:
+                    self.cells.append((self.row, self.col, self.parse(text)))
+                except (ValueError, ArithmeticError):
+                    pass
+
+    def data(self, text):
+        if self.in_value:
+            self.text.append(text)
+
+
+def iter_numeric_cells(zf: zipfile.ZipFile, part: str,
+                       wanted: Optional[CellFilter] = None,
+                       parse: Callable[[str], Number] = cast_number) -> Iterator[Tuple[int, int, Number]]:
+    """
+    Recorre en streaming el XML de una hoja y entrega (fila, columna, valor)
+    para cada celda con valor numérico. Si se indica `wanted`, solo se leen
+    las celdas para las que retorna True; `parse` convierte el texto de <v>
+    (por ejemplo `Decimal` para sumas exactas). La memoria queda acotada al
+    bloque descomprimido en curso.
+    """
+    collector = _NumericCellCollector(wanted, parse)
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = collector.start
+    parser.EndElementHandler = collector.end
+    parser.CharacterDataHandler = collector.data
+
+    with zf.open(part) as fh:
+        while True:
+            chunk = fh.read(READ_CHUNK_SIZE)
+            final = not chunk
+            parser.Parse(chunk, final)
+            if collector.cells:
+                yield from collector.cells
+                collector.cells = []
+            if final:
+                break
+
+
+class FormulaCell(NamedTuple):
+    """Fórmula de una celda tal como está en el XML de la hoja"""
+    row: int
+    col: int
+    text: str                  # vacío en las celdas que siguen a una fórmula compartida
+    kind: str                  # "normal", "shared", "array" o "dataTable"
+    shared_index: Optional[int]
+    ref: Optional[str]         # rango de la fórmula compartida o matricial (en la celda maestra)
+
+
+def read_sheet_formulas(zf: zipfile.ZipFile, part: str) -> List[FormulaCell]:
+    """Fórmulas de una hoja (<f> de cada celda), en orden del XML"""
+    formulas: List[FormulaCell] = []
+    estado = {"row": 0, "col": 0, "f": None, "text": []}
+
+    def start(tag, attrs):
+        tag = local_name(tag)
+        if tag == "c":
+            ref = attrs.get("r")
+            if ref:
+                estado["row"], estado["col"] = split_cell_ref(ref)
+            else:
+                estado["col"] += 1
+        elif tag == "f":
+            estado["f"] = attrs
+            estado["text"] = []
+        elif tag == "row":
+            ref = attrs.get("r")
+            estado["row"] = int(ref) if ref else estado["row"] + 1
+            estado["col"] = 0
+
+    def end(tag):
+        if local_name(tag) != "f" or estado["f"] is None:
+            return
+        attrs = estado["f"]
+        si = attrs.get("si")
+        formulas.append(FormulaCell(
+            estado["row"], estado["col"], "".join(estado["text"]), attrs.get("t", "normal"),
+            int(si) if si is not None else None, attrs.get("ref")
+        ))
+        estado["f"] = None
+
+    def data(text):
+        if estado["f"] is not None:
+            estado["text"].append(text)
+
+    with zf.open(part) as fh:
+        parse_xml(fh, start, end, data)
+    return formulas
+
+
+def read_sheet_ids(zf: zipfile.ZipFile) -> Dict[int, str]:
+    """{sheetId: nombre de hoja} según workbook.xml"""
+    ids: Dict[int, str] = {}
+
+    def start(tag, attrs):
+        if local_name(tag) == "sheet" and attrs.get("sheetId"):
+            ids[int(attrs["sheetId"])] = attrs.get("name")
+
+    with zf.open(find_workbook_part(zf)) as fh:
+        parse_xml(fh, start)
+    return ids
+
+
+def read_calc_chain(zf: zipfile.ZipFile) -> List[Tuple[str, int, int]]:
+    """
+    Orden del último cálculo de Excel (calcChain.xml): [(hoja, fila, columna)].
+    Vacío si el libro no lo tiene.
+    """
+    part = _workbook_part_path(zf, "/calcChain")
+    if part is None:
+        return []
+    nombres = read_sheet_ids(zf)
+    orden: List[Tuple[str, int, int]] = []
+    estado = {"sheet": None}
+
+    def start(tag, attrs):
+        if local_name(tag) != "c" or not attrs.get("r"):
+            return
+        if attrs.get("i"):
+            # Una entrada sin "i" es de la misma hoja que la anterior
+            estado["sheet"] = nombres.get(int(attrs["i"]))
+        if estado["sheet"] is not None:
+            row, col = split_cell_ref(attrs["r"])
+            orden.append((estado["sheet"], row, col))
+
+    with zf.open(part) as fh:
+        parse_xml(fh, start)
+    return orden
+
+
+class XlsxReader:
+    """
+    Lector numérico de un libro Excel abierto directamente como zip.
+
+    Uso:
+        with XlsxReader(path) as wb:
+            for row, col, value in wb.iter_numeric_cells("A01"):
+                ...
+    """
+
+    def __init__(self, source: Union[str, IO[bytes]]):
+        self.zf = zipfile.ZipFile(source)
+        self._context: Optional[ValueContext] = None
+        try:
+            self.sheet_parts = read_sheet_parts(self.zf)
+        except Exception:
+            self.zf.close()
+            raise
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return list(self.sheet_parts)
+
+    def read_cell(self, sheet_name: str, ref: str) -> CellValue:
+        return read_cell(self.zf, self.sheet_parts[sheet_name], ref)
+
+    def read_sheet_values(self, sheet_name: str, skip_empty: bool = False,
+                          serial_dates: bool = False) -> Tuple[List[Tuple[int, int, CellValue]], List[CellBounds]]:
+        """`serial_dates` deja las fechas como número de serie (lo que ven las fórmulas)"""
+        if self._context is None:
+            self._context = read_value_context(self.zf)
+        contexto = self._context
+        if serial_dates:
+            contexto = contexto._replace(date_styles=set(), timedelta_styles=set())
+        return read_sheet_values(self.zf, self.sheet_parts[sheet_name], contexto, skip_empty)
+
+    def read_sheet_formulas(self, sheet_name: str) -> List[FormulaCell]:
+        return read_sheet_formulas(self.zf, self.sheet_parts[sheet_name])
+
+    def read_calc_chain(self) -> List[Tuple[str, int, int]]:
+        return read_calc_chain(self.zf)
+
+    def iter_numeric_cells(self, sheet_name: str, wanted: Optional[CellFilter] = None,
+                           parse: Callable[[str], Number] = cast_number) -> Iterator[Tuple[int, int, Number]]:
+        return iter_numeric_cells(self.zf, self.sheet_parts[sheet_name], wanted, parse)
+
+    def close(self):
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
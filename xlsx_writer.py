@@ -0,0 +1,235 @@
+"""
+Escritura del consolidado parchando directamente el zip de la plantilla.
+
+Los miembros que no cambian se copian comprimidos, byte a byte, sin
+descomprimirlos (mismo orden y mismos metadatos de ZipInfo): el costo de
+escribir no depende del tamaño de calcChain, estilos o macros. Solo se
+descomprimen y vuelven a comprimir las hojas afectadas, donde se reescriben
+los `<v>` de las celdas destino y los valores calculados de las fórmulas
+(ver formula_engine), y `workbook.xml`, que se marca para recalcular al
+abrir. No se usa el modelo de objetos de openpyxl, por lo que no se pierde
+nada que openpyxl no sepa representar.
+"""
+import copy
+import math
+import re
+import shutil
+import struct
+import zipfile
+from xml.sax.saxutils import escape
+from decimal import Decimal
+from typing import IO, Dict, Iterable, Optional, Tuple
+
+from openpyxl.utils import get_column_letter
+
+from xlsx_reader import Number, find_workbook_part, read_sheet_parts
+
+CellValues = Iterable[Tuple[int, int, Number]]
+
+_CELL_OPEN_RE = re.compile(rb'<c r="([A-Z]+[0-9]+)"')
+_TYPE_ATTR_RE = re.compile(rb'\s(?:t|cm|vm)="[^"]*"')
+_T_ATTR_RE = re.compile(rb'\st="[^"]*"')
+_FORMULA_RE = re.compile(rb"<f\b[^>]*/>|<f\b[^>]*>.*?</f>", re.DOTALL)
+_CACHED_VALUE_RE = re.compile(rb"<v\b[^>]*/>|<v\b[^>]*>.*?</v>", re.DOTALL)
+_CALC_PR_RE = re.compile(rb"<calcPr\b[^>]*?/?>")
+_FULL_CALC_RE = re.compile(rb'\sfullCalcOnLoad="[^"]*"')
+
+
+def format_number(valor: Number) -> Optional[bytes]:
+    """Texto de <v> para un número; None si no es representable en Excel"""
+    if isinstance(valor, bool):
+        return b"1" if valor else b"0"
+    if isinstance(valor, int):
+        return str(valor).encode("ascii")
+    if isinstance(valor, Decimal):
+        return format(valor, "f").encode("ascii") if valor.is_finite() else None
+    valor = float(valor)
+    if not math.isfinite(valor):
+        return None
+    # 16 dígitos significativos, igual que openpyxl
+    return b"%.16g" % valor
+
+
+def format_cached_value(valor) -> Tuple[Optional[bytes], Optional[bytes]]:
+    """
+    (atributo t, texto de <v>) del valor calculado de una fórmula. Los
+    errores (#DIV/0!, ...) llegan como objetos cuyo str es el código.
+    """
+    if isinstance(valor, bool):
+        return b"b", b"1" if valor else b"0"
+    if isinstance(valor, (int, float, Decimal)):
+        texto = format_number(valor)
+        return (None, texto) if texto is not None else (b"e", b"#NUM!")
+    if isinstance(valor, str):
+        return b"str", escape(valor).encode("utf-8")
+    return b"e", str(valor).encode("ascii")
+
+
+def _patch_formula_cell(ref: bytes, attrs: bytes, contenido: bytes,
+                        tipo: Optional[bytes], texto: bytes) -> Optional[bytes]:
+    """Celda de fórmula con su `<v>` reemplazado; None si la celda no tiene fórmula"""
+    formula = _FORMULA_RE.search(contenido)
+    if formula is None:
+        return None
+    contenido = _CACHED_VALUE_RE.sub(b"", contenido[:formula.end()]) + b"<v>" + texto + b"</v>" \
+        + _CACHED_VALUE_RE.sub(b"", contenido[formula.end():])
+    attrs = _T_ATTR_RE.sub(b"", attrs).rstrip()
+    if tipo is not None:
+        attrs += b' t="' + tipo + b'"'
+    return b'<c r="' + ref + b'"' + attrs + b">" + contenido + b"</c>"
+
+
+def patch_sheet_xml(data: bytes, valores: Dict[bytes, bytes],
+                    calculados: Optional[Dict[bytes, Tuple[Optional[bytes], bytes]]] = None) -> Tuple[bytes, int]:
+    """
+    Reemplaza el contenido de las celdas indicadas ({b"B6": b"42"}) por un
+    `<v>` numérico. Conserva los demás atributos (estilo); quita el tipo.
+    En las celdas de `calculados` ({b"C6": (t, texto)}) se conserva la
+    fórmula y solo se reemplaza su valor guardado.
+    Retorna el XML parchado y la cantidad de celdas que no existían.
+    """
+    partes = []
+    pos = 0
+    pendientes = dict(valores)
+    pendientes_formulas = dict(calculados or {})
+    for match in _CELL_OPEN_RE.finditer(data):
+        ref = match.group(1)
+        valor = pendientes.pop(ref, None)
+        if valor is None:
+            calculado = pendientes_formulas.pop(ref, None)
+            if calculado is None:
+                continue
+            cierre_tag = data.index(b">", match.end())
+            if data[cierre_tag - 1:cierre_tag] == b"/":
+                continue  # celda vacía: no tiene fórmula
+            fin = data.index(b"</c>", cierre_tag) + 4
+            celda = _patch_formula_cell(ref, data[match.end():cierre_tag],
+                                        data[cierre_tag + 1:fin - 4], *calculado)
+            if celda is not None:
+                partes.append(data[pos:match.start()])
+                partes.append(celda)
+                pos = fin
+            if not pendientes and not pendientes_formulas:
+                break
+            continue
+        inicio = match.start()
+        cierre_tag = data.index(b">", match.end())
+        autocerrada = data[cierre_tag - 1:cierre_tag] == b"/"
+        fin_attrs = cierre_tag - 1 if autocerrada else cierre_tag
+        if autocerrada:
+            fin = cierre_tag + 1
+        else:
+            fin = data.index(b"</c>", cierre_tag) + 4
+            if b"<f" in data[cierre_tag:fin]:
+                # Nunca se pisa una fórmula de la plantilla
+                continue
+        attrs = _TYPE_ATTR_RE.sub(b"", data[match.end():fin_attrs]).rstrip()
+        partes.append(data[pos:inicio])
+        partes.append(b'<c r="' + ref + b'"' + attrs + b"><v>" + valor + b"</v></c>")
+        pos = fin
+        if not pendientes and not pendientes_formulas:
+            break
+    partes.append(data[pos:])
+    return b"".join(partes), len(pendientes) + len(pendientes_formulas)
+
+
+def set_full_calc_on_load(data: bytes) -> bytes:
+    """Marca el libro para que Excel recalcule todas las fórmulas al abrir"""
+    match = _CALC_PR_RE.search(data)
+    if match:
+        tag = _FULL_CALC_RE.sub(b"", match.group(0))
+        cierre = b"/>" if tag.endswith(b"/>") else b">"
+        tag = tag[:-len(cierre)].rstrip() + b' fullCalcOnLoad="1"' + cierre
+        return data[:match.start()] + tag + data[match.end():]
+    # calcPr va después de definedNames (o de sheets si no hay nombres)
+    for ancla in (b"</definedNames>", b"</sheets>"):
+        i = data.find(ancla)
+        if i >= 0:
+            i += len(ancla)
+            return data[:i] + b'<calcPr fullCalcOnLoad="1"/>' + data[i:]
+    return data
+
+
+def write_patched_workbook(template_path: str, output_path: str,
+                           cells_by_sheet: Dict[str, CellValues],
+                           formulas_by_sheet: Optional[Dict[str, Iterable[Tuple[int, int, object]]]] = None) -> int:
+    """
+    Genera `output_path` copiando la plantilla y reescribiendo solo los
+    valores de las celdas indicadas por hoja y los valores calculados de las
+    fórmulas de `formulas_by_sheet`. Retorna la cantidad de celdas destino
+    que no existían en la plantilla (y por lo tanto no se escribieron).
+    """
+    faltantes = 0
+    with zipfile.ZipFile(template_path) as zin:
+        sheet_parts = read_sheet_parts(zin)
+        workbook_part = find_workbook_part(zin)
+
+        # Texto de <v> por parte XML; la conversión a A1 ocurre solo aquí
+        parches: Dict[str, Dict[bytes, bytes]] = {}
+        for hoja, celdas in cells_by_sheet.items():
+            part = sheet_parts.get(hoja)
+            if part is None:
+                continue
+            valores = parches.setdefault(part, {})
+            for row, col, valor in celdas:
+                texto = format_number(valor)
+                if texto is not None:
+                    valores[f"{get_column_letter(col)}{row}".encode("ascii")] = texto
+        calculados: Dict[str, Dict[bytes, Tuple[Optional[bytes], bytes]]] = {}
+        for hoja, celdas in (formulas_by_sheet or {}).items():
+            part = sheet_parts.get(hoja)
+            if part is None:
+                continue
+            valores = calculados.setdefault(part, {})
+            for row, col, valor in celdas:
+                valores[f"{get_column_letter(col)}{row}".encode("ascii")] = format_cached_value(valor)
+
+        with open(template_path, "rb") as origen, zipfile.ZipFile(output_path, "w") as zout:
+            for info in zin.infolist():
+                if parches.get(info.filename) or calculados.get(info.filename):
+                    data, no_encontradas = patch_sheet_xml(
+                        zin.read(info), parches.get(info.filename, {}), calculados.get(info.filename)
+                    )
+                    faltantes += no_encontradas
+                elif info.filename == workbook_part:
+                    data = set_full_calc_on_load(zin.read(info))
+                else:
+                    copy_raw_member(origen, info, zout)
+                    continue
+                zout.writestr(info, data)
+    return faltantes
+
+
+def copy_raw_member(origen: IO[bytes], info: zipfile.ZipInfo, zout: zipfile.ZipFile):
+    """
+    Copia un miembro de `origen` (el archivo de `info`) a `zout` con sus
+    bytes comprimidos tal cual. El encabezado local se vuelve a generar desde
+    el directorio central, sin descriptor de datos (CRC y tamaños ya se
+    conocen); zipfile escribe la entrada del directorio central al cerrar.
+    """
+    origen.seek(info.header_offset)
+    encabezado = origen.read(zipfile.sizeFileHeader)
+    campos = struct.unpack(zipfile.structFileHeader, encabezado)
+    if campos[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Encabezado local inválido en {info.filename}")
+    # Los datos comprimidos empiezan después del nombre y el campo extra locales
+    origen.seek(campos[zipfile._FH_FILENAME_LENGTH] + campos[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    destino = copy.copy(info)
+    destino.flag_bits &= ~0x08
+    # Mismo protocolo que ZipFile.writestr, sin pasar por el compresor
+    with zout._lock:
+        zout.fp.seek(zout.start_dir)
+        destino.header_offset = zout.fp.tell()
+        zout.fp.write(destino.FileHeader())
+        restante = info.compress_size
+        while restante > 0:
+            bloque = origen.read(min(restante, shutil.COPY_BUFSIZE))
+            if not bloque:
+                raise zipfile.BadZipFile(f"Datos truncados en {info.filename}")
+            zout.fp.write(bloque)
+            restante -= len(bloque)
+        zout.start_dir = zout.fp.tell()
+        zout.filelist.append(destino)
+        zout.NameToInfo[destino.filename] = destino
+        zout._didModify = True